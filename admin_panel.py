@@ -19,6 +19,7 @@ from handlers.utils import (
 )
 import aiosqlite
 from excel_utils import create_payments_excel, create_registrations_excel
+from executors import cpu_executor
 import os
 
 logger = logging.getLogger(__name__)
@@ -397,13 +398,13 @@ async def send_daily_payments_report(bot: Bot) -> None:
         # Генерируем Excel-файлы, если есть данные
         if payments:
             payments_filename = f"payments_{yesterday}_{uuid.uuid4().hex[:8]}.xlsx"
-            payments_file_path = create_payments_excel(payments, payments_filename, yesterday)
+            payments_file_path = await cpu_executor.run(create_payments_excel, [tuple(row) for row in payments], payments_filename, yesterday)
         else:
             logger.info(f"Платежи за {yesterday} не найдены.")
 
         if registrations:
             registrations_filename = f"registrations_{yesterday}_{uuid.uuid4().hex[:8]}.xlsx"
-            registrations_file_path = create_registrations_excel(registrations, registrations_filename, yesterday)
+            registrations_file_path = await cpu_executor.run(create_registrations_excel, [tuple(row) for row in registrations], registrations_filename, yesterday)
         else:
             logger.info(f"Регистрации за {yesterday} не найдены.")
 
@@ -0,0 +1,325 @@
+# benchmarks/broadcast_benchmark.py
+"""Офлайн-бенчмарк пропускной способности рассылок.
+
+Поднимает локальный фейковый Telegram Bot API на aiohttp, создаёт
+синтетическую SQLite-базу с пользователями и прогоняет через неё
+broadcast_message_admin и соседние функции рассылки. Реальные пользователи
+не затрагиваются.
+
+Фейковый API имитирует:
+    * задержку ответа (нормальное распределение вокруг --latency-ms);
+    * 429 RetryAfter при превышении --server-rate сообщений в секунду;
+    * 403 для пользователей, заблокировавших бота (каждый --blocked-every);
+    * 400 "can't parse entities" для MarkdownV2 (каждый --parse-error-every).
+
+Отчёт: сообщений/с, p50/p99 задержки отправки, запросов к БД на получателя
+и пиковая память.
+
+Пример:
+    python benchmarks/broadcast_benchmark.py --users 100000 --target all
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import deque
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_TOKEN = "123456:BENCHMARK-TOKEN"
+ADMIN_CHAT_ID = 706527960
+
+TARGETS = {
+    'all': 'broadcast_message_admin',
+    'paid': 'broadcast_to_paid_users',
+    'non_paid': 'broadcast_to_non_paid_users',
+    'with_payment': 'broadcast_with_payment',
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Бенчмарк рассылок на фейковом Telegram Bot API")
+    parser.add_argument('--users', type=int, default=100000, help="Количество пользователей в синтетической БД")
+    parser.add_argument('--paid-ratio', type=float, default=0.1, help="Доля оплативших пользователей")
+    parser.add_argument('--target', choices=sorted(TARGETS) + ['every'], default='all', help="Какую рассылку запускать")
+    parser.add_argument('--rate', type=float, default=2000.0, help="BROADCAST_MAX_RATE для token bucket")
+    parser.add_argument('--concurrency', type=int, default=50, help="BROADCAST_CONCURRENCY")
+    parser.add_argument('--server-rate', type=float, default=1500.0, help="Лимит фейкового API, сообщ/с (0 — без лимита)")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after в ответах 429")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="Средняя задержка ответа API")
+    parser.add_argument('--blocked-every', type=int, default=40, help="Каждый N-й пользователь заблокировал бота (0 — нет)")
+    parser.add_argument('--parse-error-every', type=int, default=97, help="Каждому N-му MarkdownV2 не парсится (0 — нет)")
+    parser.add_argument('--buttons', action='store_true', help="Добавить динамические кнопки (запросы к БД на получателя)")
+    parser.add_argument('--json', action='store_true', help="Вывести отчёт в JSON")
+    parser.add_argument('--port', type=int, default=0, help="Порт фейкового API (0 — любой свободный)")
+    return parser.parse_args()
+
+
+class FakeBotAPI:
+    """Локальная замена api.telegram.org."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.message_id = 0
+        self.window: deque = deque()
+        self.counters: Dict[str, int] = {'requests': 0, 'ok': 0, '429': 0, '403': 0, '400': 0}
+
+    def _error(self, code: int, description: str, parameters: Dict[str, Any] = None) -> web.Response:
+        self.counters[str(code)] += 1
+        payload = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            payload['parameters'] = parameters
+        return web.json_response(payload, status=code)
+
+    def _message(self, chat_id: int, text: str = "") -> Dict[str, Any]:
+        self.message_id += 1
+        return {
+            'message_id': self.message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': text,
+        }
+
+    def _rate_limited(self) -> bool:
+        if self.args.server_rate <= 0:
+            return False
+        now = time.monotonic()
+        while self.window and now - self.window[0] > 1.0:
+            self.window.popleft()
+        if len(self.window) >= self.args.server_rate:
+            return True
+        self.window.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.counters['requests'] += 1
+
+        if self.args.latency_ms > 0:
+            await asyncio.sleep(max(0.0, random.gauss(self.args.latency_ms, self.args.latency_ms / 4)) / 1000)
+
+        if method == 'getMe':
+            self.counters['ok'] += 1
+            return web.json_response({'ok': True, 'result': {
+                'id': 123456, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'
+            }})
+
+        chat_id = int(data.get('chat_id', 0))
+        if method == 'editMessageText':
+            self.counters['ok'] += 1
+            return web.json_response({'ok': True, 'result': self._message(chat_id, data.get('text', ''))})
+
+        if method not in ('sendMessage', 'sendPhoto', 'sendVideo'):
+            return self._error(400, f"Bad Request: method {method} is not simulated")
+
+        if self._rate_limited():
+            return self._error(
+                429, f"Too Many Requests: retry after {self.args.retry_after}",
+                {'retry_after': self.args.retry_after}
+            )
+        if chat_id != ADMIN_CHAT_ID and self.args.blocked_every and chat_id % self.args.blocked_every == 0:
+            return self._error(403, "Forbidden: bot was blocked by the user")
+        if (self.args.parse_error_every and chat_id % self.args.parse_error_every == 0
+                and data.get('parse_mode') == 'MarkdownV2'):
+            return self._error(400, "Bad Request: can't parse entities: character '!' is reserved")
+
+        self.counters['ok'] += 1
+        return web.json_response({'ok': True, 'result': self._message(chat_id, data.get('text', ''))})
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', self.args.port)
+        await site.start()
+        return runner
+
+
+def build_database(path: str, users: int, paid_ratio: float) -> None:
+    """Заполняет синтетическую базу пользователями и платежами."""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, username, first_name, generations_left, avatar_left, first_purchase) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ((1_000_000 + i, f"user{i}", f"User {i}", i % 5, i % 2, 1) for i in range(users))
+        )
+        paid_every = max(1, int(round(1 / paid_ratio))) if paid_ratio > 0 else 0
+        if paid_every:
+            conn.executemany(
+                "INSERT OR IGNORE INTO payments (payment_id, user_id, plan, amount, status) VALUES (?, ?, ?, ?, 'succeeded')",
+                ((f"bench-{i}", 1_000_000 + i, 'лайт', 599.0) for i in range(0, users, paid_every))
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+class QueryCounter:
+    """Считает SQL-запросы, проходящие через aiosqlite."""
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self) -> None:
+        import aiosqlite
+
+        counter = self
+
+        def wrap(original):
+            async def execute(self, *args, **kwargs):
+                counter.count += 1
+                return await original(self, *args, **kwargs)
+            return execute
+
+        aiosqlite.Connection.execute = wrap(aiosqlite.Connection.execute)
+        aiosqlite.Connection.executemany = wrap(aiosqlite.Connection.executemany)
+        aiosqlite.Cursor.execute = wrap(aiosqlite.Cursor.execute)
+        aiosqlite.Cursor.executemany = wrap(aiosqlite.Cursor.executemany)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_target(target: str, bot, latencies: List[float], queries: QueryCounter, buttons: bool) -> Dict[str, Any]:
+    from handlers import broadcast
+
+    func = getattr(broadcast, TARGETS[target])
+    button_list = [{'text': "🎨 Сгенерировать", 'callback_data': 'photo_generate_menu'}] if buttons else []
+    latencies.clear()
+    queries_before = queries.count
+    tracemalloc.reset_peak()
+    started = time.perf_counter()
+    await func(bot, "Бенчмарк рассылки\\!", ADMIN_CHAT_ID, None, None, button_list)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+
+    from broadcast_engine import recent_broadcasts
+    progress = recent_broadcasts[-1] if recent_broadcasts else {}
+    recipients = progress.get('total', 0) or 1
+    return {
+        'target': target,
+        'function': TARGETS[target],
+        'recipients': progress.get('total', 0),
+        'sent': progress.get('sent', 0),
+        'failed': progress.get('failed', 0),
+        'blocked': progress.get('blocked', 0),
+        'retry_after_events': progress.get('retry_after_events', 0),
+        'elapsed_sec': round(elapsed, 2),
+        'msgs_per_sec': round(progress.get('sent', 0) / elapsed, 1) if elapsed else 0.0,
+        'send_latency_p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'send_latency_p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'db_queries_per_recipient': round((queries.count - queries_before) / recipients, 3),
+        'peak_memory_mb': round(peak / 1024 / 1024, 2),
+    }
+
+
+async def main_async(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    fake_api = FakeBotAPI(args)
+    runner = await fake_api.start()
+    port = runner.addresses[0][1]
+
+    # Импортируем модули бота только после настройки окружения
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from database import init_db
+
+    await init_db()
+    build_database(os.environ['DATABASE_PATH'], args.users, args.paid_ratio)
+
+    latencies: List[float] = []
+
+    class TimedSession(AiohttpSession):
+        """Сессия aiogram, измеряющая задержку отправки сообщений."""
+
+        async def make_request(self, bot, method, timeout=None):
+            started = time.perf_counter()
+            try:
+                return await super().make_request(bot, method, timeout=timeout)
+            finally:
+                if type(method).__name__ in ('SendMessage', 'SendPhoto', 'SendVideo'):
+                    latencies.append(time.perf_counter() - started)
+
+    queries = QueryCounter()
+    queries.install()
+    session = TimedSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{port}"))
+    bot = Bot(token=FAKE_TOKEN, session=session)
+    targets = sorted(TARGETS) if args.target == 'every' else [args.target]
+    results = []
+    tracemalloc.start()
+    try:
+        for target in targets:
+            results.append(await run_target(target, bot, latencies, queries, args.buttons))
+    finally:
+        tracemalloc.stop()
+        await bot.session.close()
+        await runner.cleanup()
+    for result in results:
+        result['fake_api'] = dict(fake_api.counters)
+    return results
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    for result in results:
+        print(f"\n=== {result['function']} ({result['target']}) ===")
+        for key, value in result.items():
+            if key in ('target', 'function'):
+                continue
+            print(f"  {key:28s} {value}")
+
+
+def main() -> None:
+    args = parse_args()
+    workdir = tempfile.mkdtemp(prefix="broadcast_bench_")
+    # Окружение должно быть настроено до импорта config
+    os.environ.update({
+        'DATABASE_PATH': os.path.join(workdir, 'bench.db'),
+        'TELEGRAM_BOT_TOKEN': FAKE_TOKEN,
+        'REPLICATE_API_TOKEN': os.environ.get('REPLICATE_API_TOKEN', 'benchmark'),
+        'YOOKASSA_SHOP_ID': os.environ.get('YOOKASSA_SHOP_ID', 'benchmark'),
+        'YOOKASSA_SECRET_KEY': os.environ.get('YOOKASSA_SECRET_KEY', 'benchmark'),
+        'BACKUP_ENABLED': 'false',
+        'BROADCAST_MAX_RATE': str(args.rate),
+        'BROADCAST_CONCURRENCY': str(args.concurrency),
+        'BROADCAST_PROGRESS_INTERVAL': '1',
+    })
+    sys.path.insert(0, PROJECT_ROOT)
+    os.chdir(workdir)
+
+    import logging
+    logging.disable(logging.ERROR)
+
+    results = asyncio.run(main_async(args))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    else:
+        print_report(results)
+    if results:
+        rates = [r['msgs_per_sec'] for r in results]
+        print(f"\nСредняя скорость: {statistics.mean(rates):.1f} сообщ/с", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+# benchmarks/prompt_engine_benchmark.py
+"""Микробенчмарк сборки промпта и выбора LoRA.
+
+Сравнивает прежнюю логику process_prompt_async / prepare_model_params
+(пересборка списков усилителей, re.sub по всему промпту, выбор пресета
+через prompt.lower() и any(), поиск LoRA в словарях на каждый запрос)
+со скомпилированным движком prompt_engine. Перед замером проверяет, что
+результаты совпадают.
+
+Пример:
+    python benchmarks/prompt_engine_benchmark.py --number 20000
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import re
+import sys
+import timeit
+from typing import Any, Dict, List, Optional, Tuple
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = {
+    'short': "woman in a red dress on a city street at night",
+    'style': (
+        "elegant woman in a luxury evening gown, studio portrait, soft cinematic lighting, "
+        "detailed eyes, natural skin texture, professional photography, magazine cover"
+    ),
+    'long': ", ".join([
+        "confident man in a tailored navy suit walking through an old european square",
+        "golden hour light, shallow depth of field, 85mm lens, candid moment",
+        "fine details on fabric, realistic skin, authentic expression, street photography",
+    ] * 8),
+}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Микробенчмарк движка промптов")
+    parser.add_argument('--number', type=int, default=20000, help="Повторов на замер")
+    parser.add_argument('--repeat', type=int, default=5, help="Серий замера (берётся лучшая)")
+    parser.add_argument('--json', action='store_true', help="Вывести отчёт в JSON")
+    return parser.parse_args()
+
+
+def legacy_build_prompt(base_prompt: str, trigger_word: Optional[str], selected_gender: Optional[str],
+                        custom: bool) -> str:
+    """Сборка промпта, как в process_prompt_async до prompt_engine."""
+    parts = []
+    if trigger_word:
+        parts.append(trigger_word)
+    photorealistic_enhancers = [
+        "professional photography",
+        "photorealistic",
+        "real person",
+        "natural skin texture with visible pores",
+        "realistic skin tone",
+        "authentic human features",
+        "not CGI",
+        "not 3D render",
+        "DSLR camera quality",
+        "natural expression",
+        "genuine emotion",
+        "sharp focus",
+        "high resolution"
+    ]
+    if not custom:
+        parts.extend(photorealistic_enhancers)
+    if selected_gender:
+        parts.append(selected_gender)
+    parts.append(base_prompt)
+    anti_cgi_details = (
+        "shot with professional DSLR camera, natural daylight, "
+        "real human skin with natural imperfections, "
+        "unretouched authentic photography, photojournalism style, "
+        "natural hair texture, realistic eye moisture, "
+        "genuine facial expression, candid moment, "
+        "no artificial enhancement, no beauty filters, "
+        "raw unprocessed photo quality"
+    )
+    if not custom:
+        parts.append(anti_cgi_details)
+    full_prompt = ", ".join(parts)
+    full_prompt = re.sub(r'\s+', ' ', full_prompt).strip()
+    if len(full_prompt) > 4000:
+        full_prompt = full_prompt[:4000].rsplit(', ', 1)[0]
+    return full_prompt
+
+
+def legacy_preset_loras(prompt: str, lora_index: int) -> Tuple[str, List[Tuple[str, float]], bool]:
+    """Выбор пресета и LoRA, как в prepare_model_params до prompt_engine."""
+    params: Dict[str, Any] = {}
+    prompt_lower = prompt.lower()
+    if any(word in prompt_lower for word in ["natural", "candid", "authentic", "lifestyle"]):
+        selected_preset = "lifestyle_natural"
+    elif any(word in prompt_lower for word in ["studio", "professional", "commercial"]):
+        selected_preset = "studio_perfection"
+    else:
+        selected_preset = "natural_portrait"
+    preset = ULTRA_PHOTOREALISTIC_PRESETS[selected_preset]
+    params["prompt"] = f"{prompt}, {preset['prompt_additions']}"
+    start = lora_index
+    for lora_name in preset.get("loras", []):
+        if lora_index <= MAX_LORA_COUNT and lora_name in ULTRA_PROFESSIONAL_LORA_CONFIG:
+            lora_cfg = ULTRA_PROFESSIONAL_LORA_CONFIG[lora_name]
+            params[f"hf_lora_{lora_index}"] = lora_cfg["model"]
+            params[f"lora_scale_{lora_index}"] = lora_cfg["strength"]
+            lora_index += 1
+    anti_cgi_added = any(
+        "Flux-Dev-Real-Anime" in params.get(f"hf_lora_{i}", "")
+        for i in range(1, lora_index)
+    )
+    loras = [(params[f"hf_lora_{i}"], params[f"lora_scale_{i}"]) for i in range(start, lora_index)]
+    return selected_preset, loras, anti_cgi_added
+
+
+def engine_preset_loras(prompt: str, lora_index: int) -> Tuple[str, List[Tuple[str, float]], bool]:
+    """Выбор пресета и LoRA, как в prepare_model_params с prompt_engine."""
+    engine = get_prompt_engine()
+    params: Dict[str, Any] = {}
+    preset = engine.select_preset(prompt)
+    params["prompt"] = prompt + preset.prompt_suffix
+    start = lora_index
+    anti_cgi_added = False
+    for slot in preset.loras:
+        if lora_index > MAX_LORA_COUNT:
+            break
+        params[f"hf_lora_{lora_index}"] = slot.model
+        params[f"lora_scale_{lora_index}"] = slot.strength
+        anti_cgi_added = anti_cgi_added or slot.model == engine.anti_cgi.model
+        lora_index += 1
+    loras = [(params[f"hf_lora_{i}"], params[f"lora_scale_{i}"]) for i in range(start, lora_index)]
+    return preset.name, loras, anti_cgi_added
+
+
+def best_of(func, number: int, repeat: int) -> float:
+    """Лучшее время одного вызова в микросекундах."""
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+
+def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    engine = get_prompt_engine()
+    results = []
+    for label, prompt in PROMPTS.items():
+        built_legacy = legacy_build_prompt(prompt, "TOK", "woman", False)
+        built_engine = engine.build_prompt(prompt, trigger_word="TOK", selected_gender="woman", custom=False)
+        assert built_legacy == built_engine, (built_legacy, built_engine)
+        assert legacy_preset_loras(built_engine, 2) == engine_preset_loras(built_engine, 2)
+
+        cases = {
+            'build_prompt': (
+                lambda: legacy_build_prompt(prompt, "TOK", "woman", False),
+                lambda: engine.build_prompt(prompt, trigger_word="TOK", selected_gender="woman", custom=False),
+            ),
+            'preset_loras': (
+                lambda: legacy_preset_loras(built_engine, 2),
+                lambda: engine_preset_loras(built_engine, 2),
+            ),
+        }
+        for case, (legacy, compiled) in cases.items():
+            legacy_us = best_of(legacy, args.number, args.repeat)
+            compiled_us = best_of(compiled, args.number, args.repeat)
+            results.append({
+                'prompt': label,
+                'prompt_chars': len(prompt),
+                'case': case,
+                'legacy_us': round(legacy_us, 2),
+                'engine_us': round(compiled_us, 2),
+                'speedup': round(legacy_us / compiled_us, 2) if compiled_us else None,
+            })
+    return results
+
+
+def load_project() -> None:
+    """Импортирует конфигурацию и движок до замеров, чтобы импорт не попадал во время вызова."""
+    global ULTRA_PROFESSIONAL_LORA_CONFIG, ULTRA_PHOTOREALISTIC_PRESETS, MAX_LORA_COUNT, get_prompt_engine
+    sys.path.insert(0, PROJECT_ROOT)
+    # generation_config печатает баннер при импорте
+    with contextlib.redirect_stdout(io.StringIO()):
+        generation_config = importlib.import_module('generation_config')
+        prompt_engine = importlib.import_module('prompt_engine')
+    ULTRA_PROFESSIONAL_LORA_CONFIG = generation_config.ULTRA_PROFESSIONAL_LORA_CONFIG
+    ULTRA_PHOTOREALISTIC_PRESETS = generation_config.ULTRA_PHOTOREALISTIC_PRESETS
+    MAX_LORA_COUNT = generation_config.MAX_LORA_COUNT
+    get_prompt_engine = prompt_engine.get_prompt_engine
+
+
+def main() -> None:
+    args = parse_args()
+    load_project()
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+    print(f"{'промпт':8s} {'символов':>8s} {'замер':22s} {'было, мкс':>10s} {'стало, мкс':>11s} {'ускорение':>10s}")
+    for r in results:
+        print(f"{r['prompt']:8s} {r['prompt_chars']:8d} {r['case']:22s} {r['legacy_us']:10.2f} {r['engine_us']:11.2f} {r['speedup']:9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
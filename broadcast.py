@@ -12,9 +12,12 @@ from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, StateFilter
 from database import get_all_users_stats, get_broadcasts_with_buttons, get_broadcast_buttons, get_paid_users, get_non_paid_users, save_broadcast_button
-from config import ADMIN_IDS, DATABASE_PATH, ALLOWED_BROADCAST_CALLBACKS, BROADCAST_CALLBACK_ALIASES
-from keyboards import create_admin_keyboard, create_dynamic_broadcast_keyboard, create_admin_user_actions_keyboard, create_broadcast_with_payment_audience_keyboard
+from config import ADMIN_IDS, DATABASE_PATH, ALLOWED_BROADCAST_CALLBACKS, BROADCAST_CALLBACK_ALIASES, BROADCAST_WORKER_PROCESSES
+from keyboards import create_admin_keyboard, create_admin_user_actions_keyboard, create_broadcast_with_payment_audience_keyboard
 from handlers.utils import escape_message_parts, send_message_with_fallback, unescape_markdown
+from broadcast_engine import run_broadcast
+from broadcast_workers import run_sharded_broadcast
+from broadcast_scheduler import broadcast_scheduler
 import aiosqlite
 from states import BotStates
 
@@ -954,6 +957,7 @@ async def schedule_broadcast(schedule_time: datetime, message_text: str, media:
                     await conn.rollback()
                     raise aiosqlite.OperationalError(f"Не удалось сохранить кнопку для broadcast_id={broadcast_id}")
             await conn.commit()
+        broadcast_scheduler.notify(broadcast_id, scheduled_time_str)
         logger.info(f"Рассылка запланирована на {scheduled_time_str} для типа {broadcast_type} от admin_user_id={admin_user_id} с {len(buttons)} кнопками")
     except Exception as e:
         logger.error(f"Ошибка при сохранении запланированной рассылки: {e}", exc_info=True)
@@ -961,195 +965,55 @@ async def schedule_broadcast(schedule_time: datetime, message_text: str, media:
 
 async def broadcast_message_admin(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
     """Выполняет рассылку всем пользователям."""
-    buttons = buttons or []
+    if BROADCAST_WORKER_PROCESSES > 0:
+        await run_sharded_broadcast(
+            bot, 'all', admin_user_id, message_text,
+            media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка"
+        )
+        return
     all_users_data, _ = await get_all_users_stats(page=1, page_size=1000000)
     target_users = [user[0] for user in all_users_data]
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало общей рассылки от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку для ~`{total_to_send}` пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            try:
-                # Пытаемся отправить с MarkdownV2
-                if media_type == 'photo' and media_id:
-                    await bot.send_photo(
-                        chat_id=target_user_id, photo=media_id,
-                        caption=message_text, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=reply_markup
-                    )
-                elif media_type == 'video' and media_id:
-                    await bot.send_video(
-                        chat_id=target_user_id, video=media_id,
-                        caption=message_text, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=target_user_id, text=message_text, parse_mode=ParseMode.MARKDOWN_V2,
-                        reply_markup=reply_markup
-                    )
-            except TelegramBadRequest as e:
-                # Fallback: отправка без Markdown
-                logger.warning(f"Ошибка Markdown для user_id={target_user_id}: {e}. Пробуем без парсинга.")
-                raw_text = unescape_markdown(message_text)
-                if media_type == 'photo' and media_id:
-                    await bot.send_photo(
-                        chat_id=target_user_id, photo=media_id,
-                        caption=raw_text, parse_mode=None,
-                        reply_markup=reply_markup
-                    )
-                elif media_type == 'video' and media_id:
-                    await bot.send_video(
-                        chat_id=target_user_id, video=media_id,
-                        caption=raw_text, parse_mode=None,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await bot.send_message(
-                        chat_id=target_user_id, text=raw_text, parse_mode=None,
-                        reply_markup=reply_markup
-                    )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
-    )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
-        parse_mode=ParseMode.MARKDOWN_V2
+    logger.info(f"Начало общей рассылки от админа {admin_user_id} для {len(target_users)} пользователей.")
+    await run_broadcast(
+        bot, target_users, admin_user_id, message_text,
+        media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка"
     )
-    logger.info(f"Общая рассылка завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
+
+def _with_signature(message_text: str) -> str:
+    """Добавляет подпись PixelPie к тексту рассылки и экранирует его для MarkdownV2."""
+    signature = "🍪 PixelPie"
+    caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
+    return escape_message_parts(caption, version=2)
 
 async def broadcast_to_paid_users(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
     """Выполняет рассылку только оплатившим пользователям."""
-    buttons = buttons or []
+    if BROADCAST_WORKER_PROCESSES > 0:
+        await run_sharded_broadcast(
+            bot, 'paid', admin_user_id, _with_signature(message_text),
+            media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка для оплативших"
+        )
+        return
     target_users = await get_paid_users()
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало рассылки для оплативших от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку для ~`{total_to_send}` оплативших пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    signature = "🍪 PixelPie"
-    caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
-    escaped_caption = escape_message_parts(caption, version=2)
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            if media_type == 'photo' and media_id:
-                await bot.send_photo(
-                    chat_id=target_user_id, photo=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            elif media_type == 'video' and media_id:
-                await bot.send_video(
-                    chat_id=target_user_id, video=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=target_user_id, text=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка для оплативших завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
-    )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
-        parse_mode=ParseMode.MARKDOWN_V2
+    logger.info(f"Начало рассылки для оплативших от админа {admin_user_id} для {len(target_users)} пользователей.")
+    await run_broadcast(
+        bot, target_users, admin_user_id, _with_signature(message_text),
+        media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка для оплативших"
     )
-    logger.info(f"Рассылка для оплативших завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
 
 async def broadcast_to_non_paid_users(bot: Bot, message_text: str, admin_user_id: int, media_type: str = None, media_id: str = None, buttons: List[Dict[str, str]] = None) -> None:
     """Выполняет рассылку только не оплатившим пользователям."""
-    buttons = buttons or []
+    if BROADCAST_WORKER_PROCESSES > 0:
+        await run_sharded_broadcast(
+            bot, 'non_paid', admin_user_id, _with_signature(message_text),
+            media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка для не оплативших"
+        )
+        return
     target_users = await get_non_paid_users()
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало рассылки для не оплативших от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку для ~`{total_to_send}` не оплативших пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    signature = "🍪 PixelPie"
-    caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
-    escaped_caption = escape_message_parts(caption, version=2)
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            if media_type == 'photo' and media_id:
-                await bot.send_photo(
-                    chat_id=target_user_id, photo=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            elif media_type == 'video' and media_id:
-                await bot.send_video(
-                    chat_id=target_user_id, video=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=target_user_id, text=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка для не оплативших завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
-    )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
-        parse_mode=ParseMode.MARKDOWN_V2
+    logger.info(f"Начало рассылки для не оплативших от админа {admin_user_id} для {len(target_users)} пользователей.")
+    await run_broadcast(
+        bot, target_users, admin_user_id, _with_signature(message_text),
+        media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка для не оплативших"
     )
-    logger.info(f"Рассылка для не оплативших завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
 
 async def broadcast_with_payment(
     bot: Bot, 
@@ -1160,61 +1024,19 @@ async def broadcast_with_payment(
     buttons: List[Dict[str, str]] = None
 ) -> None:
     """Выполняет рассылку всем пользователям с кнопкой для перехода к тарифам."""
-    buttons = buttons or []
+    if BROADCAST_WORKER_PROCESSES > 0:
+        await run_sharded_broadcast(
+            bot, 'all', admin_user_id, _with_signature(message_text),
+            media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка с оплатой"
+        )
+        return
     all_users_data, _ = await get_all_users_stats(page=1, page_size=1000000)
     target_users = [user[0] for user in all_users_data]
-    sent_count = 0
-    failed_count = 0
-    total_to_send = len(target_users)
-    logger.info(f"Начало рассылки с оплатой от админа {admin_user_id} для {total_to_send} пользователей.")
-    await send_message_with_fallback(
-        bot, admin_user_id,
-        escape_message_parts(
-            f"🚀 Начинаю рассылку с оплатой для ~`{total_to_send}` пользователей...",
-            version=2
-        ),
-        parse_mode=ParseMode.MARKDOWN_V2
-    )
-    signature = "🍪 PixelPie"
-    caption = message_text + ("\n\n" + signature if message_text.strip() else "\n" + signature)
-    escaped_caption = escape_message_parts(caption, version=2)
-    for target_user_id in target_users:
-        try:
-            reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-            if media_type == 'photo' and media_id:
-                await bot.send_photo(
-                    chat_id=target_user_id, photo=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            elif media_type == 'video' and media_id:
-                await bot.send_video(
-                    chat_id=target_user_id, video=media_id,
-                    caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                    reply_markup=reply_markup
-                )
-            else:
-                await bot.send_message(
-                    chat_id=target_user_id, text=escaped_caption,
-                    parse_mode=ParseMode.MARKDOWN_V2, reply_markup=reply_markup
-                )
-            sent_count += 1
-            if sent_count % 20 == 0:
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
-            failed_count += 1
-    summary_text = escape_message_parts(
-        f"🏁 Рассылка с оплатой завершена!\n",
-        f"✅ Отправлено: `{sent_count}`\n",
-        f"❌ Не удалось отправить: `{failed_count}`",
-        version=2
+    logger.info(f"Начало рассылки с оплатой от админа {admin_user_id} для {len(target_users)} пользователей.")
+    await run_broadcast(
+        bot, target_users, admin_user_id, _with_signature(message_text),
+        media_type=media_type, media_id=media_id, buttons=buttons, title="Рассылка с оплатой"
     )
-    await send_message_with_fallback(
-        bot, admin_user_id, summary_text,
-        reply_markup=await create_admin_keyboard(), parse_mode=ParseMode.MARKDOWN_V2
-    )
-    logger.info(f"Рассылка с оплатой завершена. Отправлено: {sent_count}, Ошибок: {failed_count}")
 
 async def handle_broadcast_schedule_input(query: CallbackQuery, state: FSMContext) -> None:
     """Обрабатывает выбор времени отправки или немедленную рассылку."""
@@ -1304,35 +1126,21 @@ async def handle_broadcast_schedule_input(query: CallbackQuery, state: FSMContex
                 parse_mode=ParseMode.MARKDOWN_V2
             )
 
-            # Выполняем рассылку
-            success_count = 0
-            error_count = 0
-            for target_user_id in target_users:
-                try:
-                    reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
-                    if media_type == 'photo' and media_id:
-                        await query.bot.send_photo(
-                            chat_id=target_user_id, photo=media_id,
-                            caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                            reply_markup=reply_markup
-                        )
-                    elif media_type == 'video' and media_id:
-                        await query.bot.send_video(
-                            chat_id=target_user_id, video=media_id,
-                            caption=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                            reply_markup=reply_markup
-                        )
-                    else:
-                        await query.bot.send_message(
-                            chat_id=target_user_id, text=escaped_caption, parse_mode=ParseMode.MARKDOWN_V2,
-                            reply_markup=reply_markup
-                        )
-                    success_count += 1
-                    if success_count % 20 == 0:
-                        await asyncio.sleep(1)
-                except Exception as e:
-                    logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}")
-                    error_count += 1
+            # Выполняем рассылку: статус обновляется отдельным сообщением админу
+            if BROADCAST_WORKER_PROCESSES > 0:
+                progress = await run_sharded_broadcast(
+                    query.bot, broadcast_type.replace('with_payment_', ''), user_id, escaped_caption,
+                    media_type=media_type, media_id=media_id, buttons=buttons,
+                    title="Рассылка", send_summary=False
+                )
+            else:
+                progress = await run_broadcast(
+                    query.bot, target_users, user_id, escaped_caption,
+                    media_type=media_type, media_id=media_id, buttons=buttons,
+                    title="Рассылка", send_summary=False
+                )
+            success_count = progress.sent
+            error_count = progress.failed
 
             # Формируем итоговое сообщение
             text = escape_message_parts(
@@ -0,0 +1,400 @@
+# broadcast_engine.py
+"""Движок рассылок: ограничение скорости, живой прогресс для админа и метрики."""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from config import BROADCAST_MAX_RATE, BROADCAST_MIN_RATE, BROADCAST_CONCURRENCY, BROADCAST_PROGRESS_INTERVAL
+from handlers.utils import escape_message_parts, send_message_with_fallback, unescape_markdown
+from keyboards import create_admin_keyboard, create_dynamic_broadcast_keyboard
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+# Окно (в секундах) для расчёта текущей скорости отправки
+RATE_WINDOW_SECONDS = 10
+# Сколько раз повторяем отправку одному пользователю после RetryAfter
+MAX_RETRY_AFTER_ATTEMPTS = 3
+
+
+class TokenBucket:
+    """Token bucket с адаптивной скоростью.
+
+    При TelegramRetryAfter скорость уменьшается вдвое и выдача токенов
+    приостанавливается на retry_after секунд, после чего скорость плавно
+    восстанавливается с каждой успешной отправкой.
+    """
+
+    def __init__(self, rate: float = BROADCAST_MAX_RATE, min_rate: float = BROADCAST_MIN_RATE, capacity: Optional[float] = None):
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+        self.retry_after_events = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> None:
+        """Ждёт, пока не появится токен на одну отправку."""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def on_retry_after(self, retry_after: float) -> None:
+        """Снижает скорость и ставит выдачу на паузу после 429 от Telegram."""
+        self.retry_after_events += 1
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = 0
+        self.updated_at = time.monotonic()
+        self.paused_until = max(self.paused_until, self.updated_at + retry_after)
+        logger.warning(f"RetryAfter {retry_after}с: скорость рассылки снижена до {self.rate:.1f} сообщ/с")
+
+    def on_success(self) -> None:
+        """Аддитивно восстанавливает скорость после успешной отправки."""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class BroadcastProgress:
+    """Счётчики одной рассылки: отправлено, ошибки, скорость и ETA."""
+
+    def __init__(self, title: str, total: int, admin_user_id: int, broadcast_id: Optional[str] = None):
+        self.broadcast_id = broadcast_id or uuid.uuid4().hex[:8]
+        self.title = title
+        self.total = total
+        self.admin_user_id = admin_user_id
+        self.sent = 0
+        self.failed = 0
+        self.blocked = 0
+        self.retry_after_events = 0
+        self.bucket_rate = 0.0
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.status_message_id: Optional[int] = None
+        self._recent: Deque[float] = deque()
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.total - self.processed)
+
+    def _mark(self) -> None:
+        now = time.monotonic()
+        self._recent.append(now)
+        while self._recent and now - self._recent[0] > RATE_WINDOW_SECONDS:
+            self._recent.popleft()
+
+    def record_sent(self) -> None:
+        self.sent += 1
+        self._mark()
+
+    def record_failed(self, blocked: bool = False) -> None:
+        self.failed += 1
+        if blocked:
+            self.blocked += 1
+        self._mark()
+
+    def apply_totals(self, sent: int, failed: int, blocked: int, retry_after_events: int) -> None:
+        """Переносит агрегированные счётчики (например, от процессов-воркеров)."""
+        delta = (sent + failed) - self.processed
+        self.sent, self.failed, self.blocked = sent, failed, blocked
+        self.retry_after_events = retry_after_events
+        if delta > 0:
+            now = time.monotonic()
+            self._recent.extend([now] * delta)
+            while self._recent and now - self._recent[0] > RATE_WINDOW_SECONDS:
+                self._recent.popleft()
+
+    def current_rate(self) -> float:
+        """Скорость обработки получателей за последние RATE_WINDOW_SECONDS секунд."""
+        now = time.monotonic()
+        recent = [t for t in self._recent if now - t <= RATE_WINDOW_SECONDS]
+        if not recent:
+            return 0.0
+        window = min(RATE_WINDOW_SECONDS, max(1.0, time.time() - self.started_at))
+        return len(recent) / window
+
+    def eta_seconds(self) -> Optional[float]:
+        rate = self.current_rate()
+        if self.remaining == 0:
+            return 0.0
+        if rate <= 0:
+            return None
+        return self.remaining / rate
+
+    def as_dict(self) -> Dict[str, Any]:
+        eta = self.eta_seconds()
+        return {
+            'broadcast_id': self.broadcast_id,
+            'title': self.title,
+            'admin_user_id': self.admin_user_id,
+            'total': self.total,
+            'sent': self.sent,
+            'failed': self.failed,
+            'blocked': self.blocked,
+            'remaining': self.remaining,
+            'msgs_per_sec': round(self.current_rate(), 2),
+            'bucket_rate': round(self.bucket_rate, 2),
+            'retry_after_events': self.retry_after_events,
+            'eta_seconds': round(eta, 1) if eta is not None else None,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+# Активные и недавно завершённые рассылки для /metrics
+active_broadcasts: Dict[str, BroadcastProgress] = {}
+recent_broadcasts: Deque[Dict[str, Any]] = deque(maxlen=10)
+
+
+def get_broadcast_metrics() -> Dict[str, Any]:
+    """Снимок состояния рассылок для эндпоинта метрик."""
+    return {
+        'active': [progress.as_dict() for progress in list(active_broadcasts.values())],
+        'recent': list(recent_broadcasts),
+    }
+
+
+metrics_registry.register('broadcasts', get_broadcast_metrics)
+
+
+def _format_eta(eta: Optional[float]) -> str:
+    if eta is None:
+        return "—"
+    minutes, seconds = divmod(int(eta), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes:02d}:{seconds:02d}"
+
+
+def render_progress_text(progress: BroadcastProgress, finished: bool = False) -> str:
+    """Формирует текст статусного сообщения рассылки (MarkdownV2)."""
+    header = f"🏁 {progress.title} завершена!" if finished else f"📢 {progress.title} идёт..."
+    return escape_message_parts(
+        f"{header}\n",
+        f"✅ Отправлено: `{progress.sent}`\n",
+        f"❌ Не удалось отправить: `{progress.failed}` (🚫 заблокировали бота: `{progress.blocked}`)\n",
+        f"⏳ Осталось: `{progress.remaining}` из `{progress.total}`\n",
+        f"⚡ Скорость: `{progress.current_rate():.1f}` сообщ/с\n",
+        f"🪣 Лимит: `{progress.bucket_rate:.1f}` сообщ/с\n",
+        f"⏸ RetryAfter: `{progress.retry_after_events}`\n",
+        f"🕒 ETA: `{_format_eta(progress.eta_seconds())}`",
+        version=2
+    )
+
+
+async def update_status_message(bot: Bot, progress: BroadcastProgress, finished: bool = False) -> None:
+    """Редактирует статусное сообщение админа, игнорируя 'message is not modified'."""
+    if not progress.status_message_id:
+        return
+    try:
+        await bot.edit_message_text(
+            text=render_progress_text(progress, finished=finished),
+            chat_id=progress.admin_user_id,
+            message_id=progress.status_message_id,
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+    except TelegramRetryAfter as e:
+        logger.debug(f"RetryAfter при обновлении статуса рассылки {progress.broadcast_id}: {e.retry_after}с")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            logger.warning(f"Не удалось обновить статус рассылки {progress.broadcast_id}: {e}")
+    except Exception as e:
+        logger.warning(f"Ошибка обновления статуса рассылки {progress.broadcast_id}: {e}")
+
+
+async def _report_progress(bot: Bot, progress: BroadcastProgress, bucket: TokenBucket) -> None:
+    """Периодически обновляет статусное сообщение админа."""
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        progress.bucket_rate = bucket.rate
+        await update_status_message(bot, progress)
+
+
+async def deliver_broadcast_message(
+    bot: Bot,
+    chat_id: int,
+    message_text: str,
+    media_type: Optional[str] = None,
+    media_id: Optional[str] = None,
+    reply_markup=None,
+    parse_mode: Optional[str] = ParseMode.MARKDOWN_V2
+) -> None:
+    """Отправляет одно сообщение рассылки (текст, фото или видео)."""
+    if media_type == 'photo' and media_id:
+        await bot.send_photo(
+            chat_id=chat_id, photo=media_id,
+            caption=message_text, parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+    elif media_type == 'video' and media_id:
+        await bot.send_video(
+            chat_id=chat_id, video=media_id,
+            caption=message_text, parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+    else:
+        await bot.send_message(
+            chat_id=chat_id, text=message_text, parse_mode=parse_mode,
+            reply_markup=reply_markup
+        )
+
+
+async def send_to_recipient(
+    bot: Bot,
+    bucket,
+    progress: BroadcastProgress,
+    target_user_id: int,
+    message_text: str,
+    media_type: Optional[str],
+    media_id: Optional[str],
+    buttons: List[Dict[str, str]]
+) -> None:
+    """Отправляет сообщение одному получателю с учётом лимита и RetryAfter.
+
+    bucket — любой объект с интерфейсом TokenBucket (acquire, on_success,
+    on_retry_after), в том числе общий для процессов бюджет.
+    """
+    try:
+        reply_markup = await create_dynamic_broadcast_keyboard(buttons, target_user_id) if buttons else None
+        for attempt in range(MAX_RETRY_AFTER_ATTEMPTS):
+            await bucket.acquire()
+            try:
+                try:
+                    await deliver_broadcast_message(bot, target_user_id, message_text, media_type, media_id, reply_markup)
+                except TelegramBadRequest as e:
+                    # Fallback: отправка без Markdown
+                    logger.warning(f"Ошибка Markdown для user_id={target_user_id}: {e}. Пробуем без парсинга.")
+                    await deliver_broadcast_message(
+                        bot, target_user_id, unescape_markdown(message_text), media_type, media_id,
+                        reply_markup, parse_mode=None
+                    )
+                bucket.on_success()
+                progress.record_sent()
+                return
+            except TelegramRetryAfter as e:
+                bucket.on_retry_after(e.retry_after)
+                progress.retry_after_events += 1
+                logger.warning(f"RetryAfter для user_id={target_user_id}, попытка {attempt + 1}/{MAX_RETRY_AFTER_ATTEMPTS}")
+        progress.record_failed()
+    except TelegramForbiddenError:
+        logger.debug(f"Пользователь {target_user_id} заблокировал бота")
+        progress.record_failed(blocked=True)
+    except Exception as e:
+        logger.error(f"Ошибка отправки сообщения пользователю {target_user_id}: {e}", exc_info=True)
+        progress.record_failed()
+
+
+async def start_status_message(bot: Bot, progress: BroadcastProgress) -> None:
+    """Отправляет админу статусное сообщение рассылки и регистрирует её в метриках."""
+    active_broadcasts[progress.broadcast_id] = progress
+    try:
+        status_message = await send_message_with_fallback(
+            bot, progress.admin_user_id, render_progress_text(progress), parse_mode=ParseMode.MARKDOWN_V2
+        )
+        progress.status_message_id = getattr(status_message, 'message_id', None)
+    except Exception as e:
+        logger.warning(f"Не удалось отправить статусное сообщение рассылки админу {progress.admin_user_id}: {e}")
+
+
+async def finish_broadcast(bot: Bot, progress: BroadcastProgress, send_summary: bool = True) -> BroadcastProgress:
+    """Фиксирует завершение рассылки: метрики, финальный статус и итоговое сообщение."""
+    progress.finished_at = time.time()
+    active_broadcasts.pop(progress.broadcast_id, None)
+    recent_broadcasts.append(progress.as_dict())
+    await update_status_message(bot, progress, finished=True)
+    logger.info(
+        f"{progress.title} {progress.broadcast_id} завершена. Отправлено: {progress.sent}, Ошибок: {progress.failed}, "
+        f"RetryAfter: {progress.retry_after_events}"
+    )
+    if not send_summary:
+        return progress
+    summary_text = escape_message_parts(
+        f"🏁 {progress.title} завершена!\n",
+        f"✅ Отправлено: `{progress.sent}`\n",
+        f"❌ Не удалось отправить: `{progress.failed}`",
+        version=2
+    )
+    await send_message_with_fallback(
+        bot, progress.admin_user_id, summary_text, reply_markup=await create_admin_keyboard(),
+        parse_mode=ParseMode.MARKDOWN_V2
+    )
+    return progress
+
+
+async def run_broadcast(
+    bot: Bot,
+    target_users: List[int],
+    admin_user_id: int,
+    message_text: str,
+    media_type: Optional[str] = None,
+    media_id: Optional[str] = None,
+    buttons: Optional[List[Dict[str, str]]] = None,
+    title: str = "Рассылка",
+    bucket: Optional[TokenBucket] = None,
+    send_summary: bool = True
+) -> BroadcastProgress:
+    """Выполняет рассылку списку пользователей с живым прогрессом для админа.
+
+    Вместо сообщений «начинаю» и «завершено» админ получает одно статусное
+    сообщение, которое редактируется каждые BROADCAST_PROGRESS_INTERVAL секунд.
+    Те же счётчики доступны через metrics_registry (раздел 'broadcasts').
+    send_summary=False отключает итоговое сообщение, если вызывающий код
+    показывает итог сам.
+    """
+    buttons = buttons or []
+    bucket = bucket or TokenBucket()
+    progress = BroadcastProgress(title, len(target_users), admin_user_id)
+    progress.bucket_rate = bucket.rate
+    logger.info(f"{title} {progress.broadcast_id}: старт для {progress.total} пользователей от админа {admin_user_id}")
+    await start_status_message(bot, progress)
+
+    reporter = asyncio.create_task(_report_progress(bot, progress, bucket))
+    users_iter = iter(target_users)
+
+    async def worker() -> None:
+        for target_user_id in users_iter:
+            await send_to_recipient(bot, bucket, progress, target_user_id, message_text, media_type, media_id, buttons)
+            progress.bucket_rate = bucket.rate
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, BROADCAST_CONCURRENCY))))
+    finally:
+        reporter.cancel()
+        try:
+            await reporter
+        except asyncio.CancelledError:
+            pass
+        progress.bucket_rate = bucket.rate
+
+    return await finish_broadcast(bot, progress, send_summary=send_summary)
+
+
+__all__ = [
+    'TokenBucket', 'BroadcastProgress', 'run_broadcast', 'deliver_broadcast_message',
+    'send_to_recipient', 'start_status_message', 'update_status_message', 'finish_broadcast',
+    'render_progress_text', 'get_broadcast_metrics', 'active_broadcasts'
+]
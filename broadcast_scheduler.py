@@ -0,0 +1,247 @@
+# broadcast_scheduler.py
+"""Планировщик отложенных рассылок.
+
+Держит в памяти min-heap (время, id) ожидающих рассылок из
+scheduled_broadcasts, спит до ближайшего срока и атомарно забирает рассылку
+перед отправкой. Пустые минуты не обращаются к БД, а рассылка, срок которой
+пришёлся на занятую минуту или на время простоя бота, выполняется при
+первой возможности.
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiosqlite
+import pytz
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from config import DATABASE_PATH, ADMIN_IDS
+from database import get_broadcast_buttons
+from handlers.utils import escape_message_parts, send_message_with_fallback, unescape_markdown
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+# Как часто перечитывать очередь из БД (рассылки могли добавить другие процессы)
+RESYNC_INTERVAL = 600
+
+MSK_TZ = pytz.timezone('Europe/Moscow')
+
+
+def parse_scheduled_time(value: str) -> Optional[float]:
+    """Переводит scheduled_time (МСК, '%Y-%m-%d %H:%M:%S' или ISO) в unix-время."""
+    try:
+        scheduled_dt = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if scheduled_dt.tzinfo is None:
+        scheduled_dt = MSK_TZ.localize(scheduled_dt)
+    return scheduled_dt.timestamp()
+
+
+async def execute_scheduled_broadcast(bot: Bot, broadcast_id: int, broadcast_data: Dict[str, Any]) -> None:
+    """Отправляет забранную рассылку нужной аудитории."""
+    # Импорт здесь: handlers.broadcast сам уведомляет этот модуль о новых рассылках
+    from handlers.broadcast import (
+        broadcast_message_admin, broadcast_to_paid_users, broadcast_to_non_paid_users, broadcast_with_payment
+    )
+    message_text = broadcast_data.get('message', '')
+    media = broadcast_data.get('media', None)
+    media_type = media.get('type') if media else None
+    media_id = media.get('file_id') if media else None
+    target_group = broadcast_data.get('broadcast_type', 'all')
+    admin_user_id = broadcast_data.get('admin_user_id', ADMIN_IDS[0])
+    # Извлекаем кнопки из таблицы broadcast_buttons
+    buttons = await get_broadcast_buttons(broadcast_id)
+    # Если кнопки не найдены в таблице, используем резерв из broadcast_data
+    if not buttons and 'buttons' in broadcast_data:
+        buttons = broadcast_data.get('buttons', [])
+        logger.debug(f"Кнопки для broadcast_id={broadcast_id} взяты из broadcast_data: {buttons}")
+    logger.info(f"Выполняется рассылка ID {broadcast_id} для группы {target_group}")
+
+    # Очищаем текст от возможного экранирования и экранируем заново
+    raw_message = unescape_markdown(message_text)
+    signature = "🍪 PixelPie"
+    caption = raw_message + ("\n\n" + signature if raw_message.strip() else "\n" + signature)
+    escaped_caption = escape_message_parts(caption, version=2)
+
+    try:
+        if target_group == 'all':
+            await broadcast_message_admin(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
+        elif target_group == 'paid':
+            await broadcast_to_paid_users(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
+        elif target_group == 'non_paid':
+            await broadcast_to_non_paid_users(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
+        elif target_group.startswith('with_payment'):
+            await broadcast_with_payment(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
+        else:
+            logger.warning(f"Неизвестная группа рассылки для ID {broadcast_id}: {target_group}")
+            return
+        logger.info(f"Рассылка ID {broadcast_id} завершена")
+    except Exception as e:
+        logger.error(f"Ошибка выполнения рассылки ID {broadcast_id}: {e}", exc_info=True)
+        for admin_id in ADMIN_IDS:
+            try:
+                await send_message_with_fallback(
+                    bot, admin_id,
+                    escape_message_parts(
+                        f"🚨 Ошибка выполнения рассылки ID {broadcast_id} для группы {target_group}: {str(e)}",
+                        version=2
+                    ),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+            except Exception as e_notify:
+                logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
+
+
+class ScheduledBroadcastScheduler:
+    """Min-heap ожидающих рассылок с пробуждением к ближайшему сроку."""
+
+    def __init__(self, resync_interval: float = RESYNC_INTERVAL):
+        self.resync_interval = resync_interval
+        self.bot: Optional[Bot] = None
+        self.executed = 0
+        self.lost_claims = 0
+        self.last_resync = 0.0
+        self._heap: List[Tuple[float, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: set = set()
+
+    async def resync(self) -> None:
+        """Перестраивает кучу из индексированного запроса по (status, scheduled_time)."""
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            cursor = await conn.execute(
+                "SELECT id, scheduled_time FROM scheduled_broadcasts WHERE status = 'pending' ORDER BY scheduled_time"
+            )
+            rows = await cursor.fetchall()
+        heap = []
+        for broadcast_id, scheduled_time in rows:
+            due_at = parse_scheduled_time(scheduled_time)
+            if due_at is None:
+                logger.warning(f"Некорректный формат scheduled_time для ID {broadcast_id}: {scheduled_time}")
+                continue
+            heap.append((due_at, broadcast_id))
+        heapq.heapify(heap)
+        self._heap = heap
+        self.last_resync = time.time()
+        logger.debug(f"Очередь отложенных рассылок перечитана: {len(heap)}")
+
+    def notify(self, broadcast_id: int, scheduled_time: str) -> None:
+        """Добавляет только что сохранённую рассылку в кучу и будит планировщик."""
+        due_at = parse_scheduled_time(scheduled_time)
+        if due_at is None:
+            logger.warning(f"Некорректный формат scheduled_time для ID {broadcast_id}: {scheduled_time}")
+            return
+        heapq.heappush(self._heap, (due_at, broadcast_id))
+        if self._heap[0][1] == broadcast_id:
+            self._wakeup.set()
+
+    async def start(self, bot: Bot) -> None:
+        """Загружает ожидающие рассылки и запускает цикл планировщика."""
+        if self._task and not self._task.done():
+            return
+        self.bot = bot
+        await self.resync()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Планировщик рассылок запущен, ожидает рассылок: {len(self._heap)}")
+
+    async def stop(self) -> None:
+        """Останавливает цикл; уже начатые рассылки не прерываются."""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Планировщик рассылок остановлен")
+
+    async def _claim(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        """Атомарно переводит рассылку из pending в completed и возвращает её данные.
+
+        None — рассылку уже забрали, удалили или её данные повреждены.
+        """
+        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            cursor = await conn.execute(
+                "UPDATE scheduled_broadcasts SET status = 'completed' WHERE id = ? AND status = 'pending'",
+                (broadcast_id,)
+            )
+            if cursor.rowcount == 0:
+                await conn.rollback()
+                return None
+            cursor = await conn.execute("SELECT broadcast_data FROM scheduled_broadcasts WHERE id = ?", (broadcast_id,))
+            row = await cursor.fetchone()
+            await conn.commit()
+        try:
+            broadcast_data = json.loads(row[0])
+        except (TypeError, json.JSONDecodeError) as e:
+            logger.error(f"Ошибка парсинга broadcast_data для ID {broadcast_id}: {e}")
+            return None
+        if not isinstance(broadcast_data, dict):
+            logger.error(f"Некорректные данные broadcast_data для broadcast_id={broadcast_id}")
+            return None
+        return broadcast_data
+
+    async def _fire(self, broadcast_id: int) -> None:
+        broadcast_data = await self._claim(broadcast_id)
+        if broadcast_data is None:
+            self.lost_claims += 1
+            logger.debug(f"Рассылка ID {broadcast_id} уже забрана или удалена")
+            return
+        self.executed += 1
+        # Рассылка может идти долго — не держим цикл, чтобы следующие запускались вовремя
+        task = asyncio.create_task(execute_scheduled_broadcast(self.bot, broadcast_id, broadcast_data))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                now = time.time()
+                if now - self.last_resync >= self.resync_interval:
+                    await self.resync()
+                while self._heap and self._heap[0][0] <= now:
+                    _, broadcast_id = heapq.heappop(self._heap)
+                    await self._fire(broadcast_id)
+                timeout = self.last_resync + self.resync_interval - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в фоновой задаче рассылок: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Состояние планировщика для /metrics."""
+        return {
+            'running': bool(self._task and not self._task.done()),
+            'pending': len(self._heap),
+            'next_due_in': round(self._heap[0][0] - time.time(), 1) if self._heap else None,
+            'executed': self.executed,
+            'in_progress': len(self._running),
+            'lost_claims': self.lost_claims,
+        }
+
+
+# Глобальный экземпляр
+broadcast_scheduler = ScheduledBroadcastScheduler()
+metrics_registry.register('scheduled_broadcasts', broadcast_scheduler.metrics)
+
+__all__ = [
+    'ScheduledBroadcastScheduler', 'broadcast_scheduler', 'execute_scheduled_broadcast', 'parse_scheduled_time'
+]
@@ -0,0 +1,551 @@
+# broadcast_workers.py
+"""Шардированные рассылки в отдельных процессах.
+
+Основной процесс кладёт рассылку в таблицу broadcast_jobs и разбивает
+аудиторию на шарды (user_id % shard_count). Процессы-воркеры забирают шарды
+из broadcast_job_shards, отправляют сообщения и пишут счётчики обратно в БД.
+Скорость отправки всех воркеров ограничена общим бюджетом в таблице
+broadcast_rate_budget, поэтому суммарно они не превышают BROADCAST_MAX_RATE.
+
+Основной процесс только следит за прогрессом и редактирует статусное
+сообщение админа — его event loop остаётся свободным для пользователей.
+
+Пока воркер обрабатывает шард, отдельная задача раз в
+SHARD_HEARTBEAT_INTERVAL обновляет updated_at независимо от того, как
+быстро идёт страница (после RetryAfter скорость может упасть до 1/с).
+Все записи шарда проверяют владельца (worker_pid и claimed_at): если шард
+всё же подхватил другой воркер, прежний прекращает отправку, а не шлёт
+тем же пользователям второй раз.
+
+Запуск воркеров отдельно от бота:
+    python broadcast_workers.py --workers 4
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from config import (
+    TELEGRAM_BOT_TOKEN, DATABASE_PATH, BROADCAST_MAX_RATE, BROADCAST_MIN_RATE, BROADCAST_CONCURRENCY,
+    BROADCAST_PROGRESS_INTERVAL, BROADCAST_WORKER_PROCESSES, BROADCAST_WORKER_STALE_SECONDS, BROADCAST_SHARD_PAGE_SIZE
+)
+from broadcast_engine import (
+    BroadcastProgress, send_to_recipient, start_status_message, update_status_message, finish_broadcast
+)
+from handlers.utils import escape_message_parts, send_message_with_fallback
+
+logger = logging.getLogger(__name__)
+
+# Сколько токенов воркер забирает из общего бюджета за одно обращение к БД
+RATE_BUDGET_BATCH = 5
+# Пауза воркера, когда свободных шардов нет
+WORKER_IDLE_SLEEP = 2
+# Как часто воркер пишет счётчики шарда в БД
+SHARD_FLUSH_INTERVAL = 2
+# Как часто воркер подтверждает, что шард ещё в работе: с запасом до BROADCAST_WORKER_STALE_SECONDS
+SHARD_HEARTBEAT_INTERVAL = max(1.0, BROADCAST_WORKER_STALE_SECONDS / 4)
+
+AUDIENCE_QUERIES = {
+    'all': """
+        SELECT user_id FROM users
+        WHERE user_id % ? = ? AND user_id > ?
+        ORDER BY user_id LIMIT ?
+    """,
+    'paid': """
+        SELECT DISTINCT user_id FROM payments
+        WHERE status = 'succeeded' AND user_id % ? = ? AND user_id > ?
+        ORDER BY user_id LIMIT ?
+    """,
+    'non_paid': """
+        SELECT user_id FROM users
+        WHERE user_id % ? = ? AND user_id > ?
+          AND user_id NOT IN (SELECT DISTINCT user_id FROM payments WHERE status = 'succeeded')
+        ORDER BY user_id LIMIT ?
+    """,
+}
+
+AUDIENCE_COUNT_QUERIES = {
+    'all': "SELECT COUNT(*) FROM users",
+    'paid': "SELECT COUNT(DISTINCT user_id) FROM payments WHERE status = 'succeeded'",
+    'non_paid': """
+        SELECT COUNT(*) FROM users
+        WHERE user_id NOT IN (SELECT DISTINCT user_id FROM payments WHERE status = 'succeeded')
+    """,
+}
+
+
+class ShardLostError(Exception):
+    """Шард забрал другой воркер: этот должен прекратить отправку."""
+
+
+async def init_broadcast_worker_tables(conn: aiosqlite.Connection) -> None:
+    """Создаёт таблицы заданий, шардов и общего бюджета скорости."""
+    await conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            title TEXT NOT NULL,
+                            audience TEXT NOT NULL,
+                            payload TEXT NOT NULL,
+                            admin_user_id INTEGER NOT NULL,
+                            shard_count INTEGER NOT NULL,
+                            status TEXT DEFAULT 'pending',
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            finished_at TIMESTAMP DEFAULT NULL
+                         )''')
+    await conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_job_shards (
+                            job_id INTEGER NOT NULL,
+                            shard INTEGER NOT NULL,
+                            status TEXT DEFAULT 'pending',
+                            worker_pid INTEGER DEFAULT NULL,
+                            last_user_id INTEGER DEFAULT 0,
+                            sent INTEGER DEFAULT 0,
+                            failed INTEGER DEFAULT 0,
+                            blocked INTEGER DEFAULT 0,
+                            retry_after_events INTEGER DEFAULT 0,
+                            claimed_at REAL DEFAULT NULL,
+                            updated_at REAL DEFAULT NULL,
+                            PRIMARY KEY (job_id, shard),
+                            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id) ON DELETE CASCADE
+                         )''')
+    await conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_rate_budget (
+                            id INTEGER PRIMARY KEY CHECK (id = 1),
+                            tokens REAL NOT NULL,
+                            rate REAL NOT NULL,
+                            updated_at REAL NOT NULL,
+                            paused_until REAL DEFAULT 0
+                         )''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_job_shards_status ON broadcast_job_shards(status, job_id)')
+    await conn.execute(
+        "INSERT OR IGNORE INTO broadcast_rate_budget (id, tokens, rate, updated_at, paused_until) VALUES (1, ?, ?, ?, 0)",
+        (BROADCAST_MAX_RATE, BROADCAST_MAX_RATE, time.time())
+    )
+    await conn.commit()
+
+
+class SharedRateBudget:
+    """Token bucket, общий для всех процессов-воркеров и хранящийся в SQLite.
+
+    Интерфейс совпадает с broadcast_engine.TokenBucket. Токены забираются
+    пачками по RATE_BUDGET_BATCH в транзакции BEGIN IMMEDIATE. RetryAfter и
+    успешные отправки копятся локально и применяются к общей строке при
+    следующем обращении к БД, поэтому on_retry_after/on_success синхронные.
+    """
+
+    def __init__(self, db_path: str = DATABASE_PATH, max_rate: float = BROADCAST_MAX_RATE,
+                 min_rate: float = BROADCAST_MIN_RATE, batch: int = RATE_BUDGET_BATCH):
+        self.db_path = db_path
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.capacity = max(1.0, max_rate)
+        self.batch = batch
+        self.rate = max_rate
+        self.local_tokens = 0
+        self.retry_after_events = 0
+        self._pending_penalty = 0.0
+        self._pending_successes = 0
+        self._lock = asyncio.Lock()
+
+    async def _reserve(self) -> float:
+        """Пытается забрать пачку токенов. Возвращает время ожидания, если токенов нет."""
+        async with aiosqlite.connect(self.db_path, timeout=15) as conn:
+            await conn.execute("PRAGMA busy_timeout = 30000")
+            await conn.execute("BEGIN IMMEDIATE")
+            c = await conn.execute("SELECT tokens, rate, updated_at, paused_until FROM broadcast_rate_budget WHERE id = 1")
+            row = await c.fetchone()
+            now = time.time()
+            if not row:
+                await conn.rollback()
+                raise aiosqlite.OperationalError("Таблица broadcast_rate_budget не инициализирована")
+            tokens, rate, updated_at, paused_until = row
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * rate)
+
+            if self._pending_penalty:
+                rate = max(self.min_rate, rate / 2)
+                tokens = 0.0
+                paused_until = max(paused_until, now + self._pending_penalty)
+                self._pending_penalty = 0.0
+            if self._pending_successes:
+                rate = min(self.max_rate, rate + 0.1 * self._pending_successes)
+                self._pending_successes = 0
+
+            wait = 0.0
+            if now < paused_until:
+                wait = paused_until - now
+            else:
+                take = min(self.batch, int(tokens))
+                if take >= 1:
+                    tokens -= take
+                    self.local_tokens += take
+                else:
+                    wait = (1 - tokens) / rate
+            await conn.execute(
+                "UPDATE broadcast_rate_budget SET tokens = ?, rate = ?, updated_at = ?, paused_until = ? WHERE id = 1",
+                (tokens, rate, now, paused_until)
+            )
+            await conn.commit()
+            self.rate = rate
+            return wait
+
+    async def acquire(self) -> None:
+        """Ждёт токен из общего бюджета."""
+        async with self._lock:
+            while self.local_tokens < 1:
+                wait = await self._reserve()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.local_tokens -= 1
+
+    def on_retry_after(self, retry_after: float) -> None:
+        self.retry_after_events += 1
+        self.local_tokens = 0
+        self._pending_penalty = max(self._pending_penalty, float(retry_after))
+        logger.warning(f"Воркер {os.getpid()}: RetryAfter {retry_after}с, общий бюджет будет снижен")
+
+    def on_success(self) -> None:
+        self._pending_successes += 1
+
+
+async def count_audience(audience: str) -> int:
+    """Считает получателей аудитории без выборки всех user_id в память."""
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        c = await conn.execute(AUDIENCE_COUNT_QUERIES[audience])
+        row = await c.fetchone()
+        return row[0] if row else 0
+
+
+async def enqueue_sharded_broadcast(
+    audience: str,
+    admin_user_id: int,
+    message_text: str,
+    media_type: Optional[str] = None,
+    media_id: Optional[str] = None,
+    buttons: Optional[List[Dict[str, str]]] = None,
+    title: str = "Рассылка",
+    shard_count: int = BROADCAST_WORKER_PROCESSES
+) -> int:
+    """Сохраняет задание рассылки и его шарды. Возвращает id задания."""
+    if audience not in AUDIENCE_QUERIES:
+        raise ValueError(f"Неизвестная аудитория рассылки: {audience}")
+    shard_count = max(1, shard_count)
+    payload = {
+        'message_text': message_text,
+        'media_type': media_type,
+        'media_id': media_id,
+        'buttons': buttons or [],
+    }
+    async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        await conn.execute("PRAGMA busy_timeout = 30000")
+        await init_broadcast_worker_tables(conn)
+        c = await conn.execute(
+            "INSERT INTO broadcast_jobs (title, audience, payload, admin_user_id, shard_count) VALUES (?, ?, ?, ?, ?)",
+            (title, audience, json.dumps(payload, ensure_ascii=False), admin_user_id, shard_count)
+        )
+        job_id = c.lastrowid
+        await conn.executemany(
+            "INSERT INTO broadcast_job_shards (job_id, shard) VALUES (?, ?)",
+            [(job_id, shard) for shard in range(shard_count)]
+        )
+        await conn.commit()
+    logger.info(f"Задание рассылки {job_id} ({audience}) создано с {shard_count} шардами")
+    return job_id
+
+
+async def _read_job_totals(job_id: int) -> Dict[str, Any]:
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        c = await conn.execute('''
+            SELECT COALESCE(SUM(sent), 0), COALESCE(SUM(failed), 0), COALESCE(SUM(blocked), 0),
+                   COALESCE(SUM(retry_after_events), 0),
+                   SUM(CASE WHEN status = 'completed' THEN 1 ELSE 0 END),
+                   SUM(CASE WHEN status = 'pending' THEN 1 ELSE 0 END),
+                   COUNT(*)
+            FROM broadcast_job_shards WHERE job_id = ?
+        ''', (job_id,))
+        sent, failed, blocked, retry_after, completed, pending, shards = await c.fetchone()
+        c = await conn.execute("SELECT rate FROM broadcast_rate_budget WHERE id = 1")
+        rate_row = await c.fetchone()
+    return {
+        'sent': sent, 'failed': failed, 'blocked': blocked, 'retry_after_events': retry_after,
+        'completed': completed or 0, 'pending': pending or 0, 'shards': shards,
+        'rate': rate_row[0] if rate_row else 0.0,
+    }
+
+
+async def run_sharded_broadcast(
+    bot: Bot,
+    audience: str,
+    admin_user_id: int,
+    message_text: str,
+    media_type: Optional[str] = None,
+    media_id: Optional[str] = None,
+    buttons: Optional[List[Dict[str, str]]] = None,
+    title: str = "Рассылка",
+    send_summary: bool = True
+) -> BroadcastProgress:
+    """Ставит рассылку воркерам и ведёт статусное сообщение админа до её завершения."""
+    total = await count_audience(audience)
+    job_id = await enqueue_sharded_broadcast(
+        audience, admin_user_id, message_text, media_type, media_id, buttons, title
+    )
+    progress = BroadcastProgress(title, total, admin_user_id, broadcast_id=f"job{job_id}")
+    await start_status_message(bot, progress)
+
+    started = time.monotonic()
+    stale_warning_sent = False
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        try:
+            totals = await _read_job_totals(job_id)
+        except Exception as e:
+            logger.error(f"Ошибка чтения прогресса задания рассылки {job_id}: {e}", exc_info=True)
+            continue
+        progress.apply_totals(totals['sent'], totals['failed'], totals['blocked'], totals['retry_after_events'])
+        progress.bucket_rate = totals['rate']
+        if totals['shards'] and totals['completed'] == totals['shards']:
+            break
+        if (not stale_warning_sent and totals['pending'] == totals['shards']
+                and time.monotonic() - started > BROADCAST_WORKER_STALE_SECONDS):
+            stale_warning_sent = True
+            logger.warning(f"Задание рассылки {job_id}: ни один шард не взят воркерами")
+            try:
+                await send_message_with_fallback(
+                    bot, admin_user_id,
+                    escape_message_parts(
+                        f"⚠️ Рассылка {job_id} ждёт воркеров: ни один шард не взят. "
+                        "Проверьте, что процессы рассылки запущены.",
+                        version=2
+                    ),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+            except Exception as e:
+                logger.error(f"Не удалось уведомить админа {admin_user_id}: {e}")
+        await update_status_message(bot, progress)
+
+    async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        await conn.execute(
+            "UPDATE broadcast_jobs SET status = 'completed', finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (job_id,)
+        )
+        await conn.commit()
+    return await finish_broadcast(bot, progress, send_summary=send_summary)
+
+
+async def claim_shard(worker_pid: int) -> Optional[Dict[str, Any]]:
+    """Атомарно забирает свободный шард или шард упавшего воркера."""
+    stale_before = time.time() - BROADCAST_WORKER_STALE_SECONDS
+    async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        conn.row_factory = aiosqlite.Row
+        await conn.execute("PRAGMA busy_timeout = 30000")
+        await conn.execute("BEGIN IMMEDIATE")
+        c = await conn.execute('''
+            SELECT s.job_id, s.shard, s.last_user_id, s.sent, s.failed, s.blocked, s.retry_after_events,
+                   j.title, j.audience, j.payload, j.admin_user_id, j.shard_count
+            FROM broadcast_job_shards s
+            JOIN broadcast_jobs j ON j.id = s.job_id
+            WHERE s.status = 'pending' OR (s.status = 'running' AND s.updated_at < ?)
+            ORDER BY s.job_id, s.shard
+            LIMIT 1
+        ''', (stale_before,))
+        row = await c.fetchone()
+        if not row:
+            await conn.rollback()
+            return None
+        now = time.time()
+        await conn.execute(
+            "UPDATE broadcast_job_shards SET status = 'running', worker_pid = ?, claimed_at = ?, updated_at = ? "
+            "WHERE job_id = ? AND shard = ?",
+            (worker_pid, now, now, row['job_id'], row['shard'])
+        )
+        await conn.execute("UPDATE broadcast_jobs SET status = 'running' WHERE id = ? AND status = 'pending'", (row['job_id'],))
+        await conn.commit()
+        shard = dict(row)
+        shard.update(worker_pid=worker_pid, claimed_at=now)
+        return shard
+
+
+# Условие владения шардом: повторный захват меняет worker_pid и claimed_at
+SHARD_OWNER_CONDITION = "job_id = ? AND shard = ? AND status = 'running' AND worker_pid = ? AND claimed_at = ?"
+
+
+def _owner_params(shard: Dict[str, Any]) -> tuple:
+    return shard['job_id'], shard['shard'], shard['worker_pid'], shard['claimed_at']
+
+
+async def _flush_shard(shard: Dict[str, Any], progress: BroadcastProgress, last_user_id: int, status: str = 'running') -> None:
+    """Пишет курсор и счётчики шарда; ShardLostError, если шард уже принадлежит другому воркеру."""
+    async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        await conn.execute("PRAGMA busy_timeout = 30000")
+        c = await conn.execute(f'''
+            UPDATE broadcast_job_shards
+            SET status = ?, last_user_id = ?, sent = ?, failed = ?, blocked = ?, retry_after_events = ?, updated_at = ?
+            WHERE {SHARD_OWNER_CONDITION}
+        ''', (status, last_user_id, progress.sent, progress.failed, progress.blocked,
+              progress.retry_after_events, time.time(), *_owner_params(shard)))
+        await conn.commit()
+    if not c.rowcount:
+        raise ShardLostError(f"Шард {shard['shard']} задания {shard['job_id']} забрал другой воркер")
+
+
+async def _heartbeat_shard(shard: Dict[str, Any]) -> bool:
+    """Продлевает владение шардом. False — шард уже принадлежит другому воркеру."""
+    async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        await conn.execute("PRAGMA busy_timeout = 30000")
+        c = await conn.execute(
+            f"UPDATE broadcast_job_shards SET updated_at = ? WHERE {SHARD_OWNER_CONDITION}",
+            (time.time(), *_owner_params(shard))
+        )
+        await conn.commit()
+    return bool(c.rowcount)
+
+
+async def _keep_shard_alive(shard: Dict[str, Any], lost: asyncio.Event) -> None:
+    while True:
+        await asyncio.sleep(SHARD_HEARTBEAT_INTERVAL)
+        try:
+            owned = await _heartbeat_shard(shard)
+        except Exception as e:
+            logger.warning(f"Воркер {os.getpid()}: не удалось продлить шард {shard['shard']} задания {shard['job_id']}: {e}")
+            continue
+        if not owned:
+            lost.set()
+            return
+
+
+async def _fetch_shard_page(audience: str, shard_count: int, shard: int, after_user_id: int) -> List[int]:
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        c = await conn.execute(AUDIENCE_QUERIES[audience], (shard_count, shard, after_user_id, BROADCAST_SHARD_PAGE_SIZE))
+        return [row[0] for row in await c.fetchall()]
+
+
+async def process_shard(bot: Bot, budget: SharedRateBudget, shard: Dict[str, Any]) -> None:
+    """Отправляет рассылку одному шарду аудитории.
+
+    Курсор last_user_id сохраняется после каждой страницы, поэтому шард,
+    подхваченный после падения воркера, продолжает с последней страницы.
+    ShardLostError — шард забрал другой воркер; отправка прекращена.
+    """
+    payload = json.loads(shard['payload'])
+    buttons = payload.get('buttons') or []
+    progress = BroadcastProgress(shard['title'], 0, shard['admin_user_id'], broadcast_id=f"job{shard['job_id']}:{shard['shard']}")
+    progress.apply_totals(shard['sent'], shard['failed'], shard['blocked'], shard['retry_after_events'])
+    last_user_id = shard['last_user_id'] or 0
+    last_flush = time.monotonic()
+    logger.info(f"Воркер {os.getpid()}: шард {shard['shard']}/{shard['shard_count']} задания {shard['job_id']}, с user_id > {last_user_id}")
+
+    lost = asyncio.Event()
+    heartbeat = asyncio.create_task(_keep_shard_alive(shard, lost))
+    try:
+        while not lost.is_set():
+            page = await _fetch_shard_page(shard['audience'], shard['shard_count'], shard['shard'], last_user_id)
+            if not page:
+                break
+            page_iter = iter(page)
+
+            async def worker() -> None:
+                for target_user_id in page_iter:
+                    if lost.is_set():
+                        return
+                    await send_to_recipient(
+                        bot, budget, progress, target_user_id, payload['message_text'],
+                        payload.get('media_type'), payload.get('media_id'), buttons
+                    )
+
+            await asyncio.gather(*(worker() for _ in range(max(1, BROADCAST_CONCURRENCY))))
+            if lost.is_set():
+                break
+            last_user_id = page[-1]
+            if time.monotonic() - last_flush >= SHARD_FLUSH_INTERVAL or len(page) < BROADCAST_SHARD_PAGE_SIZE:
+                await _flush_shard(shard, progress, last_user_id)
+                last_flush = time.monotonic()
+        if lost.is_set():
+            raise ShardLostError(f"Шард {shard['shard']} задания {shard['job_id']} забрал другой воркер")
+        await _flush_shard(shard, progress, last_user_id, status='completed')
+    finally:
+        heartbeat.cancel()
+        try:
+            await heartbeat
+        except asyncio.CancelledError:
+            pass
+    logger.info(
+        f"Воркер {os.getpid()}: шард {shard['shard']} задания {shard['job_id']} завершён. "
+        f"Отправлено: {progress.sent}, Ошибок: {progress.failed}"
+    )
+
+
+async def run_broadcast_worker(worker_index: int = 0) -> None:
+    """Главный цикл процесса-воркера: забирает шарды и отправляет сообщения."""
+    async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+        await conn.execute("PRAGMA busy_timeout = 30000")
+        await init_broadcast_worker_tables(conn)
+    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    budget = SharedRateBudget()
+    worker_pid = os.getpid()
+    logger.info(f"Воркер рассылок #{worker_index} запущен (pid={worker_pid})")
+    try:
+        while True:
+            try:
+                shard = await claim_shard(worker_pid)
+            except Exception as e:
+                logger.error(f"Воркер {worker_pid}: ошибка получения шарда: {e}", exc_info=True)
+                shard = None
+            if not shard:
+                await asyncio.sleep(WORKER_IDLE_SLEEP)
+                continue
+            try:
+                await process_shard(bot, budget, shard)
+            except ShardLostError as e:
+                logger.warning(f"Воркер {worker_pid}: {e}, отправка прекращена")
+            except Exception as e:
+                # Шард останется в статусе running и будет подхвачен после BROADCAST_WORKER_STALE_SECONDS
+                logger.error(f"Воркер {worker_pid}: ошибка обработки шарда {shard['shard']} задания {shard['job_id']}: {e}", exc_info=True)
+    finally:
+        await bot.session.close()
+
+
+def worker_process_main(worker_index: int) -> None:
+    """Точка входа процесса-воркера."""
+    try:
+        asyncio.run(run_broadcast_worker(worker_index))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_broadcast_workers(count: int = BROADCAST_WORKER_PROCESSES) -> List[multiprocessing.Process]:
+    """Запускает процессы-воркеры рассылок (spawn, чтобы не наследовать event loop)."""
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for index in range(count):
+        process = context.Process(target=worker_process_main, args=(index,), name=f"broadcast-worker-{index}", daemon=True)
+        process.start()
+        processes.append(process)
+    if processes:
+        logger.info(f"Запущено {len(processes)} процессов рассылки")
+    return processes
+
+
+def stop_broadcast_workers(processes: List[multiprocessing.Process], timeout: float = 10) -> None:
+    """Останавливает процессы-воркеры рассылок."""
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        process.join(timeout)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Процессы-воркеры шардированных рассылок")
+    parser.add_argument('--workers', type=int, default=max(1, BROADCAST_WORKER_PROCESSES))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    workers = start_broadcast_workers(args.workers)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop_broadcast_workers(workers)
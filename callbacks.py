@@ -145,10 +145,9 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional
         elif callback_data == "repeat_last_generation":
             try:
                 # Импортируем глобальное хранилище
-                from generation.images import user_last_generation_params, user_last_generation_lock
+                from user_state import user_state_registry
                 
-                async with user_last_generation_lock:
-                    last_params = user_last_generation_params.get(user_id)
+                last_params = user_state_registry.get_last_generation_params(user_id)
                 
                 if not last_params:
                     await send_message_with_fallback(
@@ -29,9 +29,11 @@ from keyboards import (
     create_subscription_keyboard, create_user_profile_keyboard, create_prompt_selection_keyboard, create_referral_keyboard,
     create_rating_keyboard, create_new_male_avatar_styles_keyboard, create_new_female_avatar_styles_keyboard, create_avatar_selection_keyboard, create_payment_only_keyboard
 )
-from generation.training import TrainingStates
+from generation.training import TrainingStates, screen_training_photos
 from generation.videos import handle_generate_video_callback
 from generation import reset_generation_context, generate_image, start_training, check_training_status
+from training_ingest import training_ingest
+from prompt_prep import prompt_preparer
 from handlers.utils import (
     safe_escape_markdown as escape_md, safe_answer_callback,
     check_resources, check_active_avatar, check_style_config, create_payment_link,
@@ -1478,6 +1480,8 @@ async def handle_aspect_ratio_callback(query: CallbackQuery, state: FSMContext)
             )
 
         await state.update_data(aspect_ratio=aspect_ratio)
+        # Если подготовка промпта ещё не запускалась (или вход изменился), запускаем её до подтверждения
+        prompt_preparer.schedule(state, target_user_id, user_data)
         
         if not user_data.get('generation_type'):
             logger.error(f"Отсутствует generation_type для user_id={user_id}")
@@ -2373,6 +2377,7 @@ async def handle_train_flux_callback(query: CallbackQuery, state: FSMContext, us
         return
     await state.clear()
     await reset_generation_context(state, "train_flux", user_id=user_id)
+    await training_ingest.discard(user_id)
     await state.update_data(training_step='upload_photos', training_photos=[], user_id=user_id)
     text_parts = [
         "🎨 СОЗДАНИЕ ВАШЕГО АВАТАРА\n\n",
@@ -2630,10 +2635,37 @@ async def handle_confirm_photo_quality_callback(query: CallbackQuery, state: FSM
         await state.update_data(user_id=user_id)
         return
 
+    # Отбраковка размытых, крошечных фото и дубликатов до сборки архива
+    training_photos, review_text = await screen_training_photos(user_id, training_photos)
+    photo_count = len(training_photos)
+    await state.update_data(training_photos=training_photos)
+    if photo_count < 10:
+        logger.info(f"После проверки качества осталось {photo_count} фото для user_id={user_id}")
+        text = escape_message_parts(
+            f"{review_text}\n",
+            f"❌ Подходящих фото осталось {photo_count}, требуется минимум 10.",
+            f" Загрузи ещё {10 - photo_count}.",
+            version=2
+        )
+        logger.debug(f"handle_confirm_photo_quality_callback: сформирован текст: {text[:200]}...")
+        await query.message.answer(
+            text,
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🔙 К загрузке фото", callback_data="continue_upload")]
+            ]),
+            parse_mode=ParseMode.MARKDOWN_V2
+        )
+        await state.update_data(user_id=user_id)
+        return
+
+    # Набор фото зафиксирован: начинаем загрузку архива, пока пользователь читает подтверждение
+    await training_ingest.stage(user_id, training_photos)
+
     text_parts = [
         "👍 Отлично! Давай проверим финальные данные:\n\n",
         f"👤 Имя аватара: {avatar_name}\n",
         f"📸 Загружено фото: {photo_count} шт.\n\n",
+        f"{review_text}\n" if review_text else "",
         "🚀 Все готово для запуска обучения!\n",
         "⏱ Это займет около 3-5 минут.\n",
         "💎 Будет списан 1 аватар с твоего баланса.\n\n",
@@ -2873,6 +2905,8 @@ async def ask_for_aspect_ratio_callback(query: CallbackQuery, state: FSMContext)
     logger.debug(f"ask_for_aspect_ratio_callback вызван для user_id={user_id}")
     try:
         user_data = await state.get_data()
+        # Промпт уже известен: готовим его, пока пользователь выбирает формат
+        prompt_preparer.schedule(state, user_data.get('admin_generation_for_user', user_id), user_data)
         came_from_custom = user_data.get('came_from_custom_prompt', False)
         back_callback = "enter_custom_prompt_manual" if came_from_custom else "back_to_style_selection"
         text = escape_message_parts(
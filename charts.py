@@ -0,0 +1,82 @@
+# charts.py
+"""Рендер графиков админ-панели в PNG.
+
+Функции уровня модуля принимают только простые данные и возвращают байты
+PNG, поэтому их можно выполнять в пуле процессов (executors.cpu_executor),
+не блокируя event loop бота.
+"""
+
+import io
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Union
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+import seaborn as sns
+
+DateLike = Union[date, str]
+
+
+def _to_png(fig) -> bytes:
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    plt.close(fig)
+    return buffer.getvalue()
+
+
+def render_payments_chart(dates: Sequence[date], amounts: Sequence[float],
+                          title: str = "Динамика платежей за последние 30 дней") -> bytes:
+    """Линейный график сумм платежей по дням."""
+    sns.set_style("whitegrid")
+    fig = plt.figure(figsize=(12, 6))
+    plt.plot(dates, amounts, color='#4CAF50', linewidth=2, marker='o')
+    plt.fill_between(dates, amounts, color=(76/255, 175/255, 80/255, 0.2))
+    plt.title(title, fontsize=14, pad=10)
+    plt.xlabel("Дата", fontsize=12)
+    plt.ylabel("Сумма (RUB)", fontsize=12)
+    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    plt.gca().xaxis.set_major_locator(mdates.DayLocator(interval=5))
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return _to_png(fig)
+
+
+def render_registrations_chart(dates: Sequence[DateLike], counts: Sequence[int],
+                               title: str = "Динамика регистраций за последние 30 дней") -> bytes:
+    """Столбчатый график регистраций по дням."""
+    sns.set_style("whitegrid")
+    fig = plt.figure(figsize=(12, 6))
+    plt.bar(dates, counts, color='#2196F3', edgecolor='#1976D2')
+    plt.title(title, fontsize=14, pad=10)
+    plt.xlabel("Дата", fontsize=12)
+    plt.ylabel("Количество регистраций", fontsize=12)
+    plt.xticks(rotation=45, ha='right')
+    plt.tight_layout()
+    return _to_png(fig)
+
+
+def render_generations_chart(dates: Sequence[DateLike], series: Dict[str, List[int]],
+                             labels: Optional[Dict[str, str]] = None,
+                             title: str = "Динамика генераций за последние 30 дней") -> bytes:
+    """Линии генераций по моделям; series — {id модели: значения по дням}, labels — {id модели: название}.
+
+    Названия моделей могут совпадать, поэтому они используются только в легенде.
+    """
+    labels = labels or {}
+    sns.set_style("whitegrid")
+    fig = plt.figure(figsize=(12, 6))
+    colors = sns.color_palette("husl", len(series))
+    for idx, (model_id, counts) in enumerate(series.items()):
+        plt.plot(dates, counts, label=labels.get(model_id, model_id), color=colors[idx], linewidth=2)
+    plt.title(title, fontsize=14, pad=10)
+    plt.xlabel("Дата", fontsize=12)
+    plt.ylabel("Количество генераций", fontsize=12)
+    plt.xticks(rotation=45, ha='right')
+    plt.legend(title="Модели", bbox_to_anchor=(1.05, 1), loc='upper left')
+    plt.tight_layout()
+    return _to_png(fig)
+
+
+__all__ = ['render_payments_chart', 'render_registrations_chart', 'render_generations_chart']
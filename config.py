@@ -42,6 +42,148 @@ WEBHOOK_URL = os.getenv('WEBHOOK_URL', 'https://axidiphoto.ru/webhook')
 MAX_CONCURRENT_TASKS = 200
 MAX_CONCURRENT_GENERATIONS = 10
 
+# === НАСТРОЙКИ РАССЫЛОК ===
+BROADCAST_MAX_RATE = float(os.getenv('BROADCAST_MAX_RATE', '25'))  # сообщений в секунду (лимит Telegram ~30/с)
+BROADCAST_MIN_RATE = float(os.getenv('BROADCAST_MIN_RATE', '1'))
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '10'))
+BROADCAST_PROGRESS_INTERVAL = int(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))  # секунд между обновлениями статуса
+BROADCAST_WORKER_PROCESSES = int(os.getenv('BROADCAST_WORKER_PROCESSES', '0'))  # 0 — рассылка в основном процессе
+BROADCAST_WORKER_STALE_SECONDS = int(os.getenv('BROADCAST_WORKER_STALE_SECONDS', '120'))
+BROADCAST_SHARD_PAGE_SIZE = int(os.getenv('BROADCAST_SHARD_PAGE_SIZE', '200'))
+
+# === НАСТРОЙКИ ОНБОРДИНГ-НАПОМИНАНИЙ ===
+REMINDER_MAX_RATE = float(os.getenv('REMINDER_MAX_RATE', '10'))  # сообщений в секунду, оставляем запас рассылкам
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY', '5'))
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '100'))  # таймеров, забираемых за одно обращение к БД
+REMINDER_MAX_ATTEMPTS = int(os.getenv('REMINDER_MAX_ATTEMPTS', '5'))  # попыток таймера, отложенного из-за RetryAfter
+
+# === НАСТРОЙКИ REPLICATE HTTP ===
+REPLICATE_HTTP_POOL_LIMIT = int(os.getenv('REPLICATE_HTTP_POOL_LIMIT', '100'))  # соединений в пуле всего
+REPLICATE_HTTP_PER_HOST_LIMIT = int(os.getenv('REPLICATE_HTTP_PER_HOST_LIMIT', '100'))
+REPLICATE_HTTP_KEEPALIVE_SECONDS = float(os.getenv('REPLICATE_HTTP_KEEPALIVE_SECONDS', '30'))
+REPLICATE_HTTP_TIMEOUT_SECONDS = float(os.getenv('REPLICATE_HTTP_TIMEOUT_SECONDS', '120'))
+REPLICATE_STREAM_READ_TIMEOUT_SECONDS = float(os.getenv('REPLICATE_STREAM_READ_TIMEOUT_SECONDS', '30'))  # пауза между событиями SSE
+
+# === ВЕБХУКИ REPLICATE ===
+# Пустой REPLICATE_WEBHOOK_URL отключает вебхуки: статусы снова опрашиваются цепочкой проверок
+REPLICATE_WEBHOOK_URL = os.getenv('REPLICATE_WEBHOOK_URL', WEBHOOK_URL.rsplit('/', 1)[0] + '/replicate/webhook')
+REPLICATE_WEBHOOK_SECRET = os.getenv('REPLICATE_WEBHOOK_SECRET', '')  # whsec_..., GET /v1/webhooks/default/secret
+REPLICATE_WEBHOOK_TOLERANCE_SECONDS = int(os.getenv('REPLICATE_WEBHOOK_TOLERANCE_SECONDS', '300'))
+# Страховочная проверка незавершённых видео и обучений на случай потерянного вебхука
+REPLICATE_SAFETY_POLL_MINUTES = int(os.getenv('REPLICATE_SAFETY_POLL_MINUTES', '30' if REPLICATE_WEBHOOK_URL else '5'))
+
+# === ОПРОС СТАТУСОВ REPLICATE ===
+PREDICTION_POLL_CONCURRENCY = int(os.getenv('PREDICTION_POLL_CONCURRENCY', '8'))  # запросов статуса одновременно
+PREDICTION_POLL_INITIAL_INTERVAL = float(os.getenv('PREDICTION_POLL_INITIAL_INTERVAL', '10'))  # секунд до первого опроса
+PREDICTION_POLL_MAX_INTERVAL = float(os.getenv('PREDICTION_POLL_MAX_INTERVAL', '120'))
+PREDICTION_POLL_BACKOFF = float(os.getenv('PREDICTION_POLL_BACKOFF', '1.5'))  # рост интервала после каждого опроса
+PREDICTION_POLL_MAX_ERRORS = int(os.getenv('PREDICTION_POLL_MAX_ERRORS', '10'))  # ошибок подряд до снятия с опроса
+
+# === ПУЛЫ ДЛЯ БЛОКИРУЮЩИХ ЗАДАЧ ===
+EXECUTOR_NETWORK_WORKERS = int(os.getenv('EXECUTOR_NETWORK_WORKERS', '32'))  # перевод и синхронные HTTP-клиенты
+EXECUTOR_CPU_WORKERS = int(os.getenv('EXECUTOR_CPU_WORKERS', str(max(1, (os.cpu_count() or 2) - 1))))  # процессы
+EXECUTOR_DISK_WORKERS = int(os.getenv('EXECUTOR_DISK_WORKERS', '8'))
+EXECUTOR_SATURATION_WARN_INTERVAL = int(os.getenv('EXECUTOR_SATURATION_WARN_INTERVAL', '60'))  # секунд между предупреждениями
+
+# === ЗАГРУЗКА СГЕНЕРИРОВАННЫХ ФАЙЛОВ ===
+DOWNLOAD_POOL_LIMIT = int(os.getenv('DOWNLOAD_POOL_LIMIT', '100'))
+DOWNLOAD_PER_HOST_LIMIT = int(os.getenv('DOWNLOAD_PER_HOST_LIMIT', '20'))
+DOWNLOAD_KEEPALIVE_SECONDS = float(os.getenv('DOWNLOAD_KEEPALIVE_SECONDS', '60'))
+DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv('DOWNLOAD_TIMEOUT_SECONDS', '60'))
+DOWNLOAD_MAX_BYTES = int(os.getenv('DOWNLOAD_MAX_BYTES', str(20 * 1024 * 1024)))  # защита памяти при загрузке в буфер
+DOWNLOAD_ZERO_DISK = os.getenv('DOWNLOAD_ZERO_DISK', 'True').lower() == 'true'  # отправлять фото из памяти, без generated/
+# Видео пишутся на диск потоком; лимит по умолчанию — максимум загрузки файла Bot API
+VIDEO_DOWNLOAD_MAX_BYTES = int(os.getenv('VIDEO_DOWNLOAD_MAX_BYTES', str(50 * 1024 * 1024)))
+VIDEO_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv('VIDEO_DOWNLOAD_TIMEOUT_SECONDS', '300'))  # на одну попытку
+VIDEO_DOWNLOAD_READ_TIMEOUT_SECONDS = float(os.getenv('VIDEO_DOWNLOAD_READ_TIMEOUT_SECONDS', '30'))  # пауза между чанками
+VIDEO_DOWNLOAD_RETRIES = int(os.getenv('VIDEO_DOWNLOAD_RETRIES', '5'))
+
+# === ПРИЁМ ФОТО ДЛЯ ОБУЧЕНИЯ ===
+TRAINING_PHOTO_MAX_SIDE = int(os.getenv('TRAINING_PHOTO_MAX_SIDE', '2048'))  # px, тренер всё равно уменьшает до 1024
+TRAINING_PHOTO_JPEG_QUALITY = int(os.getenv('TRAINING_PHOTO_JPEG_QUALITY', '95'))
+TRAINING_INGEST_TTL_SECONDS = int(os.getenv('TRAINING_INGEST_TTL_SECONDS', str(24 * 3600)))  # брошенные архивы
+# Проверка качества: короткая сторона в px, резкость — дисперсия лапласиана на 512 px
+TRAINING_PHOTO_MIN_SIDE = int(os.getenv('TRAINING_PHOTO_MIN_SIDE', '256'))  # меньше — исключается
+TRAINING_PHOTO_WARN_SIDE = int(os.getenv('TRAINING_PHOTO_WARN_SIDE', '512'))
+TRAINING_PHOTO_BLUR_REJECT = float(os.getenv('TRAINING_PHOTO_BLUR_REJECT', '15'))  # меньше — исключается
+TRAINING_PHOTO_BLUR_WARN = float(os.getenv('TRAINING_PHOTO_BLUR_WARN', '50'))
+TRAINING_PHOTO_BLUR_RELATIVE = float(os.getenv('TRAINING_PHOTO_BLUR_RELATIVE', '0.25'))  # доля медианы набора
+TRAINING_PHOTO_DARK_MEAN = float(os.getenv('TRAINING_PHOTO_DARK_MEAN', '50'))  # средняя яркость 0..255
+TRAINING_PHOTO_BRIGHT_MEAN = float(os.getenv('TRAINING_PHOTO_BRIGHT_MEAN', '205'))
+TRAINING_PHOTO_CLIPPED_FRACTION = float(os.getenv('TRAINING_PHOTO_CLIPPED_FRACTION', '0.25'))  # провалы/пересветы
+TRAINING_PHOTO_DUPLICATE_DISTANCE = int(os.getenv('TRAINING_PHOTO_DUPLICATE_DISTANCE', '6'))  # бит из 64 в dHash
+
+# === НОРМАЛИЗАЦИЯ ВХОДНЫХ ИЗОБРАЖЕНИЙ ===
+# Длинная сторона в px: модели всё равно уменьшают вход до своего разрешения
+IMAGE_REFERENCE_MAX_SIDE = int(os.getenv('IMAGE_REFERENCE_MAX_SIDE', '1440'))  # optimal_resolution Flux
+IMAGE_GEN4_REFERENCE_MAX_SIDE = int(os.getenv('IMAGE_GEN4_REFERENCE_MAX_SIDE', '1280'))  # вывод gen4 — до 1080p
+IMAGE_VIDEO_START_MAX_SIDE = int(os.getenv('IMAGE_VIDEO_START_MAX_SIDE', '1280'))  # Kling — до 1080p
+IMAGE_NORMALIZE_JPEG_QUALITY = int(os.getenv('IMAGE_NORMALIZE_JPEG_QUALITY', '90'))
+IMAGE_NORMALIZE_CACHE_SIZE = int(os.getenv('IMAGE_NORMALIZE_CACHE_SIZE', '256'))  # записей
+IMAGE_NORMALIZE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_NORMALIZE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# === ОЖИДАНИЕ ПРЕДСКАЗАНИЙ В ЗАПРОСЕ (prediction_tracker) ===
+PREDICTION_TRACK_INITIAL_INTERVAL = float(os.getenv('PREDICTION_TRACK_INITIAL_INTERVAL', '1'))  # секунд
+PREDICTION_TRACK_MAX_INTERVAL = float(os.getenv('PREDICTION_TRACK_MAX_INTERVAL', '8'))
+PREDICTION_TRACK_BACKOFF = float(os.getenv('PREDICTION_TRACK_BACKOFF', '1.5'))
+PREDICTION_TRACK_DEADLINE_SECONDS = float(os.getenv('PREDICTION_TRACK_DEADLINE_SECONDS', '300'))  # потом отмена
+PREDICTION_TRACK_MAX_ERRORS = int(os.getenv('PREDICTION_TRACK_MAX_ERRORS', '5'))  # ошибок опроса подряд
+
+# === АДАПТИВНЫЙ ЛИМИТ И ПРЕДОХРАНИТЕЛЬ REPLICATE (replicate_limiter) ===
+# Лимит одновременных предсказаний на модель: +1 за каждые limit успешных, умножение на
+# REPLICATE_LIMIT_DECREASE_FACTOR при 429/5xx/таймаутах (не чаще раза в REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS)
+REPLICATE_LIMIT_INITIAL = int(os.getenv('REPLICATE_LIMIT_INITIAL', '10'))
+REPLICATE_LIMIT_MIN = int(os.getenv('REPLICATE_LIMIT_MIN', '1'))
+REPLICATE_LIMIT_MAX = int(os.getenv('REPLICATE_LIMIT_MAX', '50'))
+REPLICATE_LIMIT_DECREASE_FACTOR = float(os.getenv('REPLICATE_LIMIT_DECREASE_FACTOR', '0.5'))
+REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS = float(os.getenv('REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS', '5'))
+REPLICATE_LIMIT_QUEUE_TIMEOUT_SECONDS = float(os.getenv('REPLICATE_LIMIT_QUEUE_TIMEOUT_SECONDS', '120'))  # ожидание слота
+# Предохранитель размыкается, если за окно не меньше MIN_REQUESTS запросов и доля ошибок не ниже ERROR_RATE
+REPLICATE_BREAKER_WINDOW_SECONDS = float(os.getenv('REPLICATE_BREAKER_WINDOW_SECONDS', '60'))
+REPLICATE_BREAKER_MIN_REQUESTS = int(os.getenv('REPLICATE_BREAKER_MIN_REQUESTS', '10'))
+REPLICATE_BREAKER_ERROR_RATE = float(os.getenv('REPLICATE_BREAKER_ERROR_RATE', '0.5'))
+REPLICATE_BREAKER_OPEN_SECONDS = float(os.getenv('REPLICATE_BREAKER_OPEN_SECONDS', '30'))  # потом пробный запрос
+
+# === ПРЕВЬЮ ГЕНЕРАЦИИ ИЗОБРАЖЕНИЙ (image_preview) ===
+# Параллельное превью — отдельное платное предсказание, поэтому по умолчанию выключено;
+# настройки превью задаются в IMAGE_GENERATION_MODELS[...]['preview']
+IMAGE_PREVIEW_ENABLED = os.getenv('IMAGE_PREVIEW_ENABLED', 'False').lower() == 'true'
+IMAGE_PREVIEW_DEADLINE_SECONDS = float(os.getenv('IMAGE_PREVIEW_DEADLINE_SECONDS', '60'))
+
+# === КЭШ ЗАГРУЗОК В REPLICATE FILES ===
+REPLICATE_UPLOAD_CACHE_SIZE = int(os.getenv('REPLICATE_UPLOAD_CACHE_SIZE', '1024'))  # записей
+REPLICATE_FILE_DEFAULT_TTL_SECONDS = int(os.getenv('REPLICATE_FILE_DEFAULT_TTL_SECONDS', str(12 * 3600)))  # если нет expires_at
+REPLICATE_UPLOAD_EXPIRY_MARGIN_SECONDS = int(os.getenv('REPLICATE_UPLOAD_EXPIRY_MARGIN_SECONDS', '1800'))  # запас до истечения
+
+# === КЭШ AI-ПОМОЩНИКА ПРОМПТОВ (llama_helper) ===
+LLAMA_PROMPT_CACHE_SIZE = int(os.getenv('LLAMA_PROMPT_CACHE_SIZE', '512'))  # записей
+LLAMA_PROMPT_CACHE_TTL_SECONDS = int(os.getenv('LLAMA_PROMPT_CACHE_TTL_SECONDS', '3600'))
+ASSISTED_PROMPT_STREAMING = os.getenv('ASSISTED_PROMPT_STREAMING', 'True').lower() == 'true'  # показывать промпт по мере генерации
+STREAM_EDIT_INTERVAL_SECONDS = float(os.getenv('STREAM_EDIT_INTERVAL_SECONDS', '1.2'))  # не чаще одного редактирования
+
+# === ПЕРЕВОД ПРОМПТОВ ===
+TRANSLATION_LRU_SIZE = int(os.getenv('TRANSLATION_LRU_SIZE', '4096'))  # переводов в памяти
+TRANSLATION_MAX_CHARS = int(os.getenv('TRANSLATION_MAX_CHARS', '4500'))  # лимит GoogleTranslator — 5000 символов
+
+# === СОСТОЯНИЕ ГЕНЕРАЦИЙ ПО ПОЛЬЗОВАТЕЛЯМ ===
+USER_STATE_MAX_USERS = int(os.getenv('USER_STATE_MAX_USERS', '20000'))  # записей в памяти, старые вытесняются
+USER_STATE_TTL_SECONDS = int(os.getenv('USER_STATE_TTL_SECONDS', str(24 * 3600)))  # в т.ч. срок «повторить генерацию»
+ACTIVE_MODEL_CACHE_TTL = int(os.getenv('ACTIVE_MODEL_CACHE_TTL', '300'))
+PROMPT_PREP_TTL_SECONDS = int(os.getenv('PROMPT_PREP_TTL_SECONDS', '900'))  # срок годности заранее подготовленного промпта
+
+# === ОЧЕРЕДЬ ГЕНЕРАЦИЙ ===
+GENERATION_QUEUE_WORKERS = int(os.getenv('GENERATION_QUEUE_WORKERS', '20'))
+GENERATION_QUEUE_MAX_DEPTH = int(os.getenv('GENERATION_QUEUE_MAX_DEPTH', '1000'))
+GENERATION_QUEUE_MAX_PER_USER = int(os.getenv('GENERATION_QUEUE_MAX_PER_USER', '3'))  # заданий в очереди на пользователя
+GENERATION_QUEUE_MAX_ATTEMPTS = int(os.getenv('GENERATION_QUEUE_MAX_ATTEMPTS', '2'))  # запусков прерванного задания
+GENERATION_QUEUE_STOP_TIMEOUT = float(os.getenv('GENERATION_QUEUE_STOP_TIMEOUT', '60'))  # ожидание текущих генераций при остановке
+# Веса тарифов для честной очереди: чем больше вес, тем чаще обслуживается тариф
+GENERATION_TIER_WEIGHTS = {
+    'admin': 8.0,
+    'paid': 4.0,
+    'trial': 1.0
+}
+
 # === ID АДМИНИСТРАТОРОВ ===
 ADMIN_IDS = [706527960, 1154672896, 444593004, 331123326, 7787636839]
 
@@ -235,6 +377,8 @@ TARIFFS = {
 # === НАСТРОЙКИ ДЛЯ СТАТИСТИКИ ===
 STATS_UPDATE_INTERVAL = 3600
 METRICS_RETENTION_DAYS = 90
+# Токен для GET /metrics (заголовок X-Metrics-Token); без него метрики доступны только с localhost
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
 
 # === ЭКСПОРТ КОНСТАНТ ДЛЯ МЕТРИК ===
 METRICS_CONFIG = {
@@ -324,8 +468,40 @@ __all__ = [
     'REFERRAL_BONUS_PHOTOS', 'REFERRAL_BONUS_FOR_REFERRER', 'NOTIFICATION_HOUR',
     'TIMEZONE', 'ANTISPAM_MESSAGE_LIMIT', 'ANTISPAM_GENERATION_LIMIT',
     'ERROR_MESSAGES', 'STATS_UPDATE_INTERVAL', 'METRICS_RETENTION_DAYS',
-    'METRICS_CONFIG', 'RATE_LIMIT_MAX_REQUESTS', 'RATE_LIMIT_WINDOW_MINUTES',
-    'MAX_CONCURRENT_TASKS', 'AWAITING_BROADCAST_MESSAGE', 'AWAITING_BROADCAST_CONFIRM',
+    'METRICS_CONFIG', 'METRICS_TOKEN', 'RATE_LIMIT_MAX_REQUESTS', 'RATE_LIMIT_WINDOW_MINUTES',
+    'MAX_CONCURRENT_TASKS', 'BROADCAST_MAX_RATE', 'BROADCAST_MIN_RATE',
+    'BROADCAST_CONCURRENCY', 'BROADCAST_PROGRESS_INTERVAL', 'BROADCAST_WORKER_PROCESSES',
+    'BROADCAST_WORKER_STALE_SECONDS', 'BROADCAST_SHARD_PAGE_SIZE',
+    'REMINDER_MAX_RATE', 'REMINDER_CONCURRENCY', 'REMINDER_BATCH_SIZE', 'REMINDER_MAX_ATTEMPTS',
+    'REPLICATE_HTTP_POOL_LIMIT', 'REPLICATE_HTTP_PER_HOST_LIMIT', 'REPLICATE_HTTP_KEEPALIVE_SECONDS',
+    'REPLICATE_HTTP_TIMEOUT_SECONDS', 'REPLICATE_STREAM_READ_TIMEOUT_SECONDS', 'EXECUTOR_NETWORK_WORKERS', 'EXECUTOR_CPU_WORKERS',
+    'EXECUTOR_DISK_WORKERS', 'EXECUTOR_SATURATION_WARN_INTERVAL',
+    'REPLICATE_WEBHOOK_URL', 'REPLICATE_WEBHOOK_SECRET', 'REPLICATE_WEBHOOK_TOLERANCE_SECONDS',
+    'REPLICATE_SAFETY_POLL_MINUTES', 'PREDICTION_POLL_CONCURRENCY', 'PREDICTION_POLL_INITIAL_INTERVAL',
+    'PREDICTION_POLL_MAX_INTERVAL', 'PREDICTION_POLL_BACKOFF', 'PREDICTION_POLL_MAX_ERRORS',
+    'DOWNLOAD_POOL_LIMIT', 'DOWNLOAD_PER_HOST_LIMIT', 'DOWNLOAD_KEEPALIVE_SECONDS',
+    'DOWNLOAD_TIMEOUT_SECONDS', 'DOWNLOAD_MAX_BYTES', 'DOWNLOAD_ZERO_DISK', 'VIDEO_DOWNLOAD_MAX_BYTES',
+    'VIDEO_DOWNLOAD_TIMEOUT_SECONDS', 'VIDEO_DOWNLOAD_READ_TIMEOUT_SECONDS', 'VIDEO_DOWNLOAD_RETRIES',
+    'TRAINING_PHOTO_MAX_SIDE', 'TRAINING_PHOTO_JPEG_QUALITY', 'TRAINING_INGEST_TTL_SECONDS',
+    'TRAINING_PHOTO_MIN_SIDE', 'TRAINING_PHOTO_WARN_SIDE', 'TRAINING_PHOTO_BLUR_REJECT', 'TRAINING_PHOTO_BLUR_WARN',
+    'TRAINING_PHOTO_BLUR_RELATIVE', 'TRAINING_PHOTO_DARK_MEAN', 'TRAINING_PHOTO_BRIGHT_MEAN',
+    'TRAINING_PHOTO_CLIPPED_FRACTION', 'TRAINING_PHOTO_DUPLICATE_DISTANCE',
+    'IMAGE_REFERENCE_MAX_SIDE', 'IMAGE_GEN4_REFERENCE_MAX_SIDE', 'IMAGE_VIDEO_START_MAX_SIDE',
+    'IMAGE_NORMALIZE_JPEG_QUALITY', 'IMAGE_NORMALIZE_CACHE_SIZE', 'IMAGE_NORMALIZE_CACHE_MAX_BYTES',
+    'REPLICATE_UPLOAD_CACHE_SIZE', 'REPLICATE_FILE_DEFAULT_TTL_SECONDS', 'REPLICATE_UPLOAD_EXPIRY_MARGIN_SECONDS',
+    'PREDICTION_TRACK_INITIAL_INTERVAL', 'PREDICTION_TRACK_MAX_INTERVAL', 'PREDICTION_TRACK_BACKOFF',
+    'PREDICTION_TRACK_DEADLINE_SECONDS', 'PREDICTION_TRACK_MAX_ERRORS',
+    'REPLICATE_LIMIT_INITIAL', 'REPLICATE_LIMIT_MIN', 'REPLICATE_LIMIT_MAX', 'REPLICATE_LIMIT_DECREASE_FACTOR',
+    'REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS', 'REPLICATE_LIMIT_QUEUE_TIMEOUT_SECONDS',
+    'REPLICATE_BREAKER_WINDOW_SECONDS', 'REPLICATE_BREAKER_MIN_REQUESTS', 'REPLICATE_BREAKER_ERROR_RATE',
+    'REPLICATE_BREAKER_OPEN_SECONDS',
+    'IMAGE_PREVIEW_ENABLED', 'IMAGE_PREVIEW_DEADLINE_SECONDS',
+    'LLAMA_PROMPT_CACHE_SIZE', 'LLAMA_PROMPT_CACHE_TTL_SECONDS', 'ASSISTED_PROMPT_STREAMING', 'STREAM_EDIT_INTERVAL_SECONDS',
+    'TRANSLATION_LRU_SIZE', 'TRANSLATION_MAX_CHARS', 'USER_STATE_MAX_USERS', 'USER_STATE_TTL_SECONDS',
+    'ACTIVE_MODEL_CACHE_TTL', 'PROMPT_PREP_TTL_SECONDS', 'GENERATION_QUEUE_WORKERS', 'GENERATION_QUEUE_MAX_DEPTH', 'GENERATION_QUEUE_MAX_PER_USER',
+    'GENERATION_QUEUE_MAX_ATTEMPTS', 'GENERATION_QUEUE_STOP_TIMEOUT',
+    'GENERATION_TIER_WEIGHTS',
+    'AWAITING_BROADCAST_MESSAGE', 'AWAITING_BROADCAST_CONFIRM',
     'AWAITING_PAYMENT_DATES', 'AWAITING_USER_SEARCH', 'AWAITING_BALANCE_CHANGE',
     'AWAITING_BROADCAST_SCHEDULE', 'AWAITING_ACTIVITY_DATES', 'AWAITING_ADMIN_PROMPT',
     'AWAITING_BLOCK_REASON', 'AWAITING_CONFIRM_QUALITY', 'AWAITING_STYLE_SELECTION',
@@ -8,7 +8,7 @@ import pytz
 import shutil
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from decimal import Decimal
 from typing import List, Tuple, Optional, Dict, Any
 from functools import wraps
@@ -374,6 +374,7 @@ async def init_db(bot: Bot = None) -> None:
                 ('idx_user_actions_action', 'user_actions(action)'),
                 ('idx_user_actions_created', 'user_actions(created_at)'),
                 ('idx_scheduled_broadcasts_schedule', 'scheduled_broadcasts(scheduled_time)'),
+                ('idx_scheduled_broadcasts_status_time', 'scheduled_broadcasts(status, scheduled_time)'),
                 ('idx_referral_rewards_referrer', 'referral_rewards(referrer_id)'),
                 ('idx_referral_rewards_referred', 'referral_rewards(referred_user_id)'),
                 ('idx_referral_stats_user', 'referral_stats(user_id)'),
@@ -1439,20 +1440,17 @@ async def get_user_logs(user_id: int, limit: int = 50) -> List[Tuple[str, str, s
         return []
 
 async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
-    
+    """Возвращает ожидающие рассылки, срок которых уже наступил (включая просроченные)."""
     from handlers.utils import safe_escape_markdown, send_message_with_fallback
     try:
         async with aiosqlite.connect(DATABASE_PATH) as conn:
             conn.row_factory = aiosqlite.Row
             c = await conn.cursor()
             msk_tz = pytz.timezone('Europe/Moscow')
-            current_time = (datetime.now(msk_tz) + timedelta(seconds=30)).strftime('%Y-%m-%d %H:%M:%S')
+            current_time = datetime.now(msk_tz).strftime('%Y-%m-%d %H:%M:%S')
             logger.debug(f"Fetching broadcasts with scheduled_time <= {current_time} (MSK)")
-            
-            await c.execute('SELECT id, scheduled_time, status, broadcast_data FROM scheduled_broadcasts')
-            all_rows = await c.fetchall()
-            logger.debug(f"Все записи в scheduled_broadcasts: {[dict(row) for row in all_rows]}")
-            
+
+            # Использует индекс idx_scheduled_broadcasts_status_time
             await c.execute('''
                 SELECT id, scheduled_time, broadcast_data, status
                 FROM scheduled_broadcasts
@@ -1460,24 +1458,17 @@ async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
                 ORDER BY scheduled_time ASC
             ''', (current_time,))
             rows = await c.fetchall()
-            
+
             broadcasts = []
-            skipped_broadcasts = []
             for row in rows:
                 try:
                     if not isinstance(row['id'], int) or row['id'] <= 0:
                         logger.error(f"Некорректный ID рассылки: {row['id']}")
                         continue
-                    
+
                     try:
-                        scheduled_dt = datetime.strptime(row['scheduled_time'], '%Y-%m-%d %H:%M:%S')
-                        scheduled_dt = msk_tz.localize(scheduled_dt)
-                        current_dt = datetime.now(msk_tz)
-                        if not (current_dt.replace(second=0, microsecond=0) <= scheduled_dt < (current_dt + timedelta(minutes=1)).replace(second=0, microsecond=0)):
-                            logger.debug(f"Рассылка ID {row['id']} пропущена: scheduled_time {row['scheduled_time']} вне текущей минуты")
-                            skipped_broadcasts.append((row['id'], row['scheduled_time']))
-                            continue
-                    except ValueError as e:
+                        datetime.strptime(row['scheduled_time'], '%Y-%m-%d %H:%M:%S')
+                    except ValueError:
                         logger.warning(f"Некорректный формат scheduled_time для ID {row['id']}: {row['scheduled_time']}")
                         if bot:
                             for admin_id in ADMIN_IDS:
@@ -1490,30 +1481,18 @@ async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
                                 except Exception as e_notify:
                                     logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
                         continue
-                    
+
                     broadcast_data = json.loads(row['broadcast_data'])
-                    message_text = broadcast_data.get('message', '')
                     media = broadcast_data.get('media', None)
-                    media_type = media.get('type') if media else None
-                    media_id = media.get('file_id') if media else None
-                    target_group = broadcast_data.get('broadcast_type', 'all')
-                    admin_user_id = broadcast_data.get('admin_user_id', ADMIN_IDS[0])
-                    criteria = broadcast_data.get('criteria', None)
-                    scheduled_time = row['scheduled_time']
-                    
-                    if not scheduled_time:
-                        logger.warning(f"Рассылка ID {row['id']} пропущена: отсутствует scheduled_time")
-                        continue
-                    
                     broadcasts.append({
                         'id': row['id'],
-                        'message_text': message_text,
-                        'media_type': media_type,
-                        'media_id': media_id,
-                        'target_group': target_group,
-                        'admin_user_id': admin_user_id,
-                        'criteria': criteria,
-                        'scheduled_time': scheduled_time,
+                        'message_text': broadcast_data.get('message', ''),
+                        'media_type': media.get('type') if media else None,
+                        'media_id': media.get('file_id') if media else None,
+                        'target_group': broadcast_data.get('broadcast_type', 'all'),
+                        'admin_user_id': broadcast_data.get('admin_user_id', ADMIN_IDS[0]),
+                        'criteria': broadcast_data.get('criteria', None),
+                        'scheduled_time': row['scheduled_time'],
                         'broadcast_data': broadcast_data
                     })
                 except json.JSONDecodeError as je:
@@ -1522,42 +1501,10 @@ async def get_scheduled_broadcasts(bot: Bot = None) -> List[Dict]:
                 except Exception as e:
                     logger.error(f"Ошибка обработки рассылки ID {row['id']}: {e}", exc_info=True)
                     continue
-            
+
             logger.info(f"Получено {len(broadcasts)} запланированных рассылок")
-            if skipped_broadcasts:
-                logger.info(f"Пропущено {len(skipped_broadcasts)} рассылок из-за времени: {skipped_broadcasts}")
-            
-            if not broadcasts and any(row['status'] == 'pending' for row in all_rows) and bot:
-                await c.execute("SELECT value FROM bot_config WHERE key = 'last_broadcast_warning_time'")
-                last_warning_row = await c.fetchone()
-                last_warning = datetime.strptime(last_warning_row[0], '%Y-%m-%d %H:%M:%S').replace(tzinfo=msk_tz) if last_warning_row else None
-                
-                current_time_dt = datetime.now(msk_tz)
-                if not last_warning or (current_time_dt - last_warning).total_seconds() >= 1200:
-                    logger.warning(f"Запланированные рассылки есть, но не найдены из-за времени: {[(row['id'], row['scheduled_time']) for row in all_rows if row['status'] == 'pending']}")
-                    await c.execute(
-                        "INSERT OR REPLACE INTO bot_config (key, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
-                        ('last_broadcast_warning_time', current_time_dt.strftime('%Y-%m-%d %H:%M:%S'))
-                    )
-                    await conn.commit()
-                    
-                    for admin_id in ADMIN_IDS:
-                        try:
-                            message_text = safe_escape_markdown(
-                                f"⚠️ Запланированные рассылки есть, но не найдены (scheduled_time > {current_time}). "
-                                f"Ожидают выполнения в будущем: {[(row['id'], row['scheduled_time']) for row in all_rows if row['status'] == 'pending']}",
-                                version=2
-                            )
-                            await send_message_with_fallback(
-                                bot, admin_id,
-                                message_text,
-                                parse_mode=ParseMode.MARKDOWN_V2
-                            )
-                        except Exception as e_notify:
-                            logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
-            
             return broadcasts
-            
+
     except Exception as e:
         logger.error(f"Ошибка получения запланированных рассылок: {e}", exc_info=True)
         if bot:
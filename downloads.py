@@ -0,0 +1,264 @@
+# downloads.py
+"""Общий сервис загрузки сгенерированных файлов.
+
+Одна aiohttp-сессия на процесс с keep-alive и DNS-кэшем вместо новой
+ClientSession + TCPConnector на каждую генерацию: повторные загрузки с
+CDN Replicate идут по уже открытым TLS-соединениям.
+
+fetch_bytes() читает ответ целиком в память — результат можно сразу
+отдать в Telegram через BufferedInputFile, без записи в generated/ и
+повторного чтения с диска. download_to_file() оставлен для мест, которым
+нужен путь к файлу.
+
+stream_to_file() для больших файлов (видео): ответ пишется на диск по
+чанкам во временный .part, память не растёт с размером файла, а после
+обрыва загрузка продолжается запросом Range с уже полученного байта.
+Готовый файл отдаётся в Telegram через FSInputFile, который тоже читает
+его с диска потоком.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import aiofiles
+import aiohttp
+from config import (
+    DOWNLOAD_POOL_LIMIT, DOWNLOAD_PER_HOST_LIMIT, DOWNLOAD_KEEPALIVE_SECONDS, DOWNLOAD_TIMEOUT_SECONDS,
+    DOWNLOAD_MAX_BYTES, VIDEO_DOWNLOAD_MAX_BYTES, VIDEO_DOWNLOAD_TIMEOUT_SECONDS, VIDEO_DOWNLOAD_READ_TIMEOUT_SECONDS,
+    VIDEO_DOWNLOAD_RETRIES
+)
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+class DownloadError(Exception):
+    """Файл не удалось загрузить."""
+
+
+class DownloadTooLargeError(DownloadError):
+    """Файл больше допустимого размера; повторять загрузку бессмысленно."""
+
+
+class DownloadService:
+    """Загрузка файлов по URL через общую aiohttp-сессию."""
+
+    def __init__(self, pool_limit: int = DOWNLOAD_POOL_LIMIT, per_host_limit: int = DOWNLOAD_PER_HOST_LIMIT,
+                 keepalive_timeout: float = DOWNLOAD_KEEPALIVE_SECONDS, timeout: float = DOWNLOAD_TIMEOUT_SECONDS,
+                 max_bytes: int = DOWNLOAD_MAX_BYTES):
+        self.pool_limit = pool_limit
+        self.per_host_limit = per_host_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.requests_total = 0
+        self.errors_total = 0
+        self.bytes_total = 0
+        self.in_flight = 0
+        self.total_seconds = 0.0
+        self.streams_total = 0
+        self.stream_errors_total = 0
+        self.stream_resumes_total = 0
+        self.stream_bytes_total = 0
+        self.stream_seconds_total = 0.0
+        self.last_stream_bytes_per_second: Optional[float] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_lock: Optional[asyncio.Lock] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is not None and not self._session.closed:
+            return self._session
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.pool_limit,
+                    limit_per_host=self.per_host_limit,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=300
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout)
+                )
+                logger.info(f"Создана сессия загрузок (лимит {self.pool_limit}, на хост {self.per_host_limit})")
+        return self._session
+
+    async def _fetch_once(self, url: str) -> bytes:
+        session = await self._get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise DownloadError(f"HTTP {response.status} при загрузке {url}")
+            if response.content_length and response.content_length > self.max_bytes:
+                raise DownloadError(f"Файл {url} больше лимита: {response.content_length} байт")
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                buffer.extend(chunk)
+                if len(buffer) > self.max_bytes:
+                    raise DownloadError(f"Файл {url} больше лимита {self.max_bytes} байт")
+            return bytes(buffer)
+
+    async def fetch_bytes(self, url: str, retry_count: int = 3) -> bytes:
+        """Загружает файл в память. DownloadError, если все попытки неудачны."""
+        last_error: Optional[Exception] = None
+        for attempt in range(retry_count):
+            self.requests_total += 1
+            self.in_flight += 1
+            started = time.monotonic()
+            try:
+                data = await self._fetch_once(url)
+                self.bytes_total += len(data)
+                self.total_seconds += time.monotonic() - started
+                logger.debug(f"Загружено {len(data)} байт: {url}")
+                return data
+            except asyncio.TimeoutError as e:
+                last_error = e
+                logger.warning(f"Таймаут загрузки {url}, попытка {attempt + 1}/{retry_count}")
+            except (aiohttp.ClientError, DownloadError) as e:
+                last_error = e
+                logger.warning(f"Ошибка загрузки {url}, попытка {attempt + 1}/{retry_count}: {e}")
+            finally:
+                self.in_flight -= 1
+            self.errors_total += 1
+            if attempt < retry_count - 1:
+                await asyncio.sleep(1 * (attempt + 1))
+        raise DownloadError(f"Не удалось загрузить {url}: {last_error}")
+
+    async def fetch_many(self, urls: List[str], retry_count: int = 3) -> List[Optional[bytes]]:
+        """Параллельно загружает файлы; на месте неудачных — None."""
+        results = await asyncio.gather(*[self.fetch_bytes(url, retry_count) for url in urls], return_exceptions=True)
+        output: List[Optional[bytes]] = []
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка загрузки {url}: {result}")
+                output.append(None)
+            else:
+                output.append(result)
+        return output
+
+    async def download_to_file(self, url: str, filepath: str, retry_count: int = 3) -> Optional[str]:
+        """Загружает файл на диск и возвращает путь или None при ошибке."""
+        try:
+            data = await self.fetch_bytes(url, retry_count)
+        except DownloadError as e:
+            logger.error(str(e))
+            return None
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        async with aiofiles.open(filepath, 'wb') as f:
+            await f.write(data)
+        return filepath
+
+    async def _stream_once(self, url: str, part_path: str, offset: int, max_bytes: int) -> int:
+        """Дописывает в part_path ответ, начиная с offset. Возвращает итоговый размер файла."""
+        session = await self._get_session()
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        timeout = aiohttp.ClientTimeout(total=VIDEO_DOWNLOAD_TIMEOUT_SECONDS, sock_read=VIDEO_DOWNLOAD_READ_TIMEOUT_SECONDS)
+        async with session.get(url, headers=headers, timeout=timeout) as response:
+            if offset and response.status == 206:
+                mode = 'ab'
+            elif response.status == 200:
+                if offset:
+                    logger.info(f"Сервер не поддерживает Range, загрузка {url} начата заново")
+                offset, mode = 0, 'wb'
+            elif offset and response.status == 416:
+                return offset  # всё уже получено
+            else:
+                raise DownloadError(f"HTTP {response.status} при загрузке {url}")
+            if response.content_length and offset + response.content_length > max_bytes:
+                raise DownloadTooLargeError(f"Файл {url} больше лимита: {offset + response.content_length} байт")
+            size = offset
+            async with aiofiles.open(part_path, mode) as f:
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise DownloadTooLargeError(f"Файл {url} больше лимита {max_bytes} байт")
+                    await f.write(chunk)
+            if response.content_length is not None and size != offset + response.content_length:
+                raise DownloadError(f"Соединение оборвано: получено {size - offset} из {response.content_length} байт")
+            return size
+
+    async def stream_to_file(self, url: str, filepath: str, max_bytes: int = VIDEO_DOWNLOAD_MAX_BYTES,
+                             retry_count: int = VIDEO_DOWNLOAD_RETRIES) -> str:
+        """Потоково загружает файл на диск с докачкой после обрывов. Возвращает путь.
+
+        DownloadTooLargeError — файл больше max_bytes; DownloadError — все попытки неудачны.
+        """
+        os.makedirs(os.path.dirname(filepath) or '.', exist_ok=True)
+        part_path = f"{filepath}.part"
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        self.streams_total += 1
+        self.in_flight += 1
+        started = time.monotonic()
+        size = 0
+        last_error: Optional[Exception] = None
+        try:
+            for attempt in range(retry_count):
+                if attempt:
+                    self.stream_resumes_total += 1
+                    logger.info(f"Докачка {url} с байта {size}, попытка {attempt + 1}/{retry_count}")
+                try:
+                    size = await self._stream_once(url, part_path, size, max_bytes)
+                    break
+                except DownloadTooLargeError:
+                    raise
+                except (DownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    last_error = e
+                logger.warning(f"Ошибка потоковой загрузки {url}, попытка {attempt + 1}/{retry_count}: {last_error!r}")
+                size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+                if attempt < retry_count - 1:
+                    await asyncio.sleep(1 * (attempt + 1))
+            else:
+                raise DownloadError(f"Не удалось загрузить {url}: {last_error!r}")
+            os.replace(part_path, filepath)
+        except BaseException:
+            self.stream_errors_total += 1
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        finally:
+            self.in_flight -= 1
+        elapsed = time.monotonic() - started
+        self.stream_bytes_total += size
+        self.stream_seconds_total += elapsed
+        self.last_stream_bytes_per_second = round(size / elapsed) if elapsed > 0 else None
+        logger.info(f"Загружено потоком {size} байт за {elapsed:.1f} с: {url}")
+        return filepath
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики загрузок для /metrics."""
+        succeeded = self.requests_total - self.errors_total
+        return {
+            'requests_total': self.requests_total,
+            'errors_total': self.errors_total,
+            'in_flight': self.in_flight,
+            'bytes_total': self.bytes_total,
+            'avg_seconds': round(self.total_seconds / succeeded, 3) if succeeded else None,
+            'streams_total': self.streams_total,
+            'stream_errors_total': self.stream_errors_total,
+            'stream_resumes_total': self.stream_resumes_total,
+            'stream_bytes_total': self.stream_bytes_total,
+            'stream_bytes_per_second': (
+                round(self.stream_bytes_total / self.stream_seconds_total) if self.stream_seconds_total else None
+            ),
+            'last_stream_bytes_per_second': self.last_stream_bytes_per_second,
+        }
+
+
+# Глобальный экземпляр
+download_service = DownloadService()
+metrics_registry.register('downloads', download_service.metrics)
+
+__all__ = ['DownloadService', 'DownloadError', 'DownloadTooLargeError', 'download_service']
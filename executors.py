@@ -0,0 +1,167 @@
+# executors.py
+"""Именованные пулы для блокирующей работы.
+
+Вместо общего run_in_executor(None, ...) у каждого вида нагрузки свой пул
+фиксированного размера:
+
+- network — потоки для синхронных сетевых клиентов (перевод промптов и т.п.);
+- cpu — процессы для тяжёлых вычислений (графики matplotlib, Excel, PIL);
+- disk — потоки для файловых операций (ZIP, удаление файлов).
+
+Медленный рендер графика или всплеск переводов больше не занимает потоки,
+нужные генерациям. Для каждого пула считаются очередь, активные задачи и
+время ожидания; при насыщении пишется предупреждение в лог.
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from config import (
+    EXECUTOR_NETWORK_WORKERS, EXECUTOR_CPU_WORKERS, EXECUTOR_DISK_WORKERS, EXECUTOR_SATURATION_WARN_INTERVAL
+)
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+
+class NamedExecutor:
+    """Пул потоков или процессов с именем, лимитом и метриками очереди."""
+
+    def __init__(self, name: str, max_workers: int, kind: str = 'thread'):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Неизвестный тип пула: {kind}")
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.kind = kind
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._executor: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._last_warning = 0.0
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                if self.kind == 'process':
+                    # spawn: форк процесса с запущенным event loop и потоками небезопасен
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn')
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix=f"{self.name}-pool"
+                    )
+                logger.info(f"Создан пул '{self.name}' ({self.kind}, {self.max_workers} воркеров)")
+            return self._executor
+
+    @property
+    def queued(self) -> int:
+        """Задачи, которые ждут свободного воркера."""
+        return max(0, self.in_flight - self.max_workers)
+
+    def _check_saturation(self) -> None:
+        if self.in_flight <= self.max_workers:
+            return
+        now = time.monotonic()
+        if now - self._last_warning < EXECUTOR_SATURATION_WARN_INTERVAL:
+            return
+        self._last_warning = now
+        logger.warning(
+            f"Пул '{self.name}' насыщен: {self.in_flight} задач на {self.max_workers} воркеров, "
+            f"в очереди {self.queued}, макс. ожидание {self.max_wait_seconds:.2f} с"
+        )
+
+    def _record_wait(self, wait: float) -> None:
+        self.total_wait_seconds += wait
+        if wait > self.max_wait_seconds:
+            self.max_wait_seconds = wait
+
+    async def run(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Выполняет func(*args, **kwargs) в пуле и возвращает результат.
+
+        Для пула процессов func и аргументы должны сериализоваться pickle
+        (функции уровня модуля, простые данные).
+        """
+        loop = asyncio.get_running_loop()
+        call = functools.partial(func, *args, **kwargs)
+        self.submitted += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self._check_saturation()
+        enqueued_at = time.monotonic()
+        try:
+            if self.kind == 'thread':
+                # В потоке можно точно замерить ожидание в очереди
+                def timed():
+                    self._record_wait(time.monotonic() - enqueued_at)
+                    return call()
+                result = await loop.run_in_executor(self._get_executor(), timed)
+            else:
+                result = await loop.run_in_executor(self._get_executor(), call)
+            self.completed += 1
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+
+    def shutdown(self, wait: bool = False) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait, cancel_futures=True)
+                self._executor = None
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'in_flight': self.in_flight,
+            'queued': self.queued,
+            'max_in_flight': self.max_in_flight,
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'avg_wait_seconds': round(self.total_wait_seconds / self.completed, 4) if self.completed and self.kind == 'thread' else None,
+            'max_wait_seconds': round(self.max_wait_seconds, 4) if self.kind == 'thread' else None,
+        }
+
+
+# Глобальные пулы
+network_executor = NamedExecutor('network', EXECUTOR_NETWORK_WORKERS, kind='thread')
+cpu_executor = NamedExecutor('cpu', EXECUTOR_CPU_WORKERS, kind='process')
+disk_executor = NamedExecutor('disk', EXECUTOR_DISK_WORKERS, kind='thread')
+
+EXECUTORS: Dict[str, NamedExecutor] = {
+    executor.name: executor for executor in (network_executor, cpu_executor, disk_executor)
+}
+
+
+def get_executor_metrics() -> Dict[str, Any]:
+    """Метрики всех пулов для /metrics."""
+    return {name: executor.metrics() for name, executor in EXECUTORS.items()}
+
+
+def shutdown_executors(wait: bool = False) -> None:
+    """Останавливает все пулы при завершении бота."""
+    for executor in EXECUTORS.values():
+        executor.shutdown(wait=wait)
+
+
+metrics_registry.register('executors', get_executor_metrics)
+
+__all__ = [
+    'NamedExecutor', 'network_executor', 'cpu_executor', 'disk_executor',
+    'get_executor_metrics', 'shutdown_executors'
+]
@@ -163,6 +163,155 @@ LORA_PRIORITIES = {
 USER_AVATAR_LORA_STRENGTH = 1.0
 MAX_LORA_COUNT = 7
 
+# ПРОФЕССИОНАЛЬНАЯ КОНФИГУРАЦИЯ LORA ДЛЯ ФОТОРЕАЛИЗМА
+# Изменено: Увеличена сила для skin_texture_master до 1.0 для более натуральной текстуры кожи и уменьшения пластикового блеска.
+# Изменено: Увеличена сила для anti_cgi до 1.0 для усиления борьбы с CGI-эффектами и пластиковым видом.
+# Изменено: Уменьшена сила для face_perfection_v2 до 0.75, чтобы избежать чрезмерной идеализации лица, делая его более реалистичным.
+# Изменено: Уменьшена сила для color_grading_pro до 0.7 для предотвращения чрезмерной цветокоррекции, которая может добавлять блеск.
+# Изменено: Увеличена сила для ultra_details до 0.85 для лучшей детализации без потери натуральности.
+# Изменено: Добавлена новая модель "prithivMLmods/Flux-BetterSkin-LoRA" с силой 0.95 для улучшения текстуры кожи и снижения пластикового эффекта.
+ULTRA_PROFESSIONAL_LORA_CONFIG = {
+    "photo_realism_pro": {
+        "model": "alvdansen/frosting_lane_flux",
+        "strength": 0.95,
+        "keywords": ["photorealistic", "professional photo", "camera shot", "DSLR", "фотореалистичный"],
+        "description": "Профессиональная фотосъемка",
+        "priority": 1
+    },
+    "skin_texture_master": {
+        "model": "prithivMLmods/Flux-Skin-Real",
+        "strength": 1.0,
+        "keywords": ["skin", "texture", "natural skin", "pores", "кожа", "текстура", "realistic skin"],
+        "description": "Натуральная текстура кожи без CGI эффекта",
+        "priority": 2
+    },
+    "face_perfection_v2": {
+        "model": "prithivMLmods/Canopus-LoRA-Flux-FaceRealism",
+        "strength": 0.75,
+        "keywords": ["face", "portrait", "eyes", "facial features", "лицо", "глаза"],
+        "description": "Совершенные лица и глаза",
+        "priority": 3
+    },
+    "color_grading_pro": {
+        "model": "renderartist/colorgrading",
+        "strength": 0.7,
+        "keywords": ["color grading", "cinematic", "professional lighting", "цветокоррекция", "natural colors"],
+        "description": "Профессиональная цветокоррекция",
+        "priority": 4
+    },
+    "ultra_details": {
+        "model": "prithivMLmods/Flux-Realism-FineDetailed",
+        "strength": 0.85,
+        "keywords": ["detailed", "high detail", "ultra detailed", "детализация", "fine details"],
+        "description": "Ультра детализация",
+        "priority": 5
+    },
+    "anti_cgi": {
+        "model": "https://huggingface.co/prithivMLmods/Flux-Dev-Real-Anime/resolve/main/Flux-Dev-Real-Anime.safetensors",
+        "strength": 1.0,
+        "keywords": ["real", "not cgi", "not 3d", "natural", "authentic", "реальный"],
+        "description": "Анти-CGI эффект для натуральности",
+        "priority": 6
+    },
+    "portrait_master_pro": {
+        "model": "gokaygokay/Flux-Portrait-LoRA",
+        "strength": 0.95,
+        "keywords": ["portrait", "headshot", "professional portrait", "портрет"],
+        "description": "Профессиональная портретная фотография",
+        "priority": 7
+    },
+    "better_skin": {
+        "model": "prithivMLmods/Flux-BetterSkin-LoRA",
+        "strength": 0.95,
+        "keywords": ["skin", "natural skin", "realistic skin"],
+        "description": "Улучшенная натуральная кожа без блеска",
+        "priority": 8
+    }
+}
+
+# ПРЕСЕТЫ ДЛЯ МАКСИМАЛЬНОГО ФОТОРЕАЛИЗМА
+# Изменено: Для всех пресетов увеличено num_inference_steps до 60 для лучшей детализации и снижения артефактов.
+# Изменено: Уменьшено guidance_scale до 2.5-3.0 для более естественной генерации без переусиления.
+# Изменено: Добавлены LoRA "better_skin" и "anti_cgi" во все пресеты для усиления натуральности кожи.
+# Изменено: Добавлены дополнительные prompt_additions для борьбы с пластиковым блеском: "matte skin finish, no shine, natural skin reflectance".
+# Изменено: Добавлены элементы для повышения сходства с реальным человеком: "imperfect skin, natural variations in skin tone".
+ULTRA_PHOTOREALISTIC_PRESETS = {
+    "natural_portrait": {
+        "loras": ["skin_texture_master", "photo_realism_pro", "face_perfection_v2", "anti_cgi", "better_skin"],
+        "guidance_scale": 2.5,
+        "num_inference_steps": 50,
+        "prompt_additions": (
+            "natural skin texture with visible pores, realistic skin tone, "
+            "authentic human features, real person not CGI, "
+            "soft natural lighting, candid expression, "
+            "professional photography, DSLR quality, unretouched natural beauty, "
+            "matte skin finish, no shine, natural skin reflectance, "
+            "imperfect skin, natural variations in skin tone"
+        )
+    },
+    "studio_perfection": {
+        "loras": ["photo_realism_pro", "color_grading_pro", "face_perfection_v2", "ultra_details", "better_skin", "anti_cgi"],
+        "guidance_scale": 3.0,
+        "num_inference_steps": 50,
+        "prompt_additions": (
+            "professional studio photography, color corrected, natural skin tones, "
+            "high-end commercial photography, realistic skin texture, "
+            "professional lighting setup, authentic expression, "
+            "magazine quality, shot on medium format camera, "
+            "matte skin finish, no shine, natural skin reflectance, "
+            "imperfect skin, natural variations in skin tone"
+        )
+    },
+    "lifestyle_natural": {
+        "loras": ["skin_texture_master", "anti_cgi", "photo_realism_pro", "portrait_master_pro", "better_skin"],
+        "guidance_scale": 2.5,
+        "num_inference_steps": 50,
+        "prompt_additions": (
+            "lifestyle photography, natural candid moment, "
+            "real skin texture, authentic expression, natural lighting, "
+            "photojournalism style, unposed, genuine emotion, "
+            "shot with natural daylight, minimal retouching, "
+            "matte skin finish, no shine, natural skin reflectance, "
+            "imperfect skin, natural variations in skin tone"
+        )
+    }
+}
+
+# === ШАБЛОНЫ ПРОМПТА ДЛЯ FLUX-TRAINED ===
+# Усилители фотореализма, добавляемые к промпту стиля (не к кастомному промпту)
+PHOTOREALISTIC_ENHANCERS = [
+    "professional photography",
+    "photorealistic",
+    "real person",
+    "natural skin texture with visible pores",
+    "realistic skin tone",
+    "authentic human features",
+    "not CGI",
+    "not 3D render",
+    "DSLR camera quality",
+    "natural expression",
+    "genuine emotion",
+    "sharp focus",
+    "high resolution"
+]
+
+ANTI_CGI_DETAILS = (
+    "shot with professional DSLR camera, natural daylight, "
+    "real human skin with natural imperfections, "
+    "unretouched authentic photography, photojournalism style, "
+    "natural hair texture, realistic eye moisture, "
+    "genuine facial expression, candid moment, "
+    "no artificial enhancement, no beauty filters, "
+    "raw unprocessed photo quality"
+)
+
+# Слова промпта, по которым выбирается пресет; проверяются по порядку, иначе — DEFAULT_PHOTOREALISTIC_PRESET
+PRESET_TRIGGER_WORDS = {
+    "lifestyle_natural": ["natural", "candid", "authentic", "lifestyle"],
+    "studio_perfection": ["studio", "professional", "commercial"]
+}
+DEFAULT_PHOTOREALISTIC_PRESET = "natural_portrait"
+
 # === УЛЬТРА-РЕАЛИСТИЧНЫЕ СТИЛИ ===
 LORA_STYLE_PRESETS = {
     "ultra_photorealistic_max": [
@@ -434,7 +583,16 @@ IMAGE_GENERATION_MODELS = {
         "api": "replicate",
         "max_quality": True,
         "optimal_resolution": (1440, 1440),
-        "supports_ultra_realism": True
+        "supports_ultra_realism": True,
+        # Превью (при IMAGE_PREVIEW_ENABLED): source 'parallel' — отдельное быстрое предсказание
+        # с переопределёнными параметрами, 'intermediate' — промежуточный output основного
+        "preview": {
+            "source": "parallel",
+            "num_inference_steps": 8,
+            "scale": 0.5,  # для моделей с width/height
+            "megapixels": "0.25",  # для Fast Flux
+            "input": {"output_format": "jpg", "output_quality": 80}
+        }
     },
     "flux-trainer": {
         "name": "🛠 Обучение аватара",
@@ -1027,6 +1185,8 @@ def validate_styles_config():
 __all__ = [
     'MULTI_LORA_MODEL', 'HF_LORA_MODELS', 'LORA_CONFIG', 'LORA_PRIORITIES',
     'LORA_STYLE_PRESETS', 'MAX_LORA_COUNT', 'USER_AVATAR_LORA_STRENGTH',
+    'ULTRA_PROFESSIONAL_LORA_CONFIG', 'ULTRA_PHOTOREALISTIC_PRESETS', 'PHOTOREALISTIC_ENHANCERS',
+    'ANTI_CGI_DETAILS', 'PRESET_TRIGGER_WORDS', 'DEFAULT_PHOTOREALISTIC_PRESET',
     'ASPECT_RATIOS', 'GENERATION_TYPE_TO_MODEL_KEY', 'CAMERA_SETUP_BASE',
     'LUXURY_DETAILS_BASE', 'REPLICATE_COSTS', 'GENERATION_QUALITY_PARAMS',
     'NEGATIVE_PROMPTS', 'CAMERA_SETUP_ENHANCED', 'IMAGE_GENERATION_MODELS',
@@ -0,0 +1,373 @@
+# generation_jobs.py
+"""Постоянная очередь генераций с честным распределением между пользователями.
+
+Задания хранятся в таблице generation_jobs и переживают перезапуск бота.
+Порядок выдачи — self-clocked fair queueing: каждому заданию при постановке
+присваивается метка finish_tag = max(виртуальное время, метка предыдущего
+задания пользователя) + стоимость / вес тарифа. Воркеры берут задание с
+наименьшей меткой среди пользователей, у которых нет выполняющегося
+задания, поэтому:
+
+- у пользователя не больше одного активного задания, частые клики не
+  занимают несколько воркеров;
+- платящие пользователи обслуживаются чаще пробных, задания админов — в
+  первую очередь, но пробные не голодают;
+- внутри одного пользователя сохраняется порядок FIFO.
+
+Фото списываются внутри задания, и списание записывается в строку
+(charged_photos) — возврат или доставка результата обнуляют его. Задание,
+прерванное перезапуском после списания, не запускается повторно: оно
+помечается failed, а фото возвращаются, чтобы пользователь не заплатил
+дважды и не получил результат два раза. Прерванное до списания задание
+возвращается в очередь, пока не исчерпано GENERATION_QUEUE_MAX_ATTEMPTS.
+stop() сначала перестаёт выдавать задания и ждёт текущие генерации до
+GENERATION_QUEUE_STOP_TIMEOUT.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from config import (
+    DATABASE_PATH, GENERATION_QUEUE_WORKERS, GENERATION_QUEUE_MAX_DEPTH, GENERATION_QUEUE_MAX_PER_USER,
+    GENERATION_TIER_WEIGHTS, GENERATION_QUEUE_MAX_ATTEMPTS, GENERATION_QUEUE_STOP_TIMEOUT
+)
+from database import get_user_payments
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+# Пауза воркера без заданий, если его не разбудили раньше
+WORKER_IDLE_TIMEOUT = 5
+# Сколько хранить завершённые задания
+FINISHED_JOBS_RETENTION_SECONDS = 24 * 3600
+# Сглаживание среднего времени ожидания
+WAIT_EWMA_ALPHA = 0.2
+
+
+class QueueFullError(Exception):
+    """Очередь или лимит заданий пользователя переполнены."""
+
+
+async def init_generation_jobs_table(conn: aiosqlite.Connection) -> None:
+    """Создаёт таблицу заданий генерации с индексами для выборки."""
+    await conn.execute('''CREATE TABLE IF NOT EXISTS generation_jobs (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_id INTEGER NOT NULL,
+                            requester_id INTEGER NOT NULL,
+                            chat_id INTEGER NOT NULL,
+                            tier TEXT NOT NULL,
+                            finish_tag REAL NOT NULL,
+                            payload TEXT NOT NULL,
+                            status TEXT DEFAULT 'queued',
+                            attempts INTEGER DEFAULT 0,
+                            charged_photos INTEGER DEFAULT 0,
+                            enqueued_at REAL NOT NULL,
+                            started_at REAL DEFAULT NULL,
+                            finished_at REAL DEFAULT NULL,
+                            error TEXT DEFAULT NULL
+                         )''')
+    cursor = await conn.execute("PRAGMA table_info(generation_jobs)")
+    columns = [col[1] for col in await cursor.fetchall()]
+    if 'charged_photos' not in columns:
+        await conn.execute("ALTER TABLE generation_jobs ADD COLUMN charged_photos INTEGER DEFAULT 0")
+        logger.info("Добавлен столбец charged_photos в таблицу generation_jobs")
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_generation_jobs_status_tag ON generation_jobs(status, finish_tag)')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_generation_jobs_user_status ON generation_jobs(user_id, status)')
+    await conn.commit()
+
+
+async def resolve_generation_tier(user_id: int, is_admin_generation: bool) -> str:
+    """Тариф для весов очереди: admin, paid или trial."""
+    if is_admin_generation:
+        return 'admin'
+    payments = await get_user_payments(user_id, limit=1)
+    return 'paid' if payments else 'trial'
+
+
+class GenerationJobQueue:
+    """Очередь генераций в SQLite и пул воркеров, которые её разбирают."""
+
+    def __init__(self, workers: int = GENERATION_QUEUE_WORKERS, max_depth: int = GENERATION_QUEUE_MAX_DEPTH,
+                 max_per_user: int = GENERATION_QUEUE_MAX_PER_USER, weights: Optional[Dict[str, float]] = None,
+                 max_attempts: int = GENERATION_QUEUE_MAX_ATTEMPTS, stop_timeout: float = GENERATION_QUEUE_STOP_TIMEOUT):
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_per_user = max_per_user
+        self.max_attempts = max_attempts
+        self.stop_timeout = stop_timeout
+        self.weights = weights or GENERATION_TIER_WEIGHTS
+        self.bot: Optional[Bot] = None
+        self.storage: Optional[BaseStorage] = None
+        self.virtual_time = 0.0
+        # Счётчики для /metrics: обновляются без обращения к БД
+        self.depth = 0
+        self.running = 0
+        self.enqueued_total = 0
+        self.completed_total = 0
+        self.failed_total = 0
+        self.interrupted_total = 0
+        self.avg_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._wakeup = asyncio.Event()
+        self._claim_lock = asyncio.Lock()
+        self._tasks: list = []
+        self._stopping = False
+
+    async def start(self, bot: Bot, storage: BaseStorage) -> None:
+        """Восстанавливает очередь после перезапуска и запускает воркеров."""
+        if self._tasks:
+            return
+        self.bot = bot
+        self.storage = storage
+        self._stopping = False
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await init_generation_jobs_table(conn)
+            await self._recover_interrupted(conn)
+            await conn.execute(
+                "DELETE FROM generation_jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+                (time.time() - FINISHED_JOBS_RETENTION_SECONDS,)
+            )
+            await conn.commit()
+            cursor = await conn.execute(
+                "SELECT COUNT(*), MIN(finish_tag) FROM generation_jobs WHERE status = 'queued'"
+            )
+            depth, min_tag = await cursor.fetchone()
+        self.depth = depth or 0
+        self.virtual_time = min_tag or 0.0
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Очередь генераций запущена: {self.workers} воркеров, в очереди {self.depth}")
+
+    async def _recover_interrupted(self, conn: aiosqlite.Connection) -> None:
+        """Разбирает задания, прерванные остановкой бота посреди выполнения."""
+        cursor = await conn.execute(
+            "SELECT id, user_id, attempts, charged_photos FROM generation_jobs WHERE status = 'running'"
+        )
+        requeued = 0
+        for job_id, user_id, attempts, charged_photos in await cursor.fetchall():
+            if charged_photos:
+                # Фото уже списаны, результат мог быть отправлен — повтор списал бы их второй раз.
+                # Возврат идёт в той же транзакции, что и пометка задания: отдельное соединение
+                # update_user_credits упёрлось бы в блокировку, которую держит conn
+                refund = await conn.execute(
+                    "UPDATE users SET generations_left = generations_left + ?, updated_at = CURRENT_TIMESTAMP "
+                    "WHERE user_id = ?",
+                    (charged_photos, user_id)
+                )
+                if not refund.rowcount:
+                    logger.warning(f"Не найден user_id={user_id} для возврата {charged_photos} фото за генерацию {job_id}")
+                await conn.execute(
+                    "UPDATE generation_jobs SET status = 'failed', finished_at = ?, charged_photos = 0, "
+                    "error = 'interrupted' WHERE id = ?",
+                    (time.time(), job_id)
+                )
+                self.interrupted_total += 1
+                logger.warning(f"Генерация {job_id} прервана после списания: {charged_photos} фото возвращены user_id={user_id}")
+            elif attempts >= self.max_attempts:
+                await conn.execute(
+                    "UPDATE generation_jobs SET status = 'failed', finished_at = ?, error = 'max attempts' WHERE id = ?",
+                    (time.time(), job_id)
+                )
+                self.interrupted_total += 1
+                logger.warning(f"Генерация {job_id} прервана {attempts} раз, больше не запускается")
+            else:
+                await conn.execute(
+                    "UPDATE generation_jobs SET status = 'queued', started_at = NULL WHERE id = ?", (job_id,)
+                )
+                requeued += 1
+        await conn.commit()
+        if requeued:
+            logger.warning(f"Возвращено в очередь {requeued} прерванных генераций")
+
+    async def stop(self) -> None:
+        """Перестаёт выдавать задания, ждёт текущие генерации до stop_timeout, затем останавливает воркеров."""
+        self._stopping = True
+        self._wakeup.set()
+        if self._tasks:
+            done, pending = await asyncio.wait(self._tasks, timeout=self.stop_timeout)
+            if pending:
+                logger.warning(f"Генерации не завершились за {self.stop_timeout:.0f} с: прерывается {len(pending)} воркеров")
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        logger.info("Очередь генераций остановлена")
+
+    async def enqueue(self, user_id: int, requester_id: int, chat_id: int, tier: str,
+                      payload: Dict[str, Any], cost: float = 1.0) -> Tuple[int, int]:
+        """Ставит задание в очередь. Возвращает (id задания, позиция в очереди).
+
+        QueueFullError — очередь заполнена или у пользователя слишком много заданий.
+        """
+        weight = self.weights.get(tier, 1.0)
+        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            cursor = await conn.execute(
+                "SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued'"
+            )
+            depth = (await cursor.fetchone())[0]
+            if depth >= self.max_depth:
+                await conn.rollback()
+                raise QueueFullError(f"Очередь генераций заполнена ({depth})")
+            cursor = await conn.execute(
+                "SELECT COUNT(*), MAX(finish_tag) FROM generation_jobs WHERE user_id = ? AND status IN ('queued', 'running')",
+                (user_id,)
+            )
+            user_jobs, user_last_tag = await cursor.fetchone()
+            if user_jobs >= self.max_per_user:
+                await conn.rollback()
+                raise QueueFullError(f"У пользователя {user_id} уже {user_jobs} заданий в очереди")
+            finish_tag = max(self.virtual_time, user_last_tag or 0.0) + cost / weight
+            cursor = await conn.execute(
+                """INSERT INTO generation_jobs (user_id, requester_id, chat_id, tier, finish_tag, payload, enqueued_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (user_id, requester_id, chat_id, tier, finish_tag, json.dumps(payload, ensure_ascii=False, default=str), time.time())
+            )
+            job_id = cursor.lastrowid
+            cursor = await conn.execute(
+                "SELECT COUNT(*) FROM generation_jobs WHERE status = 'queued' AND finish_tag <= ?",
+                (finish_tag,)
+            )
+            position = (await cursor.fetchone())[0]
+            await conn.commit()
+        self.depth = depth + 1
+        self.enqueued_total += 1
+        self._wakeup.set()
+        logger.info(f"Генерация {job_id} в очереди: user_id={user_id}, tier={tier}, tag={finish_tag:.2f}, позиция {position}")
+        return job_id, position
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        """Атомарно забирает задание с наименьшей меткой у пользователя без активного задания."""
+        async with self._claim_lock:
+            async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+                conn.row_factory = aiosqlite.Row
+                await conn.execute('BEGIN IMMEDIATE')
+                cursor = await conn.execute(
+                    """SELECT id, user_id, requester_id, chat_id, tier, finish_tag, payload, enqueued_at
+                       FROM generation_jobs
+                       WHERE status = 'queued'
+                         AND user_id NOT IN (SELECT user_id FROM generation_jobs WHERE status = 'running')
+                       ORDER BY finish_tag, id
+                       LIMIT 1"""
+                )
+                row = await cursor.fetchone()
+                if row is None:
+                    await conn.rollback()
+                    return None
+                started_at = time.time()
+                await conn.execute(
+                    "UPDATE generation_jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE id = ?",
+                    (started_at, row['id'])
+                )
+                await conn.commit()
+        job = dict(row)
+        job['payload'] = json.loads(job['payload'])
+        self.virtual_time = max(self.virtual_time, job['finish_tag'])
+        self.depth = max(0, self.depth - 1)
+        wait = started_at - job['enqueued_at']
+        self.avg_wait_seconds = wait if not self.completed_total else (
+            WAIT_EWMA_ALPHA * wait + (1 - WAIT_EWMA_ALPHA) * self.avg_wait_seconds
+        )
+        self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        return job
+
+    async def record_charge(self, job_id: int, photos: int) -> None:
+        """Записывает, сколько фото списано за задание (0 — возвращены или результат доставлен)."""
+        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+            await conn.execute("UPDATE generation_jobs SET charged_photos = ? WHERE id = ?", (photos, job_id))
+            await conn.commit()
+
+    async def mark_delivered(self, job_id: int) -> None:
+        """Результат отправлен: после перезапуска задание не повторяется и фото не возвращаются."""
+        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+            await conn.execute(
+                "UPDATE generation_jobs SET status = 'done', finished_at = ?, charged_photos = 0 WHERE id = ?",
+                (time.time(), job_id)
+            )
+            await conn.commit()
+
+    async def _finish(self, job_id: int, status: str, error: Optional[str] = None) -> None:
+        async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
+            await conn.execute(
+                "UPDATE generation_jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+                (status, time.time(), error, job_id)
+            )
+            await conn.commit()
+
+    def _state_for(self, job: Dict[str, Any]) -> FSMContext:
+        key = StorageKey(bot_id=self.bot.id, chat_id=job['chat_id'], user_id=job['requester_id'])
+        return FSMContext(storage=self.storage, key=key)
+
+    async def _run_job(self, job: Dict[str, Any]) -> None:
+        # Импорт здесь: generation.images сам ставит задания в эту очередь
+        from generation.images import _generate_image_internal
+        payload = job['payload']
+        state = self._state_for(job)
+        # После перезапуска FSM-хранилище пустое — восстанавливаем данные генерации
+        await state.update_data(payload['generation_data'])
+        await _generate_image_internal(self.bot, state, payload.get('num_outputs', 2), requester_id=job['requester_id'],
+                                       job_id=job['id'])
+
+    async def _worker(self, worker_id: int) -> None:
+        while not self._stopping:
+            try:
+                job = await self._claim()
+                if job is None:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=WORKER_IDLE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                self.running += 1
+                try:
+                    await self._run_job(job)
+                    await self._finish(job['id'], 'done')
+                    self.completed_total += 1
+                except Exception as e:
+                    self.failed_total += 1
+                    logger.error(f"Worker {worker_id}: Ошибка обработки генерации {job['id']}: {e}", exc_info=True)
+                    await self._finish(job['id'], 'failed', str(e)[:500])
+                finally:
+                    self.running -= 1
+                    # Освободился пользователь — его следующее задание может стать доступным
+                    self._wakeup.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Worker {worker_id}: Критическая ошибка в обработчике очереди: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Глубина очереди и время ожидания для /metrics."""
+        return {
+            'workers': len(self._tasks),
+            'depth': self.depth,
+            'running': self.running,
+            'enqueued_total': self.enqueued_total,
+            'completed_total': self.completed_total,
+            'failed_total': self.failed_total,
+            'interrupted_total': self.interrupted_total,
+            'avg_wait_seconds': round(self.avg_wait_seconds, 2),
+            'max_wait_seconds': round(self.max_wait_seconds, 2),
+        }
+
+
+# Глобальный экземпляр
+generation_job_queue = GenerationJobQueue()
+metrics_registry.register('generation_queue', generation_job_queue.metrics)
+
+__all__ = [
+    'GenerationJobQueue', 'generation_job_queue', 'QueueFullError', 'resolve_generation_tier',
+    'init_generation_jobs_table'
+]
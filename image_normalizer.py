@@ -0,0 +1,201 @@
+# image_normalizer.py
+"""Общая нормализация входных изображений перед отправкой в Replicate.
+
+Раньше фото уходили в модели как есть: PhotoTransformGenerator кодировал
+в data URI весь оригинал (+33% на base64), а upload_image_to_replicate
+загружал полноразмерные файлы для photo-to-photo и первого кадра видео,
+хотя модели всё равно уменьшают вход до своего разрешения.
+
+Теперь вход приводится к профилю модели (ImageProfile): поворот по EXIF,
+RGB, ограничение длинной стороны и перекодирование в JPEG заданного
+качества без метаданных. Работа Pillow идёт в пуле процессов
+(cpu_executor). Результат кэшируется по SHA-256 содержимого и профилю, а
+одновременные запросы одного и того же изображения ждут одну обработку:
+повторы после sensitive content и повторная генерация по тому же фото
+берут готовые байты.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Tuple
+
+import aiofiles
+from PIL import Image, ImageOps
+from config import (
+    IMAGE_NORMALIZE_CACHE_SIZE, IMAGE_NORMALIZE_CACHE_MAX_BYTES, IMAGE_NORMALIZE_JPEG_QUALITY,
+    IMAGE_REFERENCE_MAX_SIDE, IMAGE_GEN4_REFERENCE_MAX_SIDE, IMAGE_VIDEO_START_MAX_SIDE,
+    TRAINING_PHOTO_MAX_SIDE, TRAINING_PHOTO_JPEG_QUALITY
+)
+from executors import cpu_executor
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+
+class ImageProfile(NamedTuple):
+    """Требования модели к входному изображению."""
+    name: str
+    max_side: int
+    quality: int
+
+
+# Профили по назначению входа
+PROFILE_REFERENCE = 'reference'  # фото-референс Flux (photo-to-photo, prompt_based)
+PROFILE_GEN4_REFERENCE = 'gen4_reference'  # reference_images для runwayml/gen4-image
+PROFILE_VIDEO_START = 'video_start'  # start_image для Kling
+PROFILE_TRAINING = 'training'  # фото для обучения аватара
+
+IMAGE_PROFILES: Dict[str, ImageProfile] = {
+    PROFILE_REFERENCE: ImageProfile(PROFILE_REFERENCE, IMAGE_REFERENCE_MAX_SIDE, IMAGE_NORMALIZE_JPEG_QUALITY),
+    PROFILE_GEN4_REFERENCE: ImageProfile(PROFILE_GEN4_REFERENCE, IMAGE_GEN4_REFERENCE_MAX_SIDE,
+                                         IMAGE_NORMALIZE_JPEG_QUALITY),
+    PROFILE_VIDEO_START: ImageProfile(PROFILE_VIDEO_START, IMAGE_VIDEO_START_MAX_SIDE, IMAGE_NORMALIZE_JPEG_QUALITY),
+    PROFILE_TRAINING: ImageProfile(PROFILE_TRAINING, TRAINING_PHOTO_MAX_SIDE, TRAINING_PHOTO_JPEG_QUALITY),
+}
+
+
+def normalize_image(source: Image.Image, max_side: int) -> Image.Image:
+    """Поворачивает по EXIF, приводит к RGB и ограничивает длинную сторону."""
+    image = ImageOps.exif_transpose(source)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+    return image
+
+
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    """JPEG без метаданных (EXIF, ICC и т.п. не переносятся)."""
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def normalize_image_bytes(data: bytes, max_side: int, quality: int) -> Tuple[bytes, int, int]:
+    """Нормализует изображение из байтов. Возвращает (JPEG, ширина, высота). Выполняется в пуле процессов."""
+    try:
+        source = Image.open(io.BytesIO(data))
+    except Exception as e:
+        raise ValueError(f"Невозможно открыть изображение: {e}")
+    with source:
+        image = normalize_image(source, max_side)
+        return encode_jpeg(image, quality), image.width, image.height
+
+
+class NormalizedImage(NamedTuple):
+    data: bytes
+    width: int
+    height: int
+    profile: str
+
+
+class ImageNormalizer:
+    """Нормализация по профилям с LRU-кэшем по хешу содержимого."""
+
+    def __init__(self, max_entries: int = IMAGE_NORMALIZE_CACHE_SIZE,
+                 max_bytes: int = IMAGE_NORMALIZE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._cache: "OrderedDict[Tuple[str, str], NormalizedImage]" = OrderedDict()
+        self._cache_bytes = 0
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds_total = 0.0
+
+    def _store(self, key: Tuple[str, str], result: NormalizedImage) -> None:
+        if len(result.data) > self.max_bytes:
+            return
+        self._cache[key] = result
+        self._cache_bytes += len(result.data)
+        while len(self._cache) > self.max_entries or self._cache_bytes > self.max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted.data)
+
+    async def normalize(self, data: bytes, profile: str) -> NormalizedImage:
+        """Приводит изображение к профилю; одинаковое содержимое обрабатывается один раз."""
+        target = IMAGE_PROFILES[profile]
+        key = (hashlib.sha256(data).hexdigest(), profile)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return cached
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # Собственная отмена пробрасывается; отменённую обработку владельца повторяем сами
+                if not pending.cancelled():
+                    raise
+            return await self.normalize(data, profile)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.misses += 1
+        started = time.monotonic()
+        try:
+            encoded, width, height = await cpu_executor.run(
+                normalize_image_bytes, data, target.max_side, target.quality
+            )
+        except asyncio.CancelledError:
+            # Отмена владельца не должна отменять чужие генерации: ожидающие обработают фото сами
+            future.cancel()
+            raise
+        except BaseException as e:
+            self.errors += 1
+            future.set_exception(e)
+            future.exception()  # ошибку получат ожидающие, сама по себе она не «потеряна»
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        result = NormalizedImage(encoded, width, height, profile)
+        self._store(key, result)
+        self.seconds_total += time.monotonic() - started
+        self.bytes_in += len(data)
+        self.bytes_out += len(encoded)
+        future.set_result(result)
+        logger.debug(f"Изображение нормализовано ({profile}): {len(data)} -> {len(encoded)} байт, {width}x{height}")
+        return result
+
+    async def normalize_file(self, path: str, profile: str) -> NormalizedImage:
+        """То же для файла на диске."""
+        async with aiofiles.open(path, 'rb') as f:
+            data = await f.read()
+        return await self.normalize(data, profile)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики нормализации для /metrics."""
+        return {
+            'cache_entries': len(self._cache),
+            'cache_bytes': self._cache_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'saved_ratio': round(1 - self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+            'avg_seconds': (
+                round(self.seconds_total / (self.misses - self.errors), 3) if self.misses > self.errors else None
+            ),
+        }
+
+
+# Глобальный экземпляр
+image_normalizer = ImageNormalizer()
+metrics_registry.register('image_normalizer', image_normalizer.metrics)
+
+__all__ = ['ImageNormalizer', 'ImageProfile', 'NormalizedImage', 'image_normalizer', 'IMAGE_PROFILES',
+           'PROFILE_REFERENCE', 'PROFILE_GEN4_REFERENCE', 'PROFILE_VIDEO_START', 'PROFILE_TRAINING',
+           'normalize_image', 'encode_jpeg', 'normalize_image_bytes']
@@ -0,0 +1,248 @@
+# image_preview.py
+"""Двухфазная выдача генерации изображений: сначала превью, затем финал.
+
+Раньше пользователь смотрел на «Генерирую ваши фото...» всё время работы
+Flux. Если для модели задан IMAGE_GENERATION_MODELS[...]['preview'] и
+включён IMAGE_PREVIEW_ENABLED, ProgressivePreview получает картинку раньше:
+
+- source 'parallel' — рядом с основным запускается отдельное быстрое
+  предсказание: один кадр, меньше шагов и разрешение (build_preview_params);
+- source 'intermediate' — берётся промежуточный output основного
+  предсказания, если модель его отдаёт (через on_update prediction_tracker).
+
+Превью отправляется фото с подписью, сообщение о прогрессе
+редактируется; финальные фото его заменяют — сообщение с превью удаляется.
+Если финал готов раньше, параллельное превью отменяется в Replicate.
+Задержка до первой картинки (превью или финала) и до финала попадает в
+/metrics как 'image_preview'.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.types import BufferedInputFile, Message
+from config import IMAGE_PREVIEW_ENABLED, IMAGE_PREVIEW_DEADLINE_SECONDS
+from downloads import download_service
+from generation_config import IMAGE_GENERATION_MODELS
+from handlers.utils import safe_escape_markdown as escape_md
+from metrics import metrics_registry
+from prediction_tracker import prediction_tracker
+from replicate_client import ReplicateObject
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_SOURCE_PARALLEL = 'parallel'
+PREVIEW_SOURCE_INTERMEDIATE = 'intermediate'
+# Сколько последних генераций учитывается в перцентилях задержки
+LATENCY_WINDOW = 200
+# Минимальная сторона превью и кратность размеров для Flux
+PREVIEW_MIN_SIDE = 256
+PREVIEW_SIDE_MULTIPLE = 16
+
+
+def preview_config(model_key: str) -> Optional[Dict[str, Any]]:
+    """Настройки превью модели или None, если превью выключено."""
+    if not IMAGE_PREVIEW_ENABLED:
+        return None
+    return IMAGE_GENERATION_MODELS.get(model_key, {}).get('preview')
+
+
+def _scaled_side(side: int, scale: float) -> int:
+    scaled = max(PREVIEW_MIN_SIDE, int(side * scale))
+    return scaled - scaled % PREVIEW_SIDE_MULTIPLE
+
+
+def build_preview_params(input_params: Dict[str, Any], config: Dict[str, Any]) -> Dict[str, Any]:
+    """Параметры быстрого превью из параметров основной генерации."""
+    params = dict(input_params)
+    params['num_outputs'] = 1
+    if config.get('num_inference_steps'):
+        params['num_inference_steps'] = config['num_inference_steps']
+    scale = config.get('scale')
+    if scale and isinstance(params.get('width'), int) and isinstance(params.get('height'), int):
+        params['width'] = _scaled_side(params['width'], scale)
+        params['height'] = _scaled_side(params['height'], scale)
+    if config.get('megapixels') and 'megapixels' in params:
+        params['megapixels'] = config['megapixels']
+    params.update(config.get('input') or {})
+    return params
+
+
+def first_output_url(output: Any) -> Optional[str]:
+    """Первый URL из output предсказания (строка или список)."""
+    if isinstance(output, str):
+        return output or None
+    if isinstance(output, list):
+        for item in output:
+            if isinstance(item, str) and item:
+                return item
+    return None
+
+
+def _percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 2)
+
+
+class PreviewStats:
+    """Счётчики превью и задержки до первой картинки."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._first_pixel: Deque[float] = deque(maxlen=window)
+        self._final: Deque[float] = deque(maxlen=window)
+        self.generations = 0
+        self.requested = 0
+        self.delivered = 0
+        self.late = 0
+        self.failed = 0
+        # Перцентили считаются при записи: метрики читаются из потока Flask
+        self._summary: Dict[str, Any] = {}
+
+    def record(self, first_pixel: float, final: Optional[float]) -> None:
+        self.generations += 1
+        self._first_pixel.append(first_pixel)
+        if final is not None:
+            self._final.append(final)
+        first_pixel_values = list(self._first_pixel)
+        final_values = list(self._final)
+        self._summary = {
+            'first_pixel_p50': _percentile(first_pixel_values, 0.5),
+            'first_pixel_p95': _percentile(first_pixel_values, 0.95),
+            'final_p50': _percentile(final_values, 0.5),
+            'final_p95': _percentile(final_values, 0.95),
+        }
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики превью для /metrics."""
+        return {
+            'enabled': IMAGE_PREVIEW_ENABLED,
+            'generations': self.generations,
+            'requested': self.requested,
+            'delivered': self.delivered,
+            'late': self.late,
+            'failed': self.failed,
+            **self._summary,
+        }
+
+
+class ProgressivePreview:
+    """Превью одной генерации. Без настроек превью только учитывает задержку финала."""
+
+    def __init__(self, bot: Bot, chat_id: int, model_key: str, started_at: float,
+                 progress_message: Optional[Message] = None, stats: Optional[PreviewStats] = None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.config = preview_config(model_key)
+        self.started_at = started_at
+        self.progress_message = progress_message
+        self.stats = stats or preview_stats
+        self.first_pixel_at: Optional[float] = None
+        self.preview_message: Optional[Message] = None
+        self._task: Optional[asyncio.Task] = None
+        self._finished = False
+
+    @property
+    def source(self) -> Optional[str]:
+        return self.config.get('source', PREVIEW_SOURCE_PARALLEL) if self.config else None
+
+    def start(self, model_id: str, input_params: Dict[str, Any], owner: Optional[int] = None) -> None:
+        """Запускает параллельное превью рядом с основной генерацией."""
+        if self.source != PREVIEW_SOURCE_PARALLEL or self._task is not None:
+            return
+        self.stats.requested += 1
+        self._task = asyncio.create_task(self._run_parallel(model_id, build_preview_params(input_params, self.config),
+                                                            owner))
+
+    def on_update(self, prediction: ReplicateObject) -> None:
+        """Обработчик опроса основного предсказания для source 'intermediate'."""
+        if self.source != PREVIEW_SOURCE_INTERMEDIATE or self._task is not None or self._finished:
+            return
+        url = first_output_url(prediction.output)
+        if url:
+            self.stats.requested += 1
+            self._task = asyncio.create_task(self._deliver(url))
+
+    async def _run_parallel(self, model_id: str, params: Dict[str, Any], owner: Optional[int]) -> None:
+        try:
+            prediction = await prediction_tracker.run(model_id, params, owner=owner,
+                                                      deadline=IMAGE_PREVIEW_DEADLINE_SECONDS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats.failed += 1
+            logger.warning(f"Превью для chat_id={self.chat_id} не получено: {e}")
+            return
+        url = first_output_url(prediction.output) if prediction.status == 'succeeded' else None
+        if not url:
+            self.stats.failed += 1
+            logger.warning(f"Превью {prediction.id} завершилось со статусом {prediction.status}")
+            return
+        await self._deliver(url)
+
+    async def _deliver(self, url: str) -> None:
+        try:
+            data = (await download_service.fetch_many([url]))[0]
+            if not data or self._finished:
+                return
+            self.preview_message = await self.bot.send_photo(
+                chat_id=self.chat_id,
+                photo=BufferedInputFile(data, filename='preview.jpg'),
+                caption=escape_md("👀 Превью — финальные фото в полном качестве почти готовы", version=2),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats.failed += 1
+            logger.warning(f"Не удалось отправить превью chat_id={self.chat_id}: {e}")
+            return
+        self.first_pixel_at = time.time()
+        self.stats.delivered += 1
+        logger.info(f"Превью отправлено chat_id={self.chat_id} через {self.first_pixel_at - self.started_at:.1f} с")
+        if isinstance(self.progress_message, Message):
+            try:
+                await self.progress_message.edit_text(
+                    escape_md("👀 Превью готово! Дорабатываю детали в полном качестве...", version=2),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+            except Exception as e:
+                logger.debug(f"Не удалось обновить сообщение о прогрессе: {e}")
+
+    async def finish(self, succeeded: bool) -> None:
+        """Финал отправлен (или генерация не удалась): убирает превью и записывает задержки."""
+        if self._finished:
+            return
+        self._finished = True
+        now = time.time()
+        if self._task is not None and not self._task.done():
+            # Финал опередил превью: отменяем его, в том числе в Replicate
+            self.stats.late += 1
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self.preview_message is not None:
+            try:
+                await self.preview_message.delete()
+            except Exception as e:
+                logger.debug(f"Не удалось удалить превью chat_id={self.chat_id}: {e}")
+        if succeeded:
+            final = now - self.started_at
+            first_pixel = self.first_pixel_at - self.started_at if self.first_pixel_at else final
+            self.stats.record(first_pixel, final)
+
+
+# Глобальная статистика превью
+preview_stats = PreviewStats()
+metrics_registry.register('image_preview', preview_stats.metrics)
+
+__all__ = ['ProgressivePreview', 'PreviewStats', 'preview_stats', 'preview_config', 'build_preview_params',
+           'first_output_url', 'PREVIEW_SOURCE_PARALLEL', 'PREVIEW_SOURCE_INTERMEDIATE']
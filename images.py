@@ -1,24 +1,18 @@
 # generation/images.py
 from aiogram.exceptions import TelegramForbiddenError
-import re
-import aiohttp
-import aiofiles
 import uuid
 import os
 import logging
 import time
 import asyncio
 import random
-from typing import Optional, List, Dict, Tuple
+from typing import Callable, Optional, List, Dict, Tuple, Union
 from aiogram import Bot
-from aiogram.types import Message, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile
+from aiogram.types import Message, InputMediaPhoto, InlineKeyboardButton, InlineKeyboardMarkup, FSInputFile, BufferedInputFile
 from aiogram.fsm.context import FSMContext
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest
 import tenacity
-import replicate
-from replicate.exceptions import ReplicateError
-from deep_translator import GoogleTranslator
 from copy import deepcopy
 
 from generation_config import (
@@ -27,7 +21,7 @@ from generation_config import (
     LORA_STYLE_PRESETS, MAX_LORA_COUNT, USER_AVATAR_LORA_STRENGTH,
     CAMERA_SETUP_BASE, LUXURY_DETAILS_BASE
 )
-from config import MAX_FILE_SIZE_BYTES, REPLICATE_API_TOKEN, REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS
+from config import MAX_FILE_SIZE_BYTES, REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS, DOWNLOAD_ZERO_DISK
 from database import (
     check_database_user, update_user_credits, get_active_trainedmodel, log_generation, check_user_resources
 )
@@ -41,9 +35,19 @@ from generation.utils import (
 )
 from llama_helper import generate_assisted_prompt
 from handlers.utils import clean_admin_context, safe_escape_markdown as escape_md
-
-user_last_generation_params = {}
-user_last_generation_lock = asyncio.Lock()
+from replicate_client import get_replicate_client, ReplicateAPIError, ReplicateObject
+from prediction_tracker import prediction_tracker, PredictionAbortedError
+from replicate_limiter import ReplicateOverloadedError, is_retryable_replicate_error
+from executors import disk_executor
+from translation import translation_service
+from prompt_engine import get_prompt_engine
+from generation_jobs import generation_job_queue, QueueFullError, resolve_generation_tier
+from downloads import download_service
+from user_state import user_state_registry
+from image_normalizer import image_normalizer
+from replicate_uploads import replicate_upload_cache
+from prompt_prep import prompt_preparer, PROMPT_PREP_KEY
+from image_preview import ProgressivePreview
 
 logger = logging.getLogger(__name__)
 
@@ -55,133 +59,8 @@ USER_GENERATION_COOLDOWN = 2
 # Семафоры для различных операций
 generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
 replicate_semaphore = asyncio.Semaphore(REPLICATE_RATE_LIMIT)
-download_semaphore = asyncio.Semaphore(100)
 file_operation_semaphore = asyncio.Semaphore(200)
 
-# Кэши для оптимизации
-active_models_cache = {}
-cache_lock = asyncio.Lock()
-user_last_generation = {}
-user_generation_lock = {}
-
-# Очередь генераций для равномерного распределения нагрузки
-generation_queue = asyncio.Queue(maxsize=1000)
-queue_processor_running = False
-
-# ПРОФЕССИОНАЛЬНАЯ КОНФИГУРАЦИЯ LORA ДЛЯ ФОТОРЕАЛИЗМА
-# Изменено: Увеличена сила для skin_texture_master до 1.0 для более натуральной текстуры кожи и уменьшения пластикового блеска.
-# Изменено: Увеличена сила для anti_cgi до 1.0 для усиления борьбы с CGI-эффектами и пластиковым видом.
-# Изменено: Уменьшена сила для face_perfection_v2 до 0.75, чтобы избежать чрезмерной идеализации лица, делая его более реалистичным.
-# Изменено: Уменьшена сила для color_grading_pro до 0.7 для предотвращения чрезмерной цветокоррекции, которая может добавлять блеск.
-# Изменено: Увеличена сила для ultra_details до 0.85 для лучшей детализации без потери натуральности.
-# Изменено: Добавлена новая модель "prithivMLmods/Flux-BetterSkin-LoRA" с силой 0.95 для улучшения текстуры кожи и снижения пластикового эффекта.
-ULTRA_PROFESSIONAL_LORA_CONFIG = {
-    "photo_realism_pro": {
-        "model": "alvdansen/frosting_lane_flux",
-        "strength": 0.95,
-        "keywords": ["photorealistic", "professional photo", "camera shot", "DSLR", "фотореалистичный"],
-        "description": "Профессиональная фотосъемка",
-        "priority": 1
-    },
-    "skin_texture_master": {
-        "model": "prithivMLmods/Flux-Skin-Real",
-        "strength": 1.0,
-        "keywords": ["skin", "texture", "natural skin", "pores", "кожа", "текстура", "realistic skin"],
-        "description": "Натуральная текстура кожи без CGI эффекта",
-        "priority": 2
-    },
-    "face_perfection_v2": {
-        "model": "prithivMLmods/Canopus-LoRA-Flux-FaceRealism",
-        "strength": 0.75,
-        "keywords": ["face", "portrait", "eyes", "facial features", "лицо", "глаза"],
-        "description": "Совершенные лица и глаза",
-        "priority": 3
-    },
-    "color_grading_pro": {
-        "model": "renderartist/colorgrading",
-        "strength": 0.7,
-        "keywords": ["color grading", "cinematic", "professional lighting", "цветокоррекция", "natural colors"],
-        "description": "Профессиональная цветокоррекция",
-        "priority": 4
-    },
-    "ultra_details": {
-        "model": "prithivMLmods/Flux-Realism-FineDetailed",
-        "strength": 0.85,
-        "keywords": ["detailed", "high detail", "ultra detailed", "детализация", "fine details"],
-        "description": "Ультра детализация",
-        "priority": 5
-    },
-    "anti_cgi": {
-        "model": "https://huggingface.co/prithivMLmods/Flux-Dev-Real-Anime/resolve/main/Flux-Dev-Real-Anime.safetensors",
-        "strength": 1.0,
-        "keywords": ["real", "not cgi", "not 3d", "natural", "authentic", "реальный"],
-        "description": "Анти-CGI эффект для натуральности",
-        "priority": 6
-    },
-    "portrait_master_pro": {
-        "model": "gokaygokay/Flux-Portrait-LoRA",
-        "strength": 0.95,
-        "keywords": ["portrait", "headshot", "professional portrait", "портрет"],
-        "description": "Профессиональная портретная фотография",
-        "priority": 7
-    },
-    "better_skin": {
-        "model": "prithivMLmods/Flux-BetterSkin-LoRA",
-        "strength": 0.95,
-        "keywords": ["skin", "natural skin", "realistic skin"],
-        "description": "Улучшенная натуральная кожа без блеска",
-        "priority": 8
-    }
-}
-
-# ПРЕСЕТЫ ДЛЯ МАКСИМАЛЬНОГО ФОТОРЕАЛИЗМА
-# Изменено: Для всех пресетов увеличено num_inference_steps до 60 для лучшей детализации и снижения артефактов.
-# Изменено: Уменьшено guidance_scale до 2.5-3.0 для более естественной генерации без переусиления.
-# Изменено: Добавлены LoRA "better_skin" и "anti_cgi" во все пресеты для усиления натуральности кожи.
-# Изменено: Добавлены дополнительные prompt_additions для борьбы с пластиковым блеском: "matte skin finish, no shine, natural skin reflectance".
-# Изменено: Добавлены элементы для повышения сходства с реальным человеком: "imperfect skin, natural variations in skin tone".
-ULTRA_PHOTOREALISTIC_PRESETS = {
-    "natural_portrait": {
-        "loras": ["skin_texture_master", "photo_realism_pro", "face_perfection_v2", "anti_cgi", "better_skin"],
-        "guidance_scale": 2.5,
-        "num_inference_steps": 50,
-        "prompt_additions": (
-            "natural skin texture with visible pores, realistic skin tone, "
-            "authentic human features, real person not CGI, "
-            "soft natural lighting, candid expression, "
-            "professional photography, DSLR quality, unretouched natural beauty, "
-            "matte skin finish, no shine, natural skin reflectance, "
-            "imperfect skin, natural variations in skin tone"
-        )
-    },
-    "studio_perfection": {
-        "loras": ["photo_realism_pro", "color_grading_pro", "face_perfection_v2", "ultra_details", "better_skin", "anti_cgi"],
-        "guidance_scale": 3.0,
-        "num_inference_steps": 50,
-        "prompt_additions": (
-            "professional studio photography, color corrected, natural skin tones, "
-            "high-end commercial photography, realistic skin texture, "
-            "professional lighting setup, authentic expression, "
-            "magazine quality, shot on medium format camera, "
-            "matte skin finish, no shine, natural skin reflectance, "
-            "imperfect skin, natural variations in skin tone"
-        )
-    },
-    "lifestyle_natural": {
-        "loras": ["skin_texture_master", "anti_cgi", "photo_realism_pro", "portrait_master_pro", "better_skin"],
-        "guidance_scale": 2.5,
-        "num_inference_steps": 50,
-        "prompt_additions": (
-            "lifestyle photography, natural candid moment, "
-            "real skin texture, authentic expression, natural lighting, "
-            "photojournalism style, unposed, genuine emotion, "
-            "shot with natural daylight, minimal retouching, "
-            "matte skin finish, no shine, natural skin reflectance, "
-            "imperfect skin, natural variations in skin tone"
-        )
-    }
-}
-
 # КРИТИЧЕСКИ УЛУЧШЕННЫЙ NEGATIVE PROMPT
 # Изменено: Добавлены дополнительные элементы против пластикового блеска: "plastic shine, glossy skin, reflective skin, shiny pores, oily reflectance".
 # Изменено: Усилены анти-CGI элементы: "cgi skin, rendered skin, artificial reflectance, fake shine".
@@ -217,93 +96,35 @@ async def process_prompt_async(original_prompt: str, model_key: str, generation_
                              user_input: str = None, user_data: Dict = None,
                              use_new_flux: bool = False) -> str:
     """Обрабатывает промпт с учетом пользовательского ввода и переводит его на английский."""
-    loop = asyncio.get_event_loop()
+    logger.info(f"Обработка промпта: original_prompt='{original_prompt[:50]}...', user_input='{user_input[:50] if user_input else None}...', "
+                f"generation_type={generation_type}, trigger_word={trigger_word}, selected_gender={selected_gender}")
     
-    def process_sync():
-        logger.info(f"Обработка промпта: original_prompt='{original_prompt[:50]}...', user_input='{user_input[:50] if user_input else None}...', "
-                    f"generation_type={generation_type}, trigger_word={trigger_word}, selected_gender={selected_gender}")
-        
-        # Если есть пользовательский ввод и это кастомный промпт, используем его
-        if user_data.get('came_from_custom_prompt') and user_input:
-            base_prompt = user_input
-            logger.debug(f"Используется пользовательский промпт: {base_prompt[:50]}...")
-        else:
-            base_prompt = original_prompt
-            logger.debug(f"Используется исходный промпт: {base_prompt[:50]}...")
+    # Если есть пользовательский ввод и это кастомный промпт, используем его
+    if user_data.get('came_from_custom_prompt') and user_input:
+        base_prompt = user_input
+        logger.debug(f"Используется пользовательский промпт: {base_prompt[:50]}...")
+    else:
+        base_prompt = original_prompt
+        logger.debug(f"Используется исходный промпт: {base_prompt[:50]}...")
 
-        if generation_type == 'photo_to_photo':
-            if use_new_flux and trigger_word:
-                base = f"{trigger_word}, copy style from reference image"
-                if base_prompt and base_prompt != "copy reference style":
-                    base += f", {base_prompt}"
-                return base + ", natural skin texture, realistic, photographic quality"
-            elif trigger_word:
-                return f"{trigger_word}, copy style from reference, natural realistic photo"
-            else:
-                return "copy reference image style, natural realistic photo, authentic"
+    # Переводим только текст пользователя/стиля: усилители ниже уже на английском
+    base_prompt = await translation_service.translate(base_prompt)
 
-        parts = []
-        if trigger_word:
-            parts.append(trigger_word)
-        photorealistic_enhancers = [
-            "professional photography",
-            "photorealistic", 
-            "real person",
-            "natural skin texture with visible pores",
-            "realistic skin tone",
-            "authentic human features",
-            "not CGI",
-            "not 3D render",
-            "DSLR camera quality",
-            "natural expression",
-            "genuine emotion",
-            "sharp focus",
-            "high resolution"
-        ]
-        # Добавляем усилители фотореализма только если не кастомный промпт
-        if not user_data.get('came_from_custom_prompt'):
-            parts.extend(photorealistic_enhancers)
-        if selected_gender:
-            parts.append(selected_gender)
-        parts.append(base_prompt)
-        anti_cgi_details = (
-            "shot with professional DSLR camera, natural daylight, "
-            "real human skin with natural imperfections, "
-            "unretouched authentic photography, photojournalism style, "
-            "natural hair texture, realistic eye moisture, "
-            "genuine facial expression, candid moment, "
-            "no artificial enhancement, no beauty filters, "
-            "raw unprocessed photo quality"
-        )
-        # Добавляем anti_cgi_details только если не кастомный промпт
-        if not user_data.get('came_from_custom_prompt'):
-            parts.append(anti_cgi_details)
-        
-        full_prompt = ", ".join(parts)
-        full_prompt = re.sub(r'\s+', ' ', full_prompt).strip()
-        
-        # Проверяем наличие русского текста и переводим
-        if re.search('[а-яА-Я]', full_prompt):
-            try:
-                translator = GoogleTranslator(source='auto', target='en')
-                translated_prompt = translator.translate(full_prompt[:4500])
-                if translated_prompt:
-                    full_prompt = translated_prompt
-                    logger.info(f"Промпт переведен на английский: {full_prompt[:50]}...")
-                else:
-                    logger.warning(f"Перевод не удался, используется исходный промпт: {full_prompt[:50]}...")
-            except Exception as e:
-                logger.error(f"Ошибка перевода промпта: {e}")
-                logger.info(f"Используется исходный промпт без перевода: {full_prompt[:50]}...")
-        
-        # Ограничиваем длину промпта
-        if len(full_prompt) > 4000:
-            full_prompt = full_prompt[:4000].rsplit(', ', 1)[0]
-            logger.warning(f"Промпт обрезан до 4000 символов: {full_prompt[:50]}...")
-        
-        return full_prompt
-    
-    return await loop.run_in_executor(None, process_sync)
+    if generation_type == 'photo_to_photo':
+        if use_new_flux and trigger_word:
+            base = f"{trigger_word}, copy style from reference image"
+            if base_prompt and base_prompt != "copy reference style":
+                base += f", {base_prompt}"
+            return base + ", natural skin texture, realistic, photographic quality"
+        elif trigger_word:
+            return f"{trigger_word}, copy style from reference, natural realistic photo"
+        else:
+            return "copy reference image style, natural realistic photo, authentic"
+
+    return get_prompt_engine().build_prompt(
+        base_prompt, trigger_word=trigger_word, selected_gender=selected_gender,
+        custom=bool(user_data.get('came_from_custom_prompt'))
+    )
 
 async def prepare_model_params(use_new_flux: bool, model_key: str, generation_type: str,
                              prompt: str, num_outputs: int, aspect_ratio: str,
@@ -366,21 +187,15 @@ async def prepare_model_params(use_new_flux: bool, model_key: str, generation_ty
             "output_quality": 100,
             "num_inference_steps": 50
         }
-        prompt_lower = prompt.lower()
+        engine = get_prompt_engine()
+        preset = None
         # Выбираем пресет только если НЕ кастомный промпт
         if not user_data.get('came_from_custom_prompt'):
-            if any(word in prompt_lower for word in ["natural", "candid", "authentic", "lifestyle"]):
-                selected_preset = "lifestyle_natural"
-            elif any(word in prompt_lower for word in ["studio", "professional", "commercial"]):
-                selected_preset = "studio_perfection"
-            else:
-                selected_preset = "natural_portrait"
-            if selected_preset in ULTRA_PHOTOREALISTIC_PRESETS:
-                preset = ULTRA_PHOTOREALISTIC_PRESETS[selected_preset]
-                params["guidance_scale"] = preset["guidance_scale"]
-                params["num_inference_steps"] = preset["num_inference_steps"]
-                params["prompt"] = f"{prompt}, {preset['prompt_additions']}"
-                logger.info(f"Применен пресет {selected_preset} с добавками: {preset['prompt_additions'][:50]}...")
+            preset = engine.select_preset(prompt)
+            params["guidance_scale"] = preset.guidance_scale
+            params["num_inference_steps"] = preset.num_inference_steps
+            params["prompt"] = prompt + preset.prompt_suffix
+            logger.info(f"Применен пресет {preset.name} с добавками: {preset.prompt_suffix[2:52]}...")
         else:
             logger.info(f"Кастомный промпт, пресет не применяется: {prompt[:50]}...")
         
@@ -401,25 +216,21 @@ async def prepare_model_params(use_new_flux: bool, model_key: str, generation_ty
                     logger.info(f"Добавлен пользовательский LoRA с силой 0.9")
         
         # Добавляем профессиональные LoRA только если НЕ кастомный промпт
-        if not user_data.get('came_from_custom_prompt'):
-            preset_loras = ULTRA_PHOTOREALISTIC_PRESETS.get(selected_preset, {}).get("loras", [])
-            for lora_name in preset_loras:
-                if lora_index <= MAX_LORA_COUNT and lora_name in ULTRA_PROFESSIONAL_LORA_CONFIG:
-                    lora_cfg = ULTRA_PROFESSIONAL_LORA_CONFIG[lora_name]
-                    params[f"hf_lora_{lora_index}"] = lora_cfg["model"]
-                    params[f"lora_scale_{lora_index}"] = lora_cfg["strength"]
-                    logger.info(f"Добавлен профессиональный LoRA {lora_name} на позицию {lora_index}: strength={lora_cfg['strength']}")
-                    lora_index += 1
+        anti_cgi_added = False
+        if preset:
+            for slot in preset.loras:
+                if lora_index > MAX_LORA_COUNT:
+                    break
+                params[f"hf_lora_{lora_index}"] = slot.model
+                params[f"lora_scale_{lora_index}"] = slot.strength
+                anti_cgi_added = anti_cgi_added or slot.model == engine.anti_cgi.model
+                logger.info(f"Добавлен профессиональный LoRA {slot.name} на позицию {lora_index}: strength={slot.strength}")
+                lora_index += 1
         
         # Всегда добавляем anti_cgi LoRA, если есть место
-        anti_cgi_added = any(
-            "Flux-Dev-Real-Anime" in params.get(f"hf_lora_{i}", "") 
-            for i in range(1, lora_index)
-        )
         if not anti_cgi_added and lora_index <= MAX_LORA_COUNT:
-            anti_cgi_cfg = ULTRA_PROFESSIONAL_LORA_CONFIG["anti_cgi"]
-            params[f"hf_lora_{lora_index}"] = anti_cgi_cfg["model"]
-            params[f"lora_scale_{lora_index}"] = anti_cgi_cfg["strength"]
+            params[f"hf_lora_{lora_index}"] = engine.anti_cgi.model
+            params[f"lora_scale_{lora_index}"] = engine.anti_cgi.strength
             logger.info(f"Добавлен Anti-CGI LoRA на позицию {lora_index}")
         
         params["negative_prompt"] = ULTRA_NEGATIVE_PROMPT
@@ -434,7 +245,7 @@ async def prepare_model_params(use_new_flux: bool, model_key: str, generation_ty
             params["strength"] = 0.75
         
         logger.info(f"=== ULTRA REALISTIC PARAMETERS ===")
-        logger.info(f"Preset: {selected_preset if not user_data.get('came_from_custom_prompt') else 'none (custom prompt)'}")
+        logger.info(f"Preset: {preset.name if preset else 'none (custom prompt)'}")
         logger.info(f"Guidance Scale: {params['guidance_scale']}")
         logger.info(f"Inference Steps: {params['num_inference_steps']}")
         logger.info(f"Total Professional LoRAs: {lora_index - 1}")
@@ -456,107 +267,56 @@ async def prepare_model_params(use_new_flux: bool, model_key: str, generation_ty
     logger.info(f"Возвращены параметры: {params}")
     return params
 
-async def start_queue_processor():
-    """Запускает обработчик очереди генераций"""
-    global queue_processor_running
-    if not queue_processor_running:
-        queue_processor_running = True
-        for i in range(20):
-            asyncio.create_task(process_generation_queue(i))
-        logger.info("Запущены обработчики очереди генераций")
-
-async def process_generation_queue(worker_id: int):
-    """Обработчик очереди генераций"""
-    while True:
-        try:
-            task = await generation_queue.get()
-            if task is None:
-                break
-            message, state, num_outputs = task
-            try:
-                await _generate_image_internal(message, state, num_outputs)
-            except Exception as e:
-                logger.error(f"Worker {worker_id}: Ошибка обработки генерации: {e}", exc_info=True)
-            finally:
-                generation_queue.task_done()
-        except Exception as e:
-            logger.error(f"Worker {worker_id}: Критическая ошибка в обработчике очереди: {e}", exc_info=True)
-            await asyncio.sleep(1)
-
-async def get_user_generation_lock(user_id: int):
-    """Получает или создает блокировку для пользователя"""
-    if user_id not in user_generation_lock:
-        user_generation_lock[user_id] = asyncio.Lock()
-    return user_generation_lock[user_id]
-
 async def check_user_cooldown(user_id: int) -> bool:
     """Проверяет, может ли пользователь генерировать (cooldown)"""
-    last_time = user_last_generation.get(user_id, 0)
-    current_time = time.time()
-    if current_time - last_time < USER_GENERATION_COOLDOWN:
-        return False
-    user_last_generation[user_id] = current_time
-    return True
+    return user_state_registry.check_cooldown(user_id, USER_GENERATION_COOLDOWN)
 
 async def get_active_model_cached(user_id: int):
-    
-    async with cache_lock:
-        if user_id in active_models_cache:
-            cache_time, model_data = active_models_cache[user_id]
-            if time.time() - cache_time < 300:
-                return model_data
+    """Активная модель пользователя с кэшем в user_state_registry (ACTIVE_MODEL_CACHE_TTL)."""
+    found, model_data = user_state_registry.get_active_model(user_id)
+    if found:
+        return model_data
     model_data = await get_active_trainedmodel(user_id)
-    async with cache_lock:
-        active_models_cache[user_id] = (time.time(), model_data)
-        if len(active_models_cache) > 1000:
-            oldest_users = sorted(active_models_cache.items(), key=lambda x: x[1][0])[:100]
-            for old_user_id, _ in oldest_users:
-                del active_models_cache[old_user_id]
+    user_state_registry.set_active_model(user_id, model_data)
     return model_data
 
-async def download_image_async(session: aiohttp.ClientSession, url: str, filepath: str, retry_count: int = 3) -> Optional[str]:
-    
-    async with download_semaphore:
-        for attempt in range(retry_count):
-            try:
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.get(url, timeout=timeout) as response:
-                    if response.status == 200:
-                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                        async with aiofiles.open(filepath, 'wb') as f:
-                            async for chunk in response.content.iter_chunked(8192):
-                                await f.write(chunk)
-                        logger.debug(f"Успешно загружен файл: {filepath}")
-                        return filepath
-                    else:
-                        logger.warning(f"HTTP {response.status} при загрузке {url}")
-            except asyncio.TimeoutError:
-                logger.warning(f"Таймаут загрузки {url}, попытка {attempt + 1}/{retry_count}")
-            except Exception as e:
-                logger.error(f"Ошибка загрузки {url}, попытка {attempt + 1}/{retry_count}: {e}")
-            if attempt < retry_count - 1:
-                await asyncio.sleep(1 * (attempt + 1))
-        return None
+def resolve_avatar_model(model_id: str, model_version: Optional[str]) -> Tuple[str, bool]:
+    """Модель Replicate для аватара: (ссылка для запуска, используется ли Fast Flux)."""
+    if is_new_fast_flux_model(model_id, model_version):
+        if '/' not in model_id:
+            model_id = f"{REPLICATE_USERNAME_OR_ORG_NAME}/{model_id}"
+        return (f"{model_id}:{model_version}" if model_version else model_id), True
+    return MULTI_LORA_MODEL, False
 
 async def download_images_parallel(urls: List[str], user_id: int) -> List[str]:
-   
+    """Загружает изображения в generated/ через общую сессию и возвращает пути."""
+    tasks = [
+        download_service.download_to_file(url, f"generated/{user_id}_{uuid.uuid4().hex[:8]}_{i}.png")
+        for i, url in enumerate(urls)
+    ]
+    results = await asyncio.gather(*tasks, return_exceptions=True)
     paths = []
-    tasks = []
-    connector = aiohttp.TCPConnector(limit=20, limit_per_host=10)
-    timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        for i, url in enumerate(urls):
-            filepath = f"generated/{user_id}_{uuid.uuid4().hex[:8]}_{i}.png"
-            task = download_image_async(session, url, filepath)
-            tasks.append(task)
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for result in results:
-            if isinstance(result, str) and result:
-                paths.append(result)
-            elif isinstance(result, Exception):
-                logger.error(f"Ошибка загрузки: {result}")
+    for result in results:
+        if isinstance(result, str) and result:
+            paths.append(result)
+        elif isinstance(result, Exception):
+            logger.error(f"Ошибка загрузки: {result}")
     return paths
 
+async def download_images_to_memory(urls: List[str], user_id: int) -> List[BufferedInputFile]:
+    """Загружает изображения в память для отправки в Telegram без записи на диск."""
+    results = await download_service.fetch_many(urls)
+    return [
+        BufferedInputFile(data, filename=f"{user_id}_{i}.png")
+        for i, data in enumerate(results) if data
+    ]
+
+async def download_generated_images(urls: List[str], user_id: int) -> List[Union[str, BufferedInputFile]]:
+    """Загружает результаты генерации: в память при DOWNLOAD_ZERO_DISK, иначе в generated/."""
+    if DOWNLOAD_ZERO_DISK:
+        return await download_images_to_memory(urls, user_id)
+    return await download_images_parallel(urls, user_id)
+
 async def generate_image(message: Message, state: FSMContext, num_outputs: int = 2, user_id: int = None) -> None:
    
     user_data = await state.get_data()
@@ -676,7 +436,6 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
             )
             return
 
-    await start_queue_processor()
     if not await check_user_cooldown(message_recipient):
         await send_message_with_fallback(
             bot, message_recipient,
@@ -698,7 +457,7 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
         if not await check_user_resources(bot, target_user_id, required_photos=required_photos):
             return
 
-    if generation_queue.full():
+    if generation_job_queue.depth >= generation_job_queue.max_depth:
         await send_message_with_fallback(
             bot, message_recipient,
             "😔 Сервер перегружен! Попробуй через минуту.",
@@ -731,7 +490,8 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
             'came_from_custom_prompt': user_data.get('came_from_custom_prompt', False),
             'use_llama_prompt': user_data.get('use_llama_prompt', False),
             'last_generation_params': user_data.get('last_generation_params'),
-            'active_avatar_name': user_data.get('active_avatar_name')
+            'active_avatar_name': user_data.get('active_avatar_name'),
+            PROMPT_PREP_KEY: user_data.get(PROMPT_PREP_KEY)
         })
         logger.info(f"Сохраненные данные для очереди: {list(generation_data.keys())}")
         logger.info(f"generation_type: '{generation_data['generation_type']}'")
@@ -751,8 +511,14 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
             return
         await state.update_data(generation_data)
         logger.info(f"Перед добавлением в очередь: user_data={user_data}")
-        await generation_queue.put((message, state, num_outputs))
-        queue_size = generation_queue.qsize()
+        tier = await resolve_generation_tier(target_user_id, is_admin_generation)
+        job_id, queue_size = await generation_job_queue.enqueue(
+            user_id=target_user_id,
+            requester_id=state.key.user_id,
+            chat_id=state.key.chat_id,
+            tier=tier,
+            payload={'generation_data': generation_data, 'num_outputs': num_outputs}
+        )
         if queue_size > 10:
             if is_admin_generation:
                 message_text = f"📊 Запрос генерации для пользователя {target_user_id} добавлен в очередь (позиция: ~{queue_size})."
@@ -763,9 +529,9 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
                 message_text,
                 parse_mode=ParseMode.MARKDOWN_V2
             )
-        logger.info(f"✅ Генерация добавлена в очередь: recipient={message_recipient}, target={target_user_id}, is_admin={is_admin_generation}, queue_size={queue_size}")
-    except asyncio.QueueFull:
-        logger.error(f"Очередь переполнена для user_id={message_recipient}")
+        logger.info(f"✅ Генерация {job_id} добавлена в очередь: recipient={message_recipient}, target={target_user_id}, is_admin={is_admin_generation}, tier={tier}, queue_size={queue_size}")
+    except QueueFullError as e:
+        logger.error(f"Очередь переполнена для user_id={message_recipient}: {e}")
         await send_message_with_fallback(
             bot, message_recipient,
             "😔 Не удалось добавить в очередь. Попробуй ещё раз!",
@@ -781,19 +547,23 @@ async def generate_image(message: Message, state: FSMContext, num_outputs: int =
             parse_mode=ParseMode.MARKDOWN_V2
         )
 
-async def _generate_image_internal(message: Message, state: FSMContext, num_outputs: int = 2) -> None:
+async def _generate_image_internal(bot: Bot, state: FSMContext, num_outputs: int = 2, requester_id: Optional[int] = None,
+                                   job_id: Optional[int] = None) -> None:
     """
     Внутренняя функция генерации изображения с ультра-реалистичными параметрами.
+    Вызывается воркером generation_jobs; requester_id — пользователь, запустивший генерацию.
+    job_id — задание очереди: в нём записываются списание, возврат и доставка, чтобы
+    прерванное перезапуском задание не списало фото повторно.
     """
     from handlers.generation import handle_admin_generation_result
 
     async with asyncio.Lock():
         user_data = await state.get_data()
-        message_recipient = user_data.get('message_recipient', message.from_user.id)
-        target_user_id = user_data.get('generation_target_user', message.from_user.id)
-        admin_user_id = user_data.get('original_admin_user', message.from_user.id)
+        requester_id = requester_id or state.key.user_id
+        message_recipient = user_data.get('message_recipient', requester_id)
+        target_user_id = user_data.get('generation_target_user', requester_id)
+        admin_user_id = user_data.get('original_admin_user', requester_id)
         is_admin_generation = user_data.get('is_admin_generation', False)
-        bot = message.bot
         bot_id = (await bot.get_me()).id
 
         # Инициализируем preserved_data пустым словарем
@@ -809,9 +579,7 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
         logger.info(f"До обработки: user_data={user_data}")
 
         start_time = time.time()
-        user_lock = await get_user_generation_lock(target_user_id)
-
-        async with user_lock:
+        async with user_state_registry.generation_lock(target_user_id):
             async with generation_semaphore:
                 logger.info(f"🎯 УЛЬТРА-РЕАЛИСТИЧНАЯ ГЕНЕРАЦИЯ для user_id={target_user_id}" + 
                            (f" (админ: {admin_user_id})" if is_admin_generation else ""))
@@ -879,6 +647,8 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                 if not is_admin_generation:
                     logger.info(f"Списание ресурсов для user_id={target_user_id}, требуется фото: {required_photos}")
                     await update_user_credits(target_user_id, "decrement_photo", amount=required_photos)
+                    if job_id is not None:
+                        await generation_job_queue.record_charge(job_id, required_photos)
                     logger.info(f"Списано {required_photos} фото для user_id={target_user_id}")
                 
                 selected_gender = user_data.get('selected_gender')
@@ -946,23 +716,10 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                     logger.info(f"Active avatar for user {target_user_id}: {avatar_name} (ID: {avatar_id})")
                     logger.info(f"Avatar model_id: {model_id}")
                     logger.info(f"Avatar model_version: {model_version}")
-                    is_fast_flux = is_new_fast_flux_model(model_id, model_version)
-                    if is_fast_flux:
-                        use_new_flux_method = True
-                        if model_version:
-                            if '/' not in model_id:
-                                replicate_model_id_to_run = f"{REPLICATE_USERNAME_OR_ORG_NAME}/{model_id}:{model_version}"
-                            else:
-                                replicate_model_id_to_run = f"{model_id}:{model_version}"
-                        else:
-                            if '/' not in model_id:
-                                replicate_model_id_to_run = f"{REPLICATE_USERNAME_OR_ORG_NAME}/{model_id}"
-                            else:
-                                replicate_model_id_to_run = model_id
+                    replicate_model_id_to_run, use_new_flux_method = resolve_avatar_model(model_id, model_version)
+                    if use_new_flux_method:
                         logger.info(f"Using Fast Flux model: {replicate_model_id_to_run}")
                     else:
-                        use_new_flux_method = False
-                        replicate_model_id_to_run = MULTI_LORA_MODEL
                         logger.info(f"Using Multi-LoRA model for old avatar: {replicate_model_id_to_run}")
                         await state.update_data(old_model_id=model_id, old_model_version=model_version)
                 
@@ -980,13 +737,24 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                         parse_mode=ParseMode.MARKDOWN_V2
                     )
                 
+                preview = None
+                delivered = False
                 try:
                     user_data = await state.get_data()
-                    processed_prompt = await process_prompt_async(
-                        prompt, model_key, generation_type,
-                        trigger_word, selected_gender, user_input_for_helper, user_data,
-                        use_new_flux=use_new_flux_method
+                    # Промпт мог быть подготовлен, пока пользователь выбирал формат (prompt_prep)
+                    prepared = await prompt_preparer.take(
+                        target_user_id, user_data,
+                        trained_model_data if generation_type in ['with_avatar', 'photo_to_photo'] else None
                     )
+                    if prepared is not None and prepared['replicate_model_id'] == replicate_model_id_to_run:
+                        processed_prompt = prepared['processed_prompt']
+                        logger.info(f"Используется заранее подготовленный промпт для user_id={target_user_id}")
+                    else:
+                        processed_prompt = await process_prompt_async(
+                            prompt, model_key, generation_type,
+                            trigger_word, selected_gender, user_input_for_helper, user_data,
+                            use_new_flux=use_new_flux_method
+                        )
                     width, height = ASPECT_RATIOS.get(aspect_ratio_key, (1440, 1440))
                     input_params = await prepare_model_params(
                         use_new_flux_method, model_key, generation_type,
@@ -1039,8 +807,13 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                             parse_mode=ParseMode.MARKDOWN_V2
                         )
                     
-                    async with replicate_semaphore:
-                        image_urls = await run_replicate_model_async(replicate_model_id_to_run, input_params)
+                    # Превью (если настроено для модели) приходит раньше финала
+                    preview = ProgressivePreview(bot, message_recipient, model_key, start_time, generation_message)
+                    preview.start(replicate_model_id_to_run, input_params, owner=target_user_id)
+                    # Одновременные запуски модели ограничивает адаптивный replicate_limiter
+                    image_urls = await run_replicate_model_async(
+                        replicate_model_id_to_run, input_params, owner=target_user_id, on_update=preview.on_update
+                    )
                     
                     if not image_urls:
                         logger.error("Пустой результат от Replicate")
@@ -1072,7 +845,7 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                             parse_mode=ParseMode.MARKDOWN_V2
                         )
                     
-                    image_paths = await download_images_parallel(image_urls, target_user_id)
+                    image_paths = await download_generated_images(image_urls, target_user_id)
                     if not image_paths:
                         logger.error("Не удалось загрузить изображения")
                         if isinstance(generation_message, Message):
@@ -1089,7 +862,7 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                                 parse_mode=ParseMode.MARKDOWN_V2
                             )
                         if not is_admin_generation:
-                            await update_user_credits(target_user_id, "increment_photo", amount=required_photos)
+                            await refund_job_photos(target_user_id, required_photos, job_id)
                             logger.info(f"Фото возвращены на баланс для user_id={target_user_id}")
                         await reset_generation_context(state, generation_type)
                         return
@@ -1135,14 +908,29 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                             bot, message_recipient, target_user_id, image_paths, duration, aspect_ratio_key,
                             generation_type, model_key, state, admin_user_id if is_admin_generation else None
                         )
+                    delivered = True
+                    if job_id is not None:
+                        await generation_job_queue.mark_delivered(job_id)
                     
                     logger.info(f"🎯 PixelPie_AI генерация завершена для user_id={target_user_id}: "
                                f"{len(image_paths)} фото за {duration:.1f} сек")
-                    asyncio.create_task(cleanup_files(image_paths + [user_data.get('photo_path')]))
+                    asyncio.create_task(cleanup_files(
+                        [path for path in image_paths if isinstance(path, str)] + [user_data.get('photo_path')]
+                    ))
                     
                 except Exception as e:
-                    logger.error(f"Ошибка генерации для user_id={target_user_id}: {e}", exc_info=True)
-                    error_message = escape_md("❌ Ошибка! Печеньки возвращены на баланс.", version=2)
+                    if isinstance(e, ReplicateOverloadedError):
+                        logger.warning(f"Генерация для user_id={target_user_id} не запущена: {e}")
+                        error_message = escape_md(
+                            f"⏳ Сервис генерации сейчас перегружен. Попробуй через "
+                            f"{max(1, round(e.retry_after / 60))} мин — печеньки возвращены на баланс.", version=2
+                        )
+                    elif isinstance(e, PredictionAbortedError):
+                        logger.info(f"Генерация для user_id={target_user_id} отменена пользователем: {e}")
+                        error_message = escape_md("🛑 Генерация отменена. Печеньки возвращены на баланс.", version=2)
+                    else:
+                        logger.error(f"Ошибка генерации для user_id={target_user_id}: {e}", exc_info=True)
+                        error_message = escape_md("❌ Ошибка! Печеньки возвращены на баланс.", version=2)
                     if isinstance(generation_message, Message):
                         try:
                             await generation_message.edit_text(
@@ -1165,10 +953,13 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                             parse_mode=ParseMode.MARKDOWN_V2
                         )
                     if not is_admin_generation:
-                        await update_user_credits(target_user_id, "increment_photo", amount=required_photos)
+                        await refund_job_photos(target_user_id, required_photos, job_id)
                         logger.info(f"Фото возвращены после ошибки для user_id={target_user_id}")
                     await reset_generation_context(state, generation_type)
                 finally:
+                    # Финал заменяет превью; задержки до первой картинки уходят в метрики
+                    if preview is not None:
+                        await preview.finish(delivered)
                     # Сохраняем параметры после генерации, если они определены
                     if preserved_data:
                         await state.update_data(**preserved_data)
@@ -1177,8 +968,18 @@ async def _generate_image_internal(message: Message, state: FSMContext, num_outp
                     user_data = await state.get_data()
                     logger.info(f"После обработки: user_data={user_data}")
 
+async def refund_job_photos(user_id: int, amount: int, job_id: Optional[int] = None) -> None:
+    """Возвращает списанные фото и снимает отметку о списании с задания очереди."""
+    await update_user_credits(user_id, "increment_photo", amount=amount)
+    if job_id is not None:
+        await generation_job_queue.record_charge(job_id, 0)
+
+def _as_input_file(image: Union[str, BufferedInputFile]) -> Union[FSInputFile, BufferedInputFile]:
+    """Путь к файлу оборачивает в FSInputFile, буфер из памяти отдаёт как есть."""
+    return FSInputFile(path=image) if isinstance(image, str) else image
+
 async def send_generation_results(bot: Bot, message_recipient: int, target_user_id: int, 
-                                image_paths: List[str], duration: float, aspect_ratio: str, 
+                                image_paths: List[Union[str, BufferedInputFile]], duration: float, aspect_ratio: str, 
                                 generation_type: str, model_key: str, state: FSMContext, 
                                 admin_user_id: int = None) -> None:
     
@@ -1189,7 +990,7 @@ async def send_generation_results(bot: Bot, message_recipient: int, target_user_
     try:
         if len(image_paths) == 1:
             caption = escape_md(f"📸 Ваша ИИ генерация фотографии готова! Время: {duration:.1f} сек", version=2)
-            photo_file = FSInputFile(path=image_paths[0])
+            photo_file = _as_input_file(image_paths[0])
             await send_photo_with_retry(
                 bot, message_recipient, photo_file, caption=caption,
                 reply_markup=await create_rating_keyboard(generation_type, model_key, message_recipient, bot),
@@ -1212,7 +1013,7 @@ async def send_generation_results(bot: Bot, message_recipient: int, target_user_
             )
             media = []
             for i, path in enumerate(image_paths):
-                photo_file = FSInputFile(path=path)
+                photo_file = _as_input_file(path)
                 if i == 0:
                     media.append(InputMediaPhoto(media=photo_file, caption=caption, parse_mode=ParseMode.MARKDOWN_V2))
                 else:
@@ -1253,22 +1054,27 @@ async def cleanup_files(filepaths: List[Optional[str]]):
         if filepath and os.path.exists(filepath):
             try:
                 async with file_operation_semaphore:
-                    await asyncio.get_event_loop().run_in_executor(None, os.remove, filepath)
+                    await disk_executor.run(os.remove, filepath)
                 logger.debug(f"Удален файл: {filepath}")
             except Exception as e:
                 logger.error(f"Ошибка удаления {filepath}: {e}")
 
-async def run_replicate_model_async(model_id: str, input_params: dict) -> List[str]:
-    """Асинхронный запуск модели Replicate с проверкой параметров."""
+async def run_replicate_model_async(model_id: str, input_params: dict, owner: Optional[int] = None,
+                                    on_update: Optional[Callable[[ReplicateObject], None]] = None) -> List[str]:
+    """Асинхронный запуск модели Replicate с проверкой параметров.
+
+    Ожидание идёт через prediction_tracker: по сроку или по /cancel (prediction_tracker.abort(owner))
+    предсказание отменяется в Replicate и не повторяется. Одновременные запуски
+    модели ограничивает replicate_limiter; 4xx и отказ предохранителя тоже не
+    повторяются. on_update получает промежуточные состояния (превью из промежуточного output).
+    """
     @tenacity.retry(
         wait=tenacity.wait_exponential(multiplier=1, min=2, max=10),
         stop=tenacity.stop_after_attempt(3),
-        retry=tenacity.retry_if_exception_type(ReplicateError),
+        retry=tenacity.retry_if_exception(is_retryable_replicate_error),
         reraise=True
     )
     async def _run():
-        loop = asyncio.get_event_loop()
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
         logger.info(f"🚀 Запуск ультра-реалистичной модели {model_id}")
         logger.debug(f"📸 Параметры: {input_params}")
         
@@ -1281,12 +1087,17 @@ async def run_replicate_model_async(model_id: str, input_params: dict) -> List[s
                 logger.error(f"Обнаружен несереализуемый параметр {key}: тип {type(value)}")
                 raise ValueError(f"Параметр {key} имеет неподдерживаемый тип: {type(value)}")
         
-        output = await loop.run_in_executor(
-            None,
-            lambda: replicate_client.run(model_id, input=input_params)
-        )
+        prediction = await prediction_tracker.run(model_id, input_params, owner=owner, on_update=on_update)
+        if prediction.status != 'succeeded':
+            raise ReplicateAPIError(
+                f"Предсказание {prediction.id} завершилось со статусом {prediction.status}: {prediction.error}",
+                detail=str(prediction.error)
+            )
+        output = prediction.output
         image_urls = []
-        if isinstance(output, list):
+        if isinstance(output, str):
+            image_urls.append(output)
+        elif isinstance(output, list):
             for item in output:
                 if isinstance(item, str):
                     image_urls.append(item)
@@ -1297,26 +1108,34 @@ async def run_replicate_model_async(model_id: str, input_params: dict) -> List[s
     
     return await _run()
 
-async def upload_image_to_replicate(photo_path: str) -> str:
-    
-    async with replicate_semaphore:
-        loop = asyncio.get_event_loop()
-        if not os.path.exists(photo_path):
-            raise FileNotFoundError(f"Файл не найден: {photo_path}")
+async def upload_image_to_replicate(photo_path: str, profile: Optional[str] = None) -> str:
+    """Загружает файл в Replicate Files.
+
+    С profile изображение сначала приводится к разрешению модели (image_normalizer),
+    загружается уменьшенный JPEG без метаданных, а URL переиспользуется для
+    того же содержимого, пока не истёк (replicate_upload_cache).
+    """
+    if not os.path.exists(photo_path):
+        raise FileNotFoundError(f"Файл не найден: {photo_path}")
+    if not profile:
         file_size = os.path.getsize(photo_path)
         if file_size > MAX_FILE_SIZE_BYTES:
             raise ValueError(f"Файл слишком большой: {file_size / 1024 / 1024:.2f} MB")
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-        def upload_sync():
-            with open(photo_path, 'rb') as f:
-                return replicate_client.files.create(file=f)
-        file_response = await loop.run_in_executor(None, upload_sync)
-        image_url = file_response.urls.get('get')
-        if not image_url:
-            raise ValueError("Replicate не вернул URL")
-        logger.info(f"Изображение загружено: {image_url}")
+        async with replicate_semaphore:
+            image_url = await get_replicate_client().upload_file(photo_path)
+        logger.info(f"Файл загружен ({file_size} байт): {image_url}")
         return image_url
 
+    normalized = await image_normalizer.normalize_file(photo_path, profile)
+    if len(normalized.data) > MAX_FILE_SIZE_BYTES:
+        raise ValueError(f"Файл слишком большой: {len(normalized.data) / 1024 / 1024:.2f} MB")
+    async with replicate_semaphore:
+        image_url = await replicate_upload_cache.upload(
+            normalized.data, os.path.basename(photo_path), content_type='image/jpeg'
+        )
+    logger.info(f"Изображение загружено ({len(normalized.data)} байт): {image_url}")
+    return image_url
+
 def is_new_fast_flux_model(model_id: str, model_version: str = None) -> bool:
     
     if model_id and ("fastnew" in model_id.lower() or "fast-flux" in model_id.lower()):
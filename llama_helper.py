@@ -1,9 +1,17 @@
-import replicate
 import logging
 import asyncio
-from typing import Optional
-from config import REPLICATE_API_TOKEN
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from config import REPLICATE_API_TOKEN, LLAMA_PROMPT_CACHE_SIZE, LLAMA_PROMPT_CACHE_TTL_SECONDS, ASSISTED_PROMPT_STREAMING
 from generation_config import IMAGE_GENERATION_MODELS
+from metrics import metrics_registry
+from prediction_tracker import prediction_tracker
+from replicate_limiter import replicate_limiter
+from replicate_client import AsyncReplicateClient, ReplicateAPIError, ReplicateObject, get_replicate_client
 
 # Настройка логирования
 logging.basicConfig(
@@ -13,6 +21,110 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+WHITESPACE_RE = re.compile(r'\s+')
+VALID_GENDERS = ('man', 'woman', 'person')
+
+# Получает весь накопленный на данный момент сырой вывод модели
+PartialCallback = Callable[[str], None]
+
+
+class AssistedPromptCache:
+    """Кэш промптов Llama 3 с TTL и LRU.
+
+    Пользователи часто отправляют ту же идею повторно, а двойное нажатие
+    запускало два одинаковых вызова модели. Ключ — нормализованные
+    (идея, пол, тип генерации, длина); одновременные одинаковые запросы
+    ждут один общий вызов. Исходная идея, возвращённая вместо промпта
+    (ошибка или модель ничего не улучшила), не кэшируется.
+    """
+
+    def __init__(self, max_entries: int = LLAMA_PROMPT_CACHE_SIZE, ttl: float = LLAMA_PROMPT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.coalesced = 0
+        self.not_cached = 0
+
+    @staticmethod
+    def make_key(user_query: str, gender: str, generation_type: str, max_length_chars: int) -> str:
+        """Ключ кэша: регистр и лишние пробелы идеи не влияют, пол приводится к man/woman/person."""
+        query = WHITESPACE_RE.sub(' ', user_query or '').strip().casefold()
+        normalized_gender = gender if gender in VALID_GENDERS else 'person'
+        raw = '\x1f'.join((query, normalized_gender, generation_type, str(max_length_chars)))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        prompt, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expired += 1
+            return None
+        self._entries.move_to_end(key)
+        return prompt
+
+    def _remember(self, key: str, prompt: str) -> None:
+        self._entries[key] = (prompt, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _resolve(self, key: str, user_query: str, generate: Callable[[], Awaitable[str]]) -> str:
+        prompt = await generate()
+        if prompt and prompt != user_query:
+            self._remember(key, prompt)
+        else:
+            self.not_cached += 1
+        return prompt
+
+    async def get_or_generate(self, key: str, user_query: str, generate: Callable[[], Awaitable[str]]) -> str:
+        """Промпт из кэша, из уже идущего вызова или от generate().
+
+        Вызов выполняется отдельной задачей: если первый запросивший
+        отменён, остальные всё равно получат результат.
+        """
+        cached = self._lookup(key)
+        if cached is not None:
+            self.hits += 1
+            logger.info("Промпт Llama 3 взят из кэша")
+            return cached
+        pending = self._inflight.get(key)
+        if pending is None:
+            self.misses += 1
+            pending = asyncio.ensure_future(self._resolve(key, user_query, generate))
+            self._inflight[key] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            logger.info("Ожидание уже идущего запроса Llama 3 с той же идеей")
+        return await asyncio.shield(pending)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики кэша AI-помощника для /metrics."""
+        requests = self.hits + self.misses + self.coalesced
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'coalesced': self.coalesced,
+            'not_cached': self.not_cached,
+            'in_flight': len(self._inflight),
+            'hit_rate': round((self.hits + self.coalesced) / requests, 3) if requests else None,
+        }
+
+
+# Глобальный кэш промптов
+assisted_prompt_cache = AssistedPromptCache()
+metrics_registry.register('llama_prompts', assisted_prompt_cache.metrics)
+
+
 class LlamaPromptAssistant:
     """Класс для работы с Llama 3 для генерации промптов"""
     
@@ -22,22 +134,34 @@ class LlamaPromptAssistant:
             logger.error("Llama 3 model ID не найден в конфигурации")
             raise ValueError("Llama 3 model configuration missing")
     
-    async def generate_prompt(self, user_query: str, gender: str, max_length_chars: int = 1000, generation_type: str = 'with_avatar') -> str:
+    async def generate_prompt(self, user_query: str, gender: str, max_length_chars: int = 1000, generation_type: str = 'with_avatar',
+                              on_partial: Optional[PartialCallback] = None) -> str:
         """
-        Генерирует промпт с помощью Llama 3.
+        Генерирует промпт с помощью Llama 3. Результат кэшируется в assisted_prompt_cache.
         
         Args:
             user_query: Введённая пользователем идея.
             gender: Пол для генерации (man, woman, person).
             max_length_chars: Максимальная длина промпта в символах.
             generation_type: Тип генерации ('with_avatar', 'photo_to_photo', 'ai_video_v2_1').
+            on_partial: Вызывается с накопленным выводом по мере генерации (SSE-поток Replicate).
+                Итоговый промпт от этого не меняется; при попадании в кэш не вызывается.
         """
         if not REPLICATE_API_TOKEN:
             logger.error("REPLICATE_API_TOKEN не установлен. Невозможно использовать Llama 3.")
             return user_query
 
+        key = AssistedPromptCache.make_key(user_query, gender, generation_type, max_length_chars)
+        return await assisted_prompt_cache.get_or_generate(
+            key, user_query,
+            lambda: self._generate_prompt(user_query, gender, max_length_chars, generation_type, on_partial)
+        )
+
+    async def _generate_prompt(self, user_query: str, gender: str, max_length_chars: int, generation_type: str,
+                               on_partial: Optional[PartialCallback] = None) -> str:
+        """Вызывает Llama 3 без кэша; при ошибке возвращает исходную идею."""
         # Проверка и нормализация параметра gender
-        valid_genders = ['man', 'woman', 'person']
+        valid_genders = list(VALID_GENDERS)
         normalized_gender = gender if gender in valid_genders else 'person'
         if gender not in valid_genders + ['neutral']:
             logger.warning(f"Некорректное значение gender: '{gender}', используется 'person'")
@@ -64,7 +188,8 @@ class LlamaPromptAssistant:
             output = await self._run_replicate_model(
                 system_prompt, 
                 full_prompt_for_llama, 
-                max_new_tokens_calculated
+                max_new_tokens_calculated,
+                on_partial
             )
             
             # Обрабатываем и очищаем результат
@@ -127,10 +252,9 @@ class LlamaPromptAssistant:
             "Generate the prompt now:"
         )
     
-    async def _run_replicate_model(self, system_prompt: str, user_prompt: str, max_tokens: int) -> str:
-        """Выполняет запрос к модели Replicate."""
-        loop = asyncio.get_event_loop()
-        
+    async def _run_replicate_model(self, system_prompt: str, user_prompt: str, max_tokens: int,
+                                   on_partial: Optional[PartialCallback] = None) -> str:
+        """Выполняет запрос к модели Replicate; с on_partial — в режиме потока."""
         # Параметры для Llama 3
         input_params = {
             "top_k": 50,
@@ -147,15 +271,82 @@ class LlamaPromptAssistant:
             )
         }
         
-        # Выполняем в отдельном потоке для совместимости с asyncio
-        output_stream = await loop.run_in_executor(
-            None, 
-            lambda: replicate.run(self.model_id, input=input_params)
-        )
-        
-        # Собираем результат из потока
-        generated_text = "".join([str(event) for event in output_stream])
+        # При перегрузке Llama предохранитель сразу отказывает, и используется исходная идея
+        async with replicate_limiter.slot(self.model_id):
+            if on_partial is not None and ASSISTED_PROMPT_STREAMING:
+                return await self._stream_replicate_model(input_params, on_partial)
+            output = await get_replicate_client().run(self.model_id, input_params)
+        return self._join_output(output)
+
+    @staticmethod
+    def _join_output(output) -> str:
+        # Языковые модели возвращают список токенов
+        if isinstance(output, str):
+            return output
+        generated_text = "".join([str(event) for event in output or []])
         return generated_text
+
+    async def _stream_replicate_model(self, input_params: dict, on_partial: PartialCallback) -> str:
+        """Читает вывод модели из SSE-потока, передавая накопленный текст в on_partial.
+
+        Если поток недоступен или оборвался, результат берётся из самого
+        предсказания, как в обычном режиме.
+        """
+        client = get_replicate_client()
+        prediction = await client.create_prediction(self.model_id, input_params, stream=True)
+        stream_url = prediction.urls.get('stream')
+        if not stream_url:
+            logger.info(f"Replicate не вернул поток для {prediction.id}, ожидаем результат целиком")
+            return await self._await_output(prediction, client)
+
+        chunks = []
+        failure = None
+        finished = False
+        events = client.stream_events(stream_url)
+        try:
+            async for event, data in events:
+                if event == 'output':
+                    chunks.append(data)
+                    on_partial(''.join(chunks))
+                elif event == 'error':
+                    failure = data or 'error'
+                    break
+                elif event == 'done':
+                    failure = self._done_reason(data)
+                    finished = True
+                    break
+        except asyncio.CancelledError:
+            # Промпт больше не нужен: не оставляем генерацию работать в Replicate
+            await asyncio.shield(prediction_tracker.cancel(prediction.id, client))
+            raise
+        except ReplicateAPIError as e:
+            logger.warning(f"Поток {prediction.id} прерван ({e}), ожидаем результат целиком")
+        finally:
+            await events.aclose()
+
+        if failure:
+            raise ReplicateAPIError(f"Предсказание {prediction.id} завершилось с ошибкой: {failure}", detail=failure)
+        if finished:
+            return ''.join(chunks)
+        return await self._await_output(prediction, client)
+
+    @staticmethod
+    def _done_reason(data: str) -> Optional[str]:
+        """Причина из события done: пусто при успехе, 'canceled' или 'error' иначе."""
+        try:
+            payload = json.loads(data) if data else {}
+        except ValueError:
+            return None
+        return payload.get('reason') if isinstance(payload, dict) else None
+
+    async def _await_output(self, prediction: ReplicateObject, client: AsyncReplicateClient) -> str:
+        prediction = await prediction_tracker.wait(prediction, client=client)
+        if prediction.status != 'succeeded':
+            raise ReplicateAPIError(
+                f"Предсказание {prediction.id} завершилось со статусом {prediction.status}: {prediction.error}",
+                detail=str(prediction.error)
+            )
+        return self._join_output(prediction.output)
     
     def _process_output(self, output: str, max_length: int) -> str:
         """Обрабатывает и очищает вывод от Llama 3."""
@@ -211,7 +402,8 @@ async def get_llama_assistant() -> LlamaPromptAssistant:
         llama_assistant = LlamaPromptAssistant()
     return llama_assistant
 
-async def generate_assisted_prompt(user_query: str, gender: str, max_length_chars: int = 1000, generation_type: str = 'with_avatar') -> str:
+async def generate_assisted_prompt(user_query: str, gender: str, max_length_chars: int = 1000, generation_type: str = 'with_avatar',
+                                   on_partial: Optional[PartialCallback] = None) -> str:
     """
     Генерирует промпт с помощью Llama ассистента.
     
@@ -220,10 +412,11 @@ async def generate_assisted_prompt(user_query: str, gender: str, max_length_char
         gender: Пол для генерации (man, woman, person).
         max_length_chars: Максимальная длина промпта в символах.
         generation_type: Тип генерации ('with_avatar', 'photo_to_photo', 'ai_video_v2_1').
+        on_partial: Получает частичный вывод модели по мере генерации (см. StreamingMessage).
     """
     try:
         assistant = await get_llama_assistant()
-        return await assistant.generate_prompt(user_query, gender, max_length_chars, generation_type)
+        return await assistant.generate_prompt(user_query, gender, max_length_chars, generation_type, on_partial)
     except Exception as e:
         logger.error(f"Ошибка в generate_assisted_prompt: {e}", exc_info=True)
         return user_query
@@ -261,4 +454,5 @@ async def test_llama_assistant():
 if __name__ == '__main__':
     asyncio.run(test_llama_assistant())
     
-__all__ = ['LlamaPromptAssistant', 'get_llama_assistant', 'generate_assisted_prompt']
\ No newline at end of file
+__all__ = ['LlamaPromptAssistant', 'AssistedPromptCache', 'assisted_prompt_cache', 'get_llama_assistant',
+           'generate_assisted_prompt']
\ No newline at end of file
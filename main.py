@@ -1,6 +1,7 @@
 # main.py
 from aiogram.fsm.context import FSMContext
 import asyncio
+import hmac
 import logging
 import json
 import os
@@ -19,14 +20,25 @@ from aiogram.filters import Command
 from flask import Flask, request, jsonify
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from bot_counter import bot_counter, cmd_bot_name
-from config import TELEGRAM_BOT_TOKEN as TOKEN, ADMIN_IDS, TARIFFS, DATABASE_PATH, METRICS_CONFIG
-from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback, escape_message_parts, unescape_markdown
+from metrics import metrics_registry
+from broadcast_workers import start_broadcast_workers, stop_broadcast_workers
+from reminder_timers import reminder_dispatcher
+from broadcast_scheduler import broadcast_scheduler
+from replicate_client import close_replicate_clients
+from executors import shutdown_executors
+from generation_jobs import generation_job_queue
+from downloads import download_service
+from replicate_webhooks import replicate_webhooks
+from prediction_poller import prediction_poller
+from config import TELEGRAM_BOT_TOKEN as TOKEN, ADMIN_IDS, TARIFFS, DATABASE_PATH, METRICS_CONFIG, METRICS_TOKEN, BROADCAST_WORKER_PROCESSES, REPLICATE_SAFETY_POLL_MINUTES
+from handlers.utils import safe_escape_markdown as escape_md
 from database import (
     init_db, add_resources_on_payment, check_database_user, get_user_payments,
     user_cache, is_user_blocked, get_user_actions_stats, check_referral_integrity,
-    update_user_balance, get_scheduled_broadcasts, get_users_for_welcome_message,
-    mark_welcome_message_sent, block_user_access, update_user_credits, retry_on_locked, get_broadcast_buttons
+    update_user_balance, get_users_for_welcome_message,
+    mark_welcome_message_sent, block_user_access, update_user_credits, retry_on_locked
 )
 from handlers.commands import start, menu, help_command, check_training, debug_avatars
 from handlers.messages import (
@@ -41,8 +53,7 @@ from handlers.user_management import (
 )
 from handlers.broadcast import (
     handle_broadcast_message, handle_broadcast_schedule_input, list_scheduled_broadcasts,
-    broadcast_message_admin, broadcast_to_paid_users, broadcast_to_non_paid_users,
-    broadcast_with_payment, handle_broadcast_schedule_time, handle_broadcast_button_input
+    handle_broadcast_schedule_time, handle_broadcast_button_input
 )
 from handlers.payments import handle_payments_date_input
 from handlers.callbacks_admin import (
@@ -678,6 +689,31 @@ def webhook():
             )
         return jsonify({'status': 'error', 'message': 'Internal server error'}), 500
 
+@app.route('/replicate/webhook', methods=['POST'])
+def replicate_webhook():
+    """Принимает вебхуки Replicate о завершении видео и обучений."""
+    raw_body = request.get_data()
+    if not replicate_webhooks.verify_signature(request.headers, raw_body):
+        replicate_webhooks.reject()
+        logger.warning("Неверная подпись вебхука Replicate")
+        return jsonify({'status': 'error', 'message': 'Invalid signature'}), 403
+
+    try:
+        data = json.loads(raw_body)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        logger.error(f"Ошибка декодирования JSON вебхука Replicate: {e}")
+        return jsonify({'status': 'error', 'message': 'Invalid JSON format'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'Invalid payload'}), 400
+
+    if not (bot_instance and bot_event_loop):
+        # Replicate повторит доставку, а страховочный опрос подберёт задачу в любом случае
+        logger.error("Экземпляр бота или event loop не инициализирован, вебхук Replicate отклонён.")
+        return jsonify({'status': 'error', 'message': 'Bot instance not initialized'}), 503
+
+    asyncio.run_coroutine_threadsafe(replicate_webhooks.handle(bot_instance, data), bot_event_loop)
+    return jsonify({'status': 'ok'}), 200
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Проверяет состояние бота."""
@@ -688,98 +724,22 @@ def health_check():
         'event_loop_ready': bot_event_loop is not None
     }), 200
 
-async def process_scheduled_broadcasts(bot: Bot) -> None:
-    """Обрабатывает запланированные рассылки."""
-    try:
-        broadcasts = await get_scheduled_broadcasts(bot=bot)
-        if not broadcasts:
-            logger.debug("Нет запланированных рассылок для обработки")
-            return
-        for broadcast in broadcasts:
-            broadcast_id = broadcast['id']
-            if not isinstance(broadcast_id, int) or broadcast_id <= 0:
-                logger.error(f"Некорректный broadcast_id: {broadcast_id}")
-                continue
-            broadcast_data = broadcast.get('broadcast_data', {})
-            if not isinstance(broadcast_data, dict):
-                logger.error(f"Некорректные данные broadcast_data для broadcast_id={broadcast_id}")
-                continue
-            message_text = broadcast_data.get('message', '')
-            media = broadcast_data.get('media', None)
-            media_type = media.get('type') if media else None
-            media_id = media.get('file_id') if media else None
-            target_group = broadcast_data.get('broadcast_type', 'all')
-            admin_user_id = broadcast_data.get('admin_user_id', ADMIN_IDS[0])
-            # Извлекаем кнопки из таблицы broadcast_buttons
-            buttons = await get_broadcast_buttons(broadcast_id)
-            # Если кнопки не найдены в таблице, используем резерв из broadcast_data
-            if not buttons and 'buttons' in broadcast_data:
-                buttons = broadcast_data.get('buttons', [])
-                logger.debug(f"Кнопки для broadcast_id={broadcast_id} взяты из broadcast_data: {buttons}")
-            scheduled_time = broadcast.get('scheduled_time')
-            if not scheduled_time:
-                logger.warning(f"Рассылка ID {broadcast_id} пропущена: отсутствует scheduled_time")
-                continue
-            logger.info(f"Выполняется рассылка ID {broadcast_id} для группы {target_group} на {scheduled_time}")
-
-            # Очищаем текст от возможного экранирования и экранируем заново
-            raw_message = unescape_markdown(message_text)
-            logger.debug(f"Очищенный текст сообщения для broadcast_id={broadcast_id}: {raw_message[:100]}...")
-            signature = "🍪 PixelPie"
-            caption = raw_message + ("\n\n" + signature if raw_message.strip() else "\n" + signature)
-            escaped_caption = escape_message_parts(caption, version=2)
-            logger.debug(f"Экранированный текст для отправки: {escaped_caption[:100]}...")
-
-            reply_markup = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Да, хочу! 💳", callback_data="subscribe")]
-            ]) if broadcast_data.get('with_payment_button', False) else None
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
 
-            try:
-                async with aiosqlite.connect(DATABASE_PATH, timeout=15) as conn:
-                    c = await conn.cursor()
-                    await c.execute(
-                        "UPDATE scheduled_broadcasts SET status = 'completed' WHERE id = ?",
-                        (broadcast_id,)
-                    )
-                    await conn.commit()
-                logger.debug(f"Статус рассылки ID {broadcast_id} обновлен на completed")
-                if target_group == 'all':
-                    await broadcast_message_admin(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                elif target_group == 'paid':
-                    await broadcast_to_paid_users(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                elif target_group == 'non_paid':
-                    await broadcast_to_non_paid_users(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                elif target_group.startswith('with_payment'):
-                    await broadcast_with_payment(bot, escaped_caption, admin_user_id, media_type, media_id, buttons)
-                else:
-                    logger.warning(f"Неизвестная группа рассылки для ID {broadcast_id}: {target_group}")
-                    continue
-                logger.info(f"Рассылка ID {broadcast_id} завершена")
-            except Exception as e:
-                logger.error(f"Ошибка выполнения рассылки ID {broadcast_id}: {e}", exc_info=True)
-                for admin_id in ADMIN_IDS:
-                    try:
-                        await send_message_with_fallback(
-                            bot, admin_id,
-                            escape_message_parts(
-                                f"🚨 Ошибка выполнения рассылки ID {broadcast_id} для группы {target_group}: {str(e)}",
-                                version=2
-                            ),
-                            parse_mode=ParseMode.MARKDOWN_V2
-                        )
-                    except Exception as e_notify:
-                        logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
-    except Exception as e:
-        logger.error(f"Ошибка в фоновой задаче рассылок: {e}", exc_info=True)
-        for admin_id in ADMIN_IDS:
-            try:
-                await send_message_with_fallback(
-                    bot, admin_id,
-                    escape_message_parts(f"🚨 Ошибка в фоновой задаче рассылок: {str(e)}", version=2),
-                    parse_mode=ParseMode.MARKDOWN_V2
-                )
-            except Exception as e_notify:
-                logger.error(f"Не удалось уведомить админа {admin_id}: {e_notify}")
+def metrics_access_allowed() -> bool:
+    """Доступ к /metrics: по заголовку X-Metrics-Token, а без METRICS_TOKEN — только с localhost."""
+    if METRICS_TOKEN:
+        token = request.headers.get('X-Metrics-Token', '')
+        return hmac.compare_digest(token.encode('utf-8'), METRICS_TOKEN.encode('utf-8'))
+    return request.remote_addr in LOCAL_ADDRESSES
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Отдаёт метрики процесса (рассылки и др.) в JSON для дашбордов."""
+    if not metrics_access_allowed():
+        logger.warning(f"Запрос /metrics без доступа с {request.remote_addr}")
+        return jsonify({'status': 'error', 'message': 'Forbidden'}), 403
+    return jsonify(metrics_registry.snapshot()), 200
 
 async def run_checks(bot: Bot) -> None:
     """Запускает проверки задач генерации."""
@@ -887,6 +847,7 @@ async def init_payment_tables():
 async def main():
     """Основная функция запуска бота."""
     global bot_instance, dp, bot_event_loop
+    broadcast_worker_processes = []
     try:
         logger.info("=== ЗАПУСК TELEGRAM БОТА ===")
         logger.info("Инициализация дополнительных таблиц для платежей...")
@@ -1007,30 +968,39 @@ async def main():
             misfire_grace_time=300,
             id='daily_report'
         )
-        scheduler.add_job(
-            process_scheduled_broadcasts,
-            trigger=CronTrigger(minute='*', timezone=pytz.timezone('Europe/Moscow')),
-            args=[bot_instance],
-            misfire_grace_time=30,
-            id='scheduled_broadcasts'
-        )
+        # Результаты видео и обучений приходят вебхуками Replicate; опрос — редкая страховка
         scheduler.add_job(
             check_pending_video_tasks,
-            trigger=CronTrigger(minute='*/5', timezone=pytz.timezone('Europe/Moscow')),
+            trigger=IntervalTrigger(minutes=REPLICATE_SAFETY_POLL_MINUTES, timezone=pytz.timezone('Europe/Moscow')),
             args=[bot_instance],
             misfire_grace_time=60,
+            max_instances=1,
             id='check_pending_videos'
         )
         scheduler.add_job(
             check_pending_trainings,
-            trigger=CronTrigger(minute='*/5', timezone=pytz.timezone('Europe/Moscow')),
+            trigger=IntervalTrigger(minutes=REPLICATE_SAFETY_POLL_MINUTES, timezone=pytz.timezone('Europe/Moscow')),
             args=[bot_instance],
             misfire_grace_time=60,
+            max_instances=1,
             id='check_pending_trainings'
         )
         scheduler.start()
         logger.info("Планировщик задач запущен")
 
+        # Процессы для шардированных рассылок, чтобы не нагружать основной event loop
+        if BROADCAST_WORKER_PROCESSES > 0:
+            broadcast_worker_processes = start_broadcast_workers(BROADCAST_WORKER_PROCESSES)
+
+        # Единый диспетчер отложенных онбординг-сообщений (таймеры хранятся в БД)
+        await reminder_dispatcher.start(bot_instance)
+        # Отложенные рассылки: min-heap по времени вместо ежеминутного опроса БД
+        await broadcast_scheduler.start(bot_instance)
+        # Постоянная очередь генераций с честным распределением между пользователями
+        await generation_job_queue.start(bot_instance, dp.storage)
+        # Единый опросчик статусов Replicate там, где нет вебхука
+        await prediction_poller.start(bot_instance)
+
         # Запуск проверки задач при старте
         logger.info("Запуск проверки задач при старте...")
         asyncio.create_task(run_checks(bot_instance))
@@ -1060,6 +1030,16 @@ async def main():
         if 'scheduler' in locals():
             scheduler.shutdown(wait=True)
             logger.info("Планировщик остановлен")
+        await reminder_dispatcher.stop()
+        await broadcast_scheduler.stop()
+        await generation_job_queue.stop()
+        await prediction_poller.stop()
+        if broadcast_worker_processes:
+            stop_broadcast_workers(broadcast_worker_processes)
+            logger.info("Процессы рассылки остановлены")
+        await close_replicate_clients()
+        await download_service.close()
+        shutdown_executors()
         if bot_instance:
             logger.info("Счетчик пользователей не имеет метода stop, пропускаем")
             await bot_instance.session.close()
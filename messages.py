@@ -17,7 +17,7 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 from transliterate import translit
 from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback, create_payment_link, get_tariff_text, safe_escape_markdown
-from config import ADMIN_IDS, TARIFFS, DATABASE_PATH
+from config import ADMIN_IDS, TARIFFS, DATABASE_PATH, ASSISTED_PROMPT_STREAMING
 from generation_config import IMAGE_GENERATION_MODELS
 from database import (
     check_database_user, update_user_credits, add_resources_on_payment,
@@ -37,7 +37,10 @@ from handlers.commands import menu
 from handlers.broadcast import broadcast_message_admin, broadcast_to_paid_users, broadcast_to_non_paid_users
 from handlers.admin_panel import admin_panel
 from states import BotStates, VideoStates
+from image_normalizer import PROFILE_REFERENCE
 from handlers.photo_transform import PhotoTransformStates
+from streaming_message import StreamingMessage
+from prompt_prep import prompt_preparer
 logger = logging.getLogger(__name__)
 
 async def notify_startup() -> None:
@@ -356,7 +359,7 @@ async def handle_prompt_based_photo(message: Message, state: FSMContext, photo_f
         await bot.download_file(photo_file.file_path, photo_path)
         
         from generation.images import upload_image_to_replicate
-        image_url = await upload_image_to_replicate(photo_path)
+        image_url = await upload_image_to_replicate(photo_path, PROFILE_REFERENCE)
         
         user_data = await state.get_data()
         await state.update_data(
@@ -403,7 +406,7 @@ async def handle_photo_to_photo_reference(message: Message, state: FSMContext, p
         await bot.download_file(photo_file.file_path, p2p_photo_path)
         
         from generation.images import upload_image_to_replicate
-        image_url = await upload_image_to_replicate(p2p_photo_path)
+        image_url = await upload_image_to_replicate(p2p_photo_path, PROFILE_REFERENCE)
         
         await state.update_data(
             photo_path=p2p_photo_path,
@@ -757,6 +760,8 @@ async def handle_manual_prompt_input(message: Message, state: FSMContext, text:
         )
         await state.set_state(VideoStates.AWAITING_VIDEO_PHOTO)
     else:
+        # Пока пользователь выбирает формат, готовим промпт заранее
+        prompt_preparer.schedule(state, target_user_id, await state.get_data())
         await message.answer(
             escape_md(
                 f"✅ Промпт сохранен: `{text[:50]}{'...' if len(text) > 50 else ''}`\n\n"
@@ -791,8 +796,8 @@ async def handle_llama_prompt_input(message: Message, state: FSMContext, text: s
         return
 
     try:
-        # Отправляем начальное сообщение о начале генерации
-        await send_message_with_fallback(
+        # Отправляем начальное сообщение о начале генерации; в него же по мере генерации выводится промпт
+        status_message = await send_message_with_fallback(
             bot, user_id,
             escape_md("⏳ Обращаюсь к AI-помощнику для создания детального промпта... Это может занять некоторое время.", version=2),
             parse_mode=ParseMode.MARKDOWN_V2
@@ -823,22 +828,37 @@ async def handle_llama_prompt_input(message: Message, state: FSMContext, text: s
                 logger.warning(f"Пол не указан для user_id={user_id}, используется значение по умолчанию 'person'")
             await state.update_data(selected_gender=gender)
 
+        streamer = None
+        if ASSISTED_PROMPT_STREAMING and isinstance(status_message, Message):
+            streamer = StreamingMessage(
+                bot, user_id, status_message.message_id,
+                render=lambda partial: escape_md(f"✍️ AI-помощник пишет промпт:\n\n{partial} ▌", version=2)
+            )
+
         # Запускаем генерацию промпта асинхронно
         start_time = time.time()
-        task = asyncio.create_task(generate_assisted_prompt(text, gender, generation_type=generation_type))
-        
-        # Ждём 3 секунды и отправляем промежуточное сообщение, если задача не завершена
-        await asyncio.sleep(3)
-        if not task.done():
-            await send_message_with_fallback(
-                bot, user_id,
-                escape_md("⏳ Генерация в процессе, пожалуйста, подождите...", version=2),
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
-            logger.debug(f"Промежуточное сообщение отправлено для user_id={user_id}, генерация ещё не завершена")
+        task = asyncio.create_task(generate_assisted_prompt(
+            text, gender, generation_type=generation_type,
+            on_partial=streamer.update if streamer else None
+        ))
+
+        if streamer is None:
+            # Без потока: если за 3 секунды промпт не готов, сообщаем, что генерация идёт
+            done, _ = await asyncio.wait({task}, timeout=3)
+            if not done:
+                await send_message_with_fallback(
+                    bot, user_id,
+                    escape_md("⏳ Генерация в процессе, пожалуйста, подождите...", version=2),
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
+                logger.debug(f"Промежуточное сообщение отправлено для user_id={user_id}, генерация ещё не завершена")
 
         # Ожидаем завершения генерации
-        assisted_prompt = await task
+        try:
+            assisted_prompt = await task
+        finally:
+            if streamer:
+                await streamer.close()
         generation_time = time.time() - start_time
         logger.debug(f"Время генерации промпта для user_id={user_id}: {generation_time:.2f} секунд")
 
@@ -886,6 +906,10 @@ async def handle_llama_prompt_input(message: Message, state: FSMContext, text: s
         if current_part:
             prompt_parts.append(current_part)
 
+        # Промпт из нескольких частей отправляется новыми сообщениями, частичный вывод убираем
+        if streamer and len(prompt_parts) > 1:
+            await streamer.delete()
+
         # Отправляем сообщения с частями промпта
         for i, part in enumerate(prompt_parts):
             text_msg = escape_md(
@@ -899,12 +923,14 @@ async def handle_llama_prompt_input(message: Message, state: FSMContext, text: s
                 [InlineKeyboardButton(text="✏️ Редактировать", callback_data="edit_assisted_prompt")],
                 [InlineKeyboardButton(text="🔙 Назад", callback_data="video_generate_menu" if generation_type == 'ai_video_v2_1' else "back_to_style_selection")]
             ]) if i == len(prompt_parts) - 1 else None
-            await send_message_with_fallback(
-                bot, user_id,
-                text_msg,
-                reply_markup=reply_markup,
-                parse_mode=ParseMode.MARKDOWN_V2
-            )
+            # Промпт в одном сообщении заменяет частичный вывод на месте
+            if not (streamer and len(prompt_parts) == 1 and await streamer.finish(text_msg, reply_markup)):
+                await send_message_with_fallback(
+                    bot, user_id,
+                    text_msg,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.MARKDOWN_V2
+                )
             logger.info(f"Часть {i+1}/{len(prompt_parts)} AI-промпта отправлена для user_id={user_id}: {part[:50]}...")
 
         await state.set_state(BotStates.AWAITING_STYLE_SELECTION)
@@ -950,6 +976,7 @@ async def handle_custom_prompt_photo_input(message: Message, state: FSMContext,
         prompt=text,
         waiting_for_custom_prompt_photo=False
     )
+    prompt_preparer.schedule(state, user_data.get('admin_generation_for_user', user_id), await state.get_data())
 
     await message.answer(
         escape_md(f"✅ Промпт сохранен: `{text[:50]}{'...' if len(text) > 50 else '}'}`", version=2),
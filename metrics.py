@@ -0,0 +1,52 @@
+# metrics.py
+"""Реестр метрик процесса для эндпоинта /metrics."""
+
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsRegistry:
+    """Собирает снимки метрик от подсистем бота.
+
+    Подсистема регистрирует функцию без аргументов, возвращающую словарь с
+    текущими значениями. Снимок читается из потока Flask, поэтому провайдер
+    должен только читать уже посчитанные значения — без await и без БД.
+    """
+
+    def __init__(self):
+        self._providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, provider: Callable[[], Dict[str, Any]]) -> None:
+        """Регистрирует (или заменяет) провайдер метрик под именем name."""
+        with self._lock:
+            self._providers[name] = provider
+        logger.debug(f"Зарегистрирован провайдер метрик: {name}")
+
+    def unregister(self, name: str) -> None:
+        """Удаляет провайдер метрик."""
+        with self._lock:
+            self._providers.pop(name, None)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Возвращает метрики всех провайдеров одним словарём."""
+        with self._lock:
+            providers = list(self._providers.items())
+        result: Dict[str, Any] = {'timestamp': time.time()}
+        for name, provider in providers:
+            try:
+                result[name] = provider()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрик '{name}': {e}", exc_info=True)
+                result[name] = {'error': str(e)}
+        return result
+
+
+# Глобальный экземпляр
+metrics_registry = MetricsRegistry()
+
+__all__ = ['MetricsRegistry', 'metrics_registry']
@@ -9,13 +9,14 @@ import pytz
 from aiogram import Bot, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, Message, CallbackQuery, InputMediaPhoto
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.fsm.context import FSMContext
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import aiosqlite
 from config import DATABASE_PATH, TARIFFS, ADMIN_IDS
 from handlers.utils import safe_escape_markdown as escape_md, get_tariff_text
 from database import check_database_user, get_user_payments, is_old_user
 from keyboards import create_subscription_keyboard, create_main_menu_keyboard
+from reminder_timers import reminder_dispatcher
 
 logger = logging.getLogger(__name__)
 
@@ -417,6 +418,9 @@ async def send_onboarding_message(bot: Bot, user_id: int, message_type: str, sub
                 except Exception as e:
                     logger.error(f"Ошибка отправки уведомления админу {admin_id} для user_id={user_id}: {e}")
                 
+    except TelegramRetryAfter:
+        # Повтор и темп отправки определяет ReminderDispatcher
+        raise
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения {message_type} для user_id={user_id}: {e}", exc_info=True)
         await bot.send_message(
@@ -468,26 +472,12 @@ async def schedule_tariff_messages(bot: Bot, user_id: int) -> None:
             ("tariff_мини", registration_date + timedelta(minutes=90)),
         ]
 
-        scheduler = AsyncIOScheduler(timezone=moscow_tz)
+        # Таймеры хранятся в БД; просроченные диспетчер отправит сразу
         for tariff_type, schedule_time in tariff_messages:
-            job_id = f"tariff_{tariff_type}_{user_id}"
-            if scheduler.get_job(job_id):
-                logger.debug(f"Задача {job_id} уже запланирована для user_id={user_id}, пропускаем")
-                continue
             if schedule_time <= current_time:
-                logger.warning(f"Попытка запланировать задачу {job_id} в прошлом: {schedule_time}")
-                await send_onboarding_message(bot, user_id, tariff_type, subscription_data)
-                continue
-            logger.info(f"Планируем задачу {job_id} для user_id={user_id} на {schedule_time}")
-            scheduler.add_job(
-                send_onboarding_message,
-                trigger='date',
-                run_date=schedule_time,
-                args=[bot, user_id, tariff_type, subscription_data],
-                id=job_id,
-                misfire_grace_time=300
-            )
-        scheduler.start()
+                logger.warning(f"Таймер {tariff_type} для user_id={user_id} уже просрочен: {schedule_time}, будет отправлен немедленно")
+            if await reminder_dispatcher.schedule(user_id, tariff_type, schedule_time):
+                logger.info(f"Запланирован таймер {tariff_type} для user_id={user_id} на {schedule_time}")
         logger.info(f"Тарифные сообщения запланированы для user_id={user_id}")
         
     except Exception as e:
@@ -532,26 +522,12 @@ async def schedule_onboarding_reminders(bot: Bot, user_id: int) -> None:
             ("reminder_day5", registration_date + timedelta(days=4)),
         ]
 
-        scheduler = AsyncIOScheduler(timezone=moscow_tz)
+        # Таймеры хранятся в БД; просроченные диспетчер отправит сразу
         for reminder_type, schedule_time in reminders:
-            job_id = f"reminder_{reminder_type}_{user_id}"
-            if scheduler.get_job(job_id):
-                logger.debug(f"Задача {job_id} уже запланирована для user_id={user_id}, пропускаем")
-                continue
             if schedule_time <= current_time:
-                logger.warning(f"Попытка запланировать задачу {job_id} в прошлом: {schedule_time}")
-                await send_onboarding_message(bot, user_id, reminder_type, subscription_data)
-                continue
-            logger.info(f"Планируем задачу {job_id} для user_id={user_id} на {schedule_time}")
-            scheduler.add_job(
-                send_onboarding_message,
-                trigger='date',
-                run_date=schedule_time,
-                args=[bot, user_id, reminder_type, subscription_data],
-                id=job_id,
-                misfire_grace_time=300
-            )
-        scheduler.start()
+                logger.warning(f"Таймер {reminder_type} для user_id={user_id} уже просрочен: {schedule_time}, будет отправлен немедленно")
+            if await reminder_dispatcher.schedule(user_id, reminder_type, schedule_time):
+                logger.info(f"Запланирован таймер {reminder_type} для user_id={user_id} на {schedule_time}")
         logger.info(f"Напоминания запланированы для user_id={user_id}")
         
     except Exception as e:
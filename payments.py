@@ -17,6 +17,7 @@ from database import get_payments_by_date, get_generation_cost_log, get_registra
 from config import ADMIN_IDS, DATABASE_PATH
 from generation_config import IMAGE_GENERATION_MODELS
 from excel_utils import create_payments_excel, create_registrations_excel
+from executors import cpu_executor
 from keyboards import create_admin_keyboard
 from handlers.utils import safe_escape_markdown as escape_md, send_message_with_fallback
 
@@ -117,14 +118,13 @@ async def handle_payments_date(query: CallbackQuery, state: FSMContext, start_da
 
         if payments:
             payments_filename = f"payments_{start_date}_{end_date}_{uuid.uuid4().hex[:8]}.xlsx"
-            payments_file_path = create_payments_excel(payments, payments_filename, start_date, end_date)
+            payments_file_path = await cpu_executor.run(create_payments_excel, [tuple(row) for row in payments], payments_filename, start_date, end_date)
         else:
             logger.info(f"Платежи за период {start_date} - {end_date} не найдены.")
 
         if registrations:
             registrations_filename = f"registrations_{start_date}_{end_date}_{uuid.uuid4().hex[:8]}.xlsx"
-            registrations_file_path = create_registrations_excel(
-                registrations, registrations_filename, start_date if start_date == end_date else f"{start_date} - {end_date}"
+            registrations_file_path = await cpu_executor.run(create_registrations_excel, [tuple(row) for row in registrations], registrations_filename, start_date if start_date == end_date else f"{start_date} - {end_date}"
             )
         else:
             logger.info(f"Регистрации за период {start_date} - {end_date} не найдены.")
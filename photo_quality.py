@@ -0,0 +1,164 @@
+# photo_quality.py
+"""Оценка качества фото для обучения аватара на NumPy.
+
+Раньше на шаге подтверждения пользователь лишь подтверждал, что фото
+хорошие, и размытые, крошечные или почти одинаковые снимки уходили в
+платное обучение. Теперь для каждого фото считаются:
+
+- размер (ширина и высота после нормализации);
+- резкость — дисперсия лапласиана полутонового изображения, уменьшенного
+  до ANALYSIS_SIDE, чтобы порог не зависел от разрешения;
+- экспозиция — средняя яркость и доли почти чёрных и почти белых пикселей
+  по гистограмме;
+- перцептивный хеш (dHash, 64 бита) для поиска почти-дубликатов.
+
+Функции анализа чистые и выполняются в пуле процессов (cpu_executor)
+сразу при приёме фото. assess_photo_set() по готовым оценкам решает, какие
+фото исключить, а какие только пометить: дубликаты ищутся одной матрицей
+расстояний Хэмминга, резкость сравнивается ещё и с медианой набора.
+"""
+
+import io
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from PIL import Image
+from config import (
+    TRAINING_PHOTO_MIN_SIDE, TRAINING_PHOTO_WARN_SIDE, TRAINING_PHOTO_BLUR_REJECT, TRAINING_PHOTO_BLUR_WARN,
+    TRAINING_PHOTO_BLUR_RELATIVE, TRAINING_PHOTO_DARK_MEAN, TRAINING_PHOTO_BRIGHT_MEAN,
+    TRAINING_PHOTO_CLIPPED_FRACTION, TRAINING_PHOTO_DUPLICATE_DISTANCE
+)
+
+# Сторона, до которой уменьшается изображение для оценки резкости и экспозиции
+ANALYSIS_SIDE = 512
+HASH_SIZE = 8
+# Уровни яркости, ниже и выше которых пиксель считается провалом в тень или пересветом
+DARK_LEVEL = 16
+BRIGHT_LEVEL = 240
+
+
+class PhotoQuality(NamedTuple):
+    """Оценки одного фото."""
+    width: int
+    height: int
+    blur: float  # дисперсия лапласиана: чем больше, тем резче
+    brightness: float  # средняя яркость 0..255
+    dark_fraction: float
+    bright_fraction: float
+    dhash: int
+
+
+class PhotoVerdict(NamedTuple):
+    """Решение по фото в наборе: rejected — причина исключения, warnings — замечания."""
+    path: str
+    quality: Optional[PhotoQuality]
+    rejected: Optional[str]
+    warnings: Tuple[str, ...]
+
+
+def _laplacian_variance(gray: np.ndarray) -> float:
+    laplacian = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+                 - 4 * gray[1:-1, 1:-1])
+    return float(laplacian.var())
+
+
+def _dhash(gray_image: Image.Image) -> int:
+    small = np.asarray(gray_image.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def analyze_image(image: Image.Image) -> PhotoQuality:
+    """Считает оценки для уже открытого изображения."""
+    width, height = image.size
+    gray_image = image.convert('L')
+    if max(gray_image.size) > ANALYSIS_SIDE:
+        gray_image.thumbnail((ANALYSIS_SIDE, ANALYSIS_SIDE), Image.BILINEAR)
+    pixels = np.asarray(gray_image, dtype=np.uint8)
+    histogram = np.bincount(pixels.ravel(), minlength=256)
+    total = max(int(histogram.sum()), 1)
+    return PhotoQuality(
+        width=width,
+        height=height,
+        blur=_laplacian_variance(pixels.astype(np.float32)),
+        brightness=float(histogram @ np.arange(256) / total),
+        dark_fraction=float(histogram[:DARK_LEVEL].sum() / total),
+        bright_fraction=float(histogram[BRIGHT_LEVEL + 1:].sum() / total),
+        dhash=_dhash(gray_image)
+    )
+
+
+def analyze_photo(data: bytes) -> PhotoQuality:
+    """Оценки фото из байтов."""
+    with Image.open(io.BytesIO(data)) as image:
+        return analyze_image(image)
+
+
+def analyze_photo_file(path: str) -> PhotoQuality:
+    """Оценки фото из файла (для фото, принятых до перезапуска бота)."""
+    with Image.open(path) as image:
+        return analyze_image(image)
+
+
+def hamming_matrix(hashes: Sequence[int]) -> np.ndarray:
+    """Попарные расстояния Хэмминга между 64-битными хешами."""
+    values = np.array(hashes, dtype=np.uint64)
+    xor = values[:, None] ^ values[None, :]
+    return np.unpackbits(xor.view(np.uint8).reshape(len(values), len(values), 8), axis=2).sum(axis=2)
+
+
+def _warnings(quality: PhotoQuality, median_blur: float) -> Tuple[str, ...]:
+    warnings = []
+    if min(quality.width, quality.height) < TRAINING_PHOTO_WARN_SIDE:
+        warnings.append(f"невысокое разрешение {quality.width}×{quality.height}")
+    if quality.blur < TRAINING_PHOTO_BLUR_WARN:
+        warnings.append(f"нерезкое (резкость {quality.blur:.0f})")
+    elif median_blur and quality.blur < median_blur * TRAINING_PHOTO_BLUR_RELATIVE:
+        warnings.append(f"заметно менее резкое, чем остальные (резкость {quality.blur:.0f})")
+    if quality.brightness < TRAINING_PHOTO_DARK_MEAN or quality.dark_fraction > TRAINING_PHOTO_CLIPPED_FRACTION:
+        warnings.append(f"слишком тёмное (яркость {quality.brightness:.0f})")
+    elif (quality.brightness > TRAINING_PHOTO_BRIGHT_MEAN
+          or quality.bright_fraction > TRAINING_PHOTO_CLIPPED_FRACTION):
+        warnings.append(f"пересвечено (яркость {quality.brightness:.0f})")
+    return tuple(warnings)
+
+
+def assess_photo_set(items: Sequence[Tuple[str, Optional[PhotoQuality]]]) -> List[PhotoVerdict]:
+    """Решения по набору фото в исходном порядке.
+
+    Исключаются нечитаемые, слишком маленькие, сильно размытые фото и
+    почти-дубликаты уже оставленных; остальные получают замечания.
+    """
+    rejected: List[Optional[str]] = [None] * len(items)
+    for index, (_, quality) in enumerate(items):
+        if quality is None:
+            rejected[index] = "не удалось прочитать файл"
+        elif min(quality.width, quality.height) < TRAINING_PHOTO_MIN_SIDE:
+            rejected[index] = f"слишком маленькое ({quality.width}×{quality.height})"
+        elif quality.blur < TRAINING_PHOTO_BLUR_REJECT:
+            rejected[index] = f"размыто (резкость {quality.blur:.0f})"
+
+    analyzed = [index for index, (_, quality) in enumerate(items) if quality is not None]
+    if analyzed:
+        distances = hamming_matrix([items[index][1].dhash for index in analyzed])
+        kept = np.array([rejected[index] is None for index in analyzed])
+        for position, index in enumerate(analyzed):
+            if not kept[position]:
+                continue
+            earlier = np.flatnonzero((distances[position, :position] <= TRAINING_PHOTO_DUPLICATE_DISTANCE)
+                                     & kept[:position])
+            if earlier.size:
+                rejected[index] = f"почти копия фото №{analyzed[earlier[0]] + 1}"
+                kept[position] = False
+
+    blurs = [quality.blur for index, (_, quality) in enumerate(items) if quality is not None and not rejected[index]]
+    median_blur = float(np.median(blurs)) if blurs else 0.0
+    return [
+        PhotoVerdict(path, quality, rejected[index],
+                     _warnings(quality, median_blur) if quality is not None and not rejected[index] else ())
+        for index, (path, quality) in enumerate(items)
+    ]
+
+
+__all__ = ['PhotoQuality', 'PhotoVerdict', 'analyze_image', 'analyze_photo', 'analyze_photo_file',
+           'hamming_matrix', 'assess_photo_set']
@@ -4,20 +4,21 @@ PixelPie AI - Фото Преображение
 Версия с безопасными промптами для избежания sensitive content флагов
 """
 
-import replicate
-import asyncio
 import aiohttp
 import os
 import logging
 import base64
 from typing import Optional, Dict, Any, Union, List
 from datetime import datetime
-from PIL import Image
-import io
 import re
+from replicate_client import get_replicate_client
+from image_normalizer import image_normalizer, PROFILE_GEN4_REFERENCE
+from replicate_uploads import replicate_upload_cache
+from prediction_tracker import prediction_tracker
 
 logger = logging.getLogger(__name__)
 
+
 class PhotoTransformGenerator:
     """Класс для генерации изображений по одному фото через Replicate"""
     
@@ -120,8 +121,8 @@ class PhotoTransformGenerator:
             "720p": "720p"
         }
         
-        # Клиент Replicate
-        self.client = replicate.Client(api_token=replicate_api_key)
+        # Клиент Replicate (общая aiohttp-сессия)
+        self.client = get_replicate_client(replicate_api_key)
         
         # Счетчик попыток для каждого пользователя
         self.user_attempts = {}
@@ -190,61 +191,43 @@ class PhotoTransformGenerator:
             
             style_config = self.styles[style]
             
-            # Выбор промпта в зависимости от попытки
-            if attempt > 0 and style in self.fallback_prompts:
-                fallback_list = self.fallback_prompts[style]
-                prompt_index = min(attempt - 1, len(fallback_list) - 1)
-                prompt = fallback_list[prompt_index]
-                logger.info(f"Используем альтернативный промпт #{prompt_index + 1} для стиля {style}")
-            else:
-                prompt = style_config['prompt_template']
+            # Основной промпт и альтернативные на случай sensitive content; начинаем с попытки attempt
+            prompts = [style_config['prompt_template']] + self.fallback_prompts.get(style, [])
+            prompts = [self._sanitize_prompt(prompt) for prompt in prompts[min(attempt, len(prompts) - 1):]]
             
-            # Дополнительная санитизация промпта
-            prompt = self._sanitize_prompt(prompt)
+            # Уменьшение до разрешения gen4 и JPEG без метаданных (в пуле процессов, с кэшем по содержимому)
+            normalized = await image_normalizer.normalize(image_bytes, PROFILE_GEN4_REFERENCE)
+            processed_image_bytes = normalized.data
+            logger.info(f"Предобработка изображения: {len(image_bytes)} -> {len(processed_image_bytes)} байт, "
+                        f"{normalized.width}x{normalized.height}")
             
-            # Предобработка изображения: конвертация в JPG
-            logger.info(f"Предобработка изображения: конвертация в JPG")
+            # URL файла в Replicate (повторы и ретраи переиспользуют уже загруженный), data URI — запасной путь
             try:
-                img = Image.open(io.BytesIO(image_bytes))
-            except Exception as pil_err:
-                raise ValueError(f"Невозможно открыть изображение: {str(pil_err)}")
-            
-            buffer = io.BytesIO()
-            img.convert('RGB').save(buffer, format="JPEG", quality=95)
-            buffer.seek(0)
-            processed_image_bytes = buffer.read()
-            
-            # Создаем data URI
-            data_uri = self._create_data_uri(processed_image_bytes)
+                reference_uri = await replicate_upload_cache.upload(
+                    processed_image_bytes, f"reference_{user_id}.jpg", content_type='image/jpeg', client=self.client
+                )
+            except Exception as upload_error:
+                logger.warning(f"Не удалось загрузить референс в Replicate, используем data URI: {upload_error}")
+                reference_uri = self._create_data_uri(processed_image_bytes)
             
-            # Параметры для модели
-            input_params = {
-                "prompt": prompt,
-                "aspect_ratio": aspect_ratio,
-                "reference_tags": ["person"],
-                "reference_images": [data_uri],
-                "output_resolution": resolution
-            }
+            # Параметры для модели: по варианту на каждый промпт
+            inputs = [
+                {
+                    "prompt": prompt,
+                    "aspect_ratio": aspect_ratio,
+                    "reference_tags": ["person"],
+                    "reference_images": [reference_uri],
+                    "output_resolution": resolution
+                }
+                for prompt in prompts
+            ]
             
-            # Создаем prediction
+            # Попытки идут циклом с общим сроком; по /cancel (prediction_tracker.abort) предсказание отменяется в Replicate
             logger.info(f"Создание prediction для модели {style_config['model']}")
-            
-            prediction = await asyncio.to_thread(
-                self.client.predictions.create,
-                model=style_config['model'],
-                input=input_params
+            prediction, attempt_offset = await prediction_tracker.run_with_retries(
+                style_config['model'], inputs, self._is_sensitive_failure, client=self.client, owner=user_id
             )
-            
-            logger.info(f"Prediction создан: {prediction.id}")
-            
-            # Ждем завершения
-            while prediction.status not in ["succeeded", "failed", "canceled"]:
-                await asyncio.sleep(2)
-                prediction = await asyncio.to_thread(
-                    self.client.predictions.get,
-                    prediction.id
-                )
-                logger.info(f"Статус: {prediction.status}")
+            attempt += attempt_offset
             
             if prediction.status == "succeeded":
                 output_url = prediction.output
@@ -274,31 +257,15 @@ class PhotoTransformGenerator:
                     "attempt": attempt
                 }
             else:
-                error_msg = f"Генерация завершилась со статусом: {prediction.status}"
-                if hasattr(prediction, 'error') and prediction.error:
-                    error_msg += f" - {prediction.error}"
-                
+                error_msg = self._failure_message(prediction)
                 logger.error(f"Ошибка генерации: {error_msg}")
                 
-                # Проверяем, является ли это ошибкой sensitive content
-                is_sensitive_error = any(phrase in error_msg.lower() for phrase in [
-                    "sensitive", "flagged", "e005", "inappropriate", "policy"
-                ])
-                
-                # Если это sensitive content и есть еще попытки с альтернативными промптами
-                if is_sensitive_error and style in self.fallback_prompts and attempt < len(self.fallback_prompts[style]):
-                    logger.info(f"Обнаружена ошибка sensitive content, пробуем альтернативный промпт")
-                    # Рекурсивный вызов с увеличенным счетчиком попыток
-                    return await self.generate_image(
-                        image_bytes, style, user_id, aspect_ratio, resolution, attempt + 1
-                    )
-                
                 return {
                     "success": False,
                     "error": error_msg,
                     "style": style,
                     "timestamp": datetime.now().isoformat(),
-                    "is_sensitive": is_sensitive_error,
+                    "is_sensitive": self._is_sensitive_failure(prediction),
                     "attempts_made": attempt + 1
                 }
                 
@@ -311,6 +278,18 @@ class PhotoTransformGenerator:
                 "timestamp": datetime.now().isoformat()
             }
     
+    @staticmethod
+    def _failure_message(prediction) -> str:
+        error_msg = f"Генерация завершилась со статусом: {prediction.status}"
+        if prediction.error:
+            error_msg += f" - {prediction.error}"
+        return error_msg
+    
+    def _is_sensitive_failure(self, prediction) -> bool:
+        """Отклонено ли предсказание фильтром sensitive content (тогда пробуем альтернативный промпт)."""
+        error_msg = self._failure_message(prediction).lower()
+        return any(phrase in error_msg for phrase in ["sensitive", "flagged", "e005", "inappropriate", "policy"])
+    
     def _create_data_uri(self, image_bytes: bytes) -> str:
         """
         Создает data URI для изображения.
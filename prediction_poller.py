@@ -0,0 +1,246 @@
+# prediction_poller.py
+"""Единый опросчик статусов предсказаний и обучений Replicate.
+
+Там, где без опроса не обойтись (вебхуки отключены или потерялись),
+раньше на каждую задачу создавалась своя цепочка спящих задач с
+get_prediction, а check_pending_* при каждом запуске добавляли ещё по
+одной, так что одну задачу могли проверять несколько цепочек сразу.
+
+Теперь все наблюдаемые id лежат в одном реестре, и их опрашивает одна
+фоновая задача:
+
+- watch() для уже наблюдаемого id ничего не делает — дубли отсекаются;
+- к API одновременно идёт не больше PREDICTION_POLL_CONCURRENCY запросов,
+  все созревшие id опрашиваются одной пачкой;
+- интервал начинается с PREDICTION_POLL_INITIAL_INTERVAL и растёт в
+  PREDICTION_POLL_BACKOFF раз до PREDICTION_POLL_MAX_INTERVAL: короткие
+  задачи подхватываются быстро, долгие не нагружают API;
+- каждое изменение статуса передаётся обработчику своего вида задач в
+  отдельной задаче, поэтому долгая доставка результата не тормозит опрос.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from config import (
+    PREDICTION_POLL_CONCURRENCY, PREDICTION_POLL_INITIAL_INTERVAL, PREDICTION_POLL_MAX_INTERVAL,
+    PREDICTION_POLL_BACKOFF, PREDICTION_POLL_MAX_ERRORS
+)
+from metrics import metrics_registry
+from replicate_client import ReplicateObject
+
+logger = logging.getLogger(__name__)
+
+# fetch(id) -> объект со статусом; handler(bot, data, объект, истёк ли срок)
+StatusFetcher = Callable[[str], Awaitable[ReplicateObject]]
+StatusHandler = Callable[[Bot, Dict[str, Any], ReplicateObject, bool], Awaitable[None]]
+
+
+class Watch:
+    """Наблюдаемая задача Replicate."""
+
+    __slots__ = ('job_id', 'kind', 'data', 'interval', 'next_at', 'deadline', 'status', 'polls', 'errors')
+
+    def __init__(self, job_id: str, kind: str, data: Dict[str, Any], interval: float,
+                 deadline: Optional[float]):
+        self.job_id = job_id
+        self.kind = kind
+        self.data = data
+        self.interval = interval
+        self.next_at = time.monotonic() + interval
+        self.deadline = deadline
+        self.status: Optional[str] = None
+        self.polls = 0
+        self.errors = 0
+
+
+class PredictionPoller:
+    """Реестр наблюдаемых id и одна задача, которая их опрашивает."""
+
+    def __init__(self, concurrency: int = PREDICTION_POLL_CONCURRENCY,
+                 initial_interval: float = PREDICTION_POLL_INITIAL_INTERVAL,
+                 max_interval: float = PREDICTION_POLL_MAX_INTERVAL,
+                 backoff: float = PREDICTION_POLL_BACKOFF, max_errors: int = PREDICTION_POLL_MAX_ERRORS):
+        self.concurrency = concurrency
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.bot: Optional[Bot] = None
+        self._kinds: Dict[str, Tuple[StatusFetcher, StatusHandler]] = {}
+        self._watches: Dict[str, Watch] = {}
+        # (время опроса, порядковый номер, id); устаревшие записи пропускаются при выборке
+        self._heap: List[Tuple[float, int, str]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._handler_tasks: set = set()
+        self.duplicates = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.dropped = 0
+        self.dispatched = 0
+        self.expired = 0
+
+    def register(self, kind: str, fetch: StatusFetcher, handler: StatusHandler) -> None:
+        """Регистрирует способ получения статуса и обработчик для вида задач."""
+        self._kinds[kind] = (fetch, handler)
+
+    def _schedule(self, watch: Watch) -> None:
+        heapq.heappush(self._heap, (watch.next_at, next(self._seq), watch.job_id))
+        self._wakeup.set()
+
+    def watch(self, job_id: str, kind: str, data: Dict[str, Any], deadline: Optional[float] = None) -> bool:
+        """Начинает наблюдение за id. False, если id уже наблюдается.
+
+        deadline — секунды, после которых обработчик вызывается с expired=True.
+        """
+        if job_id in self._watches:
+            self.duplicates += 1
+            logger.debug(f"{kind} {job_id} уже наблюдается, повторная проверка отклонена")
+            return False
+        if kind not in self._kinds:
+            raise ValueError(f"Неизвестный вид задач для опроса: {kind}")
+        watch = Watch(job_id, kind, dict(data), self.initial_interval,
+                      time.monotonic() + deadline if deadline else None)
+        self._watches[job_id] = watch
+        self._schedule(watch)
+        logger.info(f"Опрос статуса {kind} {job_id} начат")
+        return True
+
+    def forget(self, job_id: str) -> None:
+        """Прекращает наблюдение (например, результат уже пришёл вебхуком)."""
+        if self._watches.pop(job_id, None) is not None:
+            logger.debug(f"Опрос статуса {job_id} прекращён")
+
+    def is_watching(self, job_id: str) -> bool:
+        return job_id in self._watches
+
+    async def start(self, bot: Bot) -> None:
+        """Запускает задачу опроса."""
+        if self._task:
+            return
+        self.bot = bot
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Опросчик статусов Replicate запущен: до {self.concurrency} запросов одновременно")
+
+    async def stop(self) -> None:
+        """Останавливает опрос и ожидающие обработчики."""
+        tasks = [task for task in [self._task, *self._handler_tasks] if task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        logger.info("Опросчик статусов Replicate остановлен")
+
+    def _due(self, now: float) -> List[Watch]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            next_at, _, job_id = heapq.heappop(self._heap)
+            watch = self._watches.get(job_id)
+            if watch is not None and watch.next_at == next_at:
+                due.append(watch)
+        return due
+
+    async def _run(self) -> None:
+        semaphore = asyncio.Semaphore(self.concurrency)
+        while True:
+            try:
+                self._wakeup.clear()
+                due = self._due(time.monotonic())
+                if due:
+                    await asyncio.gather(*(self._poll(watch, semaphore) for watch in due))
+                    continue
+                timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в цикле опроса статусов: {e}", exc_info=True)
+                await asyncio.sleep(1)
+
+    async def _poll(self, watch: Watch, semaphore: asyncio.Semaphore) -> None:
+        fetch, handler = self._kinds[watch.kind]
+        try:
+            async with semaphore:
+                result = await fetch(watch.job_id)
+        except Exception as e:
+            self.poll_errors += 1
+            watch.errors += 1
+            if watch.errors >= self.max_errors:
+                self.dropped += 1
+                self._watches.pop(watch.job_id, None)
+                logger.error(f"Опрос {watch.kind} {watch.job_id} прекращён после {watch.errors} ошибок подряд: {e}")
+                return
+            logger.warning(f"Ошибка опроса {watch.kind} {watch.job_id} ({watch.errors}/{self.max_errors}): {e}")
+            self._reschedule(watch)
+            return
+
+        if self._watches.get(watch.job_id) is not watch:
+            return  # забыт, пока шёл запрос
+        self.polls += 1
+        watch.polls += 1
+        watch.errors = 0
+        changed = result.status != watch.status
+        watch.status = result.status
+        expired = watch.deadline is not None and time.monotonic() >= watch.deadline
+        if result.finished or expired:
+            self._watches.pop(watch.job_id, None)
+            if expired and not result.finished:
+                self.expired += 1
+            self._dispatch(handler, watch, result, expired and not result.finished)
+            return
+        if changed:
+            logger.info(f"{watch.kind} {watch.job_id}: статус {result.status}")
+            self._dispatch(handler, watch, result, False)
+        self._reschedule(watch)
+
+    def _reschedule(self, watch: Watch) -> None:
+        watch.interval = min(watch.interval * self.backoff, self.max_interval)
+        watch.next_at = time.monotonic() + watch.interval
+        self._schedule(watch)
+
+    def _dispatch(self, handler: StatusHandler, watch: Watch, result: ReplicateObject, expired: bool) -> None:
+        self.dispatched += 1
+        task = asyncio.create_task(handler(self.bot, watch.data, result, expired))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_done)
+
+    def _handler_done(self, task: asyncio.Task) -> None:
+        self._handler_tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Ошибка обработчика статуса Replicate: {task.exception()}", exc_info=task.exception())
+
+    def metrics(self) -> Dict[str, Any]:
+        """Состояние опросчика для /metrics."""
+        watches = list(self._watches.values())
+        by_kind: Dict[str, int] = {}
+        for watch in watches:
+            by_kind[watch.kind] = by_kind.get(watch.kind, 0) + 1
+        return {
+            'running': self._task is not None,
+            'watching': len(watches),
+            'watching_by_kind': by_kind,
+            'handlers_running': len(self._handler_tasks),
+            'polls': self.polls,
+            'poll_errors': self.poll_errors,
+            'duplicates_rejected': self.duplicates,
+            'dispatched': self.dispatched,
+            'expired': self.expired,
+            'dropped': self.dropped,
+        }
+
+
+# Глобальный экземпляр
+prediction_poller = PredictionPoller()
+metrics_registry.register('prediction_poller', prediction_poller.metrics)
+
+__all__ = ['PredictionPoller', 'prediction_poller', 'Watch']
@@ -0,0 +1,268 @@
+# prediction_tracker.py
+"""Ожидание предсказания Replicate внутри запроса: опрос, срок и отмена.
+
+Раньше PhotoTransformGenerator опрашивал предсказание каждые 2 с без
+ограничения по времени и при sensitive content рекурсивно вызывал сам
+себя, а AsyncReplicateClient.run ждал с фиксированным интервалом. Если
+пользователь уходил или задача отменялась, предсказание продолжало
+работать в Replicate, и за него приходилось платить.
+
+PredictionTracker.wait():
+
+- интервал опроса начинается с PREDICTION_TRACK_INITIAL_INTERVAL и растёт
+  в PREDICTION_TRACK_BACKOFF раз до PREDICTION_TRACK_MAX_INTERVAL, а при
+  смене статуса (starting -> processing) сбрасывается: холодный старт
+  модели не опрашивается впустую, а результат после начала обработки
+  подхватывается быстро;
+- общий срок: по его истечении предсказание отменяется в Replicate и
+  поднимается PredictionTimeoutError;
+- abort(owner) (команда /cancel) и отмена ожидающей задачи (CancelledError)
+  тоже отменяют предсказание в Replicate;
+- временные ошибки опроса допускаются до PREDICTION_TRACK_MAX_ERRORS подряд.
+
+run_with_retries() перебирает варианты input (например, альтернативные
+промпты после sensitive content) циклом с общим сроком вместо рекурсии.
+
+run() занимает слот replicate_limiter на всё время предсказания: при
+перегрузке модели лимит одновременных запусков снижается, а при
+разомкнутом предохранителе предсказание не создаётся вовсе.
+
+Для долгих задач без ожидающего запроса (видео, обучение) по-прежнему
+используется prediction_poller; отсюда им нужен только cancel().
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+from config import (
+    PREDICTION_TRACK_INITIAL_INTERVAL, PREDICTION_TRACK_MAX_INTERVAL, PREDICTION_TRACK_BACKOFF,
+    PREDICTION_TRACK_DEADLINE_SECONDS, PREDICTION_TRACK_MAX_ERRORS
+)
+from metrics import metrics_registry
+from replicate_client import AsyncReplicateClient, ReplicateAPIError, ReplicateObject, get_replicate_client
+from replicate_limiter import replicate_limiter
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionTrackingError(ReplicateAPIError):
+    """Ожидание прервано трекером (срок или отмена); предсказание уже отменено в Replicate."""
+
+    def __init__(self, message: str, prediction_id: Optional[str] = None):
+        super().__init__(message)
+        self.prediction_id = prediction_id
+
+
+class PredictionTimeoutError(PredictionTrackingError):
+    pass
+
+
+class PredictionAbortedError(PredictionTrackingError):
+    pass
+
+
+class TrackedPrediction:
+    """Ожидаемое предсказание."""
+
+    __slots__ = ('id', 'owner', 'client', 'aborted', 'started_at', 'status')
+
+    def __init__(self, prediction: ReplicateObject, owner: Optional[int], client: AsyncReplicateClient):
+        self.id = prediction.id
+        self.owner = owner
+        self.client = client
+        self.aborted = asyncio.Event()
+        self.started_at = time.monotonic()
+        self.status = prediction.status
+
+
+class PredictionTracker:
+    """Ожидание предсказаний с адаптивным опросом, сроком и отменой в Replicate."""
+
+    def __init__(self, initial_interval: float = PREDICTION_TRACK_INITIAL_INTERVAL,
+                 max_interval: float = PREDICTION_TRACK_MAX_INTERVAL, backoff: float = PREDICTION_TRACK_BACKOFF,
+                 deadline: float = PREDICTION_TRACK_DEADLINE_SECONDS, max_errors: int = PREDICTION_TRACK_MAX_ERRORS):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.deadline = deadline
+        self.max_errors = max_errors
+        self._active: Dict[str, TrackedPrediction] = {}
+        self.tracked = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.aborts = 0
+        self.retries = 0
+        self.polls = 0
+        self.poll_errors = 0
+        self.remote_cancels = 0
+        self.cancel_errors = 0
+
+    async def cancel(self, job_id: str, client: Optional[AsyncReplicateClient] = None,
+                     training: bool = False) -> bool:
+        """Отменяет предсказание или обучение в Replicate. Ошибки только логируются."""
+        client = client or get_replicate_client()
+        kind = 'обучение' if training else 'предсказание'
+        try:
+            if training:
+                try:
+                    await client.cancel_training(job_id)
+                except ReplicateAPIError as e:
+                    # Обучение могло быть запущено как предсказание (запасной путь start_training)
+                    if e.status != 404:
+                        raise
+                    await client.cancel_prediction(job_id)
+            else:
+                await client.cancel_prediction(job_id)
+        except Exception as e:
+            self.cancel_errors += 1
+            logger.warning(f"Не удалось отменить {kind} {job_id} в Replicate: {e}")
+            return False
+        self.remote_cancels += 1
+        logger.info(f"Отменено {kind} {job_id} в Replicate")
+        return True
+
+    def abort(self, owner: int) -> int:
+        """Прерывает все ожидания пользователя; возвращает их число."""
+        aborted = 0
+        for tracked in list(self._active.values()):
+            if tracked.owner == owner and not tracked.aborted.is_set():
+                tracked.aborted.set()
+                aborted += 1
+        if aborted:
+            logger.info(f"Прервано {aborted} ожидающих предсказаний user_id={owner}")
+        return aborted
+
+    async def wait(self, prediction: ReplicateObject, client: Optional[AsyncReplicateClient] = None,
+                   owner: Optional[int] = None, deadline: Optional[float] = None,
+                   on_update: Optional[Callable[[ReplicateObject], None]] = None) -> ReplicateObject:
+        """Ждёт финального статуса предсказания. deadline — секунды от текущего момента.
+
+        on_update получает каждое опрошенное незавершённое состояние (например,
+        промежуточный output); его ошибки только логируются.
+        """
+        client = client or get_replicate_client()
+        tracked = TrackedPrediction(prediction, owner, client)
+        self._active[tracked.id] = tracked
+        self.tracked += 1
+        until = tracked.started_at + (deadline or self.deadline)
+        interval = self.initial_interval
+        errors = 0
+        try:
+            while not prediction.finished:
+                remaining = until - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    await self.cancel(tracked.id, client)
+                    raise PredictionTimeoutError(
+                        f"Предсказание {tracked.id} не завершилось за {deadline or self.deadline:.0f} с", tracked.id
+                    )
+                try:
+                    await asyncio.wait_for(tracked.aborted.wait(), min(interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                if tracked.aborted.is_set():
+                    self.aborts += 1
+                    await self.cancel(tracked.id, client)
+                    raise PredictionAbortedError(f"Ожидание предсказания {tracked.id} прервано", tracked.id)
+
+                try:
+                    current = await client.get_prediction(tracked.id)
+                except ReplicateAPIError as e:
+                    self.poll_errors += 1
+                    errors += 1
+                    if errors >= self.max_errors:
+                        raise
+                    logger.warning(f"Ошибка опроса предсказания {tracked.id} ({errors}/{self.max_errors}): {e}")
+                    interval = min(interval * self.backoff, self.max_interval)
+                    continue
+                self.polls += 1
+                errors = 0
+                if current.status != prediction.status:
+                    logger.info(f"Предсказание {tracked.id}: статус {current.status}")
+                    tracked.status = current.status
+                    interval = self.initial_interval
+                else:
+                    interval = min(interval * self.backoff, self.max_interval)
+                prediction = current
+                if on_update is not None and not prediction.finished:
+                    try:
+                        on_update(prediction)
+                    except Exception as e:
+                        logger.warning(f"Ошибка обработчика обновления предсказания {tracked.id}: {e}")
+        except asyncio.CancelledError:
+            # Ожидающую задачу отменили (пользователь ушёл, остановка бота): не платим за ненужный результат
+            self.aborts += 1
+            await asyncio.shield(self.cancel(tracked.id, client))
+            raise
+        finally:
+            self._active.pop(tracked.id, None)
+
+        if prediction.status == 'succeeded':
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        return prediction
+
+    async def run(self, ref: str, input: Dict[str, Any], client: Optional[AsyncReplicateClient] = None,
+                  owner: Optional[int] = None, deadline: Optional[float] = None,
+                  on_update: Optional[Callable[[ReplicateObject], None]] = None, **create_kwargs) -> ReplicateObject:
+        """Создаёт предсказание и ждёт его завершения (успешного или нет).
+
+        Ожидание слота модели в replicate_limiter в срок deadline не входит.
+        """
+        client = client or get_replicate_client()
+        async with replicate_limiter.slot(ref):
+            prediction = await client.create_prediction(ref, input, **create_kwargs)
+            logger.info(f"Предсказание {prediction.id} создано для {ref}")
+            return await self.wait(prediction, client=client, owner=owner, deadline=deadline, on_update=on_update)
+
+    async def run_with_retries(self, ref: str, inputs: Sequence[Dict[str, Any]],
+                               should_retry: Callable[[ReplicateObject], bool],
+                               client: Optional[AsyncReplicateClient] = None, owner: Optional[int] = None,
+                               deadline: Optional[float] = None) -> Tuple[ReplicateObject, int]:
+        """Запускает варианты input по очереди, пока предсказание не успешно и should_retry разрешает повтор.
+
+        Возвращает (последнее предсказание, индекс варианта). Срок общий на все попытки.
+        """
+        if not inputs:
+            raise ValueError("Нет вариантов input для запуска")
+        total = deadline or self.deadline
+        until = time.monotonic() + total
+        for attempt, input in enumerate(inputs):
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                raise PredictionTimeoutError(f"Попытки {ref} не уложились в {total:.0f} с")
+            prediction = await self.run(ref, input, client=client, owner=owner, deadline=remaining)
+            if prediction.status == 'succeeded' or attempt == len(inputs) - 1 or not should_retry(prediction):
+                return prediction, attempt
+            self.retries += 1
+            logger.info(f"Предсказание {prediction.id} завершилось со статусом {prediction.status}, "
+                        f"попытка {attempt + 2} из {len(inputs)}")
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики ожиданий для /metrics."""
+        return {
+            'active': len(self._active),
+            'tracked': self.tracked,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'timeouts': self.timeouts,
+            'aborts': self.aborts,
+            'retries': self.retries,
+            'polls': self.polls,
+            'poll_errors': self.poll_errors,
+            'remote_cancels': self.remote_cancels,
+            'cancel_errors': self.cancel_errors,
+        }
+
+
+# Глобальный экземпляр
+prediction_tracker = PredictionTracker()
+metrics_registry.register('prediction_tracker', prediction_tracker.metrics)
+
+__all__ = ['PredictionTracker', 'TrackedPrediction', 'prediction_tracker', 'PredictionTrackingError',
+           'PredictionTimeoutError', 'PredictionAbortedError']
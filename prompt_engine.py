@@ -0,0 +1,137 @@
+# prompt_engine.py
+"""Предкомпилированная сборка промптов и выбор пресета LoRA.
+
+Всё, что раньше пересобиралось на каждый запрос в process_prompt_async и
+prepare_model_params, строится один раз при импорте (или в
+reload_prompt_engine() после изменения generation_config):
+
+- постоянные фрагменты промпта склеены и нормализованы заранее, на запрос
+  нормализуются только пользовательские части;
+- пресеты ULTRA_PHOTOREALISTIC_PRESETS разрешены в готовые слоты LoRA
+  (модель, сила) и суффикс промпта;
+- слова выбора пресета приведены к нижнему регистру и сгруппированы.
+
+Замеры — benchmarks/prompt_engine_benchmark.py.
+"""
+
+import logging
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from generation_config import (
+    ULTRA_PROFESSIONAL_LORA_CONFIG, ULTRA_PHOTOREALISTIC_PRESETS, PRESET_TRIGGER_WORDS,
+    DEFAULT_PHOTOREALISTIC_PRESET, PHOTOREALISTIC_ENHANCERS, ANTI_CGI_DETAILS
+)
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE_RE = re.compile(r'\s+')
+MAX_PROMPT_LENGTH = 4000
+
+
+class LoraSlot(NamedTuple):
+    """LoRA, готовая к подстановке в hf_lora_N / lora_scale_N."""
+    name: str
+    model: str
+    strength: float
+
+
+class CompiledPreset(NamedTuple):
+    """Пресет фотореализма с разрешёнными LoRA и готовым суффиксом промпта."""
+    name: str
+    guidance_scale: float
+    num_inference_steps: int
+    prompt_suffix: str
+    loras: Tuple[LoraSlot, ...]
+
+
+def _normalize(text: str) -> str:
+    return WHITESPACE_RE.sub(' ', text).strip()
+
+
+def _slots(names: Iterable[str], config: Dict[str, Dict]) -> Tuple[LoraSlot, ...]:
+    return tuple(
+        LoraSlot(name, config[name]["model"], config[name]["strength"])
+        for name in names if name in config
+    )
+
+
+class PromptEngine:
+    """Скомпилированные шаблоны промпта и таблицы LoRA."""
+
+    def __init__(self, professional_loras: Dict[str, Dict] = ULTRA_PROFESSIONAL_LORA_CONFIG,
+                 photorealistic_presets: Dict[str, Dict] = ULTRA_PHOTOREALISTIC_PRESETS,
+                 trigger_words: Dict[str, List[str]] = PRESET_TRIGGER_WORDS,
+                 default_preset: str = DEFAULT_PHOTOREALISTIC_PRESET,
+                 enhancers: List[str] = PHOTOREALISTIC_ENHANCERS, anti_cgi_details: str = ANTI_CGI_DETAILS,
+                 max_prompt_length: int = MAX_PROMPT_LENGTH):
+        self.max_prompt_length = max_prompt_length
+        self._enhancers_text = _normalize(", ".join(enhancers))
+        self._anti_cgi_text = _normalize(anti_cgi_details)
+
+        self.presets: Dict[str, CompiledPreset] = {
+            name: CompiledPreset(
+                name=name,
+                guidance_scale=preset["guidance_scale"],
+                num_inference_steps=preset["num_inference_steps"],
+                prompt_suffix=f", {preset['prompt_additions']}",
+                loras=_slots(preset["loras"], professional_loras)
+            )
+            for name, preset in photorealistic_presets.items()
+        }
+        self.default_preset = self.presets[default_preset]
+        self._preset_rules: Tuple[Tuple[Tuple[str, ...], CompiledPreset], ...] = tuple(
+            (tuple(word.lower() for word in words), self.presets[name])
+            for name, words in trigger_words.items() if name in self.presets and words
+        )
+        self.anti_cgi = _slots(["anti_cgi"], professional_loras)[0]
+
+    def build_prompt(self, base_prompt: Optional[str], trigger_word: Optional[str] = None,
+                     selected_gender: Optional[str] = None, custom: bool = False) -> str:
+        """Собирает промпт: триггер, усилители, пол, текст пользователя, анти-CGI детали.
+
+        Для кастомного промпта постоянные фрагменты не добавляются.
+        """
+        parts = []
+        if trigger_word:
+            parts.append(_normalize(trigger_word))
+        if not custom:
+            parts.append(self._enhancers_text)
+        if selected_gender:
+            parts.append(_normalize(selected_gender))
+        parts.append(_normalize(base_prompt or ''))
+        if not custom:
+            parts.append(self._anti_cgi_text)
+        prompt = ", ".join(parts)
+
+        if len(prompt) > self.max_prompt_length:
+            prompt = prompt[:self.max_prompt_length].rsplit(', ', 1)[0]
+            logger.warning(f"Промпт обрезан до {self.max_prompt_length} символов: {prompt[:50]}...")
+        return prompt
+
+    def select_preset(self, prompt: str) -> CompiledPreset:
+        """Пресет фотореализма по словам промпта (подстрока без учёта регистра)."""
+        prompt_lower = prompt.lower()
+        for words, preset in self._preset_rules:
+            if any(word in prompt_lower for word in words):
+                return preset
+        return self.default_preset
+
+
+_engine = PromptEngine()
+
+
+def get_prompt_engine() -> PromptEngine:
+    """Текущий скомпилированный движок."""
+    return _engine
+
+
+def reload_prompt_engine(**overrides) -> PromptEngine:
+    """Пересобирает движок, например после изменения конфигурации LoRA."""
+    global _engine
+    _engine = PromptEngine(**overrides)
+    logger.info("Движок промптов пересобран")
+    return _engine
+
+
+__all__ = ['PromptEngine', 'LoraSlot', 'CompiledPreset', 'get_prompt_engine', 'reload_prompt_engine']
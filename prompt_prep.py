@@ -0,0 +1,179 @@
+# prompt_prep.py
+"""Подготовка промпта заранее, пока пользователь выбирает формат.
+
+Раньше перевод, сборка промпта с усилителями и поиск активного аватара
+выполнялись в _generate_image_internal только после выбора соотношения
+сторон, подтверждения и ожидания в очереди. Эти шаги от формата не
+зависят, поэтому schedule() запускает их фоном, как только известен
+промпт, и сохраняет результат в FSM под ключом PROMPT_PREP_KEY вместе с
+отпечатком входных данных (промпт, тип генерации, модель, пол, идея для
+AI-помощника, кастомность) и подписью аватара.
+
+take() при запуске генерации отдаёт готовый результат, дожидается ещё
+идущей подготовки или возвращает None — тогда всё считается как раньше.
+Результат отбрасывается, если с тех пор изменился вход, сменился активный
+аватар или истёк PROMPT_PREP_TTL_SECONDS. Баланс по-прежнему проверяется
+при подтверждении: заранее проверенный баланс к тому моменту мог измениться.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from aiogram.fsm.context import FSMContext
+from config import PROMPT_PREP_TTL_SECONDS
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+PROMPT_PREP_KEY = 'prompt_prep'
+# Генерации изображений, для которых промпт собирает process_prompt_async
+PREPARED_GENERATION_TYPES = ('with_avatar', 'photo_to_photo')
+
+
+def preparation_key(user_data: Dict[str, Any], target_user_id: int) -> Optional[str]:
+    """Отпечаток входных данных подготовки; None, если готовить нечего."""
+    generation_type = user_data.get('generation_type')
+    prompt = user_data.get('prompt')
+    if generation_type not in PREPARED_GENERATION_TYPES or not prompt or not isinstance(prompt, str):
+        return None
+    raw = json.dumps([
+        target_user_id, prompt, generation_type, user_data.get('model_key') or 'flux-trained',
+        user_data.get('selected_gender'), user_data.get('user_input_for_llama'),
+        bool(user_data.get('came_from_custom_prompt'))
+    ], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def avatar_signature(trained_model_data: Optional[Sequence[Any]]) -> Optional[List[Any]]:
+    """(id аватара, model_id, версия, триггер) — то, от чего зависит подготовленный промпт."""
+    if not trained_model_data or trained_model_data[3] != 'success':
+        return None
+    avatar_id, model_id, model_version, _, _, trigger_word = trained_model_data[:6]
+    return [avatar_id, model_id, model_version, trigger_word]
+
+
+class PromptPreparer:
+    """Фоновая подготовка промпта с результатом в FSM."""
+
+    def __init__(self, ttl: float = PROMPT_PREP_TTL_SECONDS):
+        self.ttl = ttl
+        self._tasks: Dict[Tuple[int, str], asyncio.Task] = {}
+        self.started = 0
+        self.prepared = 0
+        self.errors = 0
+        self.hits = 0
+        self.awaited = 0
+        self.misses = 0
+        self.stale = 0
+        self.superseded = 0
+
+    def schedule(self, state: FSMContext, target_user_id: int, user_data: Dict[str, Any]) -> None:
+        """Запускает подготовку для текущих данных FSM, если она ещё не готова и не идёт."""
+        key = preparation_key(user_data, target_user_id)
+        if key is None:
+            return
+        prepared = user_data.get(PROMPT_PREP_KEY)
+        if prepared and prepared.get('key') == key:
+            return
+        task_key = (target_user_id, key)
+        if task_key in self._tasks:
+            return
+        self.started += 1
+        task = asyncio.create_task(self._prepare(state, target_user_id, key, dict(user_data)))
+        self._tasks[task_key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(task_key, None))
+
+    async def _prepare(self, state: FSMContext, target_user_id: int, key: str,
+                       user_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Импорт здесь: generation.images сам использует prompt_preparer
+        from generation.images import get_active_model_cached, process_prompt_async, resolve_avatar_model
+        started = time.monotonic()
+        try:
+            trained_model_data = await get_active_model_cached(target_user_id)
+            avatar = avatar_signature(trained_model_data)
+            if avatar is None:
+                return None
+            model_key = user_data.get('model_key') or 'flux-trained'
+            replicate_model_id, use_new_flux = resolve_avatar_model(avatar[1], avatar[2])
+            processed_prompt = await process_prompt_async(
+                user_data['prompt'], model_key, user_data['generation_type'],
+                avatar[3], user_data.get('selected_gender'), user_data.get('user_input_for_llama'), user_data,
+                use_new_flux=use_new_flux
+            )
+        except Exception as e:
+            self.errors += 1
+            logger.warning(f"Предварительная подготовка промпта для user_id={target_user_id} не удалась: {e}")
+            return None
+
+        prepared = {
+            'key': key,
+            'avatar': avatar,
+            'replicate_model_id': replicate_model_id,
+            'use_new_flux': use_new_flux,
+            'processed_prompt': processed_prompt,
+            'prepared_at': time.time(),
+        }
+        # Пока шла подготовка, пользователь мог сменить промпт или стиль
+        current = await state.get_data()
+        if preparation_key(current, target_user_id) != key:
+            self.superseded += 1
+            logger.debug(f"Подготовка промпта для user_id={target_user_id} устарела до сохранения")
+        else:
+            await state.update_data({PROMPT_PREP_KEY: prepared})
+        self.prepared += 1
+        logger.info(f"Промпт для user_id={target_user_id} подготовлен заранее за {time.monotonic() - started:.2f} с")
+        return prepared
+
+    async def take(self, target_user_id: int, user_data: Dict[str, Any],
+                   trained_model_data: Optional[Sequence[Any]]) -> Optional[Dict[str, Any]]:
+        """Подготовленный результат для текущих данных или None, если его нужно посчитать заново."""
+        key = preparation_key(user_data, target_user_id)
+        if key is None:
+            return None
+        prepared = user_data.get(PROMPT_PREP_KEY)
+        if not prepared or prepared.get('key') != key:
+            task = self._tasks.get((target_user_id, key))
+            if task is None:
+                self.misses += 1
+                return None
+            self.awaited += 1
+            prepared = await asyncio.shield(task)
+            if prepared is None:
+                self.misses += 1
+                return None
+        if time.time() - prepared.get('prepared_at', 0) > self.ttl:
+            self.stale += 1
+            return None
+        if prepared.get('avatar') != avatar_signature(trained_model_data):
+            self.stale += 1
+            logger.info(f"Активный аватар user_id={target_user_id} сменился, подготовленный промпт отброшен")
+            return None
+        self.hits += 1
+        return prepared
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики предварительной подготовки для /metrics."""
+        used = self.hits + self.misses + self.stale
+        return {
+            'in_flight': len(self._tasks),
+            'started': self.started,
+            'prepared': self.prepared,
+            'errors': self.errors,
+            'hits': self.hits,
+            'awaited': self.awaited,
+            'misses': self.misses,
+            'stale': self.stale,
+            'superseded': self.superseded,
+            'hit_rate': round(self.hits / used, 3) if used else None,
+        }
+
+
+# Глобальный экземпляр
+prompt_preparer = PromptPreparer()
+metrics_registry.register('prompt_prep', prompt_preparer.metrics)
+
+__all__ = ['PromptPreparer', 'prompt_preparer', 'preparation_key', 'avatar_signature', 'PROMPT_PREP_KEY']
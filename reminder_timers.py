@@ -0,0 +1,254 @@
+# reminder_timers.py
+"""Постоянное хранилище таймеров онбординга и тарифных напоминаний.
+
+Каждое отложенное сообщение — строка (user_id, message_type, due_at) в
+таблице reminder_timers. Один диспетчер на процесс спит до ближайшего
+срока, забирает созревшие таймеры пачкой и отправляет их через token
+bucket, поэтому память не растёт с числом регистраций, а таймеры
+переживают перезапуск бота.
+
+TelegramRetryAfter снижает скорость token bucket, а таймер откладывается
+на retry_after и возвращается в 'pending'; после REMINDER_MAX_ATTEMPTS
+попыток он помечается 'failed'.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiosqlite
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from config import DATABASE_PATH, REMINDER_MAX_RATE, REMINDER_CONCURRENCY, REMINDER_BATCH_SIZE, REMINDER_MAX_ATTEMPTS
+from broadcast_engine import TokenBucket
+from database import check_database_user
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+# Результат отправки таймера: (id, новый статус, новый срок или None)
+SendResult = Tuple[int, str, Optional[float]]
+
+# Максимальный сон диспетчера без пробуждения — страховка от перевода часов
+MAX_IDLE_SECONDS = 3600
+
+
+async def init_reminder_timers_table(conn: aiosqlite.Connection) -> None:
+    """Создаёт таблицу таймеров и индекс по ближайшему сроку."""
+    await conn.execute('''CREATE TABLE IF NOT EXISTS reminder_timers (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            user_id INTEGER NOT NULL,
+                            message_type TEXT NOT NULL,
+                            due_at REAL NOT NULL,
+                            status TEXT DEFAULT 'pending',
+                            attempts INTEGER DEFAULT 0,
+                            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                            sent_at REAL DEFAULT NULL,
+                            UNIQUE (user_id, message_type)
+                         )''')
+    await conn.execute('CREATE INDEX IF NOT EXISTS idx_reminder_timers_status_due ON reminder_timers(status, due_at)')
+    await conn.commit()
+
+
+class ReminderDispatcher:
+    """Единственный диспетчер отложенных онбординг-сообщений.
+
+    schedule() только пишет строку в БД и будит диспетчер, если новый таймер
+    раньше текущего ближайшего. Сам диспетчер держит в памяти лишь время
+    ближайшего срока и счётчики.
+    """
+
+    def __init__(self, batch_size: int = REMINDER_BATCH_SIZE, concurrency: int = REMINDER_CONCURRENCY,
+                 bucket: Optional[TokenBucket] = None, max_attempts: int = REMINDER_MAX_ATTEMPTS):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.bucket = bucket or TokenBucket(rate=REMINDER_MAX_RATE)
+        self.bot: Optional[Bot] = None
+        self.next_due_at: Optional[float] = None
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+        self.scheduled = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._table_ready = False
+
+    async def _ensure_table(self, conn: aiosqlite.Connection) -> None:
+        if not self._table_ready:
+            await init_reminder_timers_table(conn)
+            self._table_ready = True
+
+    async def schedule(self, user_id: int, message_type: str, due_at: datetime) -> bool:
+        """Сохраняет таймер. Повторный вызов для той же пары (user_id, message_type) ничего не меняет.
+
+        Возвращает True, если таймер был создан.
+        """
+        due_ts = due_at.timestamp()
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await self._ensure_table(conn)
+            cursor = await conn.execute(
+                "INSERT OR IGNORE INTO reminder_timers (user_id, message_type, due_at) VALUES (?, ?, ?)",
+                (user_id, message_type, due_ts)
+            )
+            await conn.commit()
+            created = cursor.rowcount > 0
+        if not created:
+            logger.debug(f"Таймер {message_type} для user_id={user_id} уже существует, пропускаем")
+            return False
+        self.scheduled += 1
+        if self.next_due_at is None or due_ts < self.next_due_at:
+            self._wakeup.set()
+        return True
+
+    async def start(self, bot: Bot) -> None:
+        """Запускает диспетчер. Таймеры, прерванные остановкой бота, возвращаются в очередь."""
+        if self._task and not self._task.done():
+            return
+        self.bot = bot
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await self._ensure_table(conn)
+            cursor = await conn.execute(
+                "UPDATE reminder_timers SET status = 'pending' WHERE status = 'sending'"
+            )
+            await conn.commit()
+            if cursor.rowcount:
+                logger.warning(f"Возвращено в очередь {cursor.rowcount} прерванных таймеров")
+        self._task = asyncio.create_task(self._run())
+        logger.info("Диспетчер онбординг-напоминаний запущен")
+
+    async def stop(self) -> None:
+        """Останавливает диспетчер. Незавершённые таймеры остаются в БД."""
+        if not self._task:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        logger.info("Диспетчер онбординг-напоминаний остановлен")
+
+    async def _load_next_due(self) -> Optional[float]:
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            cursor = await conn.execute(
+                "SELECT MIN(due_at) FROM reminder_timers WHERE status = 'pending'"
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def _claim_due(self) -> List[Tuple[int, int, str, int]]:
+        """Атомарно помечает пачку созревших таймеров как 'sending' и возвращает их с номером попытки."""
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await conn.execute('BEGIN IMMEDIATE')
+            cursor = await conn.execute(
+                """SELECT id, user_id, message_type, attempts + 1 FROM reminder_timers
+                   WHERE status = 'pending' AND due_at <= ?
+                   ORDER BY due_at LIMIT ?""",
+                (time.time(), self.batch_size)
+            )
+            rows = await cursor.fetchall()
+            if rows:
+                await conn.executemany(
+                    "UPDATE reminder_timers SET status = 'sending', attempts = attempts + 1 WHERE id = ?",
+                    [(row[0],) for row in rows]
+                )
+            await conn.commit()
+        return rows
+
+    async def _mark(self, results: List[SendResult]) -> None:
+        now = time.time()
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await conn.executemany(
+                "UPDATE reminder_timers SET status = ?, sent_at = ? WHERE id = ?",
+                [(status, now, timer_id) for timer_id, status, due_at in results if due_at is None]
+            )
+            await conn.executemany(
+                "UPDATE reminder_timers SET status = ?, due_at = ? WHERE id = ?",
+                [(status, due_at, timer_id) for timer_id, status, due_at in results if due_at is not None]
+            )
+            await conn.commit()
+
+    async def _send_one(self, semaphore: asyncio.Semaphore, timer_id: int, user_id: int, message_type: str,
+                        attempt: int) -> SendResult:
+        # Импорт здесь: handlers.onboarding сам импортирует этот модуль
+        from handlers.onboarding import send_onboarding_message
+        async with semaphore:
+            await self.bucket.acquire()
+            try:
+                subscription_data = await check_database_user(user_id)
+                await send_onboarding_message(self.bot, user_id, message_type, subscription_data)
+                self.bucket.on_success()
+                self.sent += 1
+                return timer_id, 'sent', None
+            except TelegramRetryAfter as e:
+                self.bucket.on_retry_after(e.retry_after)
+                if attempt >= self.max_attempts:
+                    self.failed += 1
+                    logger.error(f"Таймер {message_type} для user_id={user_id}: RetryAfter после {attempt} попыток")
+                    return timer_id, 'failed', None
+                self.deferred += 1
+                logger.warning(f"Таймер {message_type} для user_id={user_id} отложен на {e.retry_after} с (RetryAfter)")
+                return timer_id, 'pending', time.time() + e.retry_after
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка отправки таймера {message_type} для user_id={user_id}: {e}", exc_info=True)
+                return timer_id, 'failed', None
+
+    async def _dispatch_due(self) -> int:
+        rows = await self._claim_due()
+        if not rows:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[
+            self._send_one(semaphore, timer_id, user_id, message_type, attempt)
+            for timer_id, user_id, message_type, attempt in rows
+        ])
+        await self._mark(results)
+        logger.info(f"Отправлено онбординг-сообщений: {len(rows)}")
+        return len(rows)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                self.next_due_at = await self._load_next_due()
+                if self.next_due_at is None:
+                    timeout = MAX_IDLE_SECONDS
+                else:
+                    timeout = min(MAX_IDLE_SECONDS, self.next_due_at - time.time())
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+                # Забираем пачки, пока созревшие таймеры не кончатся
+                while await self._dispatch_due() >= self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка диспетчера онбординг-напоминаний: {e}", exc_info=True)
+                await asyncio.sleep(5)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики диспетчера для /metrics."""
+        return {
+            'running': bool(self._task and not self._task.done()),
+            'scheduled': self.scheduled,
+            'sent': self.sent,
+            'failed': self.failed,
+            'deferred': self.deferred,
+            'next_due_in': round(self.next_due_at - time.time(), 1) if self.next_due_at else None,
+            'rate': round(self.bucket.rate, 2),
+        }
+
+
+# Глобальный экземпляр
+reminder_dispatcher = ReminderDispatcher()
+metrics_registry.register('reminders', reminder_dispatcher.metrics)
+
+__all__ = ['ReminderDispatcher', 'reminder_dispatcher', 'init_reminder_timers_table']
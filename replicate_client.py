@@ -0,0 +1,337 @@
+# replicate_client.py
+"""Асинхронный клиент Replicate HTTP API.
+
+Одна долгоживущая aiohttp-сессия с пулом соединений (keep-alive, лимит на
+хост) вместо replicate.Client + run_in_executor: запросы к Replicate больше
+не занимают потоки стандартного executor'а, которых всего min(32, cpu + 4).
+"""
+
+import asyncio
+import logging
+import mimetypes
+import os
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple, Union
+
+import aiofiles
+import aiohttp
+from replicate.exceptions import ReplicateError
+from config import (
+    REPLICATE_API_TOKEN, REPLICATE_HTTP_POOL_LIMIT, REPLICATE_HTTP_PER_HOST_LIMIT,
+    REPLICATE_HTTP_KEEPALIVE_SECONDS, REPLICATE_HTTP_TIMEOUT_SECONDS, REPLICATE_STREAM_READ_TIMEOUT_SECONDS
+)
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+REPLICATE_API_URL = "https://api.replicate.com/v1"
+TERMINAL_STATUSES = ('succeeded', 'failed', 'canceled')
+
+
+class ReplicateAPIError(ReplicateError):
+    """Ошибка ответа Replicate API.
+
+    Наследуется от ReplicateError, поэтому существующие tenacity-ретраи и
+    обработчики except ReplicateError продолжают работать. ReplicateError.__str__
+    и __repr__ читают type/title/instance, поэтому вызывается и его __init__,
+    а str() возвращает само сообщение.
+    """
+
+    def __init__(self, message: str, status: Optional[int] = None, detail: Optional[str] = None):
+        Exception.__init__(self, message)
+        ReplicateError.__init__(self, status=status, detail=detail or message)
+        self.message = message
+
+    def __str__(self) -> str:
+        return self.message
+
+
+class ReplicateObject:
+    """Предсказание или обучение Replicate с доступом к полям как к атрибутам."""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.data = data
+        self.id: Optional[str] = data.get('id')
+        self.status: Optional[str] = data.get('status')
+        self.output: Any = data.get('output')
+        self.error: Any = data.get('error')
+        self.logs: Optional[str] = data.get('logs')
+        self.urls: Dict[str, str] = data.get('urls') or {}
+
+    @property
+    def finished(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def __repr__(self) -> str:
+        return f"ReplicateObject(id={self.id!r}, status={self.status!r})"
+
+
+def _prediction_route(ref: str) -> Tuple[str, Dict[str, Any]]:
+    """Определяет эндпоинт создания предсказания по ссылке на модель.
+
+    'owner/name:version' и голый id версии идут в /predictions,
+    'owner/name' — в /models/owner/name/predictions (официальные модели).
+    """
+    if ':' in ref:
+        return '/predictions', {'version': ref.split(':', 1)[1]}
+    if '/' in ref:
+        return f'/models/{ref}/predictions', {}
+    return '/predictions', {'version': ref}
+
+
+class AsyncReplicateClient:
+    """Клиент Replicate поверх общей aiohttp-сессии."""
+
+    def __init__(self, api_token: Optional[str] = None, base_url: str = REPLICATE_API_URL,
+                 pool_limit: int = REPLICATE_HTTP_POOL_LIMIT, per_host_limit: int = REPLICATE_HTTP_PER_HOST_LIMIT,
+                 keepalive_timeout: float = REPLICATE_HTTP_KEEPALIVE_SECONDS, timeout: float = REPLICATE_HTTP_TIMEOUT_SECONDS):
+        self.api_token = api_token or REPLICATE_API_TOKEN
+        self.base_url = base_url.rstrip('/')
+        self.pool_limit = pool_limit
+        self.per_host_limit = per_host_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.requests_total = 0
+        self.errors_total = 0
+        self.in_flight = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._session_lock: Optional[asyncio.Lock] = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is not None and not self._session.closed:
+            return self._session
+        if self._session_lock is None:
+            self._session_lock = asyncio.Lock()
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.pool_limit,
+                    limit_per_host=self.per_host_limit,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=300
+                )
+                self._session = aiohttp.ClientSession(
+                    connector=connector,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout),
+                    headers={'Authorization': f'Bearer {self.api_token}'}
+                )
+                logger.info(f"Создана сессия Replicate HTTP (лимит {self.pool_limit}, на хост {self.per_host_limit})")
+        return self._session
+
+    async def request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        """Выполняет запрос к API и возвращает JSON ответа."""
+        session = await self._get_session()
+        url = path if path.startswith('http') else f"{self.base_url}{path}"
+        self.requests_total += 1
+        self.in_flight += 1
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                if response.status >= 400:
+                    self.errors_total += 1
+                    try:
+                        body = await response.json(content_type=None)
+                        detail = body.get('detail') or body.get('title') or str(body)
+                    except (aiohttp.ContentTypeError, ValueError):
+                        detail = await response.text()
+                    raise ReplicateAPIError(
+                        f"Replicate API {method} {path}: {response.status} {detail}",
+                        status=response.status, detail=detail
+                    )
+                if response.status == 204:
+                    return {}
+                return await response.json(content_type=None)
+        except aiohttp.ClientError as e:
+            self.errors_total += 1
+            raise ReplicateAPIError(f"Ошибка соединения с Replicate ({method} {path}): {e}") from e
+        except asyncio.TimeoutError as e:
+            self.errors_total += 1
+            raise ReplicateAPIError(f"Таймаут запроса к Replicate ({method} {path})") from e
+        finally:
+            self.in_flight -= 1
+
+    async def create_prediction(self, ref: str, input: Dict[str, Any], webhook: Optional[str] = None,
+                                webhook_events_filter: Optional[List[str]] = None,
+                                stream: bool = False) -> ReplicateObject:
+        """Создаёт предсказание для 'owner/name', 'owner/name:version' или id версии.
+
+        stream=True запрашивает SSE-поток вывода (urls['stream']) у моделей, которые его поддерживают.
+        """
+        path, payload = _prediction_route(ref)
+        payload['input'] = input
+        if stream:
+            payload['stream'] = True
+        if webhook:
+            payload['webhook'] = webhook
+            if webhook_events_filter:
+                payload['webhook_events_filter'] = webhook_events_filter
+        return ReplicateObject(await self.request('POST', path, json=payload))
+
+    async def get_prediction(self, prediction_id: str) -> ReplicateObject:
+        return ReplicateObject(await self.request('GET', f'/predictions/{prediction_id}'))
+
+    async def cancel_prediction(self, prediction_id: str) -> ReplicateObject:
+        return ReplicateObject(await self.request('POST', f'/predictions/{prediction_id}/cancel'))
+
+    async def stream_events(self, url: str,
+                            read_timeout: float = REPLICATE_STREAM_READ_TIMEOUT_SECONDS) -> AsyncIterator[Tuple[str, str]]:
+        """Читает SSE-поток предсказания и отдаёт пары (event, data).
+
+        События Replicate: output (очередной фрагмент вывода), error и done
+        (data — JSON, при отмене или ошибке с полем reason). Общего таймаута
+        у потока нет, ограничена только пауза между данными.
+        """
+        session = await self._get_session()
+        self.requests_total += 1
+        self.in_flight += 1
+        try:
+            async with session.get(
+                url,
+                headers={'Accept': 'text/event-stream', 'Cache-Control': 'no-store'},
+                timeout=aiohttp.ClientTimeout(total=None, sock_read=read_timeout)
+            ) as response:
+                if response.status >= 400:
+                    self.errors_total += 1
+                    detail = await response.text()
+                    raise ReplicateAPIError(
+                        f"Replicate stream: {response.status} {detail}", status=response.status, detail=detail
+                    )
+                event, data = 'message', []
+                async for raw in response.content:
+                    line = raw.decode('utf-8').rstrip('\r\n')
+                    if not line:
+                        if data or event != 'message':
+                            yield event, '\n'.join(data)
+                        event, data = 'message', []
+                        continue
+                    if line.startswith(':'):
+                        continue
+                    field, _, value = line.partition(':')
+                    if value.startswith(' '):
+                        value = value[1:]
+                    if field == 'event':
+                        event = value
+                    elif field == 'data':
+                        data.append(value)
+        except aiohttp.ClientError as e:
+            self.errors_total += 1
+            raise ReplicateAPIError(f"Ошибка соединения с потоком Replicate: {e}") from e
+        except asyncio.TimeoutError as e:
+            self.errors_total += 1
+            raise ReplicateAPIError("Таймаут чтения потока Replicate") from e
+        finally:
+            self.in_flight -= 1
+
+    async def wait(self, prediction: ReplicateObject, poll_interval: float = 1.0,
+                   timeout: Optional[float] = None) -> ReplicateObject:
+        """Опрашивает предсказание до финального статуса."""
+        deadline = time.monotonic() + timeout if timeout else None
+        while not prediction.finished:
+            if deadline and time.monotonic() >= deadline:
+                raise ReplicateAPIError(f"Предсказание {prediction.id} не завершилось за {timeout} с")
+            await asyncio.sleep(poll_interval)
+            prediction = await self.get_prediction(prediction.id)
+        return prediction
+
+    async def run(self, ref: str, input: Dict[str, Any], poll_interval: float = 1.0,
+                  timeout: Optional[float] = None) -> Any:
+        """Создаёт предсказание, дожидается результата и возвращает output.
+
+        Неуспешное предсказание поднимает ReplicateAPIError, как replicate.run.
+        """
+        prediction = await self.create_prediction(ref, input)
+        prediction = await self.wait(prediction, poll_interval=poll_interval, timeout=timeout)
+        if prediction.status != 'succeeded':
+            raise ReplicateAPIError(
+                f"Предсказание {prediction.id} завершилось со статусом {prediction.status}: {prediction.error}",
+                detail=str(prediction.error)
+            )
+        return prediction.output
+
+    async def upload_file(self, file: Union[str, bytes], filename: Optional[str] = None,
+                          content_type: Optional[str] = None) -> str:
+        """Загружает файл (путь или байты) в Replicate Files и возвращает URL для input."""
+        data = await self.create_file(file, filename=filename, content_type=content_type)
+        return data['urls']['get']
+
+    async def create_file(self, file: Union[str, bytes], filename: Optional[str] = None,
+                          content_type: Optional[str] = None) -> Dict[str, Any]:
+        """Загружает файл в Replicate Files и возвращает описание файла (urls, expires_at и т.д.)."""
+        if isinstance(file, str):
+            filename = filename or os.path.basename(file)
+            async with aiofiles.open(file, 'rb') as f:
+                content = await f.read()
+        else:
+            content = file
+            filename = filename or 'upload.bin'
+        content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        form = aiohttp.FormData()
+        form.add_field('content', content, filename=filename, content_type=content_type)
+        data = await self.request('POST', '/files', data=form)
+        if not (data.get('urls') or {}).get('get'):
+            raise ReplicateAPIError("Replicate не вернул URL загруженного файла")
+        return data
+
+    async def create_training(self, ref: str, destination: str, input: Dict[str, Any],
+                              webhook: Optional[str] = None,
+                              webhook_events_filter: Optional[List[str]] = None) -> ReplicateObject:
+        """Запускает обучение тренера 'owner/name:version' в модель destination."""
+        if ':' not in ref:
+            raise ValueError(f"Для обучения нужна ссылка вида owner/name:version, получено: {ref}")
+        model, version = ref.split(':', 1)
+        payload: Dict[str, Any] = {'destination': destination, 'input': input}
+        if webhook:
+            payload['webhook'] = webhook
+            if webhook_events_filter:
+                payload['webhook_events_filter'] = webhook_events_filter
+        return ReplicateObject(await self.request('POST', f'/models/{model}/versions/{version}/trainings', json=payload))
+
+    async def get_training(self, training_id: str) -> ReplicateObject:
+        return ReplicateObject(await self.request('GET', f'/trainings/{training_id}'))
+
+    async def cancel_training(self, training_id: str) -> ReplicateObject:
+        return ReplicateObject(await self.request('POST', f'/trainings/{training_id}/cancel'))
+
+    async def get_model(self, model: str) -> Dict[str, Any]:
+        """Возвращает описание модели 'owner/name' (в т.ч. latest_version)."""
+        return await self.request('GET', f'/models/{model}')
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+# Клиенты по токену: обычно один, но PhotoTransformGenerator может получить свой ключ
+_clients: Dict[str, AsyncReplicateClient] = {}
+
+
+def get_replicate_client(api_token: Optional[str] = None) -> AsyncReplicateClient:
+    """Возвращает общий клиент для токена (по умолчанию REPLICATE_API_TOKEN)."""
+    token = api_token or REPLICATE_API_TOKEN
+    client = _clients.get(token)
+    if client is None:
+        client = AsyncReplicateClient(api_token=token)
+        _clients[token] = client
+    return client
+
+
+async def close_replicate_clients() -> None:
+    """Закрывает сессии всех клиентов при остановке бота."""
+    for client in list(_clients.values()):
+        await client.close()
+
+
+def get_replicate_metrics() -> Dict[str, Any]:
+    """Метрики HTTP-клиентов Replicate для /metrics."""
+    requests_total = sum(client.requests_total for client in _clients.values())
+    errors_total = sum(client.errors_total for client in _clients.values())
+    in_flight = sum(client.in_flight for client in _clients.values())
+    return {'clients': len(_clients), 'requests_total': requests_total, 'errors_total': errors_total, 'in_flight': in_flight}
+
+
+metrics_registry.register('replicate_http', get_replicate_metrics)
+
+__all__ = [
+    'AsyncReplicateClient', 'ReplicateAPIError', 'ReplicateObject', 'get_replicate_client',
+    'close_replicate_clients', 'get_replicate_metrics', 'TERMINAL_STATUSES'
+]
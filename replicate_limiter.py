@@ -0,0 +1,319 @@
+# replicate_limiter.py
+"""Адаптивный лимит одновременных запросов к Replicate и предохранитель.
+
+Раньше число запусков ограничивали фиксированные replicate_semaphore(50)
+и generation_semaphore(100), а tenacity повторял любую ReplicateError с
+экспоненциальной паузой. Когда Replicate деградировал, бот продолжал
+держать те же 50 запросов и добавлял к ним повторы, усиливая перегрузку.
+
+Теперь для каждой модели (обученные аватары аккаунта считаются одной
+моделью) ModelLimiter ведёт:
+
+- AIMD-лимит: после успешного запроса лимит растёт на 1/limit (в сумме
+  +1 за limit успехов), при признаке перегрузки — 429, 5xx, обрыв
+  соединения, истёкший срок предсказания — умножается на
+  REPLICATE_LIMIT_DECREASE_FACTOR, но не чаще раза в
+  REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS: ошибки уже запущенных
+  запросов одной волны не обрушивают лимит до минимума;
+- предохранитель: если за REPLICATE_BREAKER_WINDOW_SECONDS набралось не
+  меньше REPLICATE_BREAKER_MIN_REQUESTS запросов и доля перегрузок не ниже
+  REPLICATE_BREAKER_ERROR_RATE, новые запросы REPLICATE_BREAKER_OPEN_SECONDS
+  сразу получают ReplicateCircuitOpenError. Затем пропускается один пробный
+  запрос: успех замыкает предохранитель, перегрузка снова размыкает.
+
+Ошибки входных данных (4xx), неуспешные предсказания и отмена
+пользователем на лимит не влияют. is_retryable_replicate_error — условие
+tenacity-ретраев: повторяются только временные сбои, но не 4xx, не
+разомкнутый предохранитель и не ожидание слота дольше
+REPLICATE_LIMIT_QUEUE_TIMEOUT_SECONDS.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+
+import aiohttp
+from replicate.exceptions import ReplicateError
+from config import (
+    REPLICATE_USERNAME_OR_ORG_NAME, REPLICATE_LIMIT_INITIAL, REPLICATE_LIMIT_MIN, REPLICATE_LIMIT_MAX,
+    REPLICATE_LIMIT_DECREASE_FACTOR, REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS, REPLICATE_LIMIT_QUEUE_TIMEOUT_SECONDS,
+    REPLICATE_BREAKER_WINDOW_SECONDS, REPLICATE_BREAKER_MIN_REQUESTS, REPLICATE_BREAKER_ERROR_RATE,
+    REPLICATE_BREAKER_OPEN_SECONDS
+)
+from metrics import metrics_registry
+from replicate_client import ReplicateAPIError
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half_open'
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_OVERLOAD = 'overload'
+OUTCOME_NEUTRAL = 'neutral'
+
+
+class ReplicateOverloadedError(ReplicateAPIError):
+    """Запрос к модели не запущен: Replicate перегружен. retry_after — через сколько секунд имеет смысл повторить."""
+
+    def __init__(self, message: str, model: str, retry_after: float):
+        super().__init__(message)
+        self.model = model
+        self.retry_after = retry_after
+
+
+class ReplicateCircuitOpenError(ReplicateOverloadedError):
+    pass
+
+
+def limiter_key(ref: str) -> str:
+    """Модель, к которой относится ссылка: без версии, все аватары аккаунта — одна модель."""
+    model = ref.split(':', 1)[0]
+    if '/' not in model:
+        return f"version:{model[:12]}"
+    if model.split('/', 1)[0] == REPLICATE_USERNAME_OR_ORG_NAME:
+        return f"{REPLICATE_USERNAME_OR_ORG_NAME}/*"
+    return model
+
+
+def is_overload_error(error: BaseException) -> bool:
+    """Признак перегрузки Replicate: 429, 5xx, сбой соединения или истёкший срок предсказания."""
+    # Импорт здесь: prediction_tracker сам использует replicate_limiter
+    from prediction_tracker import PredictionTimeoutError
+    if isinstance(error, PredictionTimeoutError):
+        return True
+    if isinstance(error, ReplicateOverloadedError):
+        return False
+    if isinstance(error, ReplicateAPIError):
+        if error.status is not None:
+            return error.status == 429 or error.status >= 500
+        # Без статуса: сбой соединения или таймаут запроса (подняты from e), а не неуспешное предсказание
+        return error.__cause__ is not None
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+def is_retryable_replicate_error(error: BaseException) -> bool:
+    """Условие tenacity-ретраев запуска модели: только временные сбои."""
+    from prediction_tracker import PredictionTrackingError
+    if not isinstance(error, ReplicateError):
+        return False
+    if isinstance(error, (PredictionTrackingError, ReplicateOverloadedError)):
+        # Срок истёк или пользователь прервал — предсказание уже отменено; при перегрузке повтор её усилит
+        return False
+    status = getattr(error, 'status', None)
+    if status is not None:
+        return status == 429 or status >= 500
+    # Без статуса повторяется только сбой соединения или таймаут запроса (подняты from e);
+    # неуспешное предсказание (NSFW, ошибка модели) повтор не исправит, а каждый запуск платный
+    return error.__cause__ is not None
+
+
+class ModelLimiter:
+    """AIMD-лимит одновременных запросов и предохранитель одной модели."""
+
+    def __init__(self, key: str, initial: int = REPLICATE_LIMIT_INITIAL, min_limit: int = REPLICATE_LIMIT_MIN,
+                 max_limit: int = REPLICATE_LIMIT_MAX, decrease_factor: float = REPLICATE_LIMIT_DECREASE_FACTOR,
+                 decrease_cooldown: float = REPLICATE_LIMIT_DECREASE_COOLDOWN_SECONDS,
+                 window: float = REPLICATE_BREAKER_WINDOW_SECONDS, min_requests: int = REPLICATE_BREAKER_MIN_REQUESTS,
+                 error_rate: float = REPLICATE_BREAKER_ERROR_RATE, open_seconds: float = REPLICATE_BREAKER_OPEN_SECONDS):
+        self.key = key
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.window = window
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.open_seconds = open_seconds
+        self.in_flight = 0
+        self.state = CIRCUIT_CLOSED
+        self.open_until = 0.0
+        self._probe_in_flight = False
+        self._last_decrease = 0.0
+        self._waiters: Deque[asyncio.Future] = deque()
+        # (время, перегрузка) за окно; счётчики ведутся при записи — метрики читаются из потока Flask
+        self._outcomes: Deque[Tuple[float, bool]] = deque()
+        self._window_overloads = 0
+        self.successes = 0
+        self.overloads = 0
+        self.decreases = 0
+        self.rejected = 0
+        self.queue_timeouts = 0
+        self.opened = 0
+
+    def _check_circuit(self, now: float) -> None:
+        if self.state == CIRCUIT_OPEN and now >= self.open_until:
+            self.state = CIRCUIT_HALF_OPEN
+            logger.info(f"Предохранитель {self.key}: пробный запрос")
+        if self.state == CIRCUIT_OPEN or (self.state == CIRCUIT_HALF_OPEN and self._probe_in_flight):
+            self.rejected += 1
+            retry_after = max(self.open_until - now, 1.0) if self.state == CIRCUIT_OPEN else self.open_seconds
+            raise ReplicateCircuitOpenError(
+                f"Модель {self.key} временно недоступна: Replicate перегружен", self.key, retry_after
+            )
+
+    def _has_capacity(self) -> bool:
+        if self.state == CIRCUIT_HALF_OPEN:
+            return not self._probe_in_flight
+        return self.in_flight < int(self.limit)
+
+    def _wake(self) -> None:
+        """Будит ожидающих по числу свободных слотов; при не замкнутом предохранителе — всех, чтобы не ждали зря."""
+        free = int(self.limit) - self.in_flight
+        while self._waiters and (free > 0 or self.state != CIRCUIT_CLOSED):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self, timeout: float) -> bool:
+        """Занимает слот; возвращает True, если это пробный запрос полуоткрытого предохранителя."""
+        until = time.monotonic() + timeout
+        woken = False
+        while True:
+            now = time.monotonic()
+            self._check_circuit(now)
+            if self._has_capacity() and (woken or not self._waiters):
+                break
+            remaining = until - now
+            if remaining <= 0:
+                self.queue_timeouts += 1
+                raise ReplicateOverloadedError(
+                    f"Нет свободного слота для {self.key} за {timeout:.0f} с", self.key, self.open_seconds
+                )
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+                woken = True
+            except asyncio.TimeoutError:
+                woken = False
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()  # разбудили, но слот не понадобился — передаём следующему
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.in_flight += 1
+        probe = self.state == CIRCUIT_HALF_OPEN
+        if probe:
+            self._probe_in_flight = True
+        return probe
+
+    def release(self, probe: bool, outcome: str) -> None:
+        """Освобождает слот и учитывает результат запроса."""
+        self.in_flight -= 1
+        now = time.monotonic()
+        if probe:
+            self._probe_in_flight = False
+        if outcome == OUTCOME_SUCCESS:
+            self.successes += 1
+            self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._observe(now, False)
+            if probe:
+                self.state = CIRCUIT_CLOSED
+                self._outcomes.clear()
+                self._window_overloads = 0
+                logger.info(f"Предохранитель {self.key} замкнут: пробный запрос успешен")
+        elif outcome == OUTCOME_OVERLOAD:
+            self.overloads += 1
+            if now - self._last_decrease >= self.decrease_cooldown:
+                self._last_decrease = now
+                self.decreases += 1
+                self.limit = max(float(self.min_limit), self.limit * self.decrease_factor)
+                logger.warning(f"Перегрузка {self.key}: лимит снижен до {int(self.limit)}")
+            self._observe(now, True)
+            total = len(self._outcomes)
+            if probe or (self.state == CIRCUIT_CLOSED and total >= self.min_requests
+                         and self._window_overloads / total >= self.error_rate):
+                self._open(now)
+        self._wake()
+
+    def _observe(self, now: float, overload: bool) -> None:
+        self._outcomes.append((now, overload))
+        self._window_overloads += overload
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            _, old_overload = self._outcomes.popleft()
+            self._window_overloads -= old_overload
+
+    def _open(self, now: float) -> None:
+        self.state = CIRCUIT_OPEN
+        self.open_until = now + self.open_seconds
+        self.opened += 1
+        logger.warning(f"Предохранитель {self.key} разомкнут на {self.open_seconds:.0f} с: "
+                       f"{self._window_overloads} перегрузок из {len(self._outcomes)} запросов")
+
+    def metrics(self) -> Dict[str, Any]:
+        total = len(self._outcomes)
+        state = self.state
+        if state == CIRCUIT_OPEN and time.monotonic() >= self.open_until:
+            state = CIRCUIT_HALF_OPEN
+        return {
+            'state': state,
+            'limit': int(self.limit),
+            'in_flight': self.in_flight,
+            'waiting': len(self._waiters),
+            'window_requests': total,
+            'window_error_rate': round(self._window_overloads / total, 3) if total else None,
+            'successes': self.successes,
+            'overloads': self.overloads,
+            'decreases': self.decreases,
+            'rejected': self.rejected,
+            'queue_timeouts': self.queue_timeouts,
+            'opened': self.opened,
+        }
+
+
+class ReplicateLimiter:
+    """Лимиты и предохранители по моделям Replicate."""
+
+    def __init__(self, queue_timeout: float = REPLICATE_LIMIT_QUEUE_TIMEOUT_SECONDS, **model_settings):
+        self.queue_timeout = queue_timeout
+        self.model_settings = model_settings
+        self._models: Dict[str, ModelLimiter] = {}
+
+    def get(self, ref: str) -> ModelLimiter:
+        key = limiter_key(ref)
+        limiter = self._models.get(key)
+        if limiter is None:
+            limiter = self._models[key] = ModelLimiter(key, **self.model_settings)
+        return limiter
+
+    @asynccontextmanager
+    async def slot(self, ref: str, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """Слот для запроса к модели; при разомкнутом предохранителе сразу ReplicateCircuitOpenError."""
+        limiter = self.get(ref)
+        probe = await limiter.acquire(self.queue_timeout if timeout is None else timeout)
+        outcome = OUTCOME_NEUTRAL
+        try:
+            yield
+            outcome = OUTCOME_SUCCESS
+        except BaseException as e:
+            if is_overload_error(e):
+                outcome = OUTCOME_OVERLOAD
+            raise
+        finally:
+            limiter.release(probe, outcome)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Состояние лимитов по моделям для /metrics."""
+        models = {key: limiter.metrics() for key, limiter in list(self._models.items())}
+        return {
+            'open_circuits': sum(1 for m in models.values() if m['state'] != CIRCUIT_CLOSED),
+            'in_flight': sum(m['in_flight'] for m in models.values()),
+            'models': models,
+        }
+
+
+# Глобальный экземпляр
+replicate_limiter = ReplicateLimiter()
+metrics_registry.register('replicate_limiter', replicate_limiter.metrics)
+
+__all__ = ['ReplicateLimiter', 'ModelLimiter', 'replicate_limiter', 'ReplicateOverloadedError',
+           'ReplicateCircuitOpenError', 'limiter_key', 'is_overload_error', 'is_retryable_replicate_error']
@@ -0,0 +1,148 @@
+# replicate_uploads.py
+"""Кэш загрузок в Replicate Files по содержимому.
+
+Одно и то же фото-референс раньше загружалось заново при каждом запуске:
+повторные photo-to-photo, ретраи PhotoTransformGenerator после sensitive
+content (там ещё и data URI на весь файл в каждом запросе), повторные
+генерации админом. Теперь ключ — SHA-256 уже нормализованных байтов
+(image_normalizer), значение — URL файла в Replicate и срок его жизни из
+expires_at. Пока URL действителен с запасом REPLICATE_UPLOAD_EXPIRY_MARGIN_SECONDS,
+он переиспользуется без загрузки; одновременные загрузки одного
+содержимого объединяются в одну.
+
+Файлы принадлежат аккаунту токена, поэтому ключ включает клиента.
+"""
+
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from config import (
+    REPLICATE_UPLOAD_CACHE_SIZE, REPLICATE_FILE_DEFAULT_TTL_SECONDS, REPLICATE_UPLOAD_EXPIRY_MARGIN_SECONDS
+)
+from metrics import metrics_registry
+from replicate_client import AsyncReplicateClient, get_replicate_client
+
+logger = logging.getLogger(__name__)
+
+
+class CachedUpload(NamedTuple):
+    url: str
+    expires_at: float  # time.time()
+    size: int
+
+
+def _parse_expiry(value: Optional[str], default_ttl: float) -> float:
+    """expires_at из ответа Replicate в unix-время; без него — default_ttl от текущего момента."""
+    if value:
+        try:
+            return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            logger.debug(f"Не удалось разобрать expires_at={value!r}")
+    return time.time() + default_ttl
+
+
+class ReplicateUploadCache:
+    """LRU URL загруженных файлов по (клиент, SHA-256 содержимого)."""
+
+    def __init__(self, max_entries: int = REPLICATE_UPLOAD_CACHE_SIZE,
+                 default_ttl: float = REPLICATE_FILE_DEFAULT_TTL_SECONDS,
+                 margin: float = REPLICATE_UPLOAD_EXPIRY_MARGIN_SECONDS):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.margin = margin
+        self._entries: "OrderedDict[Tuple[str, str], CachedUpload]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.bytes_uploaded = 0
+        self.bytes_saved = 0
+
+    def _valid(self, entry: CachedUpload) -> bool:
+        return entry.expires_at - self.margin > time.time()
+
+    def _lookup(self, key: Tuple[str, str]) -> Optional[CachedUpload]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not self._valid(entry):
+            del self._entries[key]
+            self.expired += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def upload(self, content: bytes, filename: str, content_type: Optional[str] = None,
+                     client: Optional[AsyncReplicateClient] = None) -> str:
+        """URL файла с таким содержимым: из кэша, если он ещё действителен, иначе после загрузки."""
+        client = client or get_replicate_client()
+        key = (client.api_token, hashlib.sha256(content).hexdigest())
+        entry = self._lookup(key)
+        if entry is not None:
+            self.hits += 1
+            self.bytes_saved += entry.size
+            logger.info(f"Файл {filename} уже загружен в Replicate, URL переиспользован")
+            return entry.url
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            self.bytes_saved += len(content)
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # Собственная отмена пробрасывается; отменённую загрузку владельца повторяем сами
+                if not pending.cancelled():
+                    raise
+            self.bytes_saved -= len(content)
+            return await self.upload(content, filename, content_type=content_type, client=client)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.misses += 1
+        try:
+            data = await client.create_file(content, filename=filename, content_type=content_type)
+        except asyncio.CancelledError:
+            # Отмена владельца не должна отменять чужие генерации: ожидающие загрузят файл сами
+            future.cancel()
+            raise
+        except BaseException as e:
+            self.errors += 1
+            future.set_exception(e)
+            future.exception()  # ожидающие получат ошибку; для одиночного вызова она не «потеряна»
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        entry = CachedUpload(data['urls']['get'], _parse_expiry(data.get('expires_at'), self.default_ttl), len(content))
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self.bytes_uploaded += len(content)
+        future.set_result(entry.url)
+        return entry.url
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики кэша загрузок для /metrics."""
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'bytes_uploaded': self.bytes_uploaded,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+# Глобальный экземпляр
+replicate_upload_cache = ReplicateUploadCache()
+metrics_registry.register('replicate_uploads', replicate_upload_cache.metrics)
+
+__all__ = ['ReplicateUploadCache', 'CachedUpload', 'replicate_upload_cache']
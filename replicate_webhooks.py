@@ -0,0 +1,222 @@
+# replicate_webhooks.py
+"""Приём вебхуков Replicate о завершении видео-предсказаний и обучений.
+
+Раньше завершение находилось опросом: на каждую задачу создавалась цепочка
+спящих задач check_*_status_with_delay, а check_pending_* каждые 5 минут
+добавляли ещё по задаче на строку. Теперь предсказания и обучения
+создаются с webhook=REPLICATE_WEBHOOK_URL и фильтром 'completed', Flask
+принимает POST /replicate/webhook и передаёт его в event loop бота, а
+здесь по id находится строка video_tasks / user_trainedmodels и сразу
+запускается доставка. Статус всё равно перечитывается через API, поэтому
+поддельный вебхук может лишь инициировать проверку. Опрос остаётся только
+как редкая страховка (REPLICATE_SAFETY_POLL_MINUTES).
+
+Проверки одного id не выполняются параллельно, повторные вебхуки
+(Replicate повторяет доставку при ошибках) отбрасываются. Задача считается
+завершённой и снимается с опроса только после того, как финальный статус
+записан в БД; если доставка не удалась, страховочный опрос и контекст
+остаются, и следующий вебхук или опрос повторит проверку.
+"""
+
+import base64
+import hashlib
+import hmac
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Mapping, Optional, Set, Tuple
+
+from aiogram import Bot
+from config import REPLICATE_WEBHOOK_URL, REPLICATE_WEBHOOK_SECRET, REPLICATE_WEBHOOK_TOLERANCE_SECONDS
+from metrics import metrics_registry
+from prediction_poller import prediction_poller
+from replicate_client import TERMINAL_STATUSES
+
+logger = logging.getLogger(__name__)
+
+KIND_VIDEO = 'video'
+KIND_TRAINING = 'training'
+# Сколько контекстов задач и завершённых id помнить в памяти
+MAX_TRACKED = 10000
+
+
+class ReplicateWebhookHandler:
+    """Сопоставляет вебхуки Replicate с задачами бота и запускает их доставку."""
+
+    def __init__(self, url: str = REPLICATE_WEBHOOK_URL, secret: str = REPLICATE_WEBHOOK_SECRET,
+                 tolerance: int = REPLICATE_WEBHOOK_TOLERANCE_SECONDS):
+        self.url = url
+        self.secret = secret
+        self.tolerance = tolerance
+        # id -> (вид, данные для check_*_status), заполняется при создании задачи
+        self._contexts: "OrderedDict[str, Tuple[str, Dict[str, Any]]]" = OrderedDict()
+        self._finished: "OrderedDict[str, float]" = OrderedDict()
+        self._inflight: Set[str] = set()
+        self.received = 0
+        self.rejected = 0
+        self.ignored = 0
+        self.duplicates = 0
+        self.unknown = 0
+        self.dispatched = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.url)
+
+    def prediction_kwargs(self) -> Dict[str, Any]:
+        """Аргументы вебхука для create_prediction (пусто, если вебхуки отключены)."""
+        if not self.enabled:
+            return {}
+        return {'webhook': self.url, 'webhook_events_filter': ['completed']}
+
+    def training_kwargs(self) -> Dict[str, Any]:
+        """Аргументы вебхука для create_training."""
+        return self.prediction_kwargs()
+
+    @staticmethod
+    def _remember(store: "OrderedDict", key: str, value: Any) -> None:
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > MAX_TRACKED:
+            store.popitem(last=False)
+
+    def track(self, job_id: str, kind: str, data: Dict[str, Any]) -> None:
+        """Запоминает контекст задачи, чтобы вебхук восстановил стиль, админа и т.п. без БД."""
+        self._remember(self._contexts, job_id, (kind, dict(data)))
+
+    def is_finished(self, job_id: Optional[str]) -> bool:
+        """Пришёл ли по задаче финальный вебхук (для пропуска запоздавших уведомлений о прогрессе)."""
+        return bool(job_id) and job_id in self._finished
+
+    def verify_signature(self, headers: Mapping[str, str], body: bytes) -> bool:
+        """Проверяет подпись webhook-signature (HMAC-SHA256 от 'id.timestamp.body').
+
+        Без REPLICATE_WEBHOOK_SECRET проверка отключена.
+        """
+        if not self.secret:
+            return True
+        webhook_id = headers.get('webhook-id', '')
+        timestamp = headers.get('webhook-timestamp', '')
+        signatures = headers.get('webhook-signature', '')
+        if not webhook_id or not timestamp or not signatures:
+            return False
+        try:
+            if abs(time.time() - int(timestamp)) > self.tolerance:
+                return False
+            key = base64.b64decode(self.secret.split('_', 1)[-1])
+        except ValueError:
+            return False
+        signed = f"{webhook_id}.{timestamp}.".encode('utf-8') + body
+        expected = base64.b64encode(hmac.new(key, signed, hashlib.sha256).digest()).decode('ascii')
+        return any(
+            hmac.compare_digest(expected, signature.split(',', 1)[-1])
+            for signature in signatures.split()
+        )
+
+    def reject(self) -> None:
+        self.rejected += 1
+
+    async def _load_context(self, job_id: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        from generation.videos import find_video_check_data
+        from generation.training import find_training_check_data
+        data = await find_video_check_data(job_id)
+        if data:
+            return KIND_VIDEO, data
+        data = await find_training_check_data(job_id)
+        if data:
+            return KIND_TRAINING, data
+        return None, None
+
+    async def handle(self, bot: Bot, payload: Dict[str, Any]) -> None:
+        """Обрабатывает тело вебхука в event loop бота."""
+        self.received += 1
+        job_id = payload.get('id')
+        status = payload.get('status')
+        if not job_id or status not in TERMINAL_STATUSES:
+            self.ignored += 1
+            logger.debug(f"Вебхук Replicate пропущен: id={job_id}, status={status}")
+            return
+        if job_id in self._finished:
+            self.duplicates += 1
+            logger.info(f"Повторный вебхук Replicate для {job_id} пропущен")
+            return
+
+        context = self._contexts.get(job_id)
+        kind, data = context if context else await self._load_context(job_id)
+        if not kind:
+            self.unknown += 1
+            logger.warning(f"Вебхук Replicate для неизвестной или завершённой задачи: id={job_id}, status={status}")
+            return
+
+        logger.info(f"Вебхук Replicate: {kind} {job_id} завершён со статусом {status}")
+        await self.check(bot, kind, data)
+        if not await self._is_committed(kind, data):
+            # Контекст и страховочный опрос остаются, проверку повторит следующий вебхук или опрос
+            self.track(job_id, kind, data)
+            logger.warning(f"Финальный статус {kind} {job_id} не записан, задача остаётся под наблюдением")
+            return
+
+        # Результат записан, страховочный опрос по этому id больше не нужен
+        self._contexts.pop(job_id, None)
+        self._remember(self._finished, job_id, time.time())
+        prediction_poller.forget(job_id)
+
+    async def _is_committed(self, kind: str, data: Dict[str, Any]) -> bool:
+        """Записан ли в БД финальный статус задачи."""
+        try:
+            if kind == KIND_VIDEO:
+                from generation.videos import is_video_task_finished
+                return await is_video_task_finished(data['task_id'])
+            from generation.training import is_training_finished
+            return await is_training_finished(data['avatar_id'])
+        except Exception as e:
+            logger.error(f"Не удалось проверить статус {kind} {data.get('prediction_id')}: {e}", exc_info=True)
+            return False
+
+    async def check(self, bot: Bot, kind: str, data: Dict[str, Any]) -> None:
+        """Запускает check_video_status / check_training_status; одна проверка на id одновременно."""
+        job_id = data['prediction_id']
+        if job_id in self._inflight:
+            self.coalesced += 1
+            logger.info(f"Проверка {kind} {job_id} уже выполняется, повтор пропущен")
+            return
+        self._inflight.add(job_id)
+        self.dispatched += 1
+        try:
+            if kind == KIND_VIDEO:
+                from generation.videos import check_video_status
+                await check_video_status(bot, data)
+            else:
+                from generation.training import check_training_status
+                await check_training_status(bot, data)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ошибка доставки результата {kind} {job_id}: {e}", exc_info=True)
+        finally:
+            self._inflight.discard(job_id)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики вебхуков для /metrics."""
+        return {
+            'enabled': self.enabled,
+            'signature_check': bool(self.secret),
+            'received': self.received,
+            'rejected': self.rejected,
+            'ignored': self.ignored,
+            'duplicates': self.duplicates,
+            'unknown': self.unknown,
+            'dispatched': self.dispatched,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'tracked': len(self._contexts),
+            'in_flight': len(self._inflight),
+        }
+
+
+# Глобальный экземпляр
+replicate_webhooks = ReplicateWebhookHandler()
+metrics_registry.register('replicate_webhooks', replicate_webhooks.metrics)
+
+__all__ = ['ReplicateWebhookHandler', 'replicate_webhooks', 'KIND_VIDEO', 'KIND_TRAINING']
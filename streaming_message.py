@@ -0,0 +1,155 @@
+# streaming_message.py
+"""Сообщение Telegram, которое дописывается по мере генерации текста.
+
+Раньше пользователь видел только «⏳ Обращаюсь к AI-помощнику...» и ждал
+полный ответ модели. StreamingMessage принимает частичный текст через
+update() — синхронно, не задерживая чтение потока, — а фоновая задача
+редактирует сообщение не чаще STREAM_EDIT_INTERVAL_SECONDS: версии,
+пришедшие между редактированиями, схлопываются в последнюю. Первое
+редактирование уходит сразу.
+
+TelegramRetryAfter откладывает следующее редактирование на указанный срок,
+«message is not modified» игнорируется, прочие ошибки отключают
+промежуточные обновления: итоговый текст обработчик всё равно отправит
+через finish() или обычным сообщением.
+"""
+
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Optional
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from config import STREAM_EDIT_INTERVAL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Запас до лимита Telegram в 4096 символов под заголовок и экранирование
+STREAM_PREVIEW_MAX_CHARS = 3500
+# Дольше этого итоговое редактирование после RetryAfter не ждём — отправляется новое сообщение
+FINISH_MAX_RETRY_AFTER = 5
+
+
+class StreamingMessage:
+    """Троттлинг редактирований одного сообщения с частичным текстом."""
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int, render: Callable[[str], str],
+                 interval: float = STREAM_EDIT_INTERVAL_SECONDS, parse_mode: Optional[str] = ParseMode.MARKDOWN_V2,
+                 max_chars: int = STREAM_PREVIEW_MAX_CHARS):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.render = render
+        self.interval = interval
+        self.parse_mode = parse_mode
+        self.max_chars = max_chars
+        self.edits = 0
+        self.retry_after_events = 0
+        self.disabled = False
+        self._pending: Optional[str] = None
+        self._shown: Optional[str] = None
+        self._next_edit_at = 0.0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def update(self, text: str) -> None:
+        """Запоминает текущий частичный текст; сообщение обновится при ближайшей возможности."""
+        if self._closed or self.disabled:
+            return
+        text = text.strip()
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars] + '…'
+        if not text:
+            return
+        self._pending = text
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        self._wake.set()
+
+    async def _run(self) -> None:
+        while not self.disabled:
+            await self._wake.wait()
+            self._wake.clear()
+            delay = self._next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            text = self._pending
+            if text is not None and text != self._shown:
+                await self._edit(text)
+
+    async def _edit(self, text: str) -> None:
+        try:
+            await self.bot.edit_message_text(
+                text=self.render(text),
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                parse_mode=self.parse_mode
+            )
+            self._shown = text
+            self.edits += 1
+        except TelegramRetryAfter as e:
+            self.retry_after_events += 1
+            logger.debug(f"RetryAfter {e.retry_after}с при обновлении сообщения {self.message_id}")
+            self._next_edit_at = time.monotonic() + e.retry_after
+            self._wake.set()
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e).lower():
+                self._shown = text
+            else:
+                logger.warning(f"Промежуточные обновления сообщения {self.message_id} отключены: {e}")
+                self.disabled = True
+        except Exception as e:
+            logger.warning(f"Промежуточные обновления сообщения {self.message_id} отключены: {e}")
+            self.disabled = True
+        self._next_edit_at = time.monotonic() + self.interval
+
+    async def close(self) -> None:
+        """Останавливает промежуточные обновления."""
+        self._closed = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def finish(self, text: str, reply_markup: Any = None) -> bool:
+        """Заменяет содержимое итоговым текстом (уже подготовленным для parse_mode).
+
+        Возвращает False, если отредактировать не удалось и текст нужно отправить отдельно.
+        """
+        await self.close()
+        for _ in range(2):
+            try:
+                await self.bot.edit_message_text(
+                    text=text,
+                    chat_id=self.chat_id,
+                    message_id=self.message_id,
+                    parse_mode=self.parse_mode,
+                    reply_markup=reply_markup
+                )
+                return True
+            except TelegramRetryAfter as e:
+                self.retry_after_events += 1
+                if e.retry_after > FINISH_MAX_RETRY_AFTER:
+                    break
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.warning(f"Не удалось заменить сообщение {self.message_id} итоговым текстом: {e}")
+                break
+        return False
+
+    async def delete(self) -> None:
+        """Удаляет сообщение (когда итог отправлен несколькими новыми сообщениями)."""
+        await self.close()
+        try:
+            await self.bot.delete_message(chat_id=self.chat_id, message_id=self.message_id)
+        except Exception as e:
+            logger.debug(f"Не удалось удалить сообщение {self.message_id}: {e}")
+
+
+__all__ = ['StreamingMessage', 'STREAM_PREVIEW_MAX_CHARS']
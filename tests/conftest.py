@@ -0,0 +1,65 @@
+# tests/conftest.py
+"""Общая подготовка тестов.
+
+Модули дерева — пакет generation бота: внутри него импорты идут как
+generation.X, соседние модули — по плоскому имени. Пакет handlers лежит
+рядом в полном проекте; если его нет, подставляются простые заглушки
+тех функций, которые импортируют тестируемые модули.
+"""
+
+import importlib
+import os
+import re
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+for _name in ('TELEGRAM_BOT_TOKEN', 'REPLICATE_API_TOKEN', 'YOOKASSA_SHOP_ID', 'YOOKASSA_SECRET_KEY'):
+    os.environ.setdefault(_name, 'test')
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+if 'generation' not in sys.modules:
+    _generation = types.ModuleType('generation')
+    _generation.__path__ = [ROOT]
+    sys.modules['generation'] = _generation
+
+
+def _install_handlers_stub() -> None:
+    try:
+        importlib.import_module('handlers.utils')
+        return
+    except ImportError:
+        pass
+
+    def safe_escape_markdown(text, version=2):
+        return re.sub(r'([_*\[\]()~`>#+\-=|{}.!\\])', r'\\\1', str(text))
+
+    async def send_message_with_fallback(bot, chat_id, text, reply_markup=None, parse_mode=None, **kwargs):
+        return await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+    async def clean_admin_context(state):
+        return None
+
+    async def _noop(*args, **kwargs):
+        return None
+
+    utils = types.ModuleType('handlers.utils')
+    utils.safe_escape_markdown = safe_escape_markdown
+    utils.send_message_with_fallback = send_message_with_fallback
+    utils.clean_admin_context = clean_admin_context
+    utils.escape_message_parts = lambda *parts, version=2: ''.join(safe_escape_markdown(p) for p in parts)
+    utils.unescape_markdown = lambda text: text
+    utils.safe_answer_callback = _noop
+    utils.get_tariff_text = lambda first_purchase=False, is_paying_user=False: ''
+    utils.send_typing_action = _noop
+    handlers = types.ModuleType('handlers')
+    handlers.__path__ = []
+    handlers.utils = utils
+    sys.modules['handlers'] = handlers
+    sys.modules['handlers.utils'] = utils
+
+
+_install_handlers_stub()
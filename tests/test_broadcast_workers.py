@@ -0,0 +1,83 @@
+# tests/test_broadcast_workers.py
+import asyncio
+import json
+
+import aiosqlite
+import pytest
+
+import broadcast_workers
+from broadcast_workers import ShardLostError, claim_shard, init_broadcast_worker_tables, process_shard
+
+
+@pytest.fixture
+def shard_db(tmp_path, monkeypatch):
+    path = str(tmp_path / 'broadcast.db')
+    monkeypatch.setattr(broadcast_workers, 'DATABASE_PATH', path)
+    monkeypatch.setattr(broadcast_workers, 'BROADCAST_CONCURRENCY', 1)
+
+    async def prepare():
+        async with aiosqlite.connect(path) as conn:
+            await init_broadcast_worker_tables(conn)
+            await conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY)")
+            await conn.executemany("INSERT INTO users (user_id) VALUES (?)", [(user_id,) for user_id in range(1, 11)])
+            await conn.execute(
+                "INSERT INTO broadcast_jobs (id, title, audience, payload, admin_user_id, shard_count) VALUES (1, 't', 'all', ?, 1, 1)",
+                (json.dumps({'message_text': 'hi'}),)
+            )
+            await conn.execute("INSERT INTO broadcast_job_shards (job_id, shard) VALUES (1, 0)")
+            await conn.commit()
+
+    asyncio.run(prepare())
+    return path
+
+
+def test_heartbeat_keeps_slow_shard_from_being_reclaimed(shard_db, monkeypatch):
+    monkeypatch.setattr(broadcast_workers, 'BROADCAST_WORKER_STALE_SECONDS', 0.3)
+    monkeypatch.setattr(broadcast_workers, 'SHARD_HEARTBEAT_INTERVAL', 0.05)
+    sent = []
+
+    async def send_to_recipient(bot, budget, progress, user_id, *args):
+        await asyncio.sleep(0.1)  # страница идёт дольше срока устаревания
+        sent.append(user_id)
+        progress.sent += 1
+
+    monkeypatch.setattr(broadcast_workers, 'send_to_recipient', send_to_recipient)
+
+    async def run():
+        shard = await claim_shard(worker_pid=1)
+        task = asyncio.create_task(process_shard(None, None, shard))
+        reclaimed = []
+        while not task.done():
+            await asyncio.sleep(0.1)
+            reclaimed.append(await claim_shard(worker_pid=2))
+        await task
+        return reclaimed
+
+    reclaimed = asyncio.run(run())
+    assert not any(reclaimed)
+    assert sent == list(range(1, 11))
+
+
+def test_lost_shard_stops_sending(shard_db, monkeypatch):
+    monkeypatch.setattr(broadcast_workers, 'SHARD_HEARTBEAT_INTERVAL', 0.05)
+    sent = []
+
+    async def send_to_recipient(bot, budget, progress, user_id, *args):
+        await asyncio.sleep(0.05)
+        sent.append(user_id)
+
+    monkeypatch.setattr(broadcast_workers, 'send_to_recipient', send_to_recipient)
+
+    async def run():
+        shard = await claim_shard(worker_pid=1)
+        task = asyncio.create_task(process_shard(None, None, shard))
+        await asyncio.sleep(0.12)
+        async with aiosqlite.connect(shard_db) as conn:
+            # Другой воркер подхватил шард
+            await conn.execute("UPDATE broadcast_job_shards SET worker_pid = 2, claimed_at = 0")
+            await conn.commit()
+        with pytest.raises(ShardLostError):
+            await task
+
+    asyncio.run(run())
+    assert 0 < len(sent) < 10
@@ -0,0 +1,80 @@
+# tests/test_generation_jobs.py
+import asyncio
+import time
+
+import aiosqlite
+
+import generation_jobs
+from generation_jobs import GenerationJobQueue, init_generation_jobs_table
+
+
+def _insert_running(conn, job_id, attempts, charged_photos):
+    return conn.execute(
+        """INSERT INTO generation_jobs (id, user_id, requester_id, chat_id, tier, finish_tag, payload, status,
+                                        attempts, charged_photos, enqueued_at, started_at)
+           VALUES (?, ?, ?, ?, 'paid', 1.0, '{}', 'running', ?, ?, ?, ?)""",
+        (job_id, 100 + job_id, 100 + job_id, 100 + job_id, attempts, charged_photos, time.time(), time.time())
+    )
+
+
+async def _create_users(conn, user_ids):
+    await conn.execute(
+        "CREATE TABLE users (user_id INTEGER PRIMARY KEY, generations_left INTEGER DEFAULT 0, updated_at TIMESTAMP)"
+    )
+    await conn.executemany("INSERT INTO users (user_id, generations_left) VALUES (?, 0)", [(u,) for u in user_ids])
+
+
+def test_interrupted_jobs_are_refunded_not_rerun(tmp_path, monkeypatch):
+    monkeypatch.setattr(generation_jobs, 'DATABASE_PATH', str(tmp_path / 'jobs.db'))
+
+    async def run():
+        async with aiosqlite.connect(generation_jobs.DATABASE_PATH) as conn:
+            await init_generation_jobs_table(conn)
+            await _create_users(conn, [101, 102, 103, 104])
+            await _insert_running(conn, 1, 1, 2)   # прервано после списания
+            await _insert_running(conn, 2, 1, 0)   # прервано до списания
+            await _insert_running(conn, 3, 2, 0)   # попытки исчерпаны
+            await _insert_running(conn, 4, 1, 3)   # второе прерванное после списания
+            await conn.commit()
+            queue = GenerationJobQueue(max_attempts=2)
+            await queue._recover_interrupted(conn)
+        # Читаем новым соединением: возвраты должны быть закоммичены
+        async with aiosqlite.connect(generation_jobs.DATABASE_PATH) as conn:
+            cursor = await conn.execute("SELECT id, status, charged_photos FROM generation_jobs ORDER BY id")
+            rows = await cursor.fetchall()
+            cursor = await conn.execute("SELECT user_id, generations_left FROM users ORDER BY user_id")
+            credits = await cursor.fetchall()
+        return queue, rows, credits
+
+    queue, rows, credits = asyncio.run(run())
+    assert rows == [(1, 'failed', 0), (2, 'queued', 0), (3, 'failed', 0), (4, 'failed', 0)]
+    assert credits == [(101, 2), (102, 0), (103, 0), (104, 3)]
+    assert queue.interrupted_total == 3
+
+
+def test_stop_waits_for_running_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(generation_jobs, 'DATABASE_PATH', str(tmp_path / 'jobs.db'))
+    finished = []
+
+    class Bot:
+        id = 1
+
+    async def run():
+        queue = GenerationJobQueue(workers=1, stop_timeout=5)
+
+        async def run_job(job):
+            await asyncio.sleep(0.2)
+            finished.append(job['id'])
+
+        queue._run_job = run_job
+        await queue.start(Bot(), storage=None)
+        job_id, _ = await queue.enqueue(user_id=100, requester_id=100, chat_id=100, tier='paid', payload={})
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        async with aiosqlite.connect(generation_jobs.DATABASE_PATH) as conn:
+            cursor = await conn.execute("SELECT status FROM generation_jobs WHERE id = ?", (job_id,))
+            return job_id, (await cursor.fetchone())[0]
+
+    job_id, status = asyncio.run(run())
+    assert finished == [job_id]
+    assert status == 'done'
@@ -0,0 +1,41 @@
+# tests/test_image_normalizer.py
+import asyncio
+
+import image_normalizer
+from image_normalizer import PROFILE_REFERENCE, ImageNormalizer
+
+
+class SlowExecutor:
+    def __init__(self):
+        self.calls = 0
+        self.started = asyncio.Event()
+
+    async def run(self, func, data, max_side, quality):
+        self.calls += 1
+        self.started.set()
+        if self.calls == 1:
+            await asyncio.sleep(3600)
+        return b'jpeg', 10, 10
+
+
+def test_cancelled_owner_does_not_cancel_waiters(monkeypatch):
+    normalizer = ImageNormalizer()
+
+    async def scenario():
+        executor = SlowExecutor()
+        monkeypatch.setattr(image_normalizer, 'cpu_executor', executor)
+        owner = asyncio.create_task(normalizer.normalize(b'photo', PROFILE_REFERENCE))
+        await executor.started.wait()
+        waiter = asyncio.create_task(normalizer.normalize(b'photo', PROFILE_REFERENCE))
+        await asyncio.sleep(0)
+        owner.cancel()
+        result = await asyncio.wait_for(waiter, timeout=1)
+        return owner, waiter, result, executor
+
+    owner, waiter, result, executor = asyncio.run(scenario())
+
+    assert owner.cancelled()
+    assert not waiter.cancelled()
+    assert result.data == b'jpeg'
+    assert executor.calls == 2
+    assert normalizer._inflight == {}
@@ -0,0 +1,134 @@
+# tests/test_reminder_timers.py
+import asyncio
+import sys
+import time
+import types
+
+import aiosqlite
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+import reminder_timers
+from reminder_timers import ReminderDispatcher, init_reminder_timers_table
+
+
+class RecordingBucket:
+    rate = 10.0
+
+    def __init__(self):
+        self.retry_after = []
+
+    async def acquire(self):
+        return None
+
+    def on_retry_after(self, retry_after):
+        self.retry_after.append(retry_after)
+
+    def on_success(self):
+        pass
+
+
+def _run_with_flood_limit(tmp_path, monkeypatch, attempts_before: int):
+    path = str(tmp_path / 'timers.db')
+    monkeypatch.setattr(reminder_timers, 'DATABASE_PATH', path)
+
+    async def check_database_user(user_id):
+        return ()
+
+    async def send_onboarding_message(bot, user_id, message_type, subscription_data):
+        raise TelegramRetryAfter(SendMessage(chat_id=user_id, text='x'), 'Flood control exceeded', 30)
+
+    monkeypatch.setattr(reminder_timers, 'check_database_user', check_database_user)
+    monkeypatch.setitem(sys.modules, 'handlers.onboarding',
+                        types.SimpleNamespace(send_onboarding_message=send_onboarding_message))
+
+    async def run():
+        async with aiosqlite.connect(path) as conn:
+            await init_reminder_timers_table(conn)
+            await conn.execute(
+                "INSERT INTO reminder_timers (user_id, message_type, due_at, attempts) VALUES (1, 'welcome', ?, ?)",
+                (time.time() - 1, attempts_before)
+            )
+            await conn.commit()
+        bucket = RecordingBucket()
+        dispatcher = ReminderDispatcher(bucket=bucket, max_attempts=3)
+        await dispatcher._dispatch_due()
+        async with aiosqlite.connect(path) as conn:
+            cursor = await conn.execute("SELECT status, due_at, attempts FROM reminder_timers")
+            return bucket, await cursor.fetchone()
+
+    return asyncio.run(run())
+
+
+def test_retry_after_defers_timer_and_slows_bucket(tmp_path, monkeypatch):
+    bucket, (status, due_at, attempts) = _run_with_flood_limit(tmp_path, monkeypatch, attempts_before=0)
+    assert bucket.retry_after == [30]
+    assert status == 'pending'
+    assert due_at > time.time() + 25
+    assert attempts == 1
+
+
+def test_retry_after_from_real_onboarding_send_is_deferred(tmp_path, monkeypatch):
+    import onboarding
+
+    path = str(tmp_path / 'timers.db')
+    monkeypatch.setattr(reminder_timers, 'DATABASE_PATH', path)
+    monkeypatch.setattr(onboarding, 'DATABASE_PATH', path)
+    monkeypatch.setattr(onboarding, 'ADMIN_IDS', [999])
+
+    async def check_database_user(user_id):
+        return ()
+
+    async def is_old_user(user_id, cutoff_date=None):
+        return False
+
+    async def get_user_payments(user_id):
+        return []
+
+    monkeypatch.setattr(reminder_timers, 'check_database_user', check_database_user)
+    monkeypatch.setattr(onboarding, 'is_old_user', is_old_user)
+    monkeypatch.setattr(onboarding, 'get_user_payments', get_user_payments)
+    monkeypatch.setitem(sys.modules, 'handlers.onboarding', onboarding)
+
+    class FloodedBot:
+        def __init__(self):
+            self.sent = []
+
+        async def get_me(self):
+            return types.SimpleNamespace(username='test_bot')
+
+        async def send_message(self, chat_id, text, **kwargs):
+            self.sent.append((chat_id, text))
+            raise TelegramRetryAfter(SendMessage(chat_id=chat_id, text=text), 'Flood control exceeded', 30)
+
+    bot = FloodedBot()
+
+    async def run():
+        async with aiosqlite.connect(path) as conn:
+            await init_reminder_timers_table(conn)
+            await conn.execute(
+                "INSERT INTO reminder_timers (user_id, message_type, due_at, attempts) VALUES (1, 'welcome', ?, 0)",
+                (time.time() - 1,)
+            )
+            await conn.commit()
+        bucket = RecordingBucket()
+        dispatcher = ReminderDispatcher(bucket=bucket, max_attempts=3)
+        dispatcher.bot = bot
+        await dispatcher._dispatch_due()
+        async with aiosqlite.connect(path) as conn:
+            cursor = await conn.execute("SELECT status, due_at FROM reminder_timers")
+            return bucket, await cursor.fetchone()
+
+    bucket, (status, due_at) = asyncio.run(run())
+    assert bucket.retry_after == [30]
+    assert status == 'pending'
+    assert due_at > time.time() + 25
+    # Ни сообщения об ошибке пользователю, ни уведомления админам
+    assert [chat_id for chat_id, _ in bot.sent] == [1]
+
+
+def test_retry_after_gives_up_after_max_attempts(tmp_path, monkeypatch):
+    bucket, (status, _, attempts) = _run_with_flood_limit(tmp_path, monkeypatch, attempts_before=2)
+    assert bucket.retry_after == [30]
+    assert status == 'failed'
+    assert attempts == 3
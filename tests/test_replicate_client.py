@@ -0,0 +1,22 @@
+# tests/test_replicate_client.py
+from replicate.exceptions import ReplicateError
+
+from replicate_client import ReplicateAPIError
+
+
+def test_api_error_formats_like_a_message():
+    error = ReplicateAPIError("Replicate API POST /predictions: 502 Bad Gateway", status=502, detail="Bad Gateway")
+    assert str(error) == "Replicate API POST /predictions: 502 Bad Gateway"
+    assert f"{error}" == str(error)
+    assert "status=502" in repr(error)
+    assert isinstance(error, ReplicateError)
+    assert error.status == 502
+    assert error.detail == "Bad Gateway"
+    assert error.to_dict() == {'status': 502, 'detail': 'Bad Gateway'}
+
+
+def test_api_error_without_status_uses_message_as_detail():
+    error = ReplicateAPIError("Таймаут запроса к Replicate (GET /predictions/x)")
+    assert error.status is None
+    assert error.detail == str(error)
+    assert "ReplicateAPIError(" in repr(error)
@@ -0,0 +1,103 @@
+# tests/test_replicate_limiter.py
+import asyncio
+import sys
+import time
+import types
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import prediction_tracker as prediction_tracker_module
+from replicate_client import ReplicateAPIError
+from replicate_limiter import ReplicateCircuitOpenError, ReplicateLimiter, is_retryable_replicate_error
+
+MODEL_REF = 'owner/model:version'
+USER_ID = 100
+
+
+def test_circuit_open_error_formats():
+    error = ReplicateCircuitOpenError("Модель owner/model временно недоступна: Replicate перегружен", 'owner/model', 12.0)
+    assert f"{error}" == "Модель owner/model временно недоступна: Replicate перегружен"
+    assert 'ReplicateCircuitOpenError(' in repr(error)
+    assert error.retry_after == 12.0
+
+
+def test_failed_prediction_is_not_retried():
+    failed = ReplicateAPIError("Предсказание p1 завершилось со статусом failed: NSFW content detected",
+                               detail="NSFW content detected")
+    assert not is_retryable_replicate_error(failed)
+    assert not is_retryable_replicate_error(ReplicateAPIError("Bad input", status=422))
+
+
+def test_transient_errors_are_retried():
+    try:
+        try:
+            raise asyncio.TimeoutError()
+        except asyncio.TimeoutError as e:
+            raise ReplicateAPIError("Таймаут запроса к Replicate") from e
+    except ReplicateAPIError as error:
+        transport = error
+    assert is_retryable_replicate_error(transport)
+    assert is_retryable_replicate_error(ReplicateAPIError("Too many requests", status=429))
+    assert is_retryable_replicate_error(ReplicateAPIError("Bad gateway", status=502))
+
+
+class FakeBot:
+    async def get_me(self):
+        return types.SimpleNamespace(id=1)
+
+
+def test_open_circuit_refunds_and_explains(monkeypatch):
+    import generation.images as images
+
+    limiter = ReplicateLimiter()
+    limiter.get(MODEL_REF)._open(time.monotonic())
+    monkeypatch.setattr(prediction_tracker_module, 'replicate_limiter', limiter)
+
+    sent = []
+    credits = []
+
+    async def send_message_with_fallback(bot, chat_id, text, reply_markup=None, parse_mode=None, **kwargs):
+        sent.append(text)
+        return None
+
+    async def update_user_credits(user_id, action, amount=1, email=None):
+        credits.append((user_id, action, amount))
+        return True
+
+    async def returns(value, *args, **kwargs):
+        return value
+
+    async def noop(*args, **kwargs):
+        return None
+
+    async def prepare_model_params(*args, **kwargs):
+        return {'prompt': 'photo of TOK', 'num_outputs': 2}
+
+    monkeypatch.setattr(images, 'send_message_with_fallback', send_message_with_fallback)
+    monkeypatch.setattr(images, 'update_user_credits', update_user_credits)
+    monkeypatch.setattr(images, 'check_database_user', lambda user_id: returns((0,) * 11))
+    monkeypatch.setattr(images, 'get_active_model_cached', lambda user_id: returns(
+        (1, 'owner/model', 'version', 'success', 'prediction', 'TOK', [], 0, 'Avatar')
+    ))
+    monkeypatch.setattr(images, 'resolve_avatar_model', lambda model_id, version: (MODEL_REF, True))
+    monkeypatch.setattr(images, 'process_prompt_async', lambda *args, **kwargs: returns('photo of TOK'))
+    monkeypatch.setattr(images, 'prepare_model_params', prepare_model_params)
+    monkeypatch.setattr(images, 'log_generation', noop)
+    monkeypatch.setattr(images, 'create_main_menu_keyboard', noop)
+    monkeypatch.setattr(images, 'reset_generation_context', noop)
+    monkeypatch.setitem(sys.modules, 'handlers.generation',
+                        types.SimpleNamespace(handle_admin_generation_result=noop))
+
+    async def run():
+        state = FSMContext(MemoryStorage(), StorageKey(bot_id=1, chat_id=USER_ID, user_id=USER_ID))
+        await state.update_data(generation_type='with_avatar', prompt='портрет', aspect_ratio='1:1',
+                                model_key='flux-trained', photos_to_deduct=2)
+        await images._generate_image_internal(FakeBot(), state, num_outputs=2, requester_id=USER_ID)
+
+    asyncio.run(run())
+
+    assert credits == [(USER_ID, 'decrement_photo', 2), (USER_ID, 'increment_photo', 2)]
+    assert any('перегружен' in text for text in sent)
+    assert limiter.get(MODEL_REF).rejected == 1
@@ -0,0 +1,41 @@
+# tests/test_replicate_uploads.py
+import asyncio
+
+from replicate_uploads import ReplicateUploadCache
+
+
+class SlowClient:
+    api_token = 'test'
+
+    def __init__(self):
+        self.calls = 0
+        self.started = asyncio.Event()
+
+    async def create_file(self, content, filename=None, content_type=None):
+        self.calls += 1
+        self.started.set()
+        if self.calls == 1:
+            await asyncio.sleep(3600)
+        return {'urls': {'get': f'https://api.replicate.com/v1/files/{self.calls}'}}
+
+
+def test_cancelled_owner_does_not_cancel_waiters():
+    cache = ReplicateUploadCache()
+
+    async def scenario():
+        client = SlowClient()
+        owner = asyncio.create_task(cache.upload(b'photo', 'photo.jpg', client=client))
+        await client.started.wait()
+        waiter = asyncio.create_task(cache.upload(b'photo', 'photo.jpg', client=client))
+        await asyncio.sleep(0)
+        owner.cancel()
+        url = await asyncio.wait_for(waiter, timeout=1)
+        return owner, waiter, url, client
+
+    owner, waiter, url, client = asyncio.run(scenario())
+
+    assert owner.cancelled()
+    assert not waiter.cancelled()
+    assert url == 'https://api.replicate.com/v1/files/2'
+    assert client.calls == 2
+    assert cache._inflight == {}
@@ -0,0 +1,50 @@
+# tests/test_replicate_webhooks.py
+import asyncio
+
+import replicate_webhooks as replicate_webhooks_module
+from replicate_webhooks import KIND_VIDEO, ReplicateWebhookHandler
+
+
+class RecordingPoller:
+    def __init__(self):
+        self.forgotten = []
+
+    def forget(self, job_id):
+        self.forgotten.append(job_id)
+
+
+def _handle_webhook(monkeypatch, committed: bool):
+    poller = RecordingPoller()
+    monkeypatch.setattr(replicate_webhooks_module, 'prediction_poller', poller)
+    handler = ReplicateWebhookHandler(url='https://bot.example/replicate/webhook', secret='')
+    data = {'user_id': 1, 'task_id': 7, 'prediction_id': 'p1'}
+    handler.track('p1', KIND_VIDEO, data)
+    checks = []
+
+    async def check(bot, kind, check_data):
+        checks.append(check_data)
+
+    async def is_committed(kind, check_data):
+        return committed
+
+    handler.check = check
+    handler._is_committed = is_committed
+    asyncio.run(handler.handle(None, {'id': 'p1', 'status': 'succeeded'}))
+    return handler, poller, checks
+
+
+def test_failed_delivery_keeps_job_watched(monkeypatch):
+    handler, poller, checks = _handle_webhook(monkeypatch, committed=False)
+
+    assert len(checks) == 1
+    assert not handler.is_finished('p1')
+    assert poller.forgotten == []
+    assert 'p1' in handler._contexts
+
+
+def test_committed_delivery_finishes_job(monkeypatch):
+    handler, poller, checks = _handle_webhook(monkeypatch, committed=True)
+
+    assert handler.is_finished('p1')
+    assert poller.forgotten == ['p1']
+    assert 'p1' not in handler._contexts
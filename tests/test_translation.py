@@ -0,0 +1,50 @@
+# tests/test_translation.py
+import asyncio
+
+from translation import TranslationService, _cache_key, normalize_text
+
+
+def test_cancelled_translation_releases_waiters():
+    service = TranslationService()
+    started = asyncio.Event()
+
+    async def resolve(key, normalized):
+        started.set()
+        await asyncio.sleep(3600)
+
+    service._resolve = resolve
+
+    async def scenario():
+        owner = asyncio.create_task(service.translate('привет мир'))
+        await started.wait()
+        waiter = asyncio.create_task(service.translate('привет мир'))
+        await asyncio.sleep(0)
+        owner.cancel()
+        result = await asyncio.wait_for(waiter, timeout=1)
+        return owner, result
+
+    owner, result = asyncio.run(scenario())
+
+    assert owner.cancelled()
+    assert result == 'привет мир'
+    assert service._inflight == {}
+
+
+def test_cache_key_matches_translated_text():
+    translated = []
+    service = TranslationService()
+
+    async def resolve(key, normalized):
+        assert key == _cache_key(normalized)
+        translated.append(normalized)
+        return normalized.upper()
+
+    service._resolve = resolve
+
+    async def scenario():
+        return await service.translate('Привет  мир'), await service.translate('привет мир')
+
+    first, second = asyncio.run(scenario())
+
+    assert translated == [normalize_text('Привет  мир'), 'привет мир']
+    assert first == 'ПРИВЕТ МИР' and second == 'ПРИВЕТ МИР'
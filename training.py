@@ -3,11 +3,10 @@ import re
 import aiosqlite
 import asyncio
 import logging
-import os
 import uuid
 import random
-import zipfile
-from typing import Dict, Optional, List
+import statistics
+from typing import Dict, Optional, List, Tuple
 from aiogram import Bot, Router
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, ContentType
 from aiogram.fsm.context import FSMContext
@@ -15,16 +14,20 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.enums import ParseMode
-import replicate
 from replicate.exceptions import ReplicateError
 
-from config import REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS, REPLICATE_API_TOKEN, DATABASE_PATH
+from config import REPLICATE_USERNAME_OR_ORG_NAME, ADMIN_IDS, DATABASE_PATH
 from generation_config import IMAGE_GENERATION_MODELS
 from database import check_database_user, update_user_credits, save_user_trainedmodel, update_trainedmodel_status, log_generation, check_user_resources
 from keyboards import create_main_menu_keyboard, create_training_keyboard, create_user_profile_keyboard, create_subscription_keyboard, create_confirmation_keyboard
 from generation.utils import TempFileManager, reset_generation_context, send_message_with_fallback
-from generation.images import upload_image_to_replicate
 from handlers.utils import clean_admin_context, safe_escape_markdown as escape_md
+from replicate_client import get_replicate_client, ReplicateObject, ReplicateAPIError
+from replicate_webhooks import replicate_webhooks, KIND_TRAINING
+from prediction_poller import prediction_poller
+from prediction_tracker import prediction_tracker
+from training_ingest import training_ingest
+from photo_quality import PhotoVerdict
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +79,9 @@ STAGE_EMOJIS = {
     4: ["💎", "🔍", "⏰", "✅"]
 }
 
+# Сколько строк с замечаниями по отдельным фото показывать на шаге подтверждения
+MAX_PHOTO_REVIEW_LINES = 12
+
 TRAINER_VERSION = "replicate/fast-flux-trainer:8b10794665aed907bb98a1a5324cd1d3a8bea0e9b31e65210967fb9c9e2e08ed"
 
 def generate_trigger_word(user_id: int, avatar_name: str) -> str:
@@ -137,17 +143,33 @@ async def send_training_progress_with_delay(bot: Bot, user_id: int, elapsed_minu
     await asyncio.sleep(delay)
     await send_training_progress(bot, user_id, elapsed_minutes, avatar_name, total_minutes)
 
+async def is_training_finished(avatar_id: int) -> bool:
+    """Есть ли у обучения аватара финальный статус."""
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        c = await conn.cursor()
+        await c.execute("SELECT status FROM user_trainedmodels WHERE avatar_id = ?", (avatar_id,))
+        row = await c.fetchone()
+    return not row or row[0] in ('success', 'failed')
+
+async def send_training_progress_series(bot: Bot, user_id: int, avatar_name: str, avatar_id: int, total_minutes: int = 5) -> None:
+    """Серия уведомлений о прогрессе в одной задаче; прерывается, как только обучение завершено."""
+    for minutes in [1, 2, 3, 4]:
+        if minutes >= total_minutes:
+            break
+        await asyncio.sleep(60)
+        if await is_training_finished(avatar_id):
+            return
+        await send_training_progress(bot, user_id, minutes, avatar_name, total_minutes)
+
 async def schedule_training_notifications(bot: Bot, user_id: int, avatar_name: str, avatar_id: int, training_id: str, model_name: str, total_minutes: int = 5):
     """Планирует серию уведомлений о прогрессе обучения."""
-    notification_schedule = [1, 2, 3, 4]
-    for minutes in notification_schedule:
-        if minutes < total_minutes:
-            asyncio.create_task(send_training_progress_with_delay(
-                bot, user_id, minutes, avatar_name, total_minutes, delay=minutes * 60
-            ))
-    asyncio.create_task(check_training_status_with_delay(
-        bot, {'user_id': user_id, 'prediction_id': training_id, 'model_name': model_name, 'avatar_id': avatar_id}, delay=total_minutes * 60
-    ))
+    asyncio.create_task(send_training_progress_series(bot, user_id, avatar_name, avatar_id, total_minutes))
+    check_data = {'user_id': user_id, 'prediction_id': training_id, 'model_name': model_name, 'avatar_id': avatar_id}
+    if replicate_webhooks.enabled:
+        # Результат доставит вебхук Replicate, опрос остаётся страховкой
+        replicate_webhooks.track(training_id, KIND_TRAINING, check_data)
+    else:
+        prediction_poller.watch(training_id, KIND_TRAINING, check_data)
 
 async def start_training(message: Message, state: FSMContext) -> None:
     """Запускает обучение аватара с использованием Replicate trainings API."""
@@ -212,33 +234,20 @@ async def start_training(message: Message, state: FSMContext) -> None:
             await update_user_credits(user_id, "decrement_avatar", amount=1)
             logger.info(f"Списан 1 аватар для user_id={user_id} ПЕРЕД запуском обучения.")
 
-            zip_dir = f"uploads/{user_id}"
-            os.makedirs(zip_dir, exist_ok=True)
-            zip_filename = f"train_photos_{trigger_word}_{uuid.uuid4().hex[:6]}.zip"
-            zip_path = os.path.join(zip_dir, zip_filename)
-            temp_manager.add(zip_path)
+            for photo_path_item in training_photos:
+                temp_manager.add(photo_path_item)
 
-            try:
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for photo_path_item in training_photos:
-                        if os.path.exists(photo_path_item):
-                            zipf.write(photo_path_item, os.path.basename(photo_path_item))
-                            temp_manager.add(photo_path_item)
-                        else:
-                            logger.warning(f"Файл фото {photo_path_item} не найден при создании ZIP для user_id={user_id}")
-                logger.info(f"ZIP-архив создан: {zip_path} с {len(training_photos)} файлами.")
-            except Exception as e_zip:
-                logger.error(f"Ошибка создания ZIP для user_id={user_id}: {e_zip}", exc_info=True)
-                raise RuntimeError(f"Ошибка создания ZIP-архива: {e_zip}")
-
-            replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+            replicate_client = get_replicate_client()
 
             await status_message.edit_text(
                 escape_md("📤 Загружаю твои фотографии в облако...", version=2),
                 parse_mode=ParseMode.MARKDOWN_V2
             )
 
-            zip_url = await upload_image_to_replicate(zip_path)
+            # Архив собирался по мере загрузки фото и обычно уже загружен на шаге подтверждения
+            zip_url, zip_path = await training_ingest.upload(user_id, training_photos)
+            temp_manager.add(zip_path)
+            logger.info(f"Архив обучения загружен: {zip_path} с {len(training_photos)} файлами.")
 
             await status_message.edit_text(
                 escape_md("✅ Фотографии загружены. Запускаю обучение нейросети...", version=2),
@@ -251,8 +260,9 @@ async def start_training(message: Message, state: FSMContext) -> None:
 
             training_id = None
             try:
-                training = replicate_client.trainings.create(
-                    destination=model_name_for_db, version=TRAINER_VERSION, input=training_params
+                training = await replicate_client.create_training(
+                    TRAINER_VERSION, destination=model_name_for_db, input=training_params,
+                    **replicate_webhooks.training_kwargs()
                 )
                 training_id = training.id
                 if not training_id:
@@ -261,8 +271,9 @@ async def start_training(message: Message, state: FSMContext) -> None:
             except Exception as e:
                 logger.warning(f"Не удалось создать обучение через trainings API: {e}")
                 try:
-                    prediction = replicate_client.run(
-                        TRAINER_VERSION, input={**training_params, "trigger_word": trigger_word}
+                    prediction = await replicate_client.create_prediction(
+                        TRAINER_VERSION, {**training_params, "trigger_word": trigger_word},
+                        **replicate_webhooks.prediction_kwargs()
                     )
                     training_id = prediction.id if hasattr(prediction, 'id') else f"training_{uuid.uuid4().hex[:8]}"
                     logger.info(f"Альтернативный запуск обучения как предикции: training_id={training_id}")
@@ -273,12 +284,16 @@ async def start_training(message: Message, state: FSMContext) -> None:
             if not training_id:
                 raise ValueError("Не удалось получить ID обучения ни одним способом!")
 
-            new_avatar_id = await save_user_trainedmodel(
-                user_id, training_id, trigger_word, training_photos, avatar_name, training_step="started"
-            )
-
-            if not new_avatar_id:
-                raise RuntimeError("Не удалось сохранить информацию о запуске обучения в БД.")
+            try:
+                new_avatar_id = await save_user_trainedmodel(
+                    user_id, training_id, trigger_word, training_photos, avatar_name, training_step="started"
+                )
+                if not new_avatar_id:
+                    raise RuntimeError("Не удалось сохранить информацию о запуске обучения в БД.")
+            except Exception:
+                # Аватар вернётся на баланс, а бот не узнает о результате — отменяем уже запущенное обучение
+                await prediction_tracker.cancel(training_id, training=True)
+                raise
 
             await update_trainedmodel_status(avatar_id=new_avatar_id, model_id=model_name_for_db, status='starting')
 
@@ -352,6 +367,7 @@ async def start_training(message: Message, state: FSMContext) -> None:
             await reset_generation_context(state, 'train_flux_general_error')
 
         finally:
+            await training_ingest.discard(user_id)
             if status_message:
                 try:
                     await status_message.delete()
@@ -369,7 +385,7 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
         conn.row_factory = aiosqlite.Row
         c = await conn.cursor()
         await c.execute(
-            "SELECT avatar_name, trigger_word, photo_paths FROM user_trainedmodels WHERE avatar_id = ?",
+            "SELECT avatar_name, trigger_word, photo_paths, status FROM user_trainedmodels WHERE avatar_id = ?",
             (avatar_id,)
         )
         avatar_info = await c.fetchone()
@@ -378,10 +394,14 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
         logger.error(f"Не найдена информация об аватаре avatar_id={avatar_id}")
         return
 
+    if avatar_info['status'] in ('success', 'failed'):
+        logger.info(f"Обучение avatar_id={avatar_id} уже имеет финальный статус: {avatar_info['status']}")
+        return
+
     avatar_name = avatar_info['avatar_name']
     trigger_word = avatar_info['trigger_word']
 
-    replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
+    replicate_client = get_replicate_client()
 
     try:
         logger.info(f"Проверка статуса тренировки для user_id={user_id}, avatar_id={avatar_id}, training_id={training_id}")
@@ -390,7 +410,7 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
         output = None
 
         try:
-            training = replicate_client.trainings.get(training_id)
+            training = await replicate_client.get_training(training_id)
             training_status = training.status
             output = training.output if hasattr(training, 'output') else None
             logger.info(f"Получен статус через trainings API: {training_status}")
@@ -398,7 +418,7 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
         except Exception as e:
             logger.warning(f"Не удалось получить статус через trainings API: {e}")
             try:
-                prediction = replicate_client.predictions.get(training_id)
+                prediction = await replicate_client.get_prediction(training_id)
                 training_status = prediction.status
                 output = prediction.output
                 logger.info(f"Получен статус через predictions API: {training_status}")
@@ -446,12 +466,11 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
                 logger.error(f"Не удалось извлечь версию модели из output: {output}")
                 try:
                     model_base = model_name.split(':')[0] if ':' in model_name else model_name
-                    model = replicate_client.models.get(model_base)
-                    if model and hasattr(model, 'latest_version'):
-                        latest_version = model.latest_version
-                        if hasattr(latest_version, 'id'):
-                            model_version = latest_version.id
-                            logger.info(f"Версия получена из latest_version: {model_version}")
+                    model = await replicate_client.get_model(model_base)
+                    latest_version = model.get('latest_version') if model else None
+                    if latest_version and latest_version.get('id'):
+                        model_version = latest_version['id']
+                        logger.info(f"Версия получена из latest_version: {model_version}")
                 except Exception as e:
                     logger.error(f"Не удалось получить версию через models API: {e}")
                 if not model_version:
@@ -528,14 +547,15 @@ async def check_training_status(bot: Bot, data: Dict[str, any]) -> None:
 
         else:
             logger.info(f"Тренировка для user_id={user_id}, avatar_id={avatar_id} всё ещё в процессе: {training_status}")
+            if replicate_webhooks.enabled or not prediction_poller.watch(training_id, KIND_TRAINING, data):
+                return
             safe_avatar_name = escape_md(avatar_name, version=2)
             progress_message = (
-                escape_md(f"⏳ Аватар '{safe_avatar_name}' почти готов! Проверю снова через 30 секунд...", version=2)
+                escape_md(f"⏳ Аватар '{safe_avatar_name}' почти готов! Сообщу, как только обучение завершится.", version=2)
             )
             await send_message_with_fallback(
                 bot, user_id, progress_message, parse_mode=ParseMode.MARKDOWN_V2, is_escaped=True
             )
-            asyncio.create_task(check_training_status_with_delay(bot, data, delay=30))
 
     except Exception as e:
         logger.error(f"Ошибка проверки статуса для user_id={user_id}: {e}", exc_info=True)
@@ -554,6 +574,45 @@ async def check_training_status_with_delay(bot: Bot, data: Dict[str, any], delay
     await asyncio.sleep(delay)
     await check_training_status(bot, data)
 
+async def fetch_training_status(training_id: str) -> ReplicateObject:
+    """Статус обучения для опросчика; обучения, запущенные как предсказания, читаются через predictions API."""
+    replicate_client = get_replicate_client()
+    try:
+        return await replicate_client.get_training(training_id)
+    except ReplicateAPIError as e:
+        if e.status != 404:
+            raise
+        return await replicate_client.get_prediction(training_id)
+
+async def on_training_update(bot: Bot, data: Dict[str, any], training: ReplicateObject, expired: bool) -> None:
+    """Обработчик опросчика: доставка результата по финальному статусу."""
+    if training.finished:
+        await replicate_webhooks.check(bot, KIND_TRAINING, data)
+
+prediction_poller.register(KIND_TRAINING, fetch_training_status, on_training_update)
+
+def _training_check_data(row) -> Dict[str, any]:
+    """Данные для check_training_status по строке user_trainedmodels."""
+    model_name = row['model_id']
+    if not model_name:
+        logger.warning(f"Отсутствует model_id для avatar_id={row['avatar_id']}, user_id={row['user_id']}. Используем дефолтное имя.")
+        model_name = f"{REPLICATE_USERNAME_OR_ORG_NAME}/fastnew"
+        logger.info(f"Восстановлен model_name для проверки: {model_name}")
+    return {'user_id': row['user_id'], 'prediction_id': row['prediction_id'], 'model_name': model_name, 'avatar_id': row['avatar_id']}
+
+async def find_training_check_data(training_id: str) -> Optional[Dict[str, any]]:
+    """Данные для check_training_status незавершённого обучения с этим training_id."""
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        c = await conn.cursor()
+        await c.execute("""
+            SELECT user_id, prediction_id, avatar_id, model_id
+            FROM user_trainedmodels
+            WHERE prediction_id = ? AND status IN ('pending', 'starting', 'processing')
+        """, (training_id,))
+        row = await c.fetchone()
+    return _training_check_data(row) if row else None
+
 async def check_pending_trainings(bot: Bot) -> None:
     """Проверяет и возобновляет незавершенные задачи обучения."""
     try:
@@ -577,30 +636,70 @@ async def check_pending_trainings(bot: Bot) -> None:
             user_id = row['user_id']
             training_id = row['prediction_id']
             avatar_id = row['avatar_id']
-            model_id_db = row['model_id']
-            trigger_word_db = row['trigger_word']
-            avatar_name = row['avatar_name'] or f"Avatar {avatar_id}"
             
             if not training_id:
                 logger.warning(f"Пропуск проверки обучения для avatar_id={avatar_id}, user_id={user_id}: отсутствует training_id.")
                 continue
             
-            model_name_for_check = model_id_db
-            if not model_name_for_check:
-                logger.warning(f"Отсутствует model_id для avatar_id={avatar_id}, user_id={user_id}. Используем дефолтное имя.")
-                model_name_for_check = f"{REPLICATE_USERNAME_OR_ORG_NAME}/fastnew"
-                logger.info(f"Восстановлен model_name для проверки: {model_name_for_check}")
-            
+            check_data = _training_check_data(row)
             logger.info(f"Возобновление проверки статуса обучения для user_id={user_id}, "
-                        f"avatar_id={avatar_id}, training_id={training_id}, model_name='{model_name_for_check}'")
+                        f"avatar_id={avatar_id}, training_id={training_id}, model_name='{check_data['model_name']}'")
             
-            asyncio.create_task(check_training_status_with_delay(bot, {
-                'user_id': user_id, 'prediction_id': training_id, 'model_name': model_name_for_check, 'avatar_id': avatar_id
-            }, delay=random.randint(10, 30)))
+            # Уже наблюдаемые обучения опросчик отклонит, дублей проверок не будет
+            prediction_poller.watch(training_id, KIND_TRAINING, check_data)
             
     except Exception as e:
         logger.error(f"Ошибка при проверке незавершенных задач обучения: {e}", exc_info=True)
 
+def format_photo_review(verdicts: List[PhotoVerdict]) -> str:
+    """Отчёт о проверке качества фото для шага подтверждения (без экранирования)."""
+    accepted = [verdict for verdict in verdicts if not verdict.rejected]
+    flagged = [verdict for verdict in accepted if verdict.warnings]
+    rejected_count = len(verdicts) - len(accepted)
+    lines = [
+        "🔍 Проверка качества фото:\n",
+        f"✅ Подходят: {len(accepted) - len(flagged)}\n"
+    ]
+    if flagged:
+        lines.append(f"⚠️ С замечаниями: {len(flagged)}\n")
+    if rejected_count:
+        lines.append(f"❌ Исключены: {rejected_count}\n")
+    scored = [verdict.quality for verdict in accepted if verdict.quality]
+    if scored:
+        lines.append(
+            f"📊 В среднем: резкость {statistics.median(q.blur for q in scored):.0f}, "
+            f"яркость {statistics.median(q.brightness for q in scored):.0f}, "
+            f"{statistics.median(q.width for q in scored):.0f}×{statistics.median(q.height for q in scored):.0f}\n"
+        )
+
+    details = []
+    for number, verdict in enumerate(verdicts, start=1):
+        if verdict.rejected:
+            details.append(f"❌ Фото №{number}: {verdict.rejected}\n")
+        elif verdict.warnings:
+            details.append(f"⚠️ Фото №{number}: {'; '.join(verdict.warnings)}\n")
+    if details:
+        lines.append("\n")
+        lines.extend(details[:MAX_PHOTO_REVIEW_LINES])
+        if len(details) > MAX_PHOTO_REVIEW_LINES:
+            lines.append(f"… и ещё {len(details) - MAX_PHOTO_REVIEW_LINES}\n")
+    return "".join(lines)
+
+async def screen_training_photos(user_id: int, training_photos: List[str]) -> Tuple[List[str], str]:
+    """Проверяет качество фото и исключает отбракованные.
+
+    Возвращает (оставшиеся фото, текст отчёта). При ошибке проверки набор не меняется.
+    """
+    try:
+        verdicts = await training_ingest.review(user_id, training_photos)
+    except Exception as e:
+        logger.error(f"Ошибка проверки качества фото для user_id={user_id}: {e}", exc_info=True)
+        return training_photos, ""
+    rejected = [verdict.path for verdict in verdicts if verdict.rejected]
+    if rejected:
+        await training_ingest.exclude(user_id, rejected)
+    return [verdict.path for verdict in verdicts if not verdict.rejected], format_photo_review(verdicts)
+
 @training_router.callback_query(lambda c: c.data and c.data.startswith("train_new_avatar"))
 async def initiate_training(query: CallbackQuery, state: FSMContext):
     """Инициирует процесс создания нового аватара."""
@@ -632,16 +731,25 @@ async def handle_avatar_name(message: Message, state: FSMContext):
     user_data = await state.get_data()
     training_photos = user_data.get('training_photos', [])
     photo_count = len(training_photos)
+    review_text = ""
+
+    if photo_count >= 10:
+        # Отбраковка размытых, крошечных фото и дубликатов до сборки архива
+        training_photos, review_text = await screen_training_photos(user_id, training_photos)
+        photo_count = len(training_photos)
 
     # Сохраняем имя аватара
     await state.update_data(avatar_name=avatar_name, training_photos=training_photos, processed_media_groups=set())
 
     if photo_count >= 10:
+        # Набор фото зафиксирован: начинаем загрузку архива, пока пользователь читает подтверждение
+        await training_ingest.stage(user_id, training_photos)
         # Если загружено достаточно фотографий, переходим к подтверждению
         text = (
             escape_md(f"👍 Отлично! Давай проверим финальные данные:\n\n", version=2) +
             escape_md(f"👤 Имя аватара: {avatar_name}\n", version=2) +
             escape_md(f"📸 Загружено фото: {photo_count} шт.\n\n", version=2) +
+            (escape_md(f"{review_text}\n", version=2) if review_text else "") +
             escape_md(f"🚀 Все готово для запуска обучения!\n", version=2) +
             escape_md(f"⏱ Это займет около 3-5 минут.\n", version=2) +
             escape_md(f"💎 Будет списан 1 аватар с твоего баланса.\n\n", version=2) +
@@ -662,6 +770,7 @@ async def handle_avatar_name(message: Message, state: FSMContext):
         # Если фотографий недостаточно, запрашиваем загрузку
         text = (
             escape_md(f"✅ Имя аватара: {avatar_name}\n\n", version=2) +
+            (escape_md(f"{review_text}\n", version=2) if review_text else "") +
             escape_md(f"📸 Загружено {photo_count} фото. Нужно минимум 10. Загрузи ещё {10 - photo_count}.", version=2) + "\n" +
             escape_md("Требования:\n", version=2) +
             escape_md("- Чёткие фото лица\n", version=2) +
@@ -737,8 +846,9 @@ async def handle_training_photos(message: Message, state: FSMContext):
     try:
         file = await bot.get_file(photo.file_id)
         photo_path = f"temp/{user_id}_{uuid.uuid4()}.jpg"
-        os.makedirs(os.path.dirname(photo_path), exist_ok=True)
-        await bot.download_file(file.file_path, photo_path)
+        photo_buffer = await bot.download_file(file.file_path)
+        # Нормализация и дозапись в ZIP сразу при получении, а не при запуске обучения
+        await training_ingest.add_photo(user_id, photo_path, photo_buffer.getvalue())
         if photo_path not in training_photos:
             training_photos.append(photo_path)
             logger.debug(f"Добавлено фото {photo_path} для user_id={user_id}")
@@ -0,0 +1,307 @@
+# training_ingest.py
+"""Конвейер приёма фото для обучения аватара.
+
+Раньше фото сохранялись в temp/ как есть, а после нажатия «Начать
+обучение» start_training упаковывал их в ZIP_DEFLATED и только потом
+загружал архив в Replicate — архивация и загрузка стояли на критическом
+пути запуска.
+
+Теперь каждое фото обрабатывается сразу при получении:
+
+1. нормализуется в пуле процессов (поворот по EXIF, RGB, ограничение
+   стороны, перекодирование в JPEG без метаданных);
+2. дописывается в ZIP пользователя без сжатия (ZIP_STORED — JPEG всё
+   равно не сжимается);
+3. тут же, на уже открытом изображении, считаются оценки качества
+   (photo_quality): резкость, экспозиция, размер и перцептивный хеш;
+4. на шаге подтверждения review() отбраковывает размытые, крошечные фото
+   и почти-дубликаты, архив закрывается (или пересобирается без
+   исключённых фото) и загрузка в Replicate начинается заранее (stage()).
+
+start_training остаётся только дождаться уже идущей (обычно завершённой)
+загрузки и отправить обучение. Новое фото после stage() отменяет
+подготовленную загрузку и дописывается в тот же архив. Если архива нет
+(например, после перезапуска бота), он собирается из файлов в temp/.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import time
+import uuid
+import zipfile
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+from image_normalizer import normalize_image, encode_jpeg
+from photo_quality import PhotoQuality, PhotoVerdict, analyze_image, analyze_photo_file, assess_photo_set
+from config import TRAINING_PHOTO_MAX_SIDE, TRAINING_PHOTO_JPEG_QUALITY, TRAINING_INGEST_TTL_SECONDS
+from executors import cpu_executor, disk_executor
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_training_photo(data: bytes, max_side: int = TRAINING_PHOTO_MAX_SIDE,
+                             quality: int = TRAINING_PHOTO_JPEG_QUALITY) -> bytes:
+    """Поворачивает по EXIF, приводит к RGB, ограничивает сторону и перекодирует в JPEG без метаданных."""
+    with Image.open(io.BytesIO(data)) as source:
+        return encode_jpeg(normalize_image(source, max_side), quality)
+
+
+def prepare_training_photo(data: bytes, max_side: int = TRAINING_PHOTO_MAX_SIDE,
+                           quality: int = TRAINING_PHOTO_JPEG_QUALITY) -> Tuple[bytes, PhotoQuality]:
+    """normalize_training_photo и оценки качества за одно декодирование (для пула процессов)."""
+    with Image.open(io.BytesIO(data)) as source:
+        image = normalize_image(source, max_side)
+        return encode_jpeg(image, quality), analyze_image(image)
+
+
+def write_training_zip(zip_path: str, photo_paths: List[str]) -> Tuple[List[str], List[str]]:
+    """Упаковывает фото для обучения в ZIP. Возвращает (добавленные, отсутствующие) пути."""
+    archived, missing = [], []
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as zipf:
+        for photo_path_item in photo_paths:
+            if os.path.exists(photo_path_item):
+                zipf.write(photo_path_item, os.path.basename(photo_path_item))
+                archived.append(photo_path_item)
+            else:
+                missing.append(photo_path_item)
+    return archived, missing
+
+
+class TrainingArchive:
+    """ZIP с фото одного пользователя, который растёт по мере загрузки."""
+
+    def __init__(self, user_id: int, zip_path: str):
+        self.user_id = user_id
+        self.zip_path = zip_path
+        self.entries: List[str] = []
+        self.quality: Dict[str, PhotoQuality] = {}
+        self.lock = asyncio.Lock()
+        self.touched_at = time.monotonic()
+        self.upload_task: Optional[asyncio.Task] = None
+        self._zip: Optional[zipfile.ZipFile] = None
+
+    def covers(self, photo_paths: List[str]) -> bool:
+        return set(self.entries) == set(photo_paths)
+
+    def _append_sync(self, photo_path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(photo_path) or '.', exist_ok=True)
+        with open(photo_path, 'wb') as f:
+            f.write(data)
+        if self._zip is None:
+            # После stage() архив закрыт: дописываем, ZipFile перезапишет центральный каталог
+            mode = 'a' if os.path.exists(self.zip_path) else 'w'
+            self._zip = zipfile.ZipFile(self.zip_path, mode, zipfile.ZIP_STORED)
+        self._zip.writestr(os.path.basename(photo_path), data)
+
+    def _close_sync(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+
+    def _cancel_upload(self) -> None:
+        if self.upload_task is not None:
+            if self.upload_task.done() and not self.upload_task.cancelled():
+                self.upload_task.exception()  # помечаем ошибку полученной
+            self.upload_task.cancel()
+            self.upload_task = None
+
+    async def append(self, photo_path: str, data: bytes) -> None:
+        async with self.lock:
+            self._cancel_upload()
+            await disk_executor.run(self._append_sync, photo_path, data)
+            self.entries.append(photo_path)
+            self.touched_at = time.monotonic()
+
+    async def stage(self) -> asyncio.Task:
+        """Закрывает архив и запускает его загрузку, если она ещё не идёт."""
+        from generation.images import upload_image_to_replicate
+        async with self.lock:
+            if self.upload_task is None:
+                await disk_executor.run(self._close_sync)
+                self.upload_task = asyncio.create_task(upload_image_to_replicate(self.zip_path))
+            self.touched_at = time.monotonic()
+            return self.upload_task
+
+    async def close(self, remove_file: bool = True) -> None:
+        async with self.lock:
+            self._cancel_upload()
+            await disk_executor.run(self._close_sync)
+            if remove_file and os.path.exists(self.zip_path):
+                await disk_executor.run(os.remove, self.zip_path)
+
+
+class TrainingIngestService:
+    """Архивы обучения по пользователям."""
+
+    def __init__(self, ttl: float = TRAINING_INGEST_TTL_SECONDS):
+        self.ttl = ttl
+        self._archives: Dict[int, TrainingArchive] = {}
+        self.photos_ingested = 0
+        self.normalize_seconds_total = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.staged = 0
+        self.staged_ready_at_start = 0
+        self.rebuilds = 0
+        self.reviews = 0
+        self.review_seconds_total = 0.0
+        self.photos_rejected = 0
+        self.photos_flagged = 0
+
+    def _archive(self, user_id: int) -> TrainingArchive:
+        self._prune()
+        archive = self._archives.get(user_id)
+        if archive is None:
+            zip_path = os.path.join(f"uploads/{user_id}", f"train_photos_{uuid.uuid4().hex[:12]}.zip")
+            os.makedirs(os.path.dirname(zip_path), exist_ok=True)
+            archive = self._archives[user_id] = TrainingArchive(user_id, zip_path)
+        return archive
+
+    def _prune(self) -> None:
+        now = time.monotonic()
+        for user_id, archive in list(self._archives.items()):
+            if now - archive.touched_at > self.ttl and not archive.lock.locked():
+                del self._archives[user_id]
+                asyncio.create_task(archive.close())
+                logger.info(f"Удалён брошенный архив обучения user_id={user_id}")
+
+    async def add_photo(self, user_id: int, photo_path: str, data: bytes) -> None:
+        """Нормализует и оценивает фото в пуле процессов, сохраняет в photo_path и дописывает в архив пользователя."""
+        started = time.monotonic()
+        normalized, quality = await cpu_executor.run(prepare_training_photo, data)
+        self.normalize_seconds_total += time.monotonic() - started
+        archive = self._archive(user_id)
+        await archive.append(photo_path, normalized)
+        archive.quality[photo_path] = quality
+        self.photos_ingested += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(normalized)
+        logger.debug(f"Фото {photo_path} добавлено в архив user_id={user_id}: {len(data)} -> {len(normalized)} байт")
+
+    async def review(self, user_id: int, photo_paths: List[str]) -> List[PhotoVerdict]:
+        """Оценивает набор фото перед подтверждением; фото без оценок анализируются из файлов."""
+        started = time.monotonic()
+        archive = self._archives.get(user_id)
+        known = archive.quality if archive is not None else {}
+        missing = [path for path in photo_paths if path not in known]
+        results = await asyncio.gather(
+            *(cpu_executor.run(analyze_photo_file, path) for path in missing), return_exceptions=True
+        )
+        analyzed = {}
+        for path, result in zip(missing, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Не удалось оценить фото {path} для user_id={user_id}: {result}")
+                continue
+            analyzed[path] = result
+            if archive is not None:
+                archive.quality[path] = result
+        verdicts = assess_photo_set([(path, known.get(path) or analyzed.get(path)) for path in photo_paths])
+        elapsed = time.monotonic() - started
+        self.reviews += 1
+        self.review_seconds_total += elapsed
+        self.photos_rejected += sum(1 for verdict in verdicts if verdict.rejected)
+        self.photos_flagged += sum(1 for verdict in verdicts if verdict.warnings)
+        logger.info(
+            f"Проверка фото user_id={user_id}: {len(verdicts)} фото, "
+            f"исключено {sum(1 for verdict in verdicts if verdict.rejected)}, "
+            f"с замечаниями {sum(1 for verdict in verdicts if verdict.warnings)}, {elapsed:.3f} с"
+        )
+        return verdicts
+
+    async def exclude(self, user_id: int, photo_paths: List[str]) -> None:
+        """Удаляет отбракованные фото; архив будет пересобран без них при stage()/upload()."""
+        archive = self._archives.get(user_id)
+        for path in photo_paths:
+            if archive is not None:
+                archive.quality.pop(path, None)
+            if os.path.exists(path):
+                await disk_executor.run(os.remove, path)
+
+    async def stage(self, user_id: int, photo_paths: List[str]) -> None:
+        """Заранее загружает архив для набора фото на шаге подтверждения.
+
+        Если в архиве лишние фото (исключены проверкой качества), он пересобирается.
+        """
+        archive = self._archives.get(user_id)
+        if archive is None:
+            return
+        if not archive.covers(photo_paths):
+            archive = await self._rebuild(user_id, photo_paths)
+        await archive.stage()
+        self.staged += 1
+        logger.info(f"Загрузка архива обучения user_id={user_id} начата заранее ({len(photo_paths)} фото)")
+
+    async def _rebuild(self, user_id: int, photo_paths: List[str]) -> TrainingArchive:
+        old = self._archives.pop(user_id, None)
+        if old is not None:
+            await old.close()
+        archive = self._archive(user_id)
+        if old is not None:
+            archive.quality = {path: old.quality[path] for path in photo_paths if path in old.quality}
+        archived, missing = await disk_executor.run(write_training_zip, archive.zip_path, photo_paths)
+        for photo_path_item in missing:
+            logger.warning(f"Файл фото {photo_path_item} не найден при создании ZIP для user_id={user_id}")
+        archive.entries = archived
+        self.rebuilds += 1
+        logger.info(f"ZIP-архив собран из файлов: {archive.zip_path} с {len(archived)} файлами.")
+        return archive
+
+    async def upload(self, user_id: int, photo_paths: List[str]) -> Tuple[str, str]:
+        """Возвращает (URL архива в Replicate, путь к архиву) для набора фото.
+
+        Архив снимается с учёта; удалить файл должен вызывающий код.
+        """
+        archive = self._archives.get(user_id)
+        if archive is None or not archive.covers(photo_paths):
+            archive = await self._rebuild(user_id, photo_paths)
+        task = archive.upload_task
+        if task is not None and task.done() and not task.cancelled() and not task.exception():
+            self.staged_ready_at_start += 1
+        try:
+            url = await (await archive.stage())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Заранее начатая загрузка могла упасть — повторяем один раз уже на критическом пути
+            logger.warning(f"Загрузка архива обучения user_id={user_id} не удалась, повтор: {e}")
+            archive.upload_task = None
+            url = await (await archive.stage())
+        self._archives.pop(user_id, None)
+        return url, archive.zip_path
+
+    async def discard(self, user_id: int) -> None:
+        """Удаляет архив пользователя (новое обучение начато с нуля)."""
+        archive = self._archives.pop(user_id, None)
+        if archive is not None:
+            await archive.close()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики приёма фото для /metrics."""
+        return {
+            'archives': len(self._archives),
+            'photos_ingested': self.photos_ingested,
+            'avg_normalize_seconds': (
+                round(self.normalize_seconds_total / self.photos_ingested, 3) if self.photos_ingested else None
+            ),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'staged_uploads': self.staged,
+            'staged_ready_at_start': self.staged_ready_at_start,
+            'rebuilds': self.rebuilds,
+            'reviews': self.reviews,
+            'avg_review_seconds': round(self.review_seconds_total / self.reviews, 3) if self.reviews else None,
+            'photos_rejected': self.photos_rejected,
+            'photos_flagged': self.photos_flagged,
+        }
+
+
+# Глобальный экземпляр
+training_ingest = TrainingIngestService()
+metrics_registry.register('training_ingest', training_ingest.metrics)
+
+__all__ = ['TrainingIngestService', 'TrainingArchive', 'training_ingest', 'normalize_training_photo',
+           'prepare_training_photo', 'write_training_zip']
@@ -0,0 +1,183 @@
+# translation.py
+"""Кэширующий перевод пользовательских фрагментов промптов на английский.
+
+Переводится только текст пользователя (или промпт стиля), а не
+постоянные английские усилители, которые к нему дописываются. Результаты
+хранятся в LRU в памяти и в таблице translation_cache, ключ —
+нормализованный текст, он же уходит переводчику, поэтому повторные стили и «повторить генерацию»
+не обращаются к переводчику повторно, в том числе после перезапуска.
+Одновременные запросы одного и того же текста объединяются в один вызов.
+"""
+
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import aiosqlite
+from deep_translator import GoogleTranslator
+from config import DATABASE_PATH, TRANSLATION_LRU_SIZE, TRANSLATION_MAX_CHARS
+from executors import network_executor
+from metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+CYRILLIC_RE = re.compile('[а-яА-ЯёЁ]')
+WHITESPACE_RE = re.compile(r'\s+')
+
+
+def needs_translation(text: Optional[str]) -> bool:
+    """Есть ли в тексте кириллица."""
+    return bool(text) and CYRILLIC_RE.search(text) is not None
+
+
+def normalize_text(text: str) -> str:
+    """Схлопывает пробелы и обрезает текст до лимита переводчика."""
+    return WHITESPACE_RE.sub(' ', text).strip()[:TRANSLATION_MAX_CHARS]
+
+
+def _cache_key(normalized: str) -> str:
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def _translate_sync(text: str) -> Optional[str]:
+    return GoogleTranslator(source='auto', target='en').translate(text)
+
+
+async def init_translation_cache_table(conn: aiosqlite.Connection) -> None:
+    """Создаёт таблицу постоянного кэша переводов."""
+    await conn.execute('''CREATE TABLE IF NOT EXISTS translation_cache (
+                            cache_key TEXT PRIMARY KEY,
+                            source_text TEXT NOT NULL,
+                            translated_text TEXT NOT NULL,
+                            created_at REAL NOT NULL
+                         )''')
+    await conn.commit()
+
+
+class TranslationService:
+    """Перевод на английский с LRU, кэшем в SQLite и объединением одинаковых запросов."""
+
+    def __init__(self, lru_size: int = TRANSLATION_LRU_SIZE):
+        self.lru_size = lru_size
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._table_ready = False
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def _remember(self, key: str, translated: str) -> None:
+        self._lru[key] = translated
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    async def _ensure_table(self, conn: aiosqlite.Connection) -> None:
+        if not self._table_ready:
+            await init_translation_cache_table(conn)
+            self._table_ready = True
+
+    async def _load(self, key: str) -> Optional[str]:
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await self._ensure_table(conn)
+            cursor = await conn.execute(
+                "SELECT translated_text FROM translation_cache WHERE cache_key = ?", (key,)
+            )
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def _store(self, key: str, source: str, translated: str) -> None:
+        async with aiosqlite.connect(DATABASE_PATH) as conn:
+            await self._ensure_table(conn)
+            await conn.execute(
+                """INSERT OR REPLACE INTO translation_cache (cache_key, source_text, translated_text, created_at)
+                   VALUES (?, ?, ?, ?)""",
+                (key, source, translated, time.time())
+            )
+            await conn.commit()
+
+    async def _resolve(self, key: str, normalized: str) -> str:
+        cached = await self._load(key)
+        if cached is not None:
+            self.db_hits += 1
+            return cached
+        self.misses += 1
+        translated = await network_executor.run(_translate_sync, normalized)
+        if not translated:
+            raise ValueError("Переводчик вернул пустой результат")
+        try:
+            await self._store(key, normalized, translated)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить перевод в кэш: {e}")
+        logger.info(f"Переведено: '{normalized[:50]}...' -> '{translated[:50]}...'")
+        return translated
+
+    async def translate(self, text: Optional[str]) -> Optional[str]:
+        """Переводит текст на английский. Текст без кириллицы и ошибки перевода возвращают исходник."""
+        if not needs_translation(text):
+            return text
+        normalized = normalize_text(text)
+        key = _cache_key(normalized)
+        cached = self._lru.get(key)
+        if cached is not None:
+            self._lru.move_to_end(key)
+            self.memory_hits += 1
+            return cached
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Перевод отменён вместе с запросившей его задачей; собственная отмена пробрасывается
+                if future.cancelled():
+                    return text
+                raise
+            except Exception:
+                return text
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            translated = await self._resolve(key, normalized)
+            self._remember(key, translated)
+            future.set_result(translated)
+            return translated
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ошибка перевода промпта: {e}")
+            future.set_exception(e)
+            # Исключение уже передано ожидающим; помечаем его полученным
+            future.exception()
+            return text
+        finally:
+            if not future.done():
+                # Отмена или другое BaseException: ожидающие не должны зависнуть
+                future.cancel()
+            self._inflight.pop(key, None)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Счётчики кэша переводов для /metrics."""
+        return {
+            'lru_size': len(self._lru),
+            'memory_hits': self.memory_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'errors': self.errors,
+            'in_flight': len(self._inflight),
+        }
+
+
+# Глобальный экземпляр
+translation_service = TranslationService()
+metrics_registry.register('translation', translation_service.metrics)
+
+__all__ = ['TranslationService', 'translation_service', 'needs_translation', 'init_translation_cache_table']
@@ -25,6 +25,7 @@ from handlers.utils import (
 )
 import aiosqlite
 from keyboards import create_main_menu_keyboard
+from prediction_tracker import prediction_tracker
 
 logger = logging.getLogger(__name__)
 
@@ -1088,8 +1089,13 @@ async def confirm_reset_avatar(query: CallbackQuery, state: FSMContext, target_u
     await query.answer()
 
 async def cancel(message: Message, state: FSMContext) -> None:
-    """Отменяет все активные действия и сбрасывает контекст."""
+    """Отменяет все активные действия и сбрасывает контекст.
+
+    Ожидаемые генерации пользователя прерываются через prediction_tracker:
+    предсказания отменяются в Replicate, а печеньки возвращает обработчик генерации.
+    """
     user_id = message.from_user.id
+    prediction_tracker.abort(user_id)
     await state.clear()
     text = escape_message_parts("✅ Все действия отменены.", version=2)
     reply_markup = await create_admin_keyboard() if user_id in ADMIN_IDS else await create_main_menu_keyboard(user_id)
@@ -0,0 +1,188 @@
+# user_state.py
+"""Ограниченный реестр состояния генераций по пользователям.
+
+Заменяет словари images.py (блокировки, время последней генерации,
+параметры для повтора, кэш активной модели), которые росли с каждым
+пользователем и никогда не очищались. Записи хранятся в OrderedDict в
+порядке последнего обращения; при превышении лимита или истечении TTL
+вытесняются самые старые. Запись, чья блокировка захвачена или ожидается
+(счётчик ссылок > 0), не вытесняется никогда — иначе два запроса одного
+пользователя получили бы разные блокировки.
+"""
+
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from config import USER_STATE_MAX_USERS, USER_STATE_TTL_SECONDS, ACTIVE_MODEL_CACHE_TTL
+from metrics import metrics_registry
+
+_MISSING = object()
+
+
+def _approx_size(obj: Any, depth: int = 3) -> int:
+    """Приблизительный размер объекта с вложенными контейнерами, в байтах."""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    if isinstance(obj, dict):
+        size += sum(_approx_size(k, depth - 1) + _approx_size(v, depth - 1) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_approx_size(item, depth - 1) for item in obj)
+    return size
+
+
+class UserState:
+    """Состояние одного пользователя."""
+
+    __slots__ = ('lock', 'lock_refs', 'touched_at', 'last_generation_at', 'last_generation_params',
+                 'active_model', 'active_model_at')
+
+    def __init__(self):
+        self.lock: Optional[asyncio.Lock] = None
+        self.lock_refs = 0
+        self.touched_at = time.monotonic()
+        self.last_generation_at = 0.0
+        self.last_generation_params: Optional[Dict[str, Any]] = None
+        self.active_model: Any = _MISSING
+        self.active_model_at = 0.0
+
+    @property
+    def pinned(self) -> bool:
+        return self.lock_refs > 0
+
+    def size(self) -> int:
+        return (sys.getsizeof(self) + _approx_size(self.last_generation_params)
+                + (_approx_size(self.active_model) if self.active_model is not _MISSING else 0))
+
+
+class UserStateRegistry:
+    """LRU/TTL-реестр UserState с подсчётом ссылок на блокировки.
+
+    Все операции синхронные и выполняются в event loop без await, поэтому
+    отдельная блокировка на сам реестр не нужна.
+    """
+
+    def __init__(self, max_users: int = USER_STATE_MAX_USERS, ttl: float = USER_STATE_TTL_SECONDS,
+                 active_model_ttl: float = ACTIVE_MODEL_CACHE_TTL):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.active_model_ttl = active_model_ttl
+        self._entries: "OrderedDict[int, UserState]" = OrderedDict()
+        self.evicted_total = 0
+        self.expired_total = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _expired(self, entry: UserState, now: float) -> bool:
+        return now - entry.touched_at > self.ttl
+
+    def _get(self, user_id: int, create: bool = True) -> Optional[UserState]:
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and self._expired(entry, now) and not entry.pinned:
+            del self._entries[user_id]
+            self.expired_total += 1
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = UserState()
+            self._entries[user_id] = entry
+            self._evict(now, keep=user_id)
+        else:
+            self._entries.move_to_end(user_id)
+        entry.touched_at = now
+        return entry
+
+    def _evict(self, now: float, keep: Optional[int] = None) -> None:
+        """Вытесняет просроченные записи и самые старые сверх лимита, пропуская закреплённые и keep."""
+        # Каждую запись просматриваем не больше одного раза: закреплённые уходят в конец
+        for _ in range(len(self._entries)):
+            user_id, entry = next(iter(self._entries.items()))
+            over_limit = len(self._entries) > self.max_users
+            expired = self._expired(entry, now)
+            if not over_limit and not expired:
+                break
+            if entry.pinned or user_id == keep:
+                self._entries.move_to_end(user_id)
+                continue
+            del self._entries[user_id]
+            if expired:
+                self.expired_total += 1
+            else:
+                self.evicted_total += 1
+
+    @asynccontextmanager
+    async def generation_lock(self, user_id: int) -> AsyncIterator[None]:
+        """Блокировка генераций пользователя; пока она захвачена или ожидается, запись не вытесняется."""
+        entry = self._get(user_id)
+        if entry.lock is None:
+            entry.lock = asyncio.Lock()
+        entry.lock_refs += 1
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            entry.lock_refs -= 1
+            entry.touched_at = time.monotonic()
+
+    def check_cooldown(self, user_id: int, cooldown: float) -> bool:
+        """True и отметка времени, если с прошлой генерации прошло не меньше cooldown секунд."""
+        entry = self._get(user_id)
+        now = time.time()
+        if now - entry.last_generation_at < cooldown:
+            return False
+        entry.last_generation_at = now
+        return True
+
+    def get_last_generation_params(self, user_id: int) -> Optional[Dict[str, Any]]:
+        entry = self._get(user_id, create=False)
+        return entry.last_generation_params if entry else None
+
+    def set_last_generation_params(self, user_id: int, params: Dict[str, Any]) -> None:
+        self._get(user_id).last_generation_params = params
+
+    def get_active_model(self, user_id: int) -> Tuple[bool, Any]:
+        """(найдено, данные) из кэша активной модели с учётом active_model_ttl."""
+        entry = self._get(user_id, create=False)
+        if entry is None or entry.active_model is _MISSING:
+            return False, None
+        if time.time() - entry.active_model_at >= self.active_model_ttl:
+            entry.active_model = _MISSING
+            return False, None
+        return True, entry.active_model
+
+    def set_active_model(self, user_id: int, model_data: Any) -> None:
+        entry = self._get(user_id)
+        entry.active_model = model_data
+        entry.active_model_at = time.time()
+
+    def invalidate_active_model(self, user_id: int) -> None:
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            entry.active_model = _MISSING
+
+    def metrics(self) -> Dict[str, Any]:
+        """Размер реестра для /metrics."""
+        # /metrics отдаётся из потока Flask: берём снимок, чтобы не итерировать изменяемый словарь
+        entries = list(self._entries.values())
+        return {
+            'users': len(entries),
+            'max_users': self.max_users,
+            'pinned': sum(1 for entry in entries if entry.pinned),
+            'evicted_total': self.evicted_total,
+            'expired_total': self.expired_total,
+            'approx_bytes': sys.getsizeof(self._entries) + sum(entry.size() for entry in entries),
+        }
+
+
+# Глобальный экземпляр
+user_state_registry = UserStateRegistry()
+metrics_registry.register('user_state', user_state_registry.metrics)
+
+__all__ = ['UserStateRegistry', 'UserState', 'user_state_registry']
@@ -1,4 +1,3 @@
-import asyncio
 import logging
 import os
 import tenacity
@@ -8,10 +7,10 @@ from aiogram.types import Message, InputMediaPhoto, InputMediaVideo, FSInputFile
 from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest, TelegramNetworkError
 from contextlib import asynccontextmanager
 from aiogram.enums import ParseMode
-import replicate
-from replicate.exceptions import ReplicateError
-from config import REPLICATE_API_TOKEN
 from handlers.utils import safe_escape_markdown as escape_md
+from replicate_client import ReplicateAPIError
+from prediction_tracker import prediction_tracker
+from replicate_limiter import is_retryable_replicate_error
 
 logger = logging.getLogger(__name__)
 
@@ -80,7 +79,7 @@ async def reset_generation_context(state: 'aiogram.fsm.context.FSMContext' = Non
         required_for_repeat = ['prompt', 'aspect_ratio', 'generation_type', 'model_key']
         if all(field in user_data and user_data[field] for field in required_for_repeat):
             try:
-                from generation.images import user_last_generation_params, user_last_generation_lock
+                from user_state import user_state_registry
                 last_params = {
                     'prompt': user_data.get('prompt'),
                     'aspect_ratio': user_data.get('aspect_ratio'),
@@ -91,9 +90,8 @@ async def reset_generation_context(state: 'aiogram.fsm.context.FSMContext' = Non
                     'current_style_set': user_data.get('current_style_set'),
                     'came_from_custom_prompt': user_data.get('came_from_custom_prompt', False)
                 }
-                async with user_last_generation_lock:
-                    user_last_generation_params[user_id_for_log] = last_params
-                    logger.info(f"Сохранены параметры для повтора для user_id={user_id_for_log}")
+                user_state_registry.set_last_generation_params(user_id_for_log, last_params)
+                logger.info(f"Сохранены параметры для повтора для user_id={user_id_for_log}")
             except Exception as e:
                 logger.error(f"Ошибка сохранения параметров для повтора: {e}")
 
@@ -246,7 +244,8 @@ async def send_video_with_retry(bot: Bot, chat_id: int, video, caption: str = No
     return await bot.send_video(chat_id=chat_id, video=video, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode)
 
 @tenacity.retry(
-    retry=tenacity.retry_if_exception_type(ReplicateError),
+    # Повторяются только временные сбои: не 4xx, не отменённое трекером и не отказ предохранителя
+    retry=tenacity.retry_if_exception(is_retryable_replicate_error),
     wait=tenacity.wait_exponential(multiplier=2, min=2, max=30),
     stop=tenacity.stop_after_attempt(4),
     before_sleep=tenacity.before_sleep_log(logger, logging.WARNING),
@@ -254,9 +253,6 @@ async def send_video_with_retry(bot: Bot, chat_id: int, video, caption: str = No
 )
 async def run_replicate_async(model_id: str, input_params: dict):
     """Асинхронный запуск модели Replicate"""
-    loop = asyncio.get_event_loop()
-    replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-    
     prompt_preview = input_params.get('prompt', 'No prompt')
     if isinstance(prompt_preview, str):
         prompt_preview = prompt_preview[:100] + ('...' if len(prompt_preview) > 100 else '')
@@ -264,9 +260,14 @@ async def run_replicate_async(model_id: str, input_params: dict):
     logger.info(f"Запуск Replicate model: {model_id} с параметрами (промпт): {prompt_preview}...")
     
     try:
-        output = await loop.run_in_executor(None, lambda: replicate_client.run(model_id, input=input_params))
+        prediction = await prediction_tracker.run(model_id, input_params)
+        if prediction.status != 'succeeded':
+            raise ReplicateAPIError(
+                f"Предсказание {prediction.id} завершилось со статусом {prediction.status}: {prediction.error}",
+                detail=str(prediction.error)
+            )
         logger.info(f"Replicate model {model_id} успешно завершен.")
-        return output
+        return prediction.output
     except Exception as e:
         logger.error(f"Ошибка выполнения Replicate model {model_id}: {e}")
         raise
\ No newline at end of file
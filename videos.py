@@ -2,9 +2,9 @@ import aiosqlite
 import asyncio
 import logging
 import os
-import requests
 import uuid
 import random
+from typing import Optional
 from aiogram import Bot, Router
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, FSInputFile
 from aiogram.fsm.context import FSMContext
@@ -12,20 +12,29 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.filters import Command
 from aiogram.types import ContentType
 from aiogram.enums import ParseMode
-from deep_translator import GoogleTranslator
-import replicate
 from replicate.exceptions import ReplicateError
 from states import BotStates
-from config import REPLICATE_API_TOKEN, DATABASE_PATH
+from config import DATABASE_PATH
+from translation import translation_service
 from generation_config import IMAGE_GENERATION_MODELS, GENERATION_TYPE_TO_MODEL_KEY, get_ultra_negative_prompt
 from database import check_database_user, update_user_credits, save_video_task, update_video_task_status, log_generation, check_user_resources
 from keyboards import create_main_menu_keyboard, create_rating_keyboard, create_video_generate_menu_keyboard, create_subscription_keyboard, create_back_keyboard, create_confirmation_keyboard
 from generation.images import upload_image_to_replicate
+from image_normalizer import PROFILE_VIDEO_START
 from generation.utils import TempFileManager, reset_generation_context, send_message_with_fallback, send_video_with_retry
 from handlers.utils import clean_admin_context, escape_message_parts, safe_escape_markdown as escape_md
+from replicate_client import get_replicate_client, ReplicateObject
+from downloads import download_service, DownloadTooLargeError
+from replicate_webhooks import replicate_webhooks, KIND_VIDEO
+from prediction_poller import prediction_poller
+from prediction_tracker import prediction_tracker
 
 logger = logging.getLogger(__name__)
 
+# Срок ожидания видео при опросе; после него задача получает статус timeout
+VIDEO_MAX_STATUS_ATTEMPTS = 30
+VIDEO_STATUS_DEADLINE_SECONDS = 30 * 60
+
 class VideoStates(StatesGroup):
     AWAITING_VIDEO_PROMPT = State()
     AWAITING_VIDEO_PHOTO = State()
@@ -117,14 +126,27 @@ async def send_video_progress_with_delay(bot: Bot, user_id: int, elapsed_minutes
     await asyncio.sleep(delay)
     await send_video_progress(bot, user_id, elapsed_minutes, model_name, style_name, total_minutes)
 
+async def is_video_task_finished(task_id: int) -> bool:
+    """Есть ли у задачи видео финальный статус."""
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        c = await conn.cursor()
+        await c.execute("SELECT status FROM video_tasks WHERE id = ?", (task_id,))
+        row = await c.fetchone()
+    return not row or row[0] in ('completed', 'failed', 'timeout')
+
+async def send_video_progress_series(bot: Bot, user_id: int, model_name: str, style_name: str, task_id: int, total_minutes: int = 5) -> None:
+    """Серия уведомлений о прогрессе в одной задаче; прерывается, как только видео готово."""
+    for minutes in [1, 2, 3, 4]:
+        if minutes >= total_minutes:
+            break
+        await asyncio.sleep(30)
+        if await is_video_task_finished(task_id):
+            return
+        await send_video_progress(bot, user_id, minutes, model_name, style_name, total_minutes)
+
 async def schedule_video_notifications(bot: Bot, user_id: int, model_name: str, style_name: str, task_id: int, prediction_id: str, total_minutes: int = 5):
     """Планирует уведомления о прогрессе генерации видео."""
-    notification_schedule = [1, 2, 3, 4]
-    for minutes in notification_schedule:
-        if minutes < total_minutes:
-            asyncio.create_task(send_video_progress_with_delay(
-                bot, user_id, minutes, model_name, style_name, total_minutes, delay=minutes * 30
-            ))
+    asyncio.create_task(send_video_progress_series(bot, user_id, model_name, style_name, task_id, total_minutes))
 
 async def generate_video(message: Message, state: FSMContext, task_id: int = None, prediction_id: str = None):
     """Генерация видео."""
@@ -264,7 +286,7 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
 
                 logger.info(f"Попытка продолжить/проверить видео для user_id={user_id}, task_id={task_id}, style_name={style_name}")
 
-            translated_prompt = GoogleTranslator(source='auto', target='en').translate(prompt)
+            translated_prompt = await translation_service.translate(prompt)
 
             input_params_video = {
                 "mode": "pro",
@@ -276,7 +298,7 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
 
             if start_image_path and os.path.exists(start_image_path):
                 logger.info(f"Загрузка start_image для видео: {start_image_path}")
-                uploaded_image_url = await upload_image_to_replicate(start_image_path)
+                uploaded_image_url = await upload_image_to_replicate(start_image_path, PROFILE_VIDEO_START)
                 input_params_video["start_image"] = uploaded_image_url
                 logger.info(f"Start_image загружен: {uploaded_image_url}")
                 temp_manager.add(start_image_path)
@@ -284,14 +306,13 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
             await update_user_credits(user_id, "decrement_photo", amount=required_photos)
             logger.info(f"Списано {required_photos} фото для видео user_id={user_id}, task_id={task_id}")
 
-            replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-
             if not prediction_id:
                 logger.info(f"Создание нового предсказания Replicate для видео task_id={task_id}")
 
-                prediction_instance = replicate_client.predictions.create(
-                    version=replicate_video_model_id,
-                    input=input_params_video
+                prediction_instance = await get_replicate_client().create_prediction(
+                    replicate_video_model_id,
+                    input_params_video,
+                    **replicate_webhooks.prediction_kwargs()
                 )
 
                 prediction_id = prediction_instance.id
@@ -301,20 +322,21 @@ async def generate_video(message: Message, state: FSMContext, task_id: int = Non
                 await update_video_task_status(task_id, status='processing', prediction_id=prediction_id)
                 logger.info(f"Видео предсказание создано: prediction_id={prediction_id}, task_id={task_id}")
 
-            asyncio.create_task(check_video_status_with_delay(
-                bot,
-                {
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'prediction_id': prediction_id,
-                    'attempt': 1,
-                    'generation_type': generation_type,
-                    'model_key': model_key,
-                    'style_name': style_name,
-                    'admin_user_id': admin_user_id
-                },
-                delay=60
-            ))
+            check_data = {
+                'user_id': user_id,
+                'task_id': task_id,
+                'prediction_id': prediction_id,
+                'attempt': 1,
+                'generation_type': generation_type,
+                'model_key': model_key,
+                'style_name': style_name,
+                'admin_user_id': admin_user_id
+            }
+            if replicate_webhooks.enabled:
+                # Результат доставит вебхук Replicate, опрос остаётся страховкой
+                replicate_webhooks.track(prediction_id, KIND_VIDEO, check_data)
+            else:
+                prediction_poller.watch(prediction_id, KIND_VIDEO, check_data, deadline=VIDEO_STATUS_DEADLINE_SECONDS)
 
         except Exception as e:
             logger.error(f"Ошибка запуска генерации видео для user_id={user_id}, task_id={task_id}: {e}", exc_info=True)
@@ -836,8 +858,7 @@ async def check_video_status(bot: Bot, data: dict):
             logger.info(f"Видео task_id={task_id} уже имеет финальный статус: {current_status_db}")
             return
 
-        replicate_client = replicate.Client(api_token=REPLICATE_API_TOKEN)
-        prediction = replicate_client.predictions.get(prediction_id)
+        prediction = await get_replicate_client().get_prediction(prediction_id)
         current_replicate_status = prediction.status
 
         logger.info(f"Статус видео на Replicate для prediction_id={prediction_id}: {current_replicate_status}")
@@ -855,12 +876,25 @@ async def check_video_status(bot: Bot, data: dict):
             if video_url:
                 try:
                     logger.info(f"Скачивание видео с URL: {video_url}")
-                    response = requests.get(video_url, timeout=300)
-                    response.raise_for_status()
-
-                    os.makedirs(os.path.dirname(video_path), exist_ok=True)
-                    with open(video_path, 'wb') as f:
-                        f.write(response.content)
+                    try:
+                        await download_service.stream_to_file(video_url, video_path)
+                    except DownloadTooLargeError as e_size:
+                        # Больше лимита загрузки Bot API: отдаём ссылку вместо файла
+                        logger.warning(f"Видео task_id={task_id} не отправить файлом: {e_size}")
+                        await update_video_task_status(task_id, status='completed')
+                        if model_key:
+                            await log_generation(user_id, generation_type, model_key, units_generated=1)
+                        await send_message_with_fallback(
+                            bot, user_id,
+                            escape_message_parts(
+                                f"🎬 Твоё видео ({style_name}) готово, но слишком большое для отправки файлом.",
+                                f" Скачай его по ссылке (действует ограниченное время): {video_url}",
+                                version=2
+                            ),
+                            reply_markup=await create_rating_keyboard(generation_type, model_key),
+                            parse_mode=ParseMode.MARKDOWN_V2
+                        )
+                        return
                     logger.info(f"Видео сохранено локально: {video_path}")
 
                     await update_video_task_status(task_id, status='completed', video_path=video_path)
@@ -991,11 +1025,11 @@ async def check_video_status(bot: Bot, data: dict):
                 )
 
         else:
-            max_attempts = 30
-
-            if attempt >= max_attempts:
+            if attempt >= VIDEO_MAX_STATUS_ATTEMPTS:
                 logger.error(f"Превышено максимальное количество попыток проверки для task_id={task_id}")
                 await update_video_task_status(task_id, status='timeout')
+                # Фото возвращаются пользователю — останавливаем и само предсказание, чтобы не платить за него
+                await prediction_tracker.cancel(prediction_id)
 
                 video_cost = IMAGE_GENERATION_MODELS.get(model_key, {}).get('cost', 20)
                 logger.debug(f"Возвращаем {video_cost} фото для user_id={user_id} из-за таймаута")
@@ -1027,50 +1061,67 @@ async def check_video_status(bot: Bot, data: dict):
                     )
                 return
 
-            next_delay = 60
-
-            logger.info(f"Видео для task_id={task_id} все еще генерируется. "
-                        f"Следующая проверка через {next_delay} сек (попытка {attempt + 1}/{max_attempts})")
-
-            asyncio.create_task(check_video_status_with_delay(
-                bot,
-                {
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'prediction_id': prediction_id,
-                    'attempt': attempt + 1,
-                    'generation_type': generation_type,
-                    'model_key': model_key,
-                    'style_name': style_name,
-                    'admin_user_id': admin_user_id
-                },
-                delay=next_delay
-            ))
+            if replicate_webhooks.enabled:
+                logger.info(f"Видео для task_id={task_id} все еще генерируется ({current_replicate_status}), ждём вебхук Replicate")
+                return
+
+            logger.info(f"Видео для task_id={task_id} все еще генерируется, статус отслеживает опросчик")
+            prediction_poller.watch(prediction_id, KIND_VIDEO, data, deadline=VIDEO_STATUS_DEADLINE_SECONDS)
 
     except Exception as e:
         logger.error(f"Ошибка при проверке статуса видео для task_id={task_id}: {e}", exc_info=True)
 
         if attempt < 10:
-            asyncio.create_task(check_video_status_with_delay(
-                bot,
-                {
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'prediction_id': prediction_id,
-                    'attempt': attempt + 1,
-                    'generation_type': generation_type,
-                    'model_key': model_key,
-                    'style_name': style_name,
-                    'admin_user_id': admin_user_id
-                },
-                delay=120
-            ))
+            prediction_poller.watch(
+                prediction_id, KIND_VIDEO, {**data, 'attempt': attempt + 1}, deadline=VIDEO_STATUS_DEADLINE_SECONDS
+            )
 
 async def check_video_status_with_delay(bot: Bot, data: dict, delay: int):
     """Проверка статуса видео с задержкой."""
     await asyncio.sleep(delay)
     await check_video_status(bot, data)
 
+async def fetch_video_prediction(prediction_id: str) -> ReplicateObject:
+    """Статус видео-предсказания для опросчика."""
+    return await get_replicate_client().get_prediction(prediction_id)
+
+async def on_video_prediction_update(bot: Bot, data: dict, prediction: ReplicateObject, expired: bool) -> None:
+    """Обработчик опросчика: доставка по финальному статусу или таймаут по сроку."""
+    if expired:
+        data = {**data, 'attempt': VIDEO_MAX_STATUS_ATTEMPTS}
+    elif not prediction.finished:
+        return
+    await replicate_webhooks.check(bot, KIND_VIDEO, data)
+
+prediction_poller.register(KIND_VIDEO, fetch_video_prediction, on_video_prediction_update)
+
+def _video_check_data(row) -> dict:
+    """Данные для check_video_status по строке video_tasks."""
+    model_key = row['model_key']
+    generation_type = 'ai_video_v2_1' if model_key == IMAGE_GENERATION_MODELS.get("kwaivgi/kling-v2.1", {}).get("id") else 'ai_video_v2_1'
+    return {
+        'user_id': row['user_id'],
+        'task_id': row['id'],
+        'prediction_id': row['prediction_id'],
+        'attempt': 1,
+        'generation_type': generation_type,
+        'model_key': model_key,
+        'style_name': row['style_name'] or 'custom'
+    }
+
+async def find_video_check_data(prediction_id: str) -> Optional[dict]:
+    """Данные для check_video_status незавершённой задачи с этим prediction_id."""
+    async with aiosqlite.connect(DATABASE_PATH) as conn:
+        conn.row_factory = aiosqlite.Row
+        c = await conn.cursor()
+        await c.execute("""
+            SELECT id, user_id, prediction_id, model_key, style_name
+            FROM video_tasks
+            WHERE prediction_id = ? AND status IN ('pending', 'starting', 'processing')
+        """, (prediction_id,))
+        row = await c.fetchone()
+    return _video_check_data(row) if row else None
+
 async def check_pending_video_tasks(bot: Bot):
     """Проверяет и возобновляет незавершенные задачи видео."""
     try:
@@ -1079,7 +1130,7 @@ async def check_pending_video_tasks(bot: Bot):
             c = await conn.cursor()
             
             await c.execute("""
-                SELECT id, user_id, video_path, prediction_id, model_key
+                SELECT id, user_id, video_path, prediction_id, model_key, style_name
                 FROM video_tasks
                 WHERE status IN ('pending', 'starting', 'processing')
             """)
@@ -1095,27 +1146,13 @@ async def check_pending_video_tasks(bot: Bot):
             task_id = row['id']
             user_id = row['user_id']
             prediction_id = row['prediction_id']
-            model_key = row['model_key']
             
             if not prediction_id:
                 logger.warning(f"Пропуск проверки видео для task_id={task_id}, user_id={user_id}: отсутствует prediction_id.")
                 continue
             
-            generation_type = 'ai_video_v2_1' if model_key == IMAGE_GENERATION_MODELS.get("kwaivgi/kling-v2.1", {}).get("id") else 'ai_video_v2_1'
-            
-            asyncio.create_task(check_video_status_with_delay(
-                bot,
-                {
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'prediction_id': prediction_id,
-                    'attempt': 1,
-                    'generation_type': generation_type,
-                    'model_key': model_key,
-                    'style_name': 'custom'
-                },
-                delay=random.randint(15, 45)
-            ))
+            # Уже наблюдаемые задачи опросчик отклонит, дублей проверок не будет
+            prediction_poller.watch(prediction_id, KIND_VIDEO, _video_check_data(row), deadline=VIDEO_STATUS_DEADLINE_SECONDS)
             
     except Exception as e:
         logger.error(f"Ошибка при проверке незавершенных задач видео: {e}", exc_info=True)
@@ -4,11 +4,8 @@ import os
 import io
 from datetime import datetime, timedelta
 from typing import List, Dict
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import seaborn as sns
+from charts import render_payments_chart, render_registrations_chart, render_generations_chart
+from executors import cpu_executor
 from aiogram import Router, Bot
 from aiogram.types import Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
@@ -100,22 +97,8 @@ async def visualize_payments(query: CallbackQuery, state: FSMContext) -> None:
             )
             return
 
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
-        plt.plot(dates, amounts, color='#4CAF50', linewidth=2, marker='o')
-        plt.fill_between(dates, amounts, color=(76/255, 175/255, 80/255, 0.2))
-        plt.title("Динамика платежей за последние 30 дней", fontsize=14, pad=10)
-        plt.xlabel("Дата", fontsize=12)
-        plt.ylabel("Сумма (RUB)", fontsize=12)
-        plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-        plt.gca().xaxis.set_major_locator(mdates.DayLocator(interval=5))
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100)
-        buffer.seek(0)
-        plt.close()
+        # Рендер в пуле процессов, чтобы не блокировать event loop
+        buffer = io.BytesIO(await cpu_executor.run(render_payments_chart, dates, amounts))
 
         text = escape_md("📈 График платежей за последние 30 дней:")
         reply_markup = InlineKeyboardMarkup([
@@ -196,19 +179,7 @@ async def visualize_registrations(query: CallbackQuery, state: FSMContext) -> No
             if reg_date in dates:
                 counts[dates.index(reg_date)] = reg['count']
 
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
-        plt.bar(dates, counts, color='#2196F3', edgecolor='#1976D2')
-        plt.title("Динамика регистраций за последние 30 дней", fontsize=14, pad=10)
-        plt.xlabel("Дата", fontsize=12)
-        plt.ylabel("Количество регистраций", fontsize=12)
-        plt.xticks(rotation=45, ha='right')
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100)
-        buffer.seek(0)
-        plt.close()
+        buffer = io.BytesIO(await cpu_executor.run(render_registrations_chart, dates, counts))
 
         text = escape_md("📊 График регистраций за последние 30 дней:")
         reply_markup = InlineKeyboardMarkup([
@@ -278,28 +249,14 @@ async def visualize_generations(query: CallbackQuery, state: FSMContext) -> None
                     generation_counts[model_id] = [0] * len(dates)
                 generation_counts[model_id][dates.index(date_str)] += units
 
-        plt.figure(figsize=(12, 6))
-        sns.set_style("whitegrid")
-        colors = sns.color_palette("husl", len(generation_counts))
-
-        for idx, (model_id, counts) in enumerate(generation_counts.items()):
-            model_name = next(
+        labels = {
+            model_id: next(
                 (m_data.get('name', model_id) for _, m_data in IMAGE_GENERATION_MODELS.items() if m_data.get('id') == model_id),
                 model_id
             )
-            plt.plot(dates, counts, label=model_name, color=colors[idx], linewidth=2)
-
-        plt.title("Динамика генераций за последние 30 дней", fontsize=14, pad=10)
-        plt.xlabel("Дата", fontsize=12)
-        plt.ylabel("Количество генераций", fontsize=12)
-        plt.xticks(rotation=45, ha='right')
-        plt.legend(title="Модели", bbox_to_anchor=(1.05, 1), loc='upper left')
-        plt.tight_layout()
-
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100)
-        buffer.seek(0)
-        plt.close()
+            for model_id in generation_counts
+        }
+        buffer = io.BytesIO(await cpu_executor.run(render_generations_chart, dates, generation_counts, labels))
 
         text = escape_md("📸 График генераций за последние 30 дней:")
         reply_markup = InlineKeyboardMarkup([